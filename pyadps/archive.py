@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only repositories in zip and tar archives. The archive is the repository itself: Storage takes the path of
+the archive as root_dir_path, and the members `[<folder>/]adps_messages/*.json` and `[<folder>/]adps_attachments/*`
+are its message and attachment files, so the archive of the repository folder works as well as the archive of its
+content. The members are referred to by the paths inside the archive path like the packed messages, e.g.
+`mails.zip/adps_messages/e375f79f4e.json`.
+
+The members are read at random: the zip members are found by the central directory, the tar members are listed by
+one pass over the headers, which skips their contents. So a zip or a plain (uncompressed) tar is required:
+the members of a compressed tar can't be listed without decompressing the whole archive and every backward seek
+decompresses it from the start again, which makes the lookups of the attachments quadratic. open_repository_archive
+rejects it by ArchiveError.
+"""
+import bisect
+import hashlib
+import itertools
+import os
+import os.path
+import shutil
+import tarfile
+import threading
+import zipfile
+from typing import IO, Collection, Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple
+
+from pyadps.profiling import stage
+
+COPY_CHUNK_SIZE_BYTES = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ArchiveEntry(NamedTuple):
+    folder: str  # Storage.MESSAGES_FOLDER or Storage.ATTACHMENTS_FOLDER
+    filename: str
+    size_bytes: int
+    offset: int  # of the member in the archive, the entries read in this order are one sequential read
+    member_name: str
+
+
+def parse_member_name(member_name: str, folders: Collection[str]) -> Optional[Tuple[str, str, str]]:
+    """(root prefix, folder, filename) of the file of the repository folders or None for the other members"""
+    parts = member_name.strip('/').split('/')
+    if len(parts) < 2 or parts[-2] not in folders or not parts[-1]:
+        return None
+
+    return '/'.join(parts[:-2]), parts[-2], parts[-1]
+
+
+class RepositoryArchive:
+    def __init__(self, archive_path: str, folders: Collection[str], members: Iterable[Tuple[str, int, int]]):
+        """members are (name, size, offset) of the regular files of the archive"""
+        self.archive_path = archive_path
+        self.root_prefix: Optional[str] = None  # the folder of the repository in the archive, '' for the top
+        self._entries: Dict[str, Dict[str, ArchiveEntry]] = {folder: {} for folder in folders}
+        self._sorted_filenames: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+        stat_result = os.stat(archive_path)
+        self._stat = (stat_result.st_size, stat_result.st_mtime_ns)
+
+        for member_name, size_bytes, offset in sorted(members, key=lambda member: member[2]):
+            parsed_name = parse_member_name(member_name, folders)
+            if parsed_name is None:
+                continue
+
+            root_prefix, folder, filename = parsed_name
+            if self.root_prefix is None:
+                self.root_prefix = root_prefix
+            elif root_prefix != self.root_prefix:
+                continue  # another repository in the same archive
+
+            self._entries[folder][filename] = ArchiveEntry(folder, filename, size_bytes, offset, member_name)
+
+    def is_changed(self) -> bool:
+        try:
+            stat_result = os.stat(self.archive_path)
+        except FileNotFoundError:
+            return True
+
+        return (stat_result.st_size, stat_result.st_mtime_ns) != self._stat
+
+    def get_entries(self, folder: str) -> Dict[str, ArchiveEntry]:
+        """Returns the entries of the folder by filename ordered by the offset in the archive"""
+        return self._entries[folder]
+
+    def get_entry(self, folder: str, filename: str) -> Optional[ArchiveEntry]:
+        return self._entries.get(folder, {}).get(filename)
+
+    def find_entries(self, folder: str, filename_prefix: str) -> List[ArchiveEntry]:
+        """The entries of the folder whose filenames start with the prefix ordered by filename"""
+        if folder not in self._sorted_filenames:
+            self._sorted_filenames[folder] = sorted(self._entries[folder])
+
+        sorted_filenames = self._sorted_filenames[folder]
+        entries = []
+        for filename in itertools.islice(sorted_filenames, bisect.bisect_left(sorted_filenames, filename_prefix), None):
+            if not filename.startswith(filename_prefix):
+                break
+            entries.append(self._entries[folder][filename])
+
+        return entries
+
+    def _open_member(self, entry: ArchiveEntry) -> IO[bytes]:
+        raise NotImplementedError()
+
+    def read(self, entry: ArchiveEntry) -> bytes:
+        with self._lock, stage('read') as read_stage, self._open_member(entry) as member_file:
+            content = member_file.read()
+            read_stage.add_bytes(len(content))
+            return content
+
+    def iter_contents(self, entries: Iterable[ArchiveEntry]) -> Generator[Tuple[ArchiveEntry, bytes], None, None]:
+        """Reads the entries one by one, entries ordered by offset make it one sequential read"""
+        for entry in entries:
+            yield entry, self.read(entry)
+
+    def copy(self, entry: ArchiveEntry, target_path: str):
+        with self._lock, stage('copy') as copy_stage, self._open_member(entry) as member_file, \
+                open(target_path, 'wb') as target_file:
+            shutil.copyfileobj(member_file, target_file, COPY_CHUNK_SIZE_BYTES)
+            copy_stage.add_bytes(entry.size_bytes)
+
+    def calculate_hashsum_hex(self, entry: ArchiveEntry) -> str:
+        file_hash = hashlib.sha512()
+        with self._lock, self._open_member(entry) as member_file:
+            while chunk := member_file.read(COPY_CHUNK_SIZE_BYTES):
+                with stage('sha512'):
+                    file_hash.update(chunk)
+
+        return file_hash.hexdigest()
+
+
+class ZipRepositoryArchive(RepositoryArchive):
+    def __init__(self, archive_path: str, folders: Collection[str]):
+        self._zip_file = zipfile.ZipFile(archive_path)
+        super().__init__(archive_path, folders, (
+            (info.filename, info.file_size, info.header_offset)
+            for info in self._zip_file.infolist() if not info.is_dir()
+        ))
+
+    def _open_member(self, entry: ArchiveEntry) -> IO[bytes]:
+        return self._zip_file.open(entry.member_name)
+
+
+class TarRepositoryArchive(RepositoryArchive):
+    def __init__(self, archive_path: str, folders: Collection[str]):
+        self._tar_file = tarfile.open(archive_path, 'r:')
+        self._members: Dict[str, tarfile.TarInfo] = {
+            member.name: member for member in self._tar_file.getmembers() if member.isfile()}
+        super().__init__(archive_path, folders, (
+            (member.name, member.size, member.offset_data) for member in self._members.values()))
+
+    def _open_member(self, entry: ArchiveEntry) -> IO[bytes]:
+        return self._tar_file.extractfile(self._members[entry.member_name])  # type: ignore
+
+
+def is_compressed_tar(archive_path: str) -> bool:
+    try:
+        with tarfile.open(archive_path, 'r:'):
+            return False
+    except tarfile.ReadError:
+        return True
+
+
+def open_repository_archive(archive_path: str, folders: Collection[str]) -> Optional[RepositoryArchive]:
+    """
+    The archive of the repository or None if the file is not a zip or tar archive. Raises ArchiveError if it's
+    a compressed tar.
+    """
+    if zipfile.is_zipfile(archive_path):
+        return ZipRepositoryArchive(archive_path, folders)
+
+    if tarfile.is_tarfile(archive_path):
+        if is_compressed_tar(archive_path):
+            raise ArchiveError(f'{archive_path!r} is a compressed tar archive, which can\'t be read at random: '
+                               f'decompress it to a plain .tar (e.g. by gunzip) or use a zip archive')
+        return TarRepositoryArchive(archive_path, folders)
+
+    return None
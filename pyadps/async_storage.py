@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+from collections import defaultdict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path, PurePath
+from typing import (Any, AsyncGenerator, Callable, Collection, Deque, Dict, Iterable, List, Optional, Tuple, TypeVar,
+                    Union)
+
+from pyadps.mail import FileAttachment, Mail, MailAttachmentInfo, MailFilter
+from pyadps.storage import (CopyMailCallbackData, CopyMailsCallbackData, CopyMailsStage, EstimationFileResult,
+                            FilteredMailResult, FilterMailCallbackData, Storage)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class AsyncStorage:
+    """
+    Asyncio wrapper around Storage. Every blocking call (globbing, reading, hashing, copying) runs
+    in a bounded executor, at most max_workers calls are in flight at once.
+    """
+
+    def __init__(self, root_dir_path: str, max_workers: int = 4, executor: Optional[Executor] = None):
+        if max_workers < 1:
+            raise ValueError('max_workers should be positive')
+
+        self.storage = Storage(root_dir_path)
+        self.max_workers = max_workers
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pyadps')
+
+    @property
+    def root_dir_path(self) -> str:
+        return self.storage.root_dir_path
+
+    async def __aenter__(self) -> 'AsyncStorage':
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    async def _run(self, func: Callable[..., R], *args: Any) -> R:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def _map_bounded(self, func: Callable[[T], R], items: Iterable[T]) -> AsyncGenerator[R, None]:
+        """Yields func(item) in the order of items, keeping at most max_workers calls in flight"""
+        loop = asyncio.get_running_loop()
+        pending: Deque['asyncio.Future[R]'] = deque()
+        try:
+            for item in items:
+                pending.append(loop.run_in_executor(self._executor, func, item))
+                if len(pending) >= self.max_workers:
+                    yield await pending.popleft()
+
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # on cancellation or early exit the calls which have not started yet are dropped
+            for future in pending:
+                future.cancel()
+
+    async def filter_mails(
+        self,
+        mail_filter: Optional[MailFilter],
+        callback: Optional[Callable[[FilterMailCallbackData], None]] = None,
+    ) -> AsyncGenerator[FilteredMailResult, None]:
+        message_paths = await self._run(self.storage.get_message_paths)
+        load_filtered_mail = partial(self.storage.load_filtered_mail, mail_filter=mail_filter)
+
+        idx = 0
+        async for filtered_mail_result in self._map_bounded(load_filtered_mail, message_paths):
+            if filtered_mail_result is not None:
+                yield filtered_mail_result
+
+            if callback is not None:
+                callback(FilterMailCallbackData(idx, len(message_paths)))
+            idx += 1
+
+    async def save_mail(self, mail: Mail, mail_attachment_infos: List[MailAttachmentInfo], target_folder_path: str):
+        await self._run(self.storage.save_mail, mail, mail_attachment_infos, target_folder_path)
+
+    def _copy_estimated_files(self, files_group: List[Tuple[PurePath, EstimationFileResult, str]]):
+        for folder, estimation_result, extension in files_group:
+            self.storage.copy_estimated_file(estimation_result, folder, extension)
+
+    async def copy_mails(
+        self,
+        msg_paths: Collection[Union[str, Path]],
+        target_folder_path: Union[str, Path],
+    ) -> AsyncGenerator[CopyMailsCallbackData, None]:
+        """Async version of Storage.copy_mails, yields the progress data instead of calling a callback"""
+        mail_files_estimation_results: List[EstimationFileResult] = []
+        attachments_to_estimate: List[FileAttachment] = []
+        attachments_files_hashsums = set()
+
+        idx = 0
+        async for mail_estimation_result, mail in self._map_bounded(self.storage.estimate_mail_file, msg_paths):
+            mail_files_estimation_results.append(mail_estimation_result)
+            for attachment in mail.attachments:
+                if attachment.hashsum_hex not in attachments_files_hashsums:
+                    attachments_files_hashsums.add(attachment.hashsum_hex)
+                    attachments_to_estimate.append(attachment)
+
+            yield CopyMailsCallbackData(
+                stage=CopyMailsStage.ESTIMATION,
+                estimation_progress=FilterMailCallbackData(idx, len(msg_paths)),
+            )
+            idx += 1
+
+        attachments_files_estimation_results = [
+            estimation_result
+            async for estimation_result
+            in self._map_bounded(self.storage.estimate_attachment_file, attachments_to_estimate)
+        ]
+
+        messages_folder = PurePath(target_folder_path) / self.storage.MESSAGES_FOLDER
+        attachments_folder = PurePath(target_folder_path) / self.storage.ATTACHMENTS_FOLDER
+        await self._run(partial(os.makedirs, messages_folder, exist_ok=True))
+        await self._run(partial(os.makedirs, attachments_folder, exist_ok=True))
+
+        # Files sharing the partial hashsum are copied by the same worker, otherwise two workers
+        # could pick the same free collision suffix
+        files_groups: Dict[Tuple[PurePath, str], List[Tuple[PurePath, EstimationFileResult, str]]] = defaultdict(list)
+        for folder, estimation_results, extension in [
+            (messages_folder, mail_files_estimation_results, 'json'),
+            (attachments_folder, attachments_files_estimation_results, 'bin'),
+        ]:
+            for estimation_result in estimation_results:
+                partial_hashsum = estimation_result.hashsum_hex[:self.storage.HASHSUM_FILENAME_PART_LEN]
+                files_groups[(folder, partial_hashsum)].append((folder, estimation_result, extension))
+
+        total_files_number = len(mail_files_estimation_results) + len(attachments_files_estimation_results)
+        total_files_size_bytes = sum(
+            estimation_result.size_bytes
+            for files_group in files_groups.values()
+            for _, estimation_result, _ in files_group
+        )
+
+        idx = 0
+        copied_bytes = 0
+        files_groups_list = list(files_groups.values())
+        group_idx = 0
+        async for _ in self._map_bounded(self._copy_estimated_files, files_groups_list):
+            files_group = files_groups_list[group_idx]
+            group_idx += 1
+            for _, estimation_result, _ in files_group:
+                copied_bytes += estimation_result.size_bytes
+                yield CopyMailsCallbackData(
+                    stage=CopyMailsStage.COPYING,
+                    copying_progress=CopyMailCallbackData(
+                        current_file_idx=idx,
+                        current_file_bytes=estimation_result.size_bytes,
+                        total_files_number=total_files_number,
+                        total_files_size_bytes=total_files_size_bytes,
+                        copied_bytes=copied_bytes,
+                    )
+                )
+                idx += 1
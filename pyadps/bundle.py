@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Single-file bundles of messages with their attachments for carrying on removable media. The bundle is
+the header b'ADPSBNDL' + version followed by the entries, every entry is the record
+(kind, name length, content size, sha512 digest), the name and the content. The attachments of a message go
+before it, so an interrupted unbundling never leaves a message without its attachments. The last record has
+the kind END and the number of the entries instead of the size, the bundle without it is truncated.
+"""
+import hashlib
+import io
+import os
+import os.path
+import struct
+from dataclasses import dataclass
+from pathlib import PurePath
+from typing import BinaryIO, Callable, Generator, Iterable, List, Optional, Tuple
+
+from pyadps import metrics
+from pyadps.mail import Mail
+from pyadps.profiling import stage
+from pyadps.storage import FilteredMailResult, Storage
+
+BUNDLE_MAGIC = b'ADPSBNDL'
+BUNDLE_VERSION = 1
+BUNDLE_HEADER = struct.Struct('>8sH')  # magic, version
+ENTRY_HEADER = struct.Struct('>cHQ64s')  # kind, name length, content size, sha512 digest of the content
+CHUNK_SIZE_BYTES = 1024 * 1024
+DATE_INDEX_BATCH_SIZE = 1000
+
+
+class BundleError(Exception):
+    pass
+
+
+class BundleEntryKind:
+    MESSAGE = b'M'
+    ATTACHMENT = b'A'
+    END = b'E'
+
+
+@dataclass
+class BundleStats:
+    messages_number: int = 0
+    attachments_number: int = 0
+    skipped_number: int = 0  # the entries which already exist in the target repository
+    size_bytes: int = 0
+
+
+def _copy_stream(source: BinaryIO, target: Optional[BinaryIO], size_bytes: int) -> str:
+    """Copies size_bytes from the source to the target (if any) by chunks, returns sha512 hex of the data"""
+    hashsum = hashlib.sha512()
+    left_bytes = size_bytes
+    while left_bytes > 0:
+        chunk = source.read(min(CHUNK_SIZE_BYTES, left_bytes))
+        if not chunk:
+            raise BundleError('the bundle is truncated')
+
+        hashsum.update(chunk)
+        if target is not None:
+            target.write(chunk)
+        left_bytes -= len(chunk)
+
+    return hashsum.hexdigest()
+
+
+class BundleWriter:
+    """
+    Writes the bundle sequentially to the temporary file next to bundle_path, the file is renamed to bundle_path
+    by `close`, so there is no half-written bundle if the writing is interrupted. Only the hashsums of
+    the written attachments are kept in memory.
+    """
+
+    def __init__(self, bundle_path: str):
+        self.bundle_path = bundle_path
+        self.stats = BundleStats()
+
+        self._tmp_path = f'{bundle_path}.{os.getpid()}.tmp'
+        self._file = open(self._tmp_path, 'xb')
+        self._file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION))
+        self._entries_number = 0
+        self._attachments_hashsums = set()
+
+    def _write_entry(self, kind: bytes, name: str, hashsum_hex: str, source: BinaryIO, size_bytes: int):
+        name_bytes = name.encode('utf-8')
+        self._file.write(ENTRY_HEADER.pack(kind, len(name_bytes), size_bytes, bytes.fromhex(hashsum_hex)))
+        self._file.write(name_bytes)
+        with stage('copy') as copy_stage:
+            content_hashsum_hex = _copy_stream(source, self._file, size_bytes)
+            copy_stage.add_bytes(size_bytes)
+
+        if content_hashsum_hex != hashsum_hex:
+            raise BundleError(f'The content of {name!r} does not match its hashsum {hashsum_hex}')
+
+        self._entries_number += 1
+        self.stats.size_bytes += size_bytes
+        metrics.increment('bundled_bytes', size_bytes)
+
+    def add_mail(self, storage: Storage, filtered_mail_result: FilteredMailResult):
+        """Writes the attachments of the message which aren't in the bundle yet and the message"""
+        for attachment in filtered_mail_result.mail.attachments:
+            if attachment.hashsum_hex in self._attachments_hashsums:
+                continue
+
+            attachment_path = storage.find_attachment_path(attachment.hashsum_hex)
+            with open(attachment_path, 'rb') as attachment_file:
+                self._write_entry(BundleEntryKind.ATTACHMENT, attachment.filename, attachment.hashsum_hex,
+                                  attachment_file, os.fstat(attachment_file.fileno()).st_size)  # type: ignore
+            self._attachments_hashsums.add(attachment.hashsum_hex)
+            self.stats.attachments_number += 1
+
+        msg_bytes = storage.read_message_bytes(filtered_mail_result.mail_path)
+        self._write_entry(BundleEntryKind.MESSAGE, os.path.basename(filtered_mail_result.mail_path),
+                          filtered_mail_result.mail_hashsum_hex, io.BytesIO(msg_bytes), len(msg_bytes))
+        self.stats.messages_number += 1
+
+    def iter_add_mails(
+        self,
+        storage: Storage,
+        filtered_mail_results: Iterable[FilteredMailResult],
+    ) -> Generator[FilteredMailResult, None, None]:
+        """Writes every message of the results (e.g. of filter_mails) before yielding it"""
+        for filtered_mail_result in filtered_mail_results:
+            self.add_mail(storage, filtered_mail_result)
+            yield filtered_mail_result
+
+    def close(self):
+        """Finishes the bundle and moves it to bundle_path"""
+        if self._file.closed:
+            return
+
+        self._file.write(ENTRY_HEADER.pack(BundleEntryKind.END, 0, self._entries_number, bytes(64)))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, self.bundle_path)
+
+    def abort(self):
+        if self._file.closed:
+            return
+
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self) -> 'BundleWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _read_entry_header(bundle_file: BinaryIO) -> Tuple[bytes, int, int, str]:
+    header_bytes = bundle_file.read(ENTRY_HEADER.size)
+    if len(header_bytes) < ENTRY_HEADER.size:
+        raise BundleError('the bundle is truncated')
+
+    kind, name_length, size, digest = ENTRY_HEADER.unpack(header_bytes)
+    return kind, name_length, size, digest.hex()
+
+
+def _skip_bytes(bundle_file: BinaryIO, size_bytes: int):
+    if bundle_file.seekable():
+        bundle_file.seek(size_bytes, os.SEEK_CUR)
+    else:
+        _copy_stream(bundle_file, None, size_bytes)
+
+
+def _save_entry(
+    bundle_file: BinaryIO, target_path: str, hashsum_hex: str, size_bytes: int, is_message: bool = False,
+) -> Optional[Mail]:
+    """
+    Streams the content to the temporary file next to target_path and moves it there if the hashsum matches.
+    The message is parsed before the move, so an invalid one never appears in the repository; returns it
+    """
+    from marshmallow import ValidationError
+
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    tmp_file = open(tmp_path, 'xb')  # outside of try: the existing temporary file isn't ours to remove
+    try:
+        with tmp_file:
+            with stage('copy') as copy_stage:
+                content_hashsum_hex = _copy_stream(bundle_file, tmp_file, size_bytes)
+                copy_stage.add_bytes(size_bytes)
+
+        if content_hashsum_hex != hashsum_hex:
+            raise BundleError(f'The content of the entry {target_path!r} does not match its hashsum {hashsum_hex}')
+
+        mail = None
+        if is_message:
+            try:
+                mail = Storage.load_mail(tmp_path)
+            except (ValueError, ValidationError) as e:
+                raise BundleError(f'the message {hashsum_hex} is invalid: {e}') from e
+
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return mail
+
+
+def extract_bundle(
+    bundle_file: BinaryIO,
+    target_folder_path: str,
+    callback: Optional[Callable[[BundleStats], None]] = None,
+) -> BundleStats:
+    """
+    Reads the bundle sequentially and saves its entries to the repository, every entry is verified before it gets
+    its name in the repository. The entries whose hashsums already exist in the repository are skipped
+    """
+    stats = BundleStats()
+    header_bytes = bundle_file.read(BUNDLE_HEADER.size)
+    if len(header_bytes) < BUNDLE_HEADER.size or BUNDLE_HEADER.unpack(header_bytes)[0] != BUNDLE_MAGIC:
+        raise BundleError('the file is not a bundle')
+    version = BUNDLE_HEADER.unpack(header_bytes)[1]
+    if version != BUNDLE_VERSION:
+        raise BundleError(f'unsupported bundle version {version}')
+
+    folders = {
+        BundleEntryKind.MESSAGE: (PurePath(target_folder_path) / Storage.MESSAGES_FOLDER, 'json'),
+        BundleEntryKind.ATTACHMENT: (PurePath(target_folder_path) / Storage.ATTACHMENTS_FOLDER, 'bin'),
+    }
+    for folder, _ in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    collision_indexes = {kind: Storage.create_collision_index(folder) for kind, (folder, _) in folders.items()}
+    date_index = Storage.get_date_index(target_folder_path)
+    new_dates: List[Tuple[str, float]] = []
+    entries_number = 0
+    try:
+        while True:
+            kind, name_length, size_bytes, hashsum_hex = _read_entry_header(bundle_file)
+            if kind == BundleEntryKind.END:
+                if size_bytes != entries_number:
+                    raise BundleError(f'the bundle has {entries_number} entries instead of {size_bytes}')
+                break
+            if kind not in folders:
+                raise BundleError(f'unknown entry kind {kind!r}')
+            if kind == BundleEntryKind.MESSAGE and size_bytes > Storage.MESSAGE_FILE_MAX_SIZE_BYTES:
+                raise BundleError(f'the message {hashsum_hex} is too big: {size_bytes} bytes')
+
+            _skip_bytes(bundle_file, name_length)
+            folder, extension = folders[kind]
+            file_search_result = Storage.get_free_file_path(
+                folder / f'{hashsum_hex[:Storage.HASHSUM_FILENAME_PART_LEN]}.{extension}', hashsum_hex,
+                collision_indexes[kind], size_bytes)
+            entries_number += 1
+
+            if file_search_result.is_exist:
+                _skip_bytes(bundle_file, size_bytes)
+                stats.skipped_number += 1
+            else:
+                mail = _save_entry(bundle_file, str(file_search_result.path), hashsum_hex, size_bytes,
+                                   is_message=kind == BundleEntryKind.MESSAGE)
+                stats.size_bytes += size_bytes
+                if mail is not None:
+                    stats.messages_number += 1
+                    if date_index.exists():
+                        new_dates.append((os.path.basename(file_search_result.path), mail.date_created.timestamp()))
+                else:
+                    stats.attachments_number += 1
+
+            if len(new_dates) >= DATE_INDEX_BATCH_SIZE:
+                date_index.append(new_dates)
+                new_dates = []
+
+            if callback is not None:
+                callback(stats)
+    finally:
+        if new_dates:  # the saved messages are indexed even if the bundle is broken
+            date_index.append(new_dates)
+        for collision_index in collision_indexes.values():
+            collision_index.save()
+
+    return stats
@@ -1,33 +1,134 @@
 # -*- coding: utf-8 -*-
+import functools
+import itertools
 import json
 import os
 import os.path
-from datetime import datetime, timedelta
+import signal
+import threading
+from contextlib import nullcontext
+from datetime import date, datetime, time, timedelta
 from pathlib import PurePath
-from shutil import copyfile
-from typing import List, Optional, Union
+from typing import (TYPE_CHECKING, BinaryIO, Callable, Collection, Generator, Iterable, List, Optional, Sequence, Tuple,
+                    Union)
 
 import click
 
-from pyadps.geo_worker import search_most_populated_city_by_coords
-from pyadps.helpers import calculate_hashsum
+from pyadps.hashing import HashsumBackend, HashsumEngine, get_default_engine, get_default_workers, set_default_engine
 from pyadps.mail import (AdditionalNotesFilterData, AttachmentFilterData, CoordsData, DampingDistanceFilterData,
                          DatetimeCreatedRangeFilterData, FileAttachment, InlineMessageFilterData, LocationFilterData,
-                         Mail, MailAttachmentInfo, MailFilter, NameFilterData)
-from pyadps.storage import (CopyMailsCallbackData, CopyMailsStage, EstimationDeleteMailsCallbackData,
-                            EstimationDeleteMailsStage, FilterMailCallbackData, Storage)
+                         Mail, MailAttachmentInfo, MailFilter, NameFilterData, dump_mail_dict)
+from pyadps.metrics import collect_metrics, get_metrics_sink
+from pyadps.profiling import profile, stage
+from pyadps.storage import (CopyMailCallbackData, CopyMailsCallbackData, CopyMailsStage,
+                            EstimationDeleteMailsCallbackData, EstimationDeleteMailsStage, FilteredMailResult,
+                            FilterMailCallbackData, MessagePathsSpill, SortBy, Storage, get_filter_location)
+
+if TYPE_CHECKING:
+    # the modules of the commands are imported by the commands, the short invocations don't load them
+    from pyadps.daemon import DaemonClient
+    from pyadps.exporting import MailExporter
+    from pyadps.fsck import FsckProgress
+    from pyadps.manifest import Manifest
+    from pyadps.result_sets import ResultSet
+    from pyadps.sampling import CountEstimate
+    from pyadps.watching import WatchBatch
 
 
 class OutputFormat:
     HASHSUMS = 'HASHSUMS'
     PATHS = 'PATHS'
     JSON = 'JSON'
+    NDJSON = 'NDJSON'  # one compact object per line with the stable schema, see OutputPrinter.get_ndjson_record
     COUNT = 'COUNT'
 
+    ALL = (HASHSUMS, JSON, NDJSON, PATHS, COUNT)
+
+
+NDJSON_SCHEMA_VERSION = 1
+
+
+def profile_option(command_func: Callable) -> Callable:
+    """Adds the --profile flag printing the time spent in every stage of the command to stderr"""
+    @click.option('--profile', 'profile_enabled', is_flag=True, default=False,
+                  help='Print the time spent in globbing, reading, hashing, parsing, etc. at the end')
+    @functools.wraps(command_func)
+    def wrapper(*args, profile_enabled: bool, **kwargs):
+        if not profile_enabled:
+            return command_func(*args, **kwargs)
+
+        try:
+            with profile() as profile_stats:
+                return command_func(*args, **kwargs)
+        finally:
+            click.echo(profile_stats.format_table(), err=True)
+
+    return wrapper
+
+
+def metrics_option(command_func: Callable) -> Callable:
+    """Adds the --metrics-out option writing the metrics of the command to the files"""
+    @click.option('--metrics-out', 'metrics_out_paths', type=click.Path(dir_okay=False), multiple=True,
+                  help='File for the metrics of the run: Prometheus textfile for *.prom, JSON lines for the others. '
+                       'The option can be repeated')
+    @functools.wraps(command_func)
+    def wrapper(*args, metrics_out_paths: Sequence[str], **kwargs):
+        if not metrics_out_paths:
+            return command_func(*args, **kwargs)
+
+        sinks = [get_metrics_sink(path) for path in metrics_out_paths]
+        with collect_metrics(sinks, command=click.get_current_context().info_name):
+            return command_func(*args, **kwargs)
+
+    return wrapper
+
+
+def daemon_option(repo_folder_param: str) -> Callable[[Callable], Callable]:
+    """
+    Adds the --use-daemon/--no-use-daemon flag, the command gets the daemon_client argument: the client of
+    `adps serve` of the repository if it is running, otherwise None. The daemon module is imported only if
+    the socket of the daemon exists. The errors of the daemon end the command with the message instead of
+    the traceback.
+    """
+    def decorator(command_func: Callable) -> Callable:
+        @click.option('--use-daemon/--no-use-daemon', default=True, envvar='ADPS_USE_DAEMON', show_default=True,
+                      help='Send the queries to "adps serve" of the repository if it is running')
+        @functools.wraps(command_func)
+        def wrapper(*args, use_daemon: bool, **kwargs):
+            repo_folder = kwargs[repo_folder_param]
+            if not use_daemon or not os.path.exists(os.path.join(repo_folder, Storage.SERVE_SOCKET_FILENAME)):
+                return command_func(*args, daemon_client=None, **kwargs)
+
+            from pyadps.daemon import DaemonClient, DaemonError
+
+            daemon_client = DaemonClient.connect(repo_folder)
+            if daemon_client is None:
+                return command_func(*args, daemon_client=None, **kwargs)
+
+            with daemon_client:
+                try:
+                    return command_func(*args, daemon_client=daemon_client, **kwargs)
+                except DaemonError as e:
+                    raise click.ClickException(f'The daemon of the repository failed: {e}. '
+                                               f'Pass --no-use-daemon to read the repository directly')
+
+        return wrapper
+
+    return decorator
+
 
 @click.group()
-def cli():
-    pass
+@click.option('--hashsum-engine', type=click.Choice(HashsumBackend.ALL, case_sensitive=False),
+              default=HashsumBackend.AUTO, envvar='ADPS_HASHSUM_ENGINE', show_default=True,
+              help='READINTO reads files by chunks, MMAP maps them to memory, AUTO uses mmap for big files only')
+@click.option('--hashsum-workers', type=click.IntRange(min=1), default=None, envvar='ADPS_HASHSUM_WORKERS',
+              help='Number of files hashed concurrently [default: number of CPUs, at most 4]')
+@click.option('--max-collision-depth', type=click.IntRange(min=0, max=Storage.MAX_COLLISION_DEPTH),
+              default=Storage.MAX_COLLISION_DEPTH, envvar='ADPS_MAX_COLLISION_DEPTH', show_default=True,
+              help='Files whose hashsum prefix already has this many colliding files are rejected')
+def cli(hashsum_engine: str, hashsum_workers: Optional[int], max_collision_depth: int):
+    set_default_engine(HashsumEngine(hashsum_engine.upper(), hashsum_workers or get_default_workers()))
+    Storage.MAX_COLLISION_DEPTH = max_collision_depth
 
 
 @cli.command('init', help='Init repository')
@@ -37,13 +138,179 @@ def init(repo_folder: str):
     os.mkdir(os.path.join(repo_folder, Storage.ATTACHMENTS_FOLDER))
 
 
-def is_valid_repo_folder(repo_folder: str) -> bool:
+def is_valid_repo_folder(repo_folder: str, is_written: bool = False) -> bool:
+    """
+    is_written: the command writes to the repository, so the deletion interrupted in it is finished first; the other
+    commands read the repository as it is
+    """
+    if os.path.isfile(repo_folder):
+        from pyadps.archive import ArchiveError
+
+        try:
+            archive = Storage.get_repository_archive(repo_folder)
+        except ArchiveError as e:
+            raise click.ClickException(str(e))
+        return archive is not None and archive.root_prefix is not None
+
     try:
         directories = os.listdir(repo_folder)
     except (NotADirectoryError, FileNotFoundError):
         return False
 
-    return Storage.MESSAGES_FOLDER in directories and Storage.ATTACHMENTS_FOLDER in directories
+    if Storage.MESSAGES_FOLDER not in directories or Storage.ATTACHMENTS_FOLDER not in directories:
+        return False
+
+    if Storage.DELETE_JOURNAL_FILENAME in directories and not is_written:
+        click.echo(f'The deletion in {repo_folder!r} was interrupted, it is finished by the next command writing to '
+                   f'the repository', err=True)
+    elif Storage.DELETE_JOURNAL_FILENAME in directories:
+        from pyadps.delete_journal import roll_forward
+
+        try:
+            roll_forward(repo_folder)  # the deletion interrupted in the repository is finished before using it
+        except OSError as e:
+            raise click.ClickException(f'Could not finish the interrupted deletion in {repo_folder!r}: {e!r}')
+
+    return True
+
+
+def is_message_path(msg_path: str) -> bool:
+    """The message file, the packed message or the message in the repository archive"""
+    return (os.path.isfile(msg_path) or Storage.get_packed_message_entry(msg_path) is not None
+            or Storage.get_archive_entry(msg_path) is not None)
+
+
+@cli.command('pack', help='Moves message files to the append-only pack file of the repository')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+def pack(repo_folder: str):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    skipped_paths = Storage(repo_folder).pack_messages()
+    for skipped_path in skipped_paths:
+        click.echo(f'The file {skipped_path!r} is left loose: the pack contains another message with this name')
+
+
+@cli.command('unpack', help='Writes packed messages to the loose files and removes the pack file')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+def unpack(repo_folder: str):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    Storage(repo_folder).unpack_messages()
+
+
+@cli.command('index', help='Creates or updates the date index used by the newest-first searches with the limit')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.option('--hashsums/--no-hashsums', type=click.BOOL, default=False,
+              help='Also create or update the hashsums of the files used for the collision checks of the saved files, '
+                   'they are kept up to date by the commands saving the files')
+def index(repo_folder: str, hashsums: bool):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    storage = Storage(repo_folder)
+    read_messages_number = storage.update_date_index()
+    click.echo(f'{read_messages_number} messages are added to the index')
+    if hashsums:
+        click.echo(f'{storage.update_collision_indexes()} files are hashed for the collision index')
+
+
+def watch_options(command_func: Callable) -> Callable:
+    """Adds the options of the folders watcher, see pyadps.watching"""
+    for option in reversed([
+        click.option('--polling/--no-polling', type=click.BOOL, default=False,
+                     help='List the folders periodically instead of inotify (used anyway if inotify is unavailable)'),
+        click.option('--poll-interval', type=click.FloatRange(min=0.0, min_open=True), default=2.0,
+                     show_default=True),
+        click.option('--debounce-seconds', type=click.FloatRange(min=0.0), default=0.5, show_default=True,
+                     help='The changes are applied after this time without new changes'),
+    ]):
+        command_func = option(command_func)
+
+    return command_func
+
+
+def start_index_maintainer(
+    repo_folder: str,
+    polling: bool,
+    poll_interval: float,
+    debounce_seconds: float,
+    stop_event: threading.Event,
+    listeners: Sequence[Callable[['WatchBatch'], None]] = (),
+) -> threading.Thread:
+    """Reconciles the date index with the repository and keeps it up to date in the thread until stop_event is set"""
+    from pyadps.watching import IndexMaintainer, create_watcher
+
+    watcher = create_watcher(repo_folder, polling=polling, poll_interval=poll_interval)
+    maintainer = IndexMaintainer(Storage(repo_folder))
+    # the watcher is started first, so the changes made during the reconciliation aren't lost
+    read_messages_number = maintainer.reconcile()
+    click.echo(f'{read_messages_number} messages are read to update the index, watching the repository by '
+               f'{type(watcher).__name__}', err=True)
+
+    def run():
+        with watcher:
+            maintainer.run(watcher, stop_event, listeners, debounce_seconds=debounce_seconds)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+@cli.command('watch', help='Watches the repository folders and keeps the date index up to date')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@watch_options
+def watch(repo_folder: str, polling: bool, poll_interval: float, debounce_seconds: float):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    stop_event = threading.Event()
+    thread = start_index_maintainer(repo_folder, polling, poll_interval, debounce_seconds, stop_event)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while thread.is_alive():
+            thread.join(1.0)
+    except KeyboardInterrupt:
+        stop_event.set()
+        thread.join()
+
+
+@cli.command('serve', help='Keeps the messages of the repository in memory and answers the queries of the other '
+                           'commands over the Unix socket adps_serve.sock')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.option('--watch/--no-watch', 'watch_repo', type=click.BOOL, default=False,
+              help='Keep the date index up to date and read the new messages as soon as they are written')
+@watch_options
+def serve(repo_folder: str, watch_repo: bool, polling: bool, poll_interval: float, debounce_seconds: float):
+    from pyadps.daemon import DaemonError, create_server, run_server
+
+    if not is_valid_repo_folder(repo_folder, is_written=watch_repo):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    try:
+        server = create_server(repo_folder)
+    except DaemonError as e:
+        raise click.ClickException(str(e))
+
+    stop_event = threading.Event()
+    if watch_repo:
+        start_index_maintainer(repo_folder, polling, poll_interval, debounce_seconds, stop_event,
+                               listeners=[lambda batch: server.cache.refresh()])
+
+    click.echo(f'Serving {len(server.cache)} messages on {server.server_address}', err=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # the socket file is removed on kill too
+    try:
+        run_server(server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
 
 
 @cli.command('create', help='Interactive command for creating a message')
@@ -51,7 +318,7 @@ def is_valid_repo_folder(repo_folder: str) -> bool:
 def create(repo_folder: str):
     click.echo('This is the interactive command for creating mail.')
 
-    if not is_valid_repo_folder(repo_folder):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
         click.echo(f'The folder {repo_folder!r} is not valid repository. Use command init for creating the repository')
         raise click.Abort()
 
@@ -85,8 +352,7 @@ def create(repo_folder: str):
         for attachment_path, size_bytes in size_by_path.items():
             click.echo(f'Calculating hashsum for {attachment_path!r}...')
 
-            with open(attachment_path, 'rb') as file_stream:
-                hashsum = calculate_hashsum(file_stream)  # type: ignore
+            hashsum = get_default_engine().hash_file(attachment_path)
 
             bar.update(size_bytes)
             hashsum_by_path[attachment_path] = hashsum
@@ -114,6 +380,48 @@ def create(repo_folder: str):
     storage.save_mail(mail=message, mail_attachment_infos=mail_attachment_infos, target_folder_path=repo_folder)
 
 
+class SaveCallback:
+    def __init__(self):
+        self.progressbar = None
+
+    def __call__(self, save_callback_data: CopyMailCallbackData):
+        if self.progressbar is None:
+            self.progressbar = click.progressbar(
+                length=save_callback_data.total_files_size_bytes,
+                label='Saving files...'
+            ).__enter__()
+
+        self.progressbar.update(save_callback_data.current_file_bytes)
+
+        if save_callback_data.current_file_idx + 1 == save_callback_data.total_files_number:
+            self.progressbar.finish()
+            self.progressbar.__exit__(None, None, None)
+
+
+@cli.command('import', help='Creates messages from the manifest: CSV file (*.csv) or JSON lines')
+@click.argument('manifest_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
+@profile_option
+@metrics_option
+def import_(manifest_path: str, repo_folder: str, show_progressbar: bool):
+    from pyadps.importing import ManifestError, build_mails, read_manifest
+
+    if not is_valid_repo_folder(repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    try:
+        records = read_manifest(manifest_path)
+    except ManifestError as e:
+        raise click.ClickException(str(e))
+
+    mails = build_mails(records)
+    save_callback = SaveCallback() if show_progressbar else None
+    msg_paths = Storage(repo_folder).save_mails(mails, repo_folder, save_callback)
+    click.echo(f'Imported {len(msg_paths)} messages')
+
+
 class SearchCallback:
     def __init__(self):
         self.progressbar = None
@@ -129,10 +437,78 @@ class SearchCallback:
 
         is_finished = filter_mail_callback_data.current_mail_idx + 1 == filter_mail_callback_data.total_mails_number
         if is_finished:
+            self.close()
+
+    def close(self):
+        """Finishes the progressbar, the search with the limit may stop before the last message"""
+        if self.progressbar is not None and not self.progressbar.finished:
             self.progressbar.finish()
             self.progressbar.__exit__(None, None, None)
 
 
+class FsckCallback:
+    """The progressbar is written to stderr, stdout gets only the issues"""
+    def __init__(self):
+        self.progressbar = None
+
+    def __call__(self, fsck_progress: 'FsckProgress'):
+        if self.progressbar is None:
+            self.progressbar = click.progressbar(length=fsck_progress.total_files_number, label='Checking files...',
+                                                 file=click.get_text_stream('stderr')).__enter__()
+
+        self.progressbar.update(1)
+        if fsck_progress.checked_files_number == fsck_progress.total_files_number:
+            self.close()
+
+    def close(self):
+        if self.progressbar is not None and not self.progressbar.finished:
+            self.progressbar.finish()
+            self.progressbar.__exit__(None, None, None)
+
+
+@cli.command('fsck', help='Checks the hashsums of the files, the attachments of the messages and the collision '
+                          'suffixes. Nothing in the repository is changed')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.option('--workers', type=click.IntRange(min=1), default=None,
+              help='Number of files checked concurrently [default: number of CPUs]')
+@click.option('--checkpoint', 'checkpoint_path', type=click.Path(dir_okay=False), default=None,
+              help='File of the checked files: the next check with it hashes only the files which are not checked yet '
+                   'or are changed')
+@click.option('--low-priority/--no-low-priority', type=click.BOOL, default=False,
+              help='Run with the lowest CPU priority and the idle I/O class')
+@click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
+@profile_option
+@metrics_option
+def fsck(
+    repo_folder: str,
+    workers: Optional[int],
+    checkpoint_path: Optional[str],
+    low_priority: bool,
+    show_progressbar: bool,
+):
+    from pyadps.fsck import check_repository, set_low_priority
+
+    if not is_valid_repo_folder(repo_folder):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    if low_priority and not set_low_priority():
+        click.echo('The I/O priority is not supported on this system, only the CPU priority is lowered', err=True)
+
+    callback = FsckCallback() if show_progressbar else None
+    issues_number = 0
+    for issue in check_repository(Storage(repo_folder), workers or os.cpu_count() or 1, checkpoint_path, callback):
+        click.echo(f'{issue.kind} {issue.path}: {issue.details}')
+        issues_number += 1
+
+    if callback is not None:
+        callback.close()
+
+    click.echo(f'{issues_number} issues found', err=True)
+    if issues_number:
+        raise click.exceptions.Exit(1)
+
+
 class CopyCallback:
     def __init__(self):
         self.progressbar = None
@@ -150,13 +526,13 @@ class CopyCallback:
         self.progressbar = click.progressbar(*args, **kwargs).__enter__()
 
     def __call__(self, copy_mails_callback_data: CopyMailsCallbackData):
-        # Stages: None -> ESTIMATION -> COPYING
+        # Stages: None -> ESTIMATION -> COPYING, the estimation is skipped for the copy plan of the daemon
         if self.stage is None and copy_mails_callback_data.stage == CopyMailsStage.ESTIMATION:
             self.stage = copy_mails_callback_data.stage
             self._create_progressbar(length=copy_mails_callback_data.estimation_progress.total_mails_number,
                                      label='Estimation of files to copy...')
 
-        if self.stage == CopyMailsStage.ESTIMATION and copy_mails_callback_data.stage == CopyMailsStage.COPYING:
+        if self.stage != CopyMailsStage.COPYING and copy_mails_callback_data.stage == CopyMailsStage.COPYING:
             self.stage = copy_mails_callback_data.stage
             self._create_progressbar(length=copy_mails_callback_data.copying_progress.total_files_size_bytes,
                                      label='Copying files...')
@@ -196,35 +572,48 @@ class EstimationDeleteCallback(CopyCallback):
 
 
 def delete_messages_by_mail_paths(
-    msg_paths: List[str],
+    msg_paths: Collection[str],
     storage: Storage,
     confirm: bool,
     print_list: bool,
     show_progressbar: bool,
+    daemon_client: Optional['DaemonClient'] = None,
 ):
-    callback = EstimationDeleteCallback() if show_progressbar else None
-    attachment_paths_to_delete = storage.get_attachments_for_delete(msg_paths=msg_paths, callback=callback)
+    for msg_path in msg_paths:
+        if not os.path.isfile(msg_path) and storage.get_packed_message_entry(msg_path) is not None:
+            raise click.ClickException(f'The message {msg_path!r} is packed, use command unpack before deleting it')
 
-    if print_list:
-        click.echo('Message files to delete:')
-        click.echo('\n'.join(msg_paths))
+    from pyadps.delete_journal import DeleteLock, delete_files
+
+    with DeleteLock.get(storage.root_dir_path):  # the planned attachments aren't renamed by a concurrent deletion
+        if daemon_client is not None:
+            attachment_paths_to_delete = daemon_client.estimate_delete(msg_paths)
+        else:
+            callback = EstimationDeleteCallback() if show_progressbar else None
+            try:
+                attachment_paths_to_delete = storage.get_attachments_for_delete(msg_paths=msg_paths, callback=callback)
+            except ValueError as e:
+                raise click.ClickException(str(e))
 
-        click.echo('Attachment files to delete:')
-        click.echo('\n'.join(attachment_paths_to_delete))
+        if print_list:
+            click.echo('Message files to delete:')
+            for msg_path in msg_paths:
+                click.echo(msg_path)
 
-    confirm_delete: bool = True
-    if confirm:
-        confirm_delete = click.confirm('Do you want to delete these files?')
+            click.echo('Attachment files to delete:')
+            for attachment_path in attachment_paths_to_delete:
+                click.echo(attachment_path)
 
-    if not confirm_delete:
-        raise click.ClickException('Operation is cancelled')
+        confirm_delete: bool = True
+        if confirm:
+            confirm_delete = click.confirm('Do you want to delete these files?')
 
-    for file_path in [*msg_paths, *attachment_paths_to_delete]:
-        os.remove(file_path)
+        if not confirm_delete:
+            raise click.ClickException('Operation is cancelled')
 
-    rename_mapping = storage.get_correct_filenames_mapping_after_delete()
-    for before_path, after_path in rename_mapping:
-        os.rename(before_path, after_path)
+        rename_mapping = storage.get_correct_filenames_mapping_after_delete(
+            {os.path.basename(attachment_path) for attachment_path in attachment_paths_to_delete})
+        delete_files(storage.root_dir_path, itertools.chain(msg_paths, attachment_paths_to_delete), rename_mapping)
 
 
 @cli.command('clear', help='Deletes expired messages with attachments linked to them')
@@ -233,31 +622,47 @@ def delete_messages_by_mail_paths(
 @click.option('--confirm/--no-confirm', type=click.BOOL, default=True)
 @click.option('--print-list/--no-print-list', type=click.BOOL, default=True)
 @click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
-def clear(repo_folder: str, days: int, confirm: bool, print_list: bool, show_progressbar: bool):
-    if not is_valid_repo_folder(repo_folder):
+@daemon_option('repo_folder')
+@profile_option
+@metrics_option
+def clear(
+    repo_folder: str,
+    days: int,
+    confirm: bool,
+    print_list: bool,
+    show_progressbar: bool,
+    daemon_client: Optional['DaemonClient'],
+):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
         click.echo(f'The folder {repo_folder!r} is not valid repository. Use command init for creating the repository')
         raise click.Abort()
 
     storage = Storage(repo_folder)
 
     max_date = datetime.now() - timedelta(days=days)
-    mail_filter_results = list(storage.filter_mails(MailFilter(
-        datetime_created_range_filter=DatetimeCreatedRangeFilterData(date_to=max_date)
-    )))
-    msg_paths = [filter_result.mail_path for filter_result in mail_filter_results]
-    delete_messages_by_mail_paths(
-        msg_paths=msg_paths,
-        storage=storage,
-        confirm=confirm,
-        print_list=print_list,
-        show_progressbar=show_progressbar,
-    )
+    mail_filter = MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(date_to=max_date))
+    with MessagePathsSpill() as msg_paths:
+        filter_results = (daemon_client.search(mail_filter) if daemon_client is not None
+                          else storage.filter_mails(mail_filter))
+        for filter_result in filter_results:
+            msg_paths.append(filter_result.mail_path)
+
+        delete_messages_by_mail_paths(
+            msg_paths=msg_paths,
+            storage=storage,
+            confirm=confirm,
+            print_list=print_list,
+            show_progressbar=show_progressbar,
+            daemon_client=daemon_client,
+        )
 
 
 def get_default_damping_distance_filter(
     damping_distance_latitude,
     damping_distance_longitude,
 ) -> DampingDistanceFilterData:
+    from pyadps.geo_worker import search_most_populated_city_by_coords
+
     worldcities_csv_path = str(PurePath(__file__).parents[0] / 'static_files/worldcities/worldcities.csv')
     try:
         most_populated_city = search_most_populated_city_by_coords(
@@ -365,19 +770,60 @@ class OutputPrinter:
         self.output_format = output_format
 
     @staticmethod
-    def _get_output_json(mail: Mail, mail_hashsum_hex: str, mail_path: str):
+    def _get_output_json(mail: Mail, mail_hashsum_hex: str, mail_path: str, repo_folders: Optional[List[str]] = None):
         mail_serialized = Mail.Schema().dump(mail)
         mail_serialized['mail_hashsum_hex'] = mail_hashsum_hex
         mail_serialized['mail_path'] = mail_path
+        if repo_folders is not None:
+            mail_serialized['repo_folders'] = repo_folders
         return json.dumps(mail_serialized, indent=None, sort_keys=True)
 
+    @staticmethod
+    def get_ndjson_record(
+        mail: Mail,
+        mail_hashsum_hex: str,
+        mail_path: str,
+        repo_folders: Optional[List[str]] = None,
+    ) -> dict:
+        """
+        The fields of the message file plus schema_version, mail_hashsum_hex and mail_path. The fields are
+        only added with the new schema versions, the incompatible changes increment the major version.
+        The search over several repositories adds repo_folders, the repositories which hold the message.
+        """
+        record = {
+            'schema_version': NDJSON_SCHEMA_VERSION,
+            **dump_mail_dict(mail),
+            'mail_hashsum_hex': mail_hashsum_hex,
+            'mail_path': mail_path,
+        }
+        if repo_folders is not None:
+            record['repo_folders'] = repo_folders
+        return record
+
+    @classmethod
+    def _get_output_ndjson(
+        cls,
+        mail: Mail,
+        mail_hashsum_hex: str,
+        mail_path: str,
+        repo_folders: Optional[List[str]] = None,
+    ) -> str:
+        record = cls.get_ndjson_record(mail, mail_hashsum_hex, mail_path, repo_folders)
+        return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
     @staticmethod
     def _print_func(s: Union[str, int]):
         click.echo(s)
 
-    def print_item(self, mail: Mail, mail_hashsum_hex: str, mail_path: str):
+    def print_item(self, mail: Mail, mail_hashsum_hex: str, mail_path: str, repo_folders: Optional[List[str]] = None):
+        with stage('output'):
+            self._print_item(mail, mail_hashsum_hex, mail_path, repo_folders)
+
+    def _print_item(self, mail: Mail, mail_hashsum_hex: str, mail_path: str, repo_folders: Optional[List[str]]):
         if self.output_format == OutputFormat.JSON:
-            self._print_func(self._get_output_json(mail, mail_hashsum_hex, mail_path))
+            self._print_func(self._get_output_json(mail, mail_hashsum_hex, mail_path, repo_folders))
+        elif self.output_format == OutputFormat.NDJSON:
+            self._print_func(self._get_output_ndjson(mail, mail_hashsum_hex, mail_path, repo_folders))
         elif self.output_format == OutputFormat.HASHSUMS:
             self._print_func(mail_hashsum_hex)
         elif self.output_format == OutputFormat.COUNT:
@@ -385,14 +831,75 @@ class OutputPrinter:
         else:
             self._print_func(mail_path)
 
+    def print_estimate(self, count_estimate: 'CountEstimate'):
+        if self.output_format in (OutputFormat.JSON, OutputFormat.NDJSON):
+            self._print_func(json.dumps({**count_estimate._asdict(), 'is_exact': count_estimate.is_exact},
+                                        sort_keys=True))
+        else:
+            self._print_func(
+                f'{count_estimate.count} ({count_estimate.confidence:.0%} interval {count_estimate.lower}-'
+                f'{count_estimate.upper}, {count_estimate.sampled_number} of {count_estimate.total_number} '
+                f'messages sampled)'
+            )
+
     def print_count(self, count: int):
         if self.output_format == OutputFormat.COUNT:
             self._print_func(count)
 
 
-@cli.command('search', help='Searches messages')
-@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
-@click.option('--datetime-from', type=click.DateTime(), default=datetime.now() - timedelta(days=30))
+def load_exclude_manifest(manifest_path: Optional[str]) -> Optional['Manifest']:
+    if manifest_path is None:
+        return None
+
+    from pyadps.manifest import ManifestError, load_manifest
+
+    try:
+        return load_manifest(manifest_path)
+    except ManifestError as exc:
+        raise click.BadParameter(f'{manifest_path!r}: {exc}', param_hint='--exclude-manifest')
+
+
+exclude_manifest_option = click.option(
+    '--exclude-manifest', 'exclude_manifest_path', type=click.Path(exists=True, dir_okay=False), default=None,
+    help='Do not copy the messages and attachments listed in the manifest of the target node, see the manifest command'
+)
+
+
+def echo_missing_attachments(mail_exporter: 'MailExporter'):
+    for msg_path, attachment in mail_exporter.missing_attachments:
+        click.echo(f'The attachment {attachment.filename!r} of the message {msg_path!r} is not found', err=True)
+
+
+def iter_merged_results(
+    storage: Storage,
+    search_results: Iterable[FilteredMailResult],
+    result_set: 'ResultSet',
+) -> Generator[FilteredMailResult, None, None]:
+    """The found messages and then the messages of the result set which were not found"""
+    found_paths = set()
+    for search_result in search_results:
+        found_paths.add(search_result.mail_path)
+        yield search_result
+
+    yield from storage.filter_mails(None, messages_bytes=result_set.iter_messages_bytes(exclude_paths=found_paths))
+
+
+def get_default_datetime_from() -> datetime:
+    """The start of the day 30 days ago, it's the same for the searches of one day, so they share the query cache"""
+    return datetime.combine(date.today() - timedelta(days=30), time.min)
+
+
+extra_repo_folders_option = click.option(
+    '--extra-repo-folder', 'extra_repo_folders', type=click.Path(exists=True), multiple=True,
+    help='Search this repository too, may be given several times. The repositories on different devices are read '
+         'concurrently and the messages found in several of them are reported once'
+)
+
+
+@cli.command('search', help='Searches messages, the repository may be a zip or tar archive')
+@click.argument('repo_folder', type=click.Path(exists=True), default='.')
+@click.option('--datetime-from', type=click.DateTime(), default=None,
+              help='[default: the start of the day 30 days ago]')
 @click.option('--datetime-to', type=click.DateTime(), default=None)
 @click.option('--latitude', type=click.FloatRange(min=-90.0, max=90.0), default=None)
 @click.option('--longitude', type=click.FloatRange(min=-180.0, max=180.0), default=None)
@@ -405,9 +912,18 @@ class OutputPrinter:
 @click.option('--damping-distance-longitude', type=click.FloatRange(min=-180.0, max=180.0), default=None)
 @click.option('--damping-distance-base-distance-meters', type=click.FLOAT, default=None)
 @click.option('--output-format',
-              type=click.Choice([OutputFormat.HASHSUMS, OutputFormat.JSON, OutputFormat.PATHS, OutputFormat.COUNT],
-                                case_sensitive=False),
-              default=OutputFormat.JSON)
+              type=click.Choice(OutputFormat.ALL, case_sensitive=False), default=OutputFormat.JSON)
+@click.option('--sort-by', type=click.Choice(SortBy.ALL, case_sensitive=False), default=None,
+              help='DATE: the newest first, DISTANCE: the nearest to the searched location first, '
+                   'SIZE: the smallest attachments first')
+@click.option('--limit', type=click.IntRange(min=1), default=None, help='Maximal number of the found messages')
+@click.option('--estimate/--no-estimate', type=click.BOOL, default=False,
+              help='Estimate the number of the found messages by the random sample instead of the full scan')
+@click.option('--estimate-confidence', type=click.FloatRange(min=0.0, max=1.0, min_open=True, max_open=True),
+              default=0.95, help='Confidence level of the estimated interval')
+@click.option('--estimate-max-samples', type=click.IntRange(min=1), default=10000)
+@click.option('--estimate-margin', type=click.FloatRange(min=0.0), default=None,
+              help='Stop sampling once the estimated count is known within this number of messages')
 @click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
 @click.option('--copy/--no-copy', 'copy_msg', type=click.BOOL, default=False,
               help='Copy filtered files to another repo')
@@ -417,6 +933,25 @@ class OutputPrinter:
               help='ask confirmation before delete')
 @click.option('--print-list-to-delete/--no-print-list-to-delete', type=click.BOOL, default=False)
 @click.option('--target-repo-folder', type=click.STRING, default=None)
+@exclude_manifest_option
+@click.option('--bundle', 'bundle_path', type=click.Path(dir_okay=False), default=None,
+              help='Write filtered messages with their attachments to the bundle file, see the unbundle command')
+@click.option('--export-folder', type=click.Path(file_okay=False), default=None,
+              help='Export filtered messages with their attachments to the subfolders of this folder')
+@click.option('--export-hardlink/--no-export-hardlink', type=click.BOOL, default=False,
+              help='Hard link the exported files on the same file system, they must not be edited then')
+@click.option('--save-results', 'save_results_name', type=click.STRING, default=None,
+              help='Save the found messages to the result set with this name for --refine and --merge')
+@click.option('--refine', 'refine_name', type=click.STRING, default=None,
+              help='Search only the messages of the saved result set')
+@click.option('--merge', 'merge_name', type=click.STRING, default=None,
+              help='Add the messages of the saved result set to the found messages')
+@click.option('--query-cache/--no-query-cache', 'use_query_cache', type=click.BOOL, default=False,
+              help='Reuse the results of the same search while the repository is not changed')
+@extra_repo_folders_option
+@daemon_option('repo_folder')
+@profile_option
+@metrics_option
 def search(
     repo_folder: str,
     datetime_from: Optional[datetime],
@@ -432,28 +967,82 @@ def search(
     damping_distance_longitude: Optional[float],
     damping_distance_base_distance_meters: Optional[float],
     output_format: str,
+    sort_by: Optional[str],
+    limit: Optional[int],
+    estimate: bool,
+    estimate_confidence: float,
+    estimate_max_samples: int,
+    estimate_margin: Optional[float],
     show_progressbar: bool,
     copy_msg: bool,
     delete_msg: bool,
     confirm_delete: bool,
     print_list_to_delete: bool,
     target_repo_folder: Optional[str],
+    exclude_manifest_path: Optional[str],
+    bundle_path: Optional[str],
+    export_folder: Optional[str],
+    export_hardlink: bool,
+    save_results_name: Optional[str],
+    refine_name: Optional[str],
+    merge_name: Optional[str],
+    use_query_cache: bool,
+    extra_repo_folders: Tuple[str, ...],
+    daemon_client: Optional['DaemonClient'],
 ):
-    if not is_valid_repo_folder(repo_folder):
+    if not is_valid_repo_folder(repo_folder, is_written=delete_msg):
         raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
                                f'Use command init for creating the repository')
 
+    for extra_repo_folder in extra_repo_folders:
+        if not is_valid_repo_folder(extra_repo_folder):
+            raise click.UsageError(f'The folder {extra_repo_folder!r} is not valid repository')
+
+    if extra_repo_folders and (delete_msg or bundle_path is not None or export_folder is not None
+                               or save_results_name is not None or refine_name is not None or merge_name is not None
+                               or use_query_cache):
+        raise click.BadOptionUsage('extra-repo-folder', 'extra-repo-folder cannot be combined with delete, bundle, '
+                                                        'export-folder, save-results, refine, merge and query-cache')
+
+    if os.path.isfile(repo_folder) and (delete_msg or save_results_name is not None or use_query_cache):
+        raise click.UsageError('The repository archive is read-only, it cannot be used with delete, save-results '
+                               'and query-cache')
+
+    if refine_name is not None and merge_name is not None:
+        raise click.BadOptionUsage('refine', 'refine cannot be combined with merge')
+
+    if merge_name is not None and (sort_by is not None or limit is not None):
+        raise click.BadOptionUsage('merge', 'merge cannot be combined with sort-by and limit')
+
     if copy_msg and (target_repo_folder is None):
         raise click.UsageError('You should specify the target_repo_folder in case you want to copy the messages')
 
-    if target_repo_folder is not None and not is_valid_repo_folder(target_repo_folder):
+    if target_repo_folder is not None and (os.path.isfile(target_repo_folder)
+                                           or not is_valid_repo_folder(target_repo_folder, is_written=True)):
         raise click.UsageError(f'The target folder {repo_folder!r} is not valid repository. '
                                'Use command init for creating the repository')
 
+    if exclude_manifest_path is not None and not copy_msg:
+        raise click.BadOptionUsage('exclude-manifest', 'exclude-manifest is used only with copy')
+    exclude_manifest = load_exclude_manifest(exclude_manifest_path)
+
     storage = Storage(repo_folder)
 
+    from pyadps.result_sets import ResultSet, ResultSetError, ResultSetWriter
+
+    try:
+        refine_result_set = ResultSet(storage, refine_name) if refine_name is not None else None
+        merge_result_set = ResultSet(storage, merge_name) if merge_name is not None else None
+        save_result_set = ResultSet(storage, save_results_name) if save_results_name is not None else None
+    except ResultSetError as exc:
+        raise click.UsageError(str(exc))
+
+    for result_set in [refine_result_set, merge_result_set]:
+        if result_set is not None and not result_set.exists():
+            raise click.UsageError(f'There is no result set {result_set.name!r}, save it by --save-results')
+
     mail_filter = build_filter(
-        datetime_from=datetime_from,
+        datetime_from=datetime_from if datetime_from is not None else get_default_datetime_from(),
         datetime_to=datetime_to,
         latitude=latitude,
         longitude=longitude,
@@ -470,28 +1059,135 @@ def search(
     output_printer = OutputPrinter(output_format)
 
     search_callback = SearchCallback() if show_progressbar else None
-    copy_callback = CopyCallback() if show_progressbar else None
-
-    count = 0
-    filtered_message_paths = []
-    for search_result in storage.filter_mails(mail_filter, search_callback):
-        output_printer.print_item(search_result.mail, search_result.mail_hashsum_hex, search_result.mail_path)
-        count += 1
-
-        if copy_msg or delete_msg:
-            filtered_message_paths.append(search_result.mail_path)
 
-    if copy_msg:
-        storage.copy_mails(filtered_message_paths, target_repo_folder, copy_callback)  # type: ignore
-
-    if delete_msg:
-        delete_messages_by_mail_paths(
-            msg_paths=filtered_message_paths,
-            storage=storage,
-            confirm=confirm_delete,
-            print_list=print_list_to_delete,
-            show_progressbar=show_progressbar
+    if estimate:
+        if (copy_msg or delete_msg or bundle_path is not None or export_folder is not None or sort_by is not None
+                or limit is not None or save_results_name is not None or refine_name is not None
+                or merge_name is not None or extra_repo_folders):
+            raise click.BadOptionUsage('estimate', 'estimate cannot be combined with copy, delete, bundle, '
+                                                   'export-folder, sort-by, limit, save-results, refine, merge and '
+                                                   'extra-repo-folder')
+
+        count_estimate = storage.estimate_count(
+            mail_filter,
+            confidence=estimate_confidence,
+            max_samples=estimate_max_samples,
+            margin=estimate_margin,
+            callback=search_callback,
         )
+        if search_callback is not None:
+            search_callback.close()
+
+        output_printer.print_estimate(count_estimate)
+        return
+
+    sort_by = sort_by.upper() if sort_by is not None else None
+    if sort_by == SortBy.DISTANCE and get_filter_location(mail_filter) is None:
+        raise click.BadOptionUsage('sort-by', 'sorting by distance requires latitude and longitude or '
+                                              'damping-distance-latitude and damping-distance-longitude')
+
+    if refine_result_set is not None or merge_result_set is not None or extra_repo_folders:
+        daemon_client = None  # the result sets are read from the repository folder, the daemon serves one repository
+
+    if extra_repo_folders:
+        from pyadps.federation import FederatedStorage
+
+        federated_storage = FederatedStorage([repo_folder, *extra_repo_folders])
+        search_results = federated_storage.filter_mails(mail_filter, search_callback, sort_by=sort_by, limit=limit)
+        if copy_msg:
+            search_results = federated_storage.iter_copy_mails(search_results, target_repo_folder,  # type: ignore
+                                                               exclude_hashsums=exclude_manifest)
+    elif daemon_client is not None:
+        if (output_format == OutputFormat.COUNT and not copy_msg and not delete_msg and bundle_path is None
+                and export_folder is None and save_result_set is None):
+            output_printer.print_count(daemon_client.count(mail_filter) if limit is None
+                                       else sum(1 for _ in daemon_client.search(mail_filter, limit=limit)))
+            return
+
+        # the results of the daemon are copied after the search by its plan, the attachments are already found
+        search_results = daemon_client.search(mail_filter, sort_by=sort_by, limit=limit)
+    else:
+        query_cache, query_key = None, None
+        if use_query_cache and refine_result_set is None:
+            from pyadps.query_cache import QueryCache, get_query_key
+
+            query_cache = QueryCache(storage)
+            query_key = get_query_key(mail_filter, sort_by, limit)
+        cached_results = query_cache.get(query_key) if query_cache is not None and query_key is not None else None
+        if cached_results is not None:
+            search_results = iter(cached_results)
+        else:
+            search_results = storage.filter_mails(
+                mail_filter, search_callback, sort_by=sort_by, limit=limit,
+                messages_bytes=refine_result_set.iter_messages_bytes() if refine_result_set is not None else None,
+            )
+            if query_cache is not None and query_key is not None:
+                search_results = query_cache.iter_put(query_key, search_results)
+        if merge_result_set is not None:
+            search_results = iter_merged_results(storage, search_results, merge_result_set)
+        if copy_msg:
+            search_results = storage.iter_copy_mails(search_results, target_repo_folder,  # type: ignore
+                                                     exclude_hashsums=exclude_manifest)
+
+    mail_exporter = None
+    if export_folder is not None:
+        from pyadps.exporting import MailExporter
+
+        mail_exporter = MailExporter(storage, export_folder, hardlink=export_hardlink)
+    if bundle_path is not None:
+        from pyadps.bundle import BundleWriter
+
+    count = 0
+    with MessagePathsSpill() as filtered_message_paths, (
+        BundleWriter(bundle_path) if bundle_path is not None else nullcontext()
+    ) as bundle_writer, (
+        ResultSetWriter(save_result_set) if save_result_set is not None else nullcontext()
+    ) as result_set_writer:
+        if bundle_writer is not None:
+            search_results = bundle_writer.iter_add_mails(storage, search_results)
+        if result_set_writer is not None:
+            search_results = result_set_writer.iter_append(search_results)
+
+        for search_result in search_results:
+            output_printer.print_item(search_result.mail, search_result.mail_hashsum_hex, search_result.mail_path,
+                                      search_result.repo_folders if extra_repo_folders  # type: ignore
+                                      else None)
+            count += 1
+
+            if mail_exporter is not None:
+                mail_exporter.add_mail(search_result.mail_path, search_result.mail)
+            if delete_msg or (copy_msg and daemon_client is not None):
+                filtered_message_paths.append(search_result.mail_path)
+
+        if search_callback is not None:
+            search_callback.close()
+
+        if copy_msg and daemon_client is not None:
+            storage.copy_estimated_files(*daemon_client.plan_copy(filtered_message_paths),
+                                         target_repo_folder, exclude_hashsums=exclude_manifest)  # type: ignore
+
+        if bundle_writer is not None:
+            bundle_writer.close()  # the bundle is complete before the messages are deleted
+        if mail_exporter is not None:
+            mail_exporter.export()
+            echo_missing_attachments(mail_exporter)
+        if result_set_writer is not None:
+            result_set_writer.close()
+
+        for result_set in [refine_result_set, merge_result_set]:
+            if result_set is not None and result_set.stale_number:
+                click.echo(f'{result_set.stale_number} stale entries of the result set {result_set.name!r} '
+                           f'are skipped', err=True)
+
+        if delete_msg:
+            delete_messages_by_mail_paths(
+                msg_paths=filtered_message_paths,
+                storage=storage,
+                confirm=confirm_delete,
+                print_list=print_list_to_delete,
+                show_progressbar=show_progressbar,
+                daemon_client=daemon_client,
+            )
 
     output_printer.print_count(count)
 
@@ -499,7 +1195,8 @@ def search(
 def get_msg_paths_by_user_input(
     hashsums: Optional[str],
     msg_path: Optional[str],
-    storage: Storage
+    storage: Storage,
+    daemon_client: Optional['DaemonClient'] = None,
 ) -> List[str]:
     if hashsums is not None and msg_path is not None:
         raise click.BadOptionUsage('hashsums', 'Cannot specify both --hashsums and --msg-path options')
@@ -513,7 +1210,8 @@ def get_msg_paths_by_user_input(
         msg_paths.append(msg_path)
     elif hashsums is not None:
         hashsums_list = hashsums.split(',')
-        for search_result in storage.filter_mails(mail_filter=None):
+        search_results = daemon_client.search(None) if daemon_client is not None else storage.filter_mails(None)
+        for search_result in search_results:
             for hashsum_part in hashsums_list:
                 if search_result.mail_hashsum_hex.startswith(hashsum_part):
                     msg_paths.append(search_result.mail_path)
@@ -535,6 +1233,9 @@ def get_msg_paths_by_user_input(
 @click.option('--confirm/--no-confirm', type=click.BOOL, default=True, help='ask confirmation before delete')
 @click.option('--print-list/--no-print-list', type=click.BOOL, default=True)
 @click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
+@daemon_option('repo_folder')
+@profile_option
+@metrics_option
 def delete(
     repo_folder: str,
     hashsums: Optional[str],
@@ -542,8 +1243,9 @@ def delete(
     confirm: bool,
     print_list: bool,
     show_progressbar: bool,
+    daemon_client: Optional['DaemonClient'],
 ):
-    if not is_valid_repo_folder(repo_folder):
+    if not is_valid_repo_folder(repo_folder, is_written=True):
         click.echo(f'The folder {repo_folder!r} is not valid repository. Use command init for creating the repository')
         raise click.Abort()
 
@@ -551,7 +1253,8 @@ def delete(
     msg_paths = get_msg_paths_by_user_input(
         hashsums=hashsums,
         msg_path=msg_path,
-        storage=storage
+        storage=storage,
+        daemon_client=daemon_client,
     )
 
     delete_messages_by_mail_paths(
@@ -560,11 +1263,13 @@ def delete(
         confirm=confirm,
         print_list=print_list,
         show_progressbar=show_progressbar,
+        daemon_client=daemon_client,
     )
 
 
-@cli.command('copy', help='Copy messages (with attachments) by their hashsums or by path to another repository')
-@click.argument('source_repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@cli.command('copy', help='Copy messages (with attachments) by their hashsums or by path to another repository, '
+                          'the source repository may be a zip or tar archive')
+@click.argument('source_repo_folder', type=click.Path(exists=True), default='.')
 @click.argument('target_repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
 @click.option(
     '--hashsums',
@@ -573,45 +1278,203 @@ def delete(
     help='hashsums of messages divided by comma, for example, "e375f79f4e,1f478f4d9d". '
          'Warning: this option conflicts with the --path option'
 )
-@click.option('--msg-path', type=click.Path(exists=True, file_okay=True, dir_okay=False), default=None, required=False)
+@click.option('--msg-path', type=click.Path(file_okay=True, dir_okay=False), default=None, required=False)
 @click.option('--show-progressbar/--no-show-progressbar', type=click.BOOL, default=True)
+@exclude_manifest_option
+@extra_repo_folders_option
+@daemon_option('source_repo_folder')
+@profile_option
+@metrics_option
 def copy(
     source_repo_folder: str,
     target_repo_folder: str,
     hashsums: Optional[str],
     msg_path: Optional[str],
     show_progressbar: bool,
+    exclude_manifest_path: Optional[str],
+    extra_repo_folders: Tuple[str, ...],
+    daemon_client: Optional['DaemonClient'],
 ):
-    for repo_folder in [source_repo_folder, target_repo_folder]:
-        if not is_valid_repo_folder(repo_folder):
+    for repo_folder in [source_repo_folder, *extra_repo_folders, target_repo_folder]:
+        if not is_valid_repo_folder(repo_folder, is_written=repo_folder == target_repo_folder):
             click.echo(f'The folder {repo_folder!r} is not valid repository. '
                        f'Use command init for creating the repository')
             raise click.Abort()
 
+    if msg_path is not None and not is_message_path(msg_path):
+        raise click.BadParameter(f'{msg_path!r} is not a message of the repository', param_hint='--msg-path')
+
+    exclude_manifest = load_exclude_manifest(exclude_manifest_path)
+    if extra_repo_folders:
+        if hashsums is None:
+            raise click.BadOptionUsage('extra-repo-folder', 'extra-repo-folder is used only with hashsums')
+
+        from pyadps.federation import FederatedStorage
+
+        federated_storage = FederatedStorage([source_repo_folder, *extra_repo_folders])
+        search_callback = SearchCallback() if show_progressbar else None
+        hashsums_list = hashsums.split(',')
+        federated_results = [
+            federated_result for federated_result in federated_storage.filter_mails(None, search_callback)
+            if any(federated_result.mail_hashsum_hex.startswith(hashsum_part) for hashsum_part in hashsums_list)
+        ]
+        if search_callback is not None:
+            search_callback.close()
+        for _ in federated_storage.iter_copy_mails(federated_results, target_repo_folder,
+                                                   exclude_hashsums=exclude_manifest,
+                                                   callback=CopyCallback() if show_progressbar else None):
+            pass
+        return
+
     source_storage = Storage(source_repo_folder)
     msg_paths = get_msg_paths_by_user_input(
         hashsums=hashsums,
         msg_path=msg_path,
-        storage=source_storage
+        storage=source_storage,
+        daemon_client=daemon_client,
     )
 
     copy_callback = CopyCallback() if show_progressbar else None
-    source_storage.copy_mails(msg_paths, target_repo_folder, copy_callback)
+    if daemon_client is not None:
+        source_storage.copy_estimated_files(*daemon_client.plan_copy(msg_paths), target_repo_folder, copy_callback,
+                                            exclude_hashsums=exclude_manifest)
+    else:
+        source_storage.copy_mails(msg_paths, target_repo_folder, copy_callback, exclude_hashsums=exclude_manifest)
+
+
+@cli.command('manifest', help='Writes the hashsums of the messages and attachments of the repository to the manifest '
+                              'file for the --exclude-manifest option of the other node')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.argument('manifest_path', type=click.Path(dir_okay=False))
+@click.option('--mode', type=click.Choice(['EXACT', 'BLOOM'], case_sensitive=False), default='EXACT',
+              show_default=True,
+              help='EXACT: 8 bytes per hashsum, BLOOM: the Bloom filter, about 15 bits per hashsum for the default '
+                   'false positive rate')
+@click.option('--false-positive-rate', type=click.FloatRange(min=0.0, max=1.0, min_open=True, max_open=True),
+              default=None,
+              help='BLOOM mode: the probability that a missing file is thought to exist and is not copied '
+                   '[default: 0.001]')
+@profile_option
+@metrics_option
+def manifest(repo_folder: str, manifest_path: str, mode: str, false_positive_rate: Optional[float]):
+    from pyadps.manifest import DEFAULT_FALSE_POSITIVE_RATE, build_manifest, write_manifest
+
+    if not is_valid_repo_folder(repo_folder):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    repo_manifest = build_manifest(Storage(repo_folder), mode.upper(),
+                                   false_positive_rate or DEFAULT_FALSE_POSITIVE_RATE)
+    write_manifest(repo_manifest, manifest_path)
+    click.echo(f'{len(repo_manifest)} hashsums ({os.path.getsize(manifest_path)} bytes) are written to {manifest_path}')
+
+
+@cli.command('bundle', help='Writes messages (with attachments) by their hashsums or by path to one bundle file')
+@click.argument('repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@click.argument('bundle_path', type=click.Path(dir_okay=False))
+@click.option(
+    '--hashsums',
+    type=click.STRING,
+    default=None,
+    help='hashsums of messages divided by comma, for example, "e375f79f4e,1f478f4d9d". '
+         'Warning: this option conflicts with the --path option'
+)
+@click.option('--msg-path', type=click.Path(exists=True, file_okay=True, dir_okay=False), default=None, required=False)
+@daemon_option('repo_folder')
+@profile_option
+@metrics_option
+def bundle(
+    repo_folder: str,
+    bundle_path: str,
+    hashsums: Optional[str],
+    msg_path: Optional[str],
+    daemon_client: Optional['DaemonClient'],
+):
+    from pyadps.bundle import BundleError, BundleWriter
+
+    if not is_valid_repo_folder(repo_folder):
+        raise click.UsageError(f'The folder {repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    storage = Storage(repo_folder)
+    msg_paths = get_msg_paths_by_user_input(
+        hashsums=hashsums,
+        msg_path=msg_path,
+        storage=storage,
+        daemon_client=daemon_client,
+    )
+
+    try:
+        with BundleWriter(bundle_path) as bundle_writer:
+            for msg_path in msg_paths:
+                bundle_writer.add_mail(storage, storage.load_filtered_mail(msg_path, None))  # type: ignore
+    except (BundleError, FileNotFoundError) as exc:
+        raise click.ClickException(str(exc))
 
+    stats = bundle_writer.stats
+    click.echo(f'{stats.messages_number} messages and {stats.attachments_number} attachments '
+               f'({stats.size_bytes} bytes) are written to {bundle_path}')
 
-@cli.command('export', help='Export one message to another folder.')
-@click.argument('msg_path', type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True)
+
+@cli.command('unbundle', help='Saves messages with attachments from the bundle file ("-" for stdin) to the repository')
+@click.argument('bundle_file', type=click.File('rb'))
+@click.argument('target_repo_folder', type=click.Path(exists=True, file_okay=False), default='.')
+@profile_option
+@metrics_option
+def unbundle(bundle_file: BinaryIO, target_repo_folder: str):
+    from pyadps.bundle import BundleError, extract_bundle
+
+    if not is_valid_repo_folder(target_repo_folder, is_written=True):
+        raise click.UsageError(f'The folder {target_repo_folder!r} is not valid repository. '
+                               f'Use command init for creating the repository')
+
+    try:
+        stats = extract_bundle(bundle_file, target_repo_folder)
+    except BundleError as exc:
+        raise click.ClickException(f'{exc}, the verified entries before the error are saved')
+
+    click.echo(f'{stats.messages_number} messages and {stats.attachments_number} attachments '
+               f'({stats.size_bytes} bytes) are saved, {stats.skipped_number} entries already exist')
+
+
+@cli.command('export', help='Export one message to another folder or, with --hashsums, the messages of the repository '
+                            'to the subfolders of the export folder. The repository may be a zip or tar archive.')
+@click.argument('msg_path', type=click.Path(file_okay=True, dir_okay=True), required=True)
 @click.argument('export_folder', type=click.Path(file_okay=False, dir_okay=True))
 @click.option('--abort-on-not-empty-folder/--not-abort-on-not-empty-folder', type=click.BOOL, default=True)
-def export(msg_path: str, export_folder: str, abort_on_not_empty_folder: bool):
-    repo_folder = str(PurePath(msg_path).parents[1])
+@click.option(
+    '--hashsums',
+    type=click.STRING,
+    default=None,
+    help='hashsums of messages divided by comma, for example, "e375f79f4e,1f478f4d9d". MSG_PATH is the repository then'
+)
+@click.option('--workers', type=click.IntRange(min=1), default=None,
+              help='Number of files copied concurrently [default: 4]')
+@click.option('--hardlink/--no-hardlink', type=click.BOOL, default=False,
+              help='Hard link the files on the same file system instead of copying them, they must not be edited then')
+@profile_option
+@metrics_option
+def export(
+    msg_path: str,
+    export_folder: str,
+    abort_on_not_empty_folder: bool,
+    hashsums: Optional[str],
+    workers: Optional[int],
+    hardlink: bool,
+):
+    from pyadps.exporting import DEFAULT_EXPORT_WORKERS, MailExporter
+
+    repo_folder = msg_path if hashsums is not None else str(PurePath(msg_path).parents[1])
     if not is_valid_repo_folder(repo_folder):
         click.echo(f'The folder {repo_folder!r} is not valid repository. '
                    f'Use command init for creating the repository')
         raise click.Abort()
 
+    if hashsums is None and not is_message_path(msg_path):
+        raise click.BadParameter(f'{msg_path!r} is not a message of the repository', param_hint='MSG_PATH')
+
     storage = Storage(repo_folder)
-    mail = storage.load_mail(msg_path)
+    msg_paths = get_msg_paths_by_user_input(hashsums, None, storage) if hashsums is not None else [msg_path]
 
     os.makedirs(export_folder, exist_ok=True)
     if os.listdir(export_folder) and abort_on_not_empty_folder:
@@ -619,10 +1482,15 @@ def export(msg_path: str, export_folder: str, abort_on_not_empty_folder: bool):
                    'Pass "--not-abort-on-not-empty-folder" to avoid this error or specify an empty folder.')
         raise click.Abort()
 
-    copyfile(msg_path, PurePath(export_folder) / os.path.basename(msg_path))
-    for attachment in mail.attachments:
-        attachment_path = storage.find_attachment_path(attachment.hashsum_hex)
-        copyfile(attachment_path, PurePath(export_folder) / attachment.filename)
+    mail_exporter = MailExporter(storage, export_folder, workers=workers or DEFAULT_EXPORT_WORKERS, hardlink=hardlink,
+                                 subfolders=hashsums is not None)
+    for msg_path in msg_paths:
+        mail_exporter.add_mail(msg_path, storage.load_mail(msg_path))
+    mail_exporter.export()
+
+    echo_missing_attachments(mail_exporter)
+    if mail_exporter.missing_attachments:
+        raise click.ClickException(f'{len(mail_exporter.missing_attachments)} attachments are not found')
 
 
 if __name__ == '__main__':
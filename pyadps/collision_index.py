@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union
+
+from pyadps import metrics
+from pyadps.hashing import get_default_engine
+
+FILENAME_RE = re.compile(r'^(?P<prefix>[^_.]+)(?:_(?P<suffix>\d{4}))?\.(?P<extension>[^.]+)$')
+DEFAULT_SLOT = -1  # <prefix>.<extension>, the suffixed files are the slots 0..9999
+HASH_ALL_BATCH_SIZE = 1024
+
+
+class CollisionDepthError(Exception):
+    pass
+
+
+@dataclass
+class BucketEntry:
+    filename: str
+    size_bytes: Optional[int]  # None until the file is stated, -1 if it's removed
+    hashsum_hex: Optional[str] = None  # None until the file is hashed
+
+
+class CollisionBucket:
+    """The files of one filename prefix and extension by their slots"""
+
+    def __init__(self):
+        self.entries: Dict[int, BucketEntry] = {}
+        self.slots_by_hashsum: Dict[str, int] = {}
+        self._first_free_slot = DEFAULT_SLOT
+
+    def add(self, slot: int, entry: BucketEntry):
+        self.entries[slot] = entry
+        if entry.hashsum_hex is not None:
+            self.slots_by_hashsum.setdefault(entry.hashsum_hex, slot)
+        while self._first_free_slot in self.entries:
+            self._first_free_slot += 1
+
+    def get_first_free_slot(self) -> int:
+        """The slot of the first missing file, get_free_file_path doesn't look further (see pyadps.fsck)"""
+        return self._first_free_slot
+
+
+def get_slot_filename(prefix: str, slot: int, extension: str) -> str:
+    return f'{prefix}.{extension}' if slot == DEFAULT_SLOT else f'{prefix}_{slot:04}.{extension}'
+
+
+def get_stat_key(stat_result: os.stat_result) -> Tuple[int, int, int]:
+    return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+def get_collision_depth(slot: int) -> int:
+    return slot - DEFAULT_SLOT
+
+
+class CollisionIndex:
+    """
+    Map of the filename prefixes of one folder to their collision buckets, built from one listing of the folder.
+    The bucket is collected from the listed names at its first lookup, its files are stated and hashed once, and
+    a file is hashed only if its size matches the size of the looked up content. So the free slot and the existing
+    file are found without probing the file system. The index is valid during one operation, the files written by
+    the caller are added by get_free_file_path.
+    If index_path is given, the known hashsums are saved by `save` and reused while the inode, the size and
+    the modification time of the file are the same (the renaming after the deletion keeps the modification time).
+    """
+
+    def __init__(
+        self,
+        folder_path: Union[str, os.PathLike],
+        max_depth: int,
+        known_entries: Optional[Mapping[str, Tuple[int, str]]] = None,
+        index_path: Optional[str] = None,
+    ):
+        """known_entries are (size, hashsum hex) by filename of the files stored elsewhere, e.g. the packed messages"""
+        self.folder_path = os.fspath(folder_path)
+        self.max_depth = max_depth
+        self.index_path = index_path
+        self._known_entries = known_entries or {}
+        self._filenames: Set[str] = set(os.listdir(self.folder_path)) if os.path.isdir(self.folder_path) else set()
+        self._filenames.update(self._known_entries)
+        self._buckets: Dict[Tuple[str, str], CollisionBucket] = {}
+        self._saved_entries = self._read_index() if index_path is not None else {}
+        self._is_changed = False
+
+    def _extend_bucket(self, bucket: CollisionBucket, prefix: str, extension: str):
+        """Adds the listed files from the first free slot of the bucket up to the next missing one"""
+        slot = bucket.get_first_free_slot()
+        while (filename := get_slot_filename(prefix, slot, extension)) in self._filenames:
+            known_entry = self._known_entries.get(filename)
+            bucket.add(slot, BucketEntry(filename, *known_entry) if known_entry else BucketEntry(filename, None))
+            slot += 1
+
+    def _get_bucket(self, prefix: str, extension: str) -> CollisionBucket:
+        bucket = self._buckets.get((prefix, extension))
+        if bucket is None:
+            bucket = self._buckets[(prefix, extension)] = CollisionBucket()
+            self._extend_bucket(bucket, prefix, extension)
+
+        return bucket
+
+    def _read_index(self) -> Dict[str, Tuple[Tuple[int, int, int], str]]:
+        """(stat key, hashsum hex) by filename"""
+        saved_entries = {}
+        try:
+            with open(self.index_path) as index_file:  # type: ignore
+                for line in index_file:
+                    if not line.endswith('\n'):
+                        continue  # incomplete line of the interrupted write
+
+                    filename, inode, size_bytes, mtime_ns, hashsum_hex = line.rstrip('\n').rsplit(' ', 4)
+                    saved_entries[filename] = ((int(inode), int(size_bytes), int(mtime_ns)), hashsum_hex)
+        except FileNotFoundError:
+            pass
+
+        return saved_entries
+
+    def _stat_entries(self, bucket: CollisionBucket, slots: Iterable[int]):
+        """Gets the sizes of the listed files and their hashsums saved for the same stat"""
+        for slot in slots:
+            entry = bucket.entries[slot]
+            if entry.size_bytes is not None or entry.hashsum_hex is not None:
+                continue
+
+            try:
+                stat_result = os.stat(os.path.join(self.folder_path, entry.filename))
+            except FileNotFoundError:
+                entry.size_bytes = -1  # removed after the listing, never matches
+                continue
+
+            entry.size_bytes = stat_result.st_size
+            saved_entry = self._saved_entries.get(entry.filename)
+            if saved_entry is not None and saved_entry[0] == get_stat_key(stat_result):
+                entry.hashsum_hex = saved_entry[1]
+                bucket.slots_by_hashsum.setdefault(entry.hashsum_hex, slot)
+
+    def _hash_entries(self, bucket_slots: List[Tuple[CollisionBucket, int]]):
+        entries = [bucket.entries[slot] for bucket, slot in bucket_slots]
+        metrics.increment('hashsum_lookups', len(entries))
+        hash_results = get_default_engine().hash_files(
+            os.path.join(self.folder_path, entry.filename) for entry in entries)
+        for (bucket, slot), entry, hash_result in zip(bucket_slots, entries, hash_results):
+            entry.hashsum_hex = hash_result.hex_digest
+            bucket.slots_by_hashsum.setdefault(hash_result.hex_digest, slot)
+        self._is_changed = True
+
+    def hash_all(self) -> int:
+        """Hashes every file of the buckets which isn't hashed yet, returns the number of the hashed files"""
+        unhashed_bucket_slots = []
+        for filename in sorted(self._filenames):
+            match = FILENAME_RE.match(filename)
+            if match is None or match.group('suffix') is not None:
+                continue
+
+            bucket = self._get_bucket(match.group('prefix'), match.group('extension'))
+            self._stat_entries(bucket, bucket.entries)
+            unhashed_bucket_slots.extend((bucket, slot) for slot, entry in bucket.entries.items()
+                                         if entry.hashsum_hex is None and entry.size_bytes != -1)
+
+        for batch_start in range(0, len(unhashed_bucket_slots), HASH_ALL_BATCH_SIZE):
+            self._hash_entries(unhashed_bucket_slots[batch_start:batch_start + HASH_ALL_BATCH_SIZE])
+
+        return len(unhashed_bucket_slots)
+
+    def _find_slot(
+        self,
+        path: str,
+        hashsum_hex: str,
+        size_bytes: Optional[int],
+    ) -> Tuple[str, str, CollisionBucket, Optional[int]]:
+        """(prefix, extension, bucket, the slot of the file with the hashsum or None)"""
+        match = FILENAME_RE.match(os.path.basename(path))
+        if match is None or match.group('suffix') is not None:
+            raise ValueError(f'{path!r} is not the default path of the hashsum prefix')
+
+        prefix, extension = match.group('prefix'), match.group('extension')
+        bucket = self._get_bucket(prefix, extension)
+        last_slot = min(bucket.get_first_free_slot(), DEFAULT_SLOT + self.max_depth + 1)
+
+        if hashsum_hex not in bucket.slots_by_hashsum:
+            self._stat_entries(bucket, range(DEFAULT_SLOT, last_slot))
+            unhashed_slots = [
+                slot for slot in range(DEFAULT_SLOT, last_slot)
+                if bucket.entries[slot].hashsum_hex is None and bucket.entries[slot].size_bytes != -1
+                and (size_bytes is None or bucket.entries[slot].size_bytes == size_bytes)
+            ]
+            if unhashed_slots:
+                self._hash_entries([(bucket, slot) for slot in unhashed_slots])
+
+        existing_slot = bucket.slots_by_hashsum.get(hashsum_hex)
+        if existing_slot is not None and existing_slot < last_slot:
+            metrics.observe('collision_depth', get_collision_depth(existing_slot))
+            return prefix, extension, bucket, existing_slot
+
+        return prefix, extension, bucket, None
+
+    def find_file_path(
+        self,
+        path: Union[str, os.PathLike],
+        hashsum_hex: str,
+        size_bytes: Optional[int] = None,
+    ) -> Optional[str]:
+        """Returns the path of the existing file with the hashsum like get_free_file_path or None, nothing is added"""
+        path = os.fspath(path)
+        prefix, extension, _, existing_slot = self._find_slot(path, hashsum_hex, size_bytes)
+        if existing_slot is None:
+            return None
+
+        return os.path.join(os.path.dirname(path), get_slot_filename(prefix, existing_slot, extension))
+
+    def get_free_file_path(
+        self,
+        path: Union[str, os.PathLike],
+        hashsum_hex: str,
+        size_bytes: Optional[int] = None,
+    ) -> Tuple[str, bool]:
+        """
+        Returns (path, is the file with the hashsum already there) like Storage.get_free_file_path. The files of
+        another size (if size_bytes is given) aren't hashed. Raises CollisionDepthError if the free slot is deeper
+        than max_depth.
+        """
+        path = os.fspath(path)
+        prefix, extension, bucket, existing_slot = self._find_slot(path, hashsum_hex, size_bytes)
+        if existing_slot is not None:
+            return os.path.join(os.path.dirname(path), get_slot_filename(prefix, existing_slot, extension)), True
+
+        first_free_slot = bucket.get_first_free_slot()
+        if get_collision_depth(first_free_slot) > self.max_depth:
+            raise CollisionDepthError(f'Could not get free path value for {path!r}: the collision depth of '
+                                      f'the prefix {prefix!r} exceeds {self.max_depth}')
+
+        filename = get_slot_filename(prefix, first_free_slot, extension)
+        bucket.add(first_free_slot, BucketEntry(filename, size_bytes, hashsum_hex))  # written by the caller
+        self._filenames.add(filename)
+        self._extend_bucket(bucket, prefix, extension)  # the files after the filled gap are found by the lookups
+        self._is_changed = True
+        metrics.observe('collision_depth', get_collision_depth(first_free_slot))
+        return os.path.join(os.path.dirname(path), filename), False
+
+    def save(self):
+        """
+        Writes the known hashsums to index_path atomically if there is something new, the saved hashsums of
+        the buckets which weren't looked up are kept
+        """
+        if self.index_path is None or not self._is_changed:
+            return
+
+        lines = {filename: f'{filename} {" ".join(map(str, stat_key))} {hashsum_hex}\n'
+                 for filename, (stat_key, hashsum_hex) in self._saved_entries.items()
+                 if filename in self._filenames}
+        for bucket in self._buckets.values():
+            for entry in bucket.entries.values():
+                lines.pop(entry.filename, None)
+                if entry.hashsum_hex is None:
+                    continue
+
+                try:
+                    stat_result = os.stat(os.path.join(self.folder_path, entry.filename))
+                except FileNotFoundError:
+                    continue  # the packed messages and the files the caller didn't write
+
+                lines[entry.filename] = f'{entry.filename} {" ".join(map(str, get_stat_key(stat_result)))} ' \
+                                        f'{entry.hashsum_hex}\n'
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as index_file:
+            index_file.writelines(lines.values())
+        os.replace(tmp_path, self.index_path)
+        self._is_changed = False
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-cache query daemon. `adps serve REPO` keeps the parsed messages of the repository in memory and answers
+the queries over the Unix domain socket `adps_serve.sock` in the root of the repository, the CLI uses it when
+the socket exists.
+
+The protocol is newline-delimited JSON: the client sends one object {"command": ..., ...} per line, the daemon
+answers with zero or more {"result": ...} lines followed by the final line {"ok": true, ...} or
+{"ok": false, "error": ...}. Several requests may be sent over one connection.
+"""
+import bisect
+import functools
+import itertools
+import json
+import os
+import os.path
+import socket
+import socketserver
+import threading
+from typing import IO, Any, Dict, Generator, Iterable, List, Optional, Tuple
+
+from pyadps import metrics
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.mail import CoordsData, MailFilter, dump_mail_filter_dict, load_mail_filter_dict
+from pyadps.storage import (EstimationFileResult, FilteredMailResult, SortBy, Storage, TopResults,
+                            dump_filtered_mail_result, get_filter_location, get_sort_score, load_filtered_mail_result)
+
+SOCKET_FILENAME = Storage.SERVE_SOCKET_FILENAME
+
+
+class DaemonError(Exception):
+    pass
+
+
+def get_socket_path(repo_folder: str) -> str:
+    return os.path.join(os.path.abspath(repo_folder), SOCKET_FILENAME)
+
+
+class RepositoryCache:
+    """
+    Parsed messages of the repository by path with the sizes of their files. The cache is brought up to date
+    before every query: if the messages folder or the pack index is changed, the listing is compared with
+    the cached paths, the new messages are read and the removed ones are dropped. The message filenames are
+    derived from their content, so a listed path which is cached doesn't have to be read again.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+        self._lock = threading.RLock()
+        self._results: Dict[str, Tuple[FilteredMailResult, int]] = {}
+        self._generation: Optional[tuple] = None
+        self._attachment_paths: Dict[str, str] = {}
+        self._attachments_generation: Optional[int] = None
+
+    def _add_message(self, msg_path: str, msg_bytes: bytes):
+        mail = Storage.parse_mail(msg_bytes)
+        filtered_mail_result = FilteredMailResult(mail, msg_path, calculate_hashsum_hex_from_bytes(msg_bytes))
+        self._results[msg_path] = (filtered_mail_result, len(msg_bytes))
+
+    def load(self) -> int:
+        """Reads the whole repository, returns the number of the messages"""
+        with self._lock:
+            Storage.clear_caches(self.storage.root_dir_path)  # the full load doesn't rely on the cached indexes
+            generation = self.storage.get_generation()
+            self._results = {}
+            for _, _, msg_path, msg_bytes in self.storage.iter_messages_bytes():
+                self._add_message(os.path.abspath(msg_path), msg_bytes)
+
+            self._generation = generation
+            return len(self._results)
+
+    def refresh(self) -> Tuple[int, int]:
+        """Brings the cache up to date, returns the numbers of the added and the removed messages"""
+        with self._lock:
+            generation = self.storage.get_generation()
+            if generation == self._generation:
+                return 0, 0
+
+            msg_paths = {os.path.abspath(msg_path) for msg_path in self.storage.get_message_paths()}
+            removed_paths = [msg_path for msg_path in self._results if msg_path not in msg_paths]
+            for msg_path in removed_paths:
+                del self._results[msg_path]
+
+            added_number = 0
+            for msg_path in sorted(msg_paths.difference(self._results)):
+                try:
+                    msg_bytes = Storage.read_message_bytes(msg_path)
+                except FileNotFoundError:
+                    continue  # removed after the listing, the next refresh sees the new generation
+                self._add_message(msg_path, msg_bytes)
+                added_number += 1
+
+            self._generation = generation
+            metrics.increment('daemon_messages_loaded', added_number)
+            return added_number, len(removed_paths)
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def find_attachment_path(self, hashsum_hex: str) -> str:
+        """Storage.find_attachment_path memoized until the attachments folder is changed"""
+        with self._lock:
+            attachments_generation = os.stat(
+                os.path.join(self.storage.root_dir_path, Storage.ATTACHMENTS_FOLDER)).st_mtime_ns
+            if attachments_generation != self._attachments_generation:
+                self._attachment_paths = {}
+                self._attachments_generation = attachments_generation
+
+            if hashsum_hex not in self._attachment_paths:
+                self._attachment_paths[hashsum_hex] = self.storage.find_attachment_path(hashsum_hex)
+
+            return self._attachment_paths[hashsum_hex]
+
+    def search(
+        self,
+        mail_filter: Optional[MailFilter],
+        sort_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort_location: Optional[CoordsData] = None,
+    ) -> List[FilteredMailResult]:
+        """Same as Storage.filter_mails over the cached messages"""
+        if limit is not None and limit < 0:
+            raise ValueError('limit should not be negative')
+
+        if sort_by == SortBy.DISTANCE:
+            sort_location = sort_location or get_filter_location(mail_filter)
+            if sort_location is None:
+                raise ValueError('sort_location is required for sorting by distance if the filter has no location')
+
+        with self._lock:
+            self.refresh()
+            matched_results = (
+                filtered_mail_result
+                for filtered_mail_result, _ in self._results.values()
+                if mail_filter is None or mail_filter.filter_func(filtered_mail_result.mail)
+            )
+            if sort_by is None:
+                return list(matched_results if limit is None else itertools.islice(matched_results, limit))
+
+            top_results = TopResults(functools.partial(get_sort_score, sort_by=sort_by, location=sort_location), limit)
+            for filtered_mail_result in matched_results:
+                top_results.push(filtered_mail_result)
+
+        return top_results.get_sorted()
+
+    def count(self, mail_filter: Optional[MailFilter]) -> int:
+        with self._lock:
+            self.refresh()
+            return sum(
+                1 for filtered_mail_result, _ in self._results.values()
+                if mail_filter is None or mail_filter.filter_func(filtered_mail_result.mail)
+            )
+
+    def _get_cached_result(self, msg_path: str) -> Tuple[FilteredMailResult, int]:
+        try:
+            return self._results[os.path.abspath(msg_path)]
+        except KeyError:
+            raise FileNotFoundError(msg_path)
+
+    def plan_copy(self, msg_paths: Iterable[str]) -> Dict[str, Any]:
+        """
+        Files to copy for the messages: every message and every attachment once with their hashsums and sizes,
+        in the order of Storage.copy_mails
+        """
+        with self._lock:
+            self.refresh()
+            messages, attachments = [], []
+            attachments_hashsums = set()
+            for msg_path in msg_paths:
+                filtered_mail_result, size_bytes = self._get_cached_result(msg_path)
+                messages.append({'path': filtered_mail_result.mail_path,
+                                 'hashsum_hex': filtered_mail_result.mail_hashsum_hex, 'size_bytes': size_bytes})
+
+                for attachment in filtered_mail_result.mail.attachments:
+                    if attachment.hashsum_hex not in attachments_hashsums:
+                        attachments_hashsums.add(attachment.hashsum_hex)
+                        attachments.append({'path': self.find_attachment_path(attachment.hashsum_hex),
+                                            'hashsum_hex': attachment.hashsum_hex,
+                                            'size_bytes': attachment.size_bytes})
+
+        return {
+            'messages': messages,
+            'attachments': attachments,
+            'total_size_bytes': sum(file_data['size_bytes'] for file_data in itertools.chain(messages, attachments)),
+        }
+
+    def estimate_delete(self, msg_paths: Iterable[str]) -> List[str]:
+        """
+        Same as Storage.get_attachments_for_delete over the cached messages. The absolute paths of the request are
+        sorted, not hashed to a set: the repeated ones are adjacent and the cached messages are looked up among them
+        by bisection. A path which is not cached (outside the repository) raises ValueError.
+        """
+        target_paths = sorted(msg_paths)
+        with self._lock:
+            self.refresh()
+            target_hashsums = set()
+            for idx, msg_path in enumerate(target_paths):
+                cached_result = self._results.get(msg_path)
+                if cached_result is None:
+                    raise ValueError(f'The message {msg_path!r} is not in the repository')
+
+                if idx == 0 or target_paths[idx - 1] != msg_path:
+                    target_hashsums.update(attachment.hashsum_hex for attachment in cached_result[0].mail.attachments)
+
+            if not target_hashsums:
+                return []
+
+            for msg_path, (filtered_mail_result, _) in self._results.items():
+                idx = bisect.bisect_left(target_paths, msg_path)
+                if idx < len(target_paths) and target_paths[idx] == msg_path:
+                    continue  # deleted
+
+                for attachment in filtered_mail_result.mail.attachments:
+                    target_hashsums.discard(attachment.hashsum_hex)  # linked to the message which is kept
+
+            attachment_paths_to_delete = []
+            for hashsum_hex in target_hashsums:
+                try:
+                    attachment_paths_to_delete.append(self.find_attachment_path(hashsum_hex))
+                except FileNotFoundError:
+                    continue
+
+            return attachment_paths_to_delete
+
+
+def _load_request_filter(request: dict) -> Optional[MailFilter]:
+    filter_data = request.get('filter')
+    return None if filter_data is None else load_mail_filter_dict(filter_data)
+
+
+def _load_request_location(request: dict) -> Optional[CoordsData]:
+    location_data = request.get('sort_location')
+    return None if location_data is None else CoordsData(float(location_data['lat']), float(location_data['lon']))
+
+
+def handle_request(cache: RepositoryCache, request: dict) -> Generator[dict, None, None]:
+    """Yields the response lines of the request, the last one has the "ok" field"""
+    command = request.get('command')
+    if command == 'status':
+        cache.refresh()
+        yield {'ok': True, 'root_dir_path': os.path.abspath(cache.storage.root_dir_path),
+               'messages_number': len(cache), 'pid': os.getpid()}
+    elif command == 'search':
+        results = cache.search(_load_request_filter(request), request.get('sort_by'), request.get('limit'),
+                               _load_request_location(request))
+        for filtered_mail_result in results:
+            yield {'result': dump_filtered_mail_result(filtered_mail_result)}
+        yield {'ok': True, 'count': len(results)}
+    elif command == 'count':
+        yield {'ok': True, 'count': cache.count(_load_request_filter(request))}
+    elif command == 'plan_copy':
+        yield {'ok': True, **cache.plan_copy(request['msg_paths'])}
+    elif command == 'estimate_delete':
+        yield {'ok': True, 'attachment_paths': cache.estimate_delete(request['msg_paths'])}
+    else:
+        raise ValueError(f'Unknown command {command!r}')
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: 'QueryServer'
+
+    def _write(self, data: dict):
+        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n')
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                for response in handle_request(self.server.cache, json.loads(line)):
+                    self._write(response)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                self._write({'ok': False, 'error': f'{type(e).__name__}: {e}'})
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, cache: RepositoryCache):
+        self.cache = cache
+        super().__init__(socket_path, _RequestHandler)
+
+
+def is_socket_alive(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        try:
+            client_socket.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+    return True
+
+
+def create_server(repo_folder: str, socket_path: Optional[str] = None) -> QueryServer:
+    """Loads the repository and binds the socket, the stale socket file of the killed daemon is replaced"""
+    socket_path = socket_path or get_socket_path(repo_folder)
+    if os.path.exists(socket_path):
+        if is_socket_alive(socket_path):
+            raise DaemonError(f'The daemon of the repository is already running on {socket_path!r}')
+        os.remove(socket_path)
+
+    cache = RepositoryCache(Storage(repo_folder))
+    cache.load()
+    return QueryServer(socket_path, cache)
+
+
+def run_server(server: QueryServer):
+    """Serves the requests until the interruption, the socket file is removed at the end"""
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(server.server_address)  # type: ignore
+        except FileNotFoundError:
+            pass
+
+
+class DaemonClient:
+    def __init__(self, client_socket: socket.socket):
+        self._socket = client_socket
+        self._file: IO[bytes] = client_socket.makefile('rwb')
+
+    @classmethod
+    def connect(cls, repo_folder: str, socket_path: Optional[str] = None) -> Optional['DaemonClient']:
+        """Returns None if the daemon of the repository isn't running"""
+        socket_path = socket_path or get_socket_path(repo_folder)
+        if not os.path.exists(socket_path):
+            return None
+
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client_socket.connect(socket_path)
+        except OSError:  # the stale socket of the killed daemon or the path is too long for the socket
+            client_socket.close()
+            return None
+
+        return cls(client_socket)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'DaemonClient':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_request(self, command: str, msg_paths: Optional[Iterable[str]] = None, **params):
+        """Writes the request line, msg_paths are written by one as their absolute paths, not collected to the list"""
+        request_line = json.dumps({'command': command, **params}).encode('utf-8')
+        if msg_paths is None:
+            self._file.write(request_line + b'\n')
+            return
+
+        self._file.write(request_line[:-1] + b', "msg_paths": [')  # the object is closed after the paths
+        for idx, msg_path in enumerate(msg_paths):
+            self._file.write((b', ' if idx else b'') + json.dumps(os.path.abspath(msg_path)).encode('utf-8'))
+        self._file.write(b']}\n')
+
+    def _request(self, command: str, **params) -> Generator[dict, None, dict]:
+        """Yields the result lines and returns the final one, the failures of the connection raise DaemonError too"""
+        try:
+            self._write_request(command, **params)
+            self._file.flush()
+            for line in self._file:
+                response = json.loads(line)
+                if 'ok' not in response:
+                    yield response['result']
+                    continue
+
+                if not response['ok']:
+                    raise DaemonError(response['error'])
+                return response
+        except (OSError, ValueError) as e:  # the daemon exited during the request
+            raise DaemonError(f'The connection to the daemon failed: {e!r}')
+
+        raise DaemonError('The daemon closed the connection')
+
+    def _call(self, command: str, **params) -> dict:
+        results = self._request(command, **params)
+        while True:
+            try:
+                next(results)
+            except StopIteration as e:
+                return e.value
+
+    def status(self) -> dict:
+        return self._call('status')
+
+    def search(
+        self,
+        mail_filter: Optional[MailFilter],
+        sort_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort_location: Optional[CoordsData] = None,
+    ) -> Generator[FilteredMailResult, None, None]:
+        """Same as Storage.filter_mails, the results are yielded while they are received"""
+        for result in self._request(
+            'search',
+            filter=None if mail_filter is None else dump_mail_filter_dict(mail_filter),
+            sort_by=sort_by,
+            limit=limit,
+            sort_location=None if sort_location is None else {'lat': sort_location.lat, 'lon': sort_location.lon},
+        ):
+            yield load_filtered_mail_result(result)
+
+    def count(self, mail_filter: Optional[MailFilter]) -> int:
+        return self._call('count', filter=None if mail_filter is None else dump_mail_filter_dict(mail_filter))['count']
+
+    def plan_copy(self, msg_paths: Iterable[str]) -> Tuple[List[EstimationFileResult], List[EstimationFileResult]]:
+        """Returns the estimation results of the message files and the attachments for Storage.copy_estimated_files"""
+        plan = self._call('plan_copy', msg_paths=msg_paths)
+
+        def load_estimation_results(files_data: List[dict]) -> List[EstimationFileResult]:
+            return [EstimationFileResult(data['path'], data['hashsum_hex'], data['size_bytes']) for data in files_data]
+
+        return load_estimation_results(plan['messages']), load_estimation_results(plan['attachments'])
+
+    def estimate_delete(self, msg_paths: Iterable[str]) -> List[str]:
+        return self._call('estimate_delete', msg_paths=msg_paths)['attachment_paths']
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path
+import tempfile
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class DateIndex:
+    """
+    Creation dates of the message files for the newest-first queries. The index file contains one line
+    "<filename> <timestamp>" per message (the filename may contain spaces), the later lines override the earlier
+    ones. The message filenames are derived from the hashsum of their content, so a filename identifies the message;
+    the lines of the deleted messages are ignored because the queries look up only the listed files.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.checkpoint_path = index_path + '.checkpoint'
+
+        self._timestamps: Dict[str, float] = {}
+        self._index_stat: Optional[Tuple[int, int]] = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.index_path)
+
+    def get_timestamps(self) -> Dict[str, float]:
+        """Returns the timestamps of date_created by filename, an empty dict if there is no index"""
+        try:
+            stat_result = os.stat(self.index_path)
+        except FileNotFoundError:
+            self._timestamps, self._index_stat = {}, None
+            return self._timestamps
+
+        index_stat = (stat_result.st_size, stat_result.st_mtime_ns)
+        if index_stat != self._index_stat:
+            self._timestamps = self._read_index()
+            self._index_stat = index_stat
+
+        return self._timestamps
+
+    def _read_index(self) -> Dict[str, float]:
+        timestamps: Dict[str, float] = {}
+        with open(self.index_path) as index_file:
+            for line in index_file:
+                if not line.endswith('\n'):
+                    continue  # incomplete line of the interrupted append
+
+                filename, timestamp = line.rstrip('\n').rsplit(' ', 1)
+                timestamps[filename] = float(timestamp)
+
+        return timestamps
+
+    def append(self, timestamps: Iterable[Tuple[str, float]]):
+        with open(self.index_path, 'a') as index_file:
+            for filename, timestamp in timestamps:
+                index_file.write(f'{filename} {timestamp!r}\n')
+
+    def write(self, timestamps: Iterable[Tuple[str, float]]):
+        """Replaces the index atomically"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as index_file:
+            for filename, timestamp in timestamps:
+                index_file.write(f'{filename} {timestamp!r}\n')
+        os.replace(tmp_path, self.index_path)
+        self._index_stat = None  # the new index may have the size and the coarse mtime (FAT) of the old one
+
+    def get_checkpoint(self) -> Optional[float]:
+        """
+        The time up to which the changes of the messages folder are known to be in the index, see
+        pyadps.watching.IndexMaintainer. None if it isn't saved.
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return float(checkpoint_file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set_checkpoint(self, timestamp: float):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.checkpoint_path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as checkpoint_file:
+            checkpoint_file.write(repr(timestamp))
+        os.replace(tmp_path, self.checkpoint_path)
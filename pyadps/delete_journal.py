@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe deletion of the repository files. The files to remove and the collision renames which close the gaps
+left by them (see Storage.get_correct_filenames_mapping_after_delete) are written to the journal
+<repo>/adps_delete.journal before anything is touched: one line {"remove": path} or {"rename": [before, after]} per
+operation with the paths relative to the repository. The journal is synced and moved in place atomically, then
+the files are unlinked without syncing them one by one, their folders are synced once, the line {"removed": true}
+is appended, the renames are applied, the folders are synced again and the journal is removed.
+
+The deletion interrupted at any point is rolled forward by `roll_forward`, which the CLI calls when a command
+writing to the repository opens it. The removals are repeated unless the journal is marked as removed (afterwards
+the renamed files take the removed names). The renames are done in the order of the slots, so the target of a rename
+is free until the rename is done and stays taken afterwards: the rename whose target exists is skipped.
+The deletion and the roll forward hold DeleteLock, so the concurrent commands don't apply the journal at once.
+"""
+import json
+import os
+import os.path
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pyadps import metrics
+from pyadps.helpers import sync_folder
+from pyadps.profiling import stage
+from pyadps.storage import Storage
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+DELETE_JOURNAL_FILENAME = Storage.DELETE_JOURNAL_FILENAME
+DELETE_LOCK_FILENAME = Storage.DELETE_LOCK_FILENAME
+
+
+class DeleteJournalError(Exception):
+    pass
+
+
+class DeleteLock:
+    """
+    Exclusive lock of the deletions in the repository: the file adps_delete.lock is locked by flock, which is
+    released when the process exits. The lock is reentrant in the thread which holds it, so the caller may keep it
+    from the planning of the deletion to delete_files. Without fcntl (Windows) only the threads are excluded.
+    """
+
+    _locks: Dict[str, 'DeleteLock'] = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, root_dir_path: str):
+        self.path = os.path.join(root_dir_path, DELETE_LOCK_FILENAME)
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd: Optional[int] = None
+
+    @classmethod
+    def get(cls, root_dir_path: str) -> 'DeleteLock':
+        """The lock of the repository, one per process"""
+        abs_root_dir_path = os.path.abspath(root_dir_path)
+        with cls._locks_lock:
+            if abs_root_dir_path not in cls._locks:
+                cls._locks[abs_root_dir_path] = cls(abs_root_dir_path)
+            return cls._locks[abs_root_dir_path]
+
+    def __enter__(self) -> 'DeleteLock':
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)  # waits for the deletion of another process
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            self._fd = fd
+
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth == 0:
+            os.close(self._fd)  # type: ignore  # releases the flock
+            self._fd = None
+        self._thread_lock.release()
+
+
+class DeleteJournal:
+    def __init__(self, root_dir_path: str):
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.path = os.path.join(self.root_dir_path, DELETE_JOURNAL_FILENAME)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def _get_relative_path(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.root_dir_path)
+
+    def _get_path(self, relative_path: str) -> str:
+        return os.path.join(self.root_dir_path, relative_path)
+
+    def write(self, remove_paths: Iterable[str], renames: Iterable[Tuple[str, str]]):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal_file:
+            for path in remove_paths:
+                journal_file.write(json.dumps({'remove': self._get_relative_path(path)}) + '\n')
+            for before_path, after_path in renames:
+                journal_file.write(json.dumps(
+                    {'rename': [self._get_relative_path(before_path), self._get_relative_path(after_path)]}) + '\n')
+
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        os.replace(tmp_path, self.path)
+        sync_folder(self.root_dir_path)
+
+    def read(self) -> Tuple[List[str], List[Tuple[str, str]], bool]:
+        """(paths to remove, renames, the files are removed already)"""
+        remove_paths: List[str] = []
+        renames: List[Tuple[str, str]] = []
+        is_removed = False
+        with open(self.path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                if not line.endswith('\n'):
+                    continue  # incomplete mark of the interrupted append
+
+                operation = json.loads(line)
+                if 'remove' in operation:
+                    remove_paths.append(self._get_path(operation['remove']))
+                elif 'rename' in operation:
+                    renames.append((self._get_path(operation['rename'][0]), self._get_path(operation['rename'][1])))
+                elif operation.get('removed'):
+                    is_removed = True
+
+        return remove_paths, renames, is_removed
+
+    def mark_removed(self):
+        with open(self.path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps({'removed': True}) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def apply(self):
+        """Applies the written journal, it's safe to apply the journal again at any point"""
+        remove_paths, renames, is_removed = self.read()
+        if not is_removed:
+            with stage('unlink'):
+                for path in remove_paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass  # removed before the interruption
+
+            for folder_path in sorted(set(map(os.path.dirname, remove_paths))):
+                sync_folder(folder_path)
+            self.mark_removed()
+
+        with stage('rename'):
+            for before_path, after_path in renames:
+                if os.path.exists(after_path) or not os.path.exists(before_path):
+                    continue  # renamed before the interruption
+                os.rename(before_path, after_path)
+
+        for folder_path in sorted(set(os.path.dirname(after_path) for _, after_path in renames)):
+            sync_folder(folder_path)
+
+        os.remove(self.path)
+        metrics.observe('delete_removed_files', len(remove_paths))
+        metrics.observe('delete_renamed_files', len(renames))
+
+
+def delete_files(
+    root_dir_path: str,
+    remove_paths: Iterable[str],
+    renames: Optional[Iterable[Tuple[str, str]]] = None,
+):
+    """
+    Removes the files of the repository and then renames the files as one transaction. The renames are computed
+    for the repository without the interrupted deletion, so it must be rolled forward before.
+    """
+    journal = DeleteJournal(root_dir_path)
+    with DeleteLock.get(root_dir_path):
+        if journal.exists():
+            raise DeleteJournalError(f'The deletion in {root_dir_path!r} is interrupted, it should be rolled forward')
+
+        journal.write(remove_paths, renames or [])
+        journal.apply()
+
+
+def roll_forward(root_dir_path: str) -> bool:
+    """Finishes the deletion interrupted in the repository, returns whether there was one"""
+    journal = DeleteJournal(root_dir_path)
+    if not journal.exists():
+        return False
+
+    with DeleteLock.get(root_dir_path):
+        if not journal.exists():
+            return False  # finished by another process while the lock was waited for
+
+        journal.apply()
+        return True
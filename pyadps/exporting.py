@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Export of many messages with their attachments for printing, every message goes to its own subfolder named after
+the message file (e.g. `e375f79f4e/`). The messages are exported in batches of EXPORT_BATCH_SIZE, so only one batch
+is kept in memory. The attachments are looked up in the collision index built from one listing of the attachments
+folder for the whole export: a file is hashed only if its size is the size of the attachment and the hashsums saved
+by `adps index --hashsums` are reused, so a file of the same prefix and size isn't taken for the attachment. The files
+are copied by the thread pool with copy_file_range, which lets the file system share the blocks (reflinks, server-side
+copies of NFS) and falls back to the plain copy between the file systems. The hard links are made on request only:
+the exported file is the repository file then and must not be edited.
+"""
+import os
+import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import PurePath
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pyadps import metrics
+from pyadps.collision_index import CollisionIndex
+from pyadps.mail import FileAttachment, Mail
+from pyadps.profiling import stage
+from pyadps.storage import Storage
+
+DEFAULT_EXPORT_WORKERS = 4
+EXPORT_BATCH_SIZE = 1000  # messages
+
+
+@dataclass
+class ExportStats:
+    messages_number: int = 0
+    files_number: int = 0
+    linked_number: int = 0  # the files exported as the hard links
+    size_bytes: int = 0
+
+
+def get_export_folder_name(msg_path: str) -> str:
+    """The subfolder of the message, the filename of the message without the extension is unique in the repository"""
+    return os.path.splitext(os.path.basename(msg_path))[0]
+
+
+def create_attachments_collision_index(storage: Storage) -> Optional[CollisionIndex]:
+    """None if the repository is an archive, its attachments are found by their archive entries"""
+    if storage.get_repository_archive(storage.root_dir_path) is not None:
+        return None
+
+    with stage('glob'):
+        return storage.create_collision_index(os.path.join(storage.root_dir_path, Storage.ATTACHMENTS_FOLDER))
+
+
+def resolve_attachment_paths(
+    storage: Storage,
+    attachments: Iterable[FileAttachment],
+    collision_index: Optional[CollisionIndex] = None,
+) -> Dict[str, str]:
+    """
+    The paths of the found attachments by hashsum. The collision index of the attachments folder (see
+    create_attachments_collision_index) may be shared by the calls of one export, it's created otherwise.
+    """
+    attachments_by_hashsum = {attachment.hashsum_hex: attachment for attachment in attachments}
+    if collision_index is None:
+        collision_index = create_attachments_collision_index(storage)
+
+    attachment_paths = {}
+    if collision_index is None:
+        for hashsum_hex in attachments_by_hashsum:
+            try:
+                attachment_paths[hashsum_hex] = storage.find_attachment_path(hashsum_hex)
+            except FileNotFoundError:
+                continue
+
+        return attachment_paths
+
+    for hashsum_hex, attachment in attachments_by_hashsum.items():
+        prefix = hashsum_hex[:Storage.HASHSUM_FILENAME_PART_LEN]
+        attachment_path = collision_index.find_file_path(
+            os.path.join(collision_index.folder_path, f'{prefix}.bin'), hashsum_hex, attachment.size_bytes)
+        if attachment_path is not None:
+            attachment_paths[hashsum_hex] = attachment_path
+
+    metrics.observe('export_attachments_resolved', len(attachment_paths))
+    return attachment_paths
+
+
+def export_file(source_path: str, target_path: str, hardlink: bool = False) -> bool:
+    """
+    Copies the file of the repository (the packed and archived messages too), returns whether the hard link
+    is made instead. The existing target is replaced, not written in place: it may be the hard link of
+    the repository file made by the previous export.
+    """
+    if os.path.isfile(source_path) and os.path.isfile(target_path) and os.path.samefile(source_path, target_path):
+        return True  # already exported as the hard link
+
+    if os.path.lexists(target_path):
+        os.unlink(target_path)
+
+    if hardlink:
+        try:
+            os.link(source_path, target_path)
+            metrics.increment('files_linked')
+            return True
+        except OSError:
+            pass  # another file system, the packed or archived file
+
+    if not hasattr(os, 'copy_file_range') or not os.path.isfile(source_path):
+        Storage.copy_file(source_path, target_path)
+        return False
+
+    copy_start = time.perf_counter()
+    try:
+        with stage('copy') as copy_stage, open(source_path, 'rb') as source_file, \
+                open(target_path, 'wb') as target_file:
+            left_bytes = os.fstat(source_file.fileno()).st_size
+            copy_stage.add_bytes(left_bytes)
+            metrics.increment('copied_bytes', left_bytes)
+            while left_bytes > 0:
+                copied_bytes = os.copy_file_range(source_file.fileno(), target_file.fileno(), left_bytes)
+                if copied_bytes == 0:
+                    break
+                left_bytes -= copied_bytes
+    except OSError:
+        Storage.copy_file(source_path, target_path)  # the kernel or the file systems don't support it
+        return False
+
+    metrics.increment('files_copied')
+    metrics.increment('copy_seconds', time.perf_counter() - copy_start)
+    return False
+
+
+class MailExporter:
+    """
+    Exports the messages added by `add_mail` in batches of batch_size, the rest of them by `export`. Without
+    subfolders the files of all messages go to export_folder itself. The attachments of a message with the same
+    filename overwrite each other.
+    """
+
+    def __init__(self, storage: Storage, export_folder: str, workers: int = DEFAULT_EXPORT_WORKERS,
+                 hardlink: bool = False, subfolders: bool = True, batch_size: int = EXPORT_BATCH_SIZE):
+        self.storage = storage
+        self.export_folder = export_folder
+        self.subfolders = subfolders
+        self.workers = workers
+        self.hardlink = hardlink
+        self.batch_size = batch_size
+        self.stats = ExportStats()
+        self.missing_attachments: List[Tuple[str, FileAttachment]] = []  # (message path, attachment)
+
+        self._mails: List[Tuple[str, Mail]] = []
+        self._collision_index: Optional[CollisionIndex] = None
+
+    def add_mail(self, msg_path: str, mail: Mail):
+        self._mails.append((msg_path, mail))
+        if len(self._mails) >= self.batch_size:
+            self._export_batch()
+
+    def _export_file(self, source_target_paths: Tuple[str, str]) -> Tuple[bool, int]:
+        source_path, target_path = source_target_paths
+        return export_file(source_path, target_path, self.hardlink), self.storage.get_file_size(source_path)
+
+    def _export_batch(self):
+        if self._collision_index is None:
+            self._collision_index = create_attachments_collision_index(self.storage)
+        attachment_paths = resolve_attachment_paths(
+            self.storage, (attachment for _, mail in self._mails for attachment in mail.attachments),
+            self._collision_index)
+
+        # the target paths are unique, the last attachment with the same filename wins
+        source_paths: Dict[str, str] = {}
+        for msg_path, mail in self._mails:
+            folder_path = PurePath(self.export_folder)
+            if self.subfolders:
+                folder_path /= get_export_folder_name(msg_path)
+            os.makedirs(folder_path, exist_ok=True)
+            source_paths[str(folder_path / os.path.basename(msg_path))] = msg_path
+            for attachment in mail.attachments:
+                attachment_path = attachment_paths.get(attachment.hashsum_hex)
+                if attachment_path is None:
+                    self.missing_attachments.append((msg_path, attachment))
+                else:
+                    source_paths[str(folder_path / attachment.filename)] = attachment_path
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='adps-export') as executor:
+            for is_linked, size_bytes in executor.map(
+                self._export_file, ((source_path, target_path) for target_path, source_path in source_paths.items())
+            ):
+                self.stats.files_number += 1
+                self.stats.linked_number += is_linked
+                self.stats.size_bytes += size_bytes
+
+        self.stats.messages_number += len(self._mails)
+        self._mails = []
+
+    def export(self) -> ExportStats:
+        """Exports the rest of the messages, the missing attachments are skipped and listed in missing_attachments"""
+        if self._mails:
+            self._export_batch()
+        return self.stats
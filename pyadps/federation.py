@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Search over several repositories at once, e.g. the sticks plugged in by the courier. The repositories are grouped
+by their devices and every device gets one scanning thread, so the sticks are read concurrently while the
+repositories of the same device don't compete for it. The results are merged by the message hashsum, every
+result lists the repositories which hold the message.
+"""
+import functools
+import itertools
+import os
+import os.path
+import queue
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Container, Dict, Generator, Iterable, List, Optional, Sequence, Tuple, Union
+
+from pyadps.mail import CoordsData, FileAttachment, MailFilter
+from pyadps.storage import (CopyMailsCallbackData, EstimationFileResult, FilteredMailResult, FilterMailCallbackData,
+                            Storage, TopResults, get_filter_location, get_sort_score)
+
+_TOTAL = 'total'
+_PROGRESS = 'progress'
+_RESULT = 'result'
+_ERROR = 'error'
+_DONE = 'done'
+
+
+@dataclass
+class FederatedMailResult(FilteredMailResult):
+    # the repositories holding the message, mail_path is in the first one
+    repo_folders: List[str] = field(default_factory=list)
+
+
+def group_by_device(repo_folders: Iterable[str]) -> List[List[str]]:
+    """The repositories grouped by the device of their folders (or archives) in the order of the first ones"""
+    groups: Dict[int, List[str]] = defaultdict(list)
+    for repo_folder in repo_folders:
+        groups[os.stat(repo_folder).st_dev].append(repo_folder)
+
+    return list(groups.values())
+
+
+class FederatedStorage:
+    def __init__(self, repo_folders: Sequence[str]):
+        """The same repository given twice is searched once"""
+        self.storages: Dict[str, Storage] = {}
+        for repo_folder in repo_folders:
+            self.storages.setdefault(os.path.abspath(repo_folder), Storage(repo_folder))
+
+    def _scan_device(
+        self,
+        repo_folders: List[str],
+        mail_filter: Optional[MailFilter],
+        sort_by: Optional[str],
+        limit: Optional[int],
+        sort_location: Optional[CoordsData],
+        events: queue.Queue,
+        stop_event: threading.Event,
+    ):
+        try:
+            for repo_folder in repo_folders:
+                events.put((_TOTAL, len(self.storages[repo_folder].get_message_paths())))
+
+            for repo_folder in repo_folders:
+                for filtered_mail_result in self.storages[repo_folder].filter_mails(
+                    mail_filter, lambda _: events.put((_PROGRESS,)), sort_by=sort_by, limit=limit,
+                    sort_location=sort_location,
+                ):
+                    if stop_event.is_set():
+                        return
+                    events.put((_RESULT, repo_folder, filtered_mail_result))
+        except Exception as exc:
+            events.put((_ERROR, exc))
+        finally:
+            events.put((_DONE,))
+
+    def filter_mails(
+        self,
+        mail_filter: Optional[MailFilter],
+        callback: Optional[Callable[[FilterMailCallbackData], None]] = None,
+        sort_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort_location: Optional[CoordsData] = None,
+    ) -> List[FederatedMailResult]:
+        """
+        Storage.filter_mails over every repository. The results are returned once all repositories are scanned:
+        in the order they are found or, with sort_by, in the sorted order. With the limit and without sorting
+        every repository is scanned up to `limit` results, so the other holders of a message may be missing.
+        The callback is called from the calling thread once the numbers of the messages of all repositories are
+        known.
+        """
+        if sort_by is not None and sort_location is None:
+            sort_location = get_filter_location(mail_filter)
+
+        events: queue.Queue = queue.Queue()
+        stop_event = threading.Event()
+        threads = [
+            threading.Thread(target=self._scan_device, daemon=True, args=(
+                repo_folders, mail_filter, sort_by, limit, sort_location, events, stop_event))
+            for repo_folders in group_by_device(self.storages)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # the first found result and its paths by repository for every hashsum
+        found_results: Dict[str, Tuple[FilteredMailResult, Dict[str, str]]] = {}
+        totals_number, total_messages_number, scanned_number = 0, 0, 0
+        done_number = 0
+        try:
+            while done_number < len(threads):
+                event = events.get()
+                if event[0] == _TOTAL:
+                    totals_number += 1
+                    total_messages_number += event[1]
+                elif event[0] == _PROGRESS:
+                    scanned_number += 1
+                    if callback is not None and totals_number == len(self.storages):
+                        callback(FilterMailCallbackData(scanned_number - 1, total_messages_number))
+                elif event[0] == _RESULT:
+                    _, repo_folder, filtered_mail_result = event
+                    found_result = found_results.setdefault(
+                        filtered_mail_result.mail_hashsum_hex, (filtered_mail_result, {}))
+                    found_result[1][repo_folder] = filtered_mail_result.mail_path
+                elif event[0] == _ERROR:
+                    raise event[1]
+                else:
+                    done_number += 1
+        finally:
+            stop_event.set()
+
+        results = []
+        for filtered_mail_result, mail_paths in found_results.values():
+            repo_folders = [repo_folder for repo_folder in self.storages if repo_folder in mail_paths]
+            results.append(FederatedMailResult(filtered_mail_result.mail, mail_paths[repo_folders[0]],
+                                               filtered_mail_result.mail_hashsum_hex, repo_folders))
+
+        if sort_by is None:
+            return results[:limit]
+
+        top_results = TopResults(functools.partial(get_sort_score, sort_by=sort_by, location=sort_location), limit)
+        for federated_result in results:
+            top_results.push(federated_result)
+
+        return top_results.get_sorted()  # type: ignore
+
+    def estimate_attachment_file(
+        self,
+        attachment: FileAttachment,
+        repo_folders: Sequence[str] = (),
+    ) -> EstimationFileResult:
+        """Storage.estimate_attachment_file of the first repository which has the attachment, repo_folders first"""
+        for repo_folder in itertools.chain(repo_folders, self.storages):
+            try:
+                return self.storages[repo_folder].estimate_attachment_file(attachment)
+            except FileNotFoundError:
+                continue
+
+        raise FileNotFoundError(attachment.hashsum_hex)
+
+    def iter_copy_mails(
+        self,
+        federated_results: Iterable[FederatedMailResult],
+        target_folder_path: Union[str, os.PathLike],
+        exclude_hashsums: Optional[Container[str]] = None,
+        callback: Optional[Callable[[CopyMailsCallbackData], None]] = None,
+    ) -> Generator[FederatedMailResult, None, None]:
+        """
+        Storage.iter_copy_mails over several repositories: the message is copied from the first repository
+        holding it, the attachment is taken from the repositories holding the message or, if they lack it,
+        from any other one
+        """
+        storage = next(iter(self.storages.values()))
+        yield from storage.iter_copy_mails(  # type: ignore
+            federated_results, target_folder_path, exclude_hashsums, callback,
+            estimate_attachment=lambda federated_result, attachment: self.estimate_attachment_file(
+                attachment, federated_result.repo_folders),  # type: ignore
+        )
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Integrity check of the repository: the content of every file matches the hashsum prefix of its filename, every
+attachment of the messages exists, there are no orphan attachments and no gaps in the collision suffixes
+(`get_free_file_path` stops at the first missing suffix, so the files after a gap can't be found). The files are
+hashed in parallel; nothing in the repository is written.
+"""
+import ctypes
+import ctypes.util
+import itertools
+import json
+import os
+import os.path
+import platform
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from pyadps import metrics
+from pyadps.hashing import HashsumEngine
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.storage import MessageFileTooBigError, Storage
+
+FILENAME_RE = re.compile(r'^(?P<prefix>[0-9a-f]+)(_(?P<suffix>\d{4}))?\.(?P<extension>json|bin)$')
+
+# ioprio_set isn't wrapped by libc, the syscall numbers of the common architectures
+IOPRIO_SET_SYSCALL_NUMBERS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+class FsckIssueKind:
+    BAD_FILENAME = 'BAD_FILENAME'
+    UNREADABLE = 'UNREADABLE'  # the file can't be read or the message can't be parsed
+    HASHSUM_MISMATCH = 'HASHSUM_MISMATCH'
+    MISSING_ATTACHMENT = 'MISSING_ATTACHMENT'
+    ATTACHMENT_SIZE_MISMATCH = 'ATTACHMENT_SIZE_MISMATCH'
+    ORPHAN_ATTACHMENT = 'ORPHAN_ATTACHMENT'
+    COLLISION_GAP = 'COLLISION_GAP'  # the path is the missing file
+
+
+class FsckIssue(NamedTuple):
+    kind: str
+    path: str
+    details: str
+
+
+class FsckProgress(NamedTuple):
+    checked_files_number: int
+    total_files_number: int
+    checked_bytes: int
+
+
+class FileCheckResult(NamedTuple):
+    path: str
+    stat: Tuple[int, int]  # (size, mtime_ns) of the loose files, (size, offset) of the packed messages
+    hashsum_hex: Optional[str]  # None if the file is unreadable
+    attachments: Optional[List[Tuple[str, int]]]  # (hashsum hex, size) of the attachments of the message
+    error: Optional[str]
+
+
+class _FileToCheck(NamedTuple):
+    path: str
+    stat: Tuple[int, int]
+    is_message: bool
+
+
+class FsckCheckpoint:
+    """
+    JSON lines of the checked files. A file with the same path and stat isn't hashed again by the next check,
+    so the interrupted check continues where it stopped and the repeated check hashes only the changed files.
+    """
+
+    def __init__(self, checkpoint_path: str):
+        self.checkpoint_path = checkpoint_path
+        self._file = None
+
+    def load(self) -> Dict[str, FileCheckResult]:
+        results: Dict[str, FileCheckResult] = {}
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as checkpoint_file:
+                for line in checkpoint_file:
+                    if not line.endswith('\n'):
+                        continue  # incomplete line of the interrupted check
+
+                    data = json.loads(line)
+                    results[data['path']] = FileCheckResult(
+                        path=data['path'],
+                        stat=tuple(data['stat']),  # type: ignore
+                        hashsum_hex=data['hashsum_hex'],
+                        attachments=None if data['attachments'] is None else [
+                            (hashsum_hex, size_bytes) for hashsum_hex, size_bytes in data['attachments']],
+                        error=data['error'],
+                    )
+        except FileNotFoundError:
+            pass
+
+        return results
+
+    def append(self, result: FileCheckResult):
+        if self._file is None:
+            self._file = open(self.checkpoint_path, 'a', encoding='utf-8')
+
+        self._file.write(json.dumps(result._asdict(), ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def set_low_priority() -> bool:
+    """
+    Lowers the CPU priority of the process and sets the idle I/O class on Linux, the threads started after
+    the call inherit the priority. Returns False if the I/O priority can't be changed.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+    syscall_number = IOPRIO_SET_SYSCALL_NUMBERS.get(platform.machine())
+    libc_name = ctypes.util.find_library('c')
+    if platform.system() != 'Linux' or syscall_number is None or libc_name is None:
+        return False
+
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    return libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+
+
+def _list_files(storage: Storage) -> List[_FileToCheck]:
+    files: List[_FileToCheck] = []
+    for folder, is_message in [(Storage.MESSAGES_FOLDER, True), (Storage.ATTACHMENTS_FOLDER, False)]:
+        with os.scandir(os.path.join(storage.root_dir_path, folder)) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith('.json' if is_message else '.bin'):
+                    continue
+
+                stat_result = entry.stat()
+                files.append(_FileToCheck(os.path.abspath(entry.path), (stat_result.st_size, stat_result.st_mtime_ns),
+                                          is_message))
+
+    loose_paths = {file_to_check.path for file_to_check in files}
+    messages_folder_path = os.path.abspath(os.path.join(storage.root_dir_path, Storage.MESSAGES_FOLDER))
+    for entry in storage.get_message_pack(storage.root_dir_path).get_entries().values():
+        msg_path = os.path.join(messages_folder_path, entry.filename)
+        if msg_path not in loose_paths:
+            files.append(_FileToCheck(msg_path, (entry.size_bytes, entry.offset), True))
+
+    return files
+
+
+def _is_attachment_path(path: str) -> bool:
+    return os.path.basename(os.path.dirname(path)) == Storage.ATTACHMENTS_FOLDER
+
+
+def _check_file(file_to_check: _FileToCheck, hashsum_engine: HashsumEngine) -> FileCheckResult:
+    from marshmallow import ValidationError
+
+    if not file_to_check.is_message:
+        try:
+            hashsum_hex = hashsum_engine.hash_file(file_to_check.path).hex_digest
+        except OSError as e:
+            return FileCheckResult(file_to_check.path, file_to_check.stat, None, None, str(e))
+        return FileCheckResult(file_to_check.path, file_to_check.stat, hashsum_hex, None, None)
+
+    try:
+        msg_bytes = Storage.read_message_bytes(file_to_check.path)
+    except MessageFileTooBigError:
+        return FileCheckResult(file_to_check.path, file_to_check.stat, None, None, 'the message file is too big')
+    except OSError as e:
+        return FileCheckResult(file_to_check.path, file_to_check.stat, None, None, str(e))
+
+    hashsum_hex = calculate_hashsum_hex_from_bytes(msg_bytes)
+    try:
+        mail = Storage.parse_mail(msg_bytes)
+    except (ValueError, ValidationError) as e:
+        return FileCheckResult(file_to_check.path, file_to_check.stat, hashsum_hex, None, f'invalid message: {e}')
+
+    attachments = [(attachment.hashsum_hex, attachment.size_bytes) for attachment in mail.attachments]
+    return FileCheckResult(file_to_check.path, file_to_check.stat, hashsum_hex, attachments, None)
+
+
+def _iter_file_issues(result: FileCheckResult) -> Generator[FsckIssue, None, None]:
+    if result.error is not None:
+        yield FsckIssue(FsckIssueKind.UNREADABLE, result.path, result.error)
+
+    filename_match = FILENAME_RE.match(os.path.basename(result.path))
+    if filename_match is None:
+        yield FsckIssue(FsckIssueKind.BAD_FILENAME, result.path, 'the name is not <hashsum prefix>[_NNNN].<ext>')
+    elif result.hashsum_hex is not None and not result.hashsum_hex.startswith(filename_match.group('prefix')):
+        yield FsckIssue(FsckIssueKind.HASHSUM_MISMATCH, result.path, f'the content hashsum is {result.hashsum_hex}')
+
+
+def _iter_collision_gaps(paths: Iterable[str]) -> Generator[FsckIssue, None, None]:
+    """The files of one hashsum prefix should be <prefix>.ext, <prefix>_0000.ext, <prefix>_0001.ext, ..."""
+    suffixes_by_prefix: Dict[Tuple[str, str, str], Set[int]] = defaultdict(set)
+    for path in paths:
+        filename_match = FILENAME_RE.match(os.path.basename(path))
+        if filename_match is not None:
+            suffix = filename_match.group('suffix')
+            suffixes_by_prefix[(os.path.dirname(path), filename_match.group('prefix'),
+                                filename_match.group('extension'))].add(-1 if suffix is None else int(suffix))
+
+    for (folder_path, prefix, extension), suffixes in sorted(suffixes_by_prefix.items()):
+        for suffix in range(-1, max(suffixes)):
+            if suffix not in suffixes:
+                filename = f'{prefix}.{extension}' if suffix == -1 else f'{prefix}_{suffix:04}.{extension}'
+                yield FsckIssue(FsckIssueKind.COLLISION_GAP, os.path.join(folder_path, filename),
+                                'the files with the greater suffixes are not found by the lookups')
+
+
+def check_repository(
+    storage: Storage,
+    workers: int = 1,
+    checkpoint_path: Optional[str] = None,
+    callback: Optional[Callable[[FsckProgress], None]] = None,
+) -> Generator[FsckIssue, None, None]:
+    """
+    Yields the issues of the repository: the issues of every file while the files are checked, then the missing
+    and the orphan attachments and the collision gaps. The files are read by `workers` threads.
+    """
+    files = _list_files(storage)
+    checkpoint = FsckCheckpoint(checkpoint_path) if checkpoint_path is not None else None
+    previous_results = checkpoint.load() if checkpoint is not None else {}
+
+    hashsum_engine = HashsumEngine(workers=1)  # the files are distributed over the threads by the executor
+    results: List[FileCheckResult] = []
+    checked_bytes = 0
+
+    def check_file(file_to_check: _FileToCheck) -> Tuple[FileCheckResult, bool]:
+        previous_result = previous_results.get(file_to_check.path)
+        if previous_result is not None and previous_result.stat == file_to_check.stat:
+            return previous_result, False
+
+        return _check_file(file_to_check, hashsum_engine), True
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='adps-fsck') as executor:
+            files_iter = iter(files)
+            # the batches bound the number of the pending results
+            while batch := list(itertools.islice(files_iter, workers * 16)):
+                for result, is_new in executor.map(check_file, batch):
+                    results.append(result)
+                    checked_bytes += result.stat[0]
+                    metrics.increment('fsck_files_checked')
+                    if is_new and checkpoint is not None:
+                        checkpoint.append(result)
+
+                    yield from _iter_file_issues(result)
+
+                    if callback is not None:
+                        callback(FsckProgress(len(results), len(files), checked_bytes))
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+    # the damaged attachments are reported by HASHSUM_MISMATCH, they aren't orphans and the messages refer to them
+    attachment_results, damaged_paths_by_prefix = [], {}
+    for result in results:
+        if _is_attachment_path(result.path) and result.hashsum_hex is not None:
+            filename_match = FILENAME_RE.match(os.path.basename(result.path))
+            if filename_match is None or result.hashsum_hex.startswith(filename_match.group('prefix')):
+                attachment_results.append(result)
+            else:
+                damaged_paths_by_prefix[filename_match.group('prefix')] = result.path
+    attachment_sizes = {result.hashsum_hex: result.stat[0] for result in attachment_results}
+
+    referenced_hashsums: Set[str] = set()
+    for result in results:
+        for hashsum_hex, size_bytes in result.attachments or []:
+            referenced_hashsums.add(hashsum_hex)
+            if hashsum_hex not in attachment_sizes:
+                damaged_path = damaged_paths_by_prefix.get(hashsum_hex[:Storage.HASHSUM_FILENAME_PART_LEN])
+                yield FsckIssue(FsckIssueKind.MISSING_ATTACHMENT, result.path, f'the attachment {hashsum_hex}' + (
+                    '' if damaged_path is None else f' is probably damaged {damaged_path}'))
+            elif attachment_sizes[hashsum_hex] != size_bytes:
+                yield FsckIssue(FsckIssueKind.ATTACHMENT_SIZE_MISMATCH, result.path,
+                                f'the attachment {hashsum_hex} has {attachment_sizes[hashsum_hex]} bytes, '
+                                f'the message refers to {size_bytes} bytes')
+
+    for result in attachment_results:
+        if result.hashsum_hex not in referenced_hashsums:
+            yield FsckIssue(FsckIssueKind.ORPHAN_ATTACHMENT, result.path, 'no message refers to the attachment')
+
+    yield from _iter_collision_gaps(result.path for result in results)
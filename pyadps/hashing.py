@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from io import IOBase
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, TypeVar, Union
+
+from pyadps.helpers import CalculateHashResult, calculate_hashsum, calculate_hashsum_with_mmap
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+T = TypeVar('T')
+
+MMAP_MIN_SIZE_BYTES = 64 * 1024 * 1024  # 64 MB
+
+
+class HashsumBackend:
+    READINTO = 'READINTO'  # the chunks are read into the reused buffer
+    MMAP = 'MMAP'  # the file is mapped to memory and hashed by one call
+    AUTO = 'AUTO'  # mmap for the files from MMAP_MIN_SIZE_BYTES, readinto for the smaller ones
+
+    ALL = (READINTO, MMAP, AUTO)
+
+
+class HashsumEngine:
+    """
+    Calculates sha512 of the files. sha512 of the large buffers releases the GIL, so the files of
+    `hash_files` and `hash_streams` are hashed concurrently by `workers` threads.
+    """
+
+    def __init__(self, backend: str = HashsumBackend.AUTO, workers: int = 1):
+        if backend not in HashsumBackend.ALL:
+            raise ValueError(f'Unknown hashsum backend {backend!r}')
+
+        if workers < 1:
+            raise ValueError('workers should be positive')
+
+        self.backend = backend
+        self.workers = workers
+
+        self._executor: Optional['ThreadPoolExecutor'] = None
+        self._executor_lock = threading.Lock()
+
+    def _is_mmap_used(self, stream: IOBase) -> bool:
+        if self.backend == HashsumBackend.READINTO or not hasattr(stream, 'fileno'):
+            return False
+
+        try:
+            # only the whole file can be mapped, so the stream should be at the beginning
+            if stream.tell() != 0:
+                return False
+
+            size_bytes = os.fstat(stream.fileno()).st_size
+        except (OSError, ValueError):
+            return False  # e.g. BytesIO
+
+        return self.backend == HashsumBackend.MMAP or size_bytes >= MMAP_MIN_SIZE_BYTES
+
+    def hash_stream(self, stream: IOBase) -> CalculateHashResult:
+        """Hashes the stream from the current position to the end"""
+        if self._is_mmap_used(stream):
+            return calculate_hashsum_with_mmap(stream)
+
+        return calculate_hashsum(stream)
+
+    def hash_file(self, path: Union[str, os.PathLike]) -> CalculateHashResult:
+        with open(path, 'rb', buffering=0) as file_stream:
+            return self.hash_stream(file_stream)  # type: ignore
+
+    def _map(self, func: Callable[[T], CalculateHashResult], items: Iterable[T]) -> List[CalculateHashResult]:
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            return [func(item) for item in items]
+
+        with self._executor_lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor  # the one-file commands don't need the threads
+
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='adps-hashsum')
+
+        return list(self._executor.map(func, items))
+
+    def hash_files(self, paths: Iterable[Union[str, os.PathLike]]) -> List[CalculateHashResult]:
+        """Returns the results in the order of the paths"""
+        return self._map(self.hash_file, paths)
+
+    def hash_streams(self, streams: Iterable[IOBase]) -> List[CalculateHashResult]:
+        """Returns the results in the order of the streams, every stream should be used by one thread only"""
+        return self._map(self.hash_stream, streams)
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def get_default_workers() -> int:
+    return min(4, os.cpu_count() or 1)
+
+
+_default_engine = HashsumEngine(workers=get_default_workers())
+
+
+def get_default_engine() -> HashsumEngine:
+    """The engine used by Storage and Mail.from_attachment_streams"""
+    return _default_engine
+
+
+def set_default_engine(engine: HashsumEngine) -> HashsumEngine:
+    """Replaces the default engine, returns the previous one"""
+    global _default_engine
+
+    previous_engine = _default_engine
+    _default_engine = engine
+    return previous_engine
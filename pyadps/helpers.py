@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import mmap
+import os
+import threading
 from dataclasses import dataclass
 from io import IOBase
 
+from pyadps.profiling import stage
+
+CHUNK_SIZE_BYTES = 8 * 1024 * 1024  # 8 MB
+
+_thread_buffers = threading.local()
+
 
 @dataclass
 class CalculateHashResult:
@@ -10,16 +19,89 @@ class CalculateHashResult:
     size_bytes: int
 
 
+def _get_chunk_buffer() -> memoryview:
+    """The buffer is allocated once per thread and reused by every calculate_hashsum call"""
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_buffers.buffer = memoryview(bytearray(CHUNK_SIZE_BYTES))
+
+    return buffer
+
+
+def sync_folder(folder_path: str):
+    """Makes the creations, removals and renames in the folder durable, does nothing where the folder can't be opened"""
+    try:
+        folder_fd = os.open(folder_path, os.O_RDONLY)
+    except OSError:
+        return  # Windows
+
+    try:
+        os.fsync(folder_fd)
+    except OSError:
+        pass  # the file system doesn't sync folders
+    finally:
+        os.close(folder_fd)
+
+
 def calculate_hashsum(stream: IOBase) -> CalculateHashResult:
+    if not hasattr(stream, 'readinto'):
+        return _calculate_hashsum_by_read(stream)
+
+    file_hash = hashlib.sha512()
+    filesize_bytes = 0
+    buffer = _get_chunk_buffer()
+    while True:
+        with stage('read') as read_stage:
+            chunk_size = stream.readinto(buffer)  # type: ignore
+            read_stage.add_bytes(chunk_size or 0)
+
+        if not chunk_size:
+            break
+
+        filesize_bytes += chunk_size
+        with stage('sha512'):
+            file_hash.update(buffer[:chunk_size])
+
+    return CalculateHashResult(file_hash.hexdigest(), filesize_bytes)
+
+
+def _calculate_hashsum_by_read(stream: IOBase) -> CalculateHashResult:
     file_hash = hashlib.sha512()
     filesize_bytes = 0
-    while chunk := stream.read(8 * 1024 * 1024):  # read 8 MB
+    while True:
+        with stage('read') as read_stage:
+            chunk = stream.read(CHUNK_SIZE_BYTES)
+            read_stage.add_bytes(len(chunk))
+
+        if not chunk:
+            break
+
         filesize_bytes += len(chunk)
-        file_hash.update(chunk)
+        with stage('sha512'):
+            file_hash.update(chunk)
 
     return CalculateHashResult(file_hash.hexdigest(), filesize_bytes)
 
 
+def calculate_hashsum_with_mmap(stream: IOBase) -> CalculateHashResult:
+    """Hashes the whole file of the stream mapped to memory, the stream is left at the end of the file"""
+    size_bytes = stream.seek(0, 2)
+    if size_bytes == 0:
+        return CalculateHashResult(hashlib.sha512().hexdigest(), 0)
+
+    # the pages are read by the hash function, so the read time is counted as sha512
+    with stage('sha512') as sha512_stage, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        file_hash = hashlib.sha512(mapped_file)
+        sha512_stage.add_bytes(size_bytes)
+
+    return CalculateHashResult(file_hash.hexdigest(), size_bytes)
+
+
 def calculate_hashsum_hex_from_file(path: str) -> str:
     with open(path, 'rb') as file_stream:
         return calculate_hashsum(file_stream).hex_digest
+
+
+def calculate_hashsum_hex_from_bytes(content: bytes) -> str:
+    with stage('sha512'):
+        return hashlib.sha512(content).hexdigest()
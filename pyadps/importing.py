@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import math
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pyadps.hashing import HashsumEngine, get_default_engine
+from pyadps.mail import CoordsData, FileAttachment, Mail, MailAttachmentInfo
+
+CSV_COORDS_SEPARATOR = ';'
+CSV_ATTACHMENTS_SEPARATOR = ';'
+
+
+class ManifestError(Exception):
+    pass
+
+
+@dataclass
+class ManifestRecord:
+    date_created: Optional[datetime]  # the import time is used if it is missing
+    recipient_coords: List[CoordsData]
+    name: str
+    additional_notes: Optional[str]
+    inline_message: Optional[str]
+    attachment_paths: List[str]  # absolute, the relative ones are resolved from the manifest folder
+
+
+def _parse_coords(lat: Any, lon: Any) -> CoordsData:
+    try:
+        coords = CoordsData(float(lat), float(lon))
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid coordinates {lat!r}, {lon!r}')
+
+    if not (math.isfinite(coords.lat) and -90.0 <= coords.lat <= 90.0
+            and math.isfinite(coords.lon) and -180.0 <= coords.lon <= 180.0):
+        raise ValueError(f'coordinates {coords.lat}, {coords.lon} are out of range')
+
+    return coords
+
+
+def _parse_record(data: Dict[str, Any], base_folder: str) -> ManifestRecord:
+    """data contains the JSON values, the coordinates are already converted to the list of (lat, lon) pairs"""
+    name = data.get('name')
+    if not isinstance(name, str) or not name:
+        raise ValueError('name is required')
+
+    date_created = None
+    if data.get('date_created'):
+        if not isinstance(data['date_created'], str):
+            raise ValueError('date_created should be an ISO 8601 string')
+        date_created = datetime.fromisoformat(data['date_created'])
+
+    recipient_coords = [_parse_coords(lat, lon) for lat, lon in data.get('recipient_coords') or []]
+    if not recipient_coords:
+        raise ValueError('at least one recipient coordinate is required')
+
+    for field_name in ['additional_notes', 'inline_message']:
+        if data.get(field_name) is not None and not isinstance(data[field_name], str):
+            raise ValueError(f'{field_name} should be a string')
+
+    attachment_paths = []
+    for attachment_path in data.get('attachments') or []:
+        attachment_path = os.path.abspath(os.path.join(base_folder, attachment_path))
+        if not os.path.isfile(attachment_path):
+            raise ValueError(f'attachment {attachment_path!r} is not found')
+        attachment_paths.append(attachment_path)
+
+    return ManifestRecord(
+        date_created=date_created,
+        recipient_coords=recipient_coords,
+        name=name,
+        additional_notes=data.get('additional_notes') or None,
+        inline_message=data.get('inline_message') or None,
+        attachment_paths=attachment_paths,
+    )
+
+
+def _convert_csv_row(row: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """
+    Columns: name, recipient_coords ("lat,lon" pairs divided by ";"), date_created, additional_notes,
+    inline_message, attachments (paths divided by ";"). Only name and recipient_coords are required.
+    """
+    recipient_coords = []
+    for coords_str in (row.get('recipient_coords') or '').split(CSV_COORDS_SEPARATOR):
+        if coords_str.strip():
+            lat, _, lon = coords_str.partition(',')
+            recipient_coords.append((lat.strip(), lon.strip()))
+
+    attachments = [
+        attachment_path.strip()
+        for attachment_path in (row.get('attachments') or '').split(CSV_ATTACHMENTS_SEPARATOR)
+        if attachment_path.strip()
+    ]
+    return {**row, 'recipient_coords': recipient_coords, 'attachments': attachments}
+
+
+def _convert_json_line(line: str) -> Dict[str, Any]:
+    """One object per line in the format of the message file, but the attachments are the paths of the files"""
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError('the line should contain an object')
+
+    recipient_coords = data.get('recipient_coords') or []
+    if not isinstance(recipient_coords, list) or not all(isinstance(coords, dict) for coords in recipient_coords):
+        raise ValueError('recipient_coords should be a list of objects with lat and lon')
+
+    attachments = data.get('attachments') or []
+    if not isinstance(attachments, list) or not all(isinstance(path, str) for path in attachments):
+        raise ValueError('attachments should be a list of paths')
+
+    return {**data, 'recipient_coords': [(coords.get('lat'), coords.get('lon')) for coords in recipient_coords]}
+
+
+def read_manifest(manifest_path: str) -> List[ManifestRecord]:
+    """Reads the CSV manifest (*.csv) or the JSON lines one (any other extension)"""
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    is_csv = manifest_path.lower().endswith('.csv')
+
+    records: List[ManifestRecord] = []
+    with open(manifest_path, newline='' if is_csv else None, encoding='utf-8') as manifest_file:
+        rows: Iterable[Tuple[int, Any]]
+        if is_csv:
+            reader = csv.DictReader(manifest_file)
+            rows = ((reader.line_num, row) for row in reader)
+            convert: Callable[[Any], Dict[str, Any]] = _convert_csv_row
+        else:
+            rows = ((line_number, line) for line_number, line in enumerate(manifest_file, start=1) if line.strip())
+            convert = _convert_json_line
+
+        line_number = 0
+        try:
+            for line_number, row in rows:
+                records.append(_parse_record(convert(row), base_folder))
+        except (ValueError, csv.Error) as e:
+            raise ManifestError(f'{manifest_path}, line {line_number}: {e}') from e
+
+    return records
+
+
+def build_mails(
+    records: List[ManifestRecord],
+    hashsum_engine: Optional[HashsumEngine] = None,
+) -> List[Tuple[Mail, List[MailAttachmentInfo]]]:
+    """
+    Creates the messages of the manifest for `Storage.save_mails`. Every attachment file is hashed once even if
+    many records refer to it, the files are hashed concurrently by the engine.
+    """
+    hashsum_engine = hashsum_engine or get_default_engine()
+    attachment_paths = list(dict.fromkeys(path for record in records for path in record.attachment_paths))
+    hashsum_by_path = dict(zip(attachment_paths, hashsum_engine.hash_files(attachment_paths)))
+
+    date_created = datetime.now()
+    result = []
+    for record in records:
+        attachments: List[FileAttachment] = []
+        attachment_infos: List[MailAttachmentInfo] = []
+        for attachment_path in record.attachment_paths:
+            hashsum = hashsum_by_path[attachment_path]
+            attachments.append(FileAttachment(os.path.basename(attachment_path), hashsum.size_bytes,
+                                              hashsum.hex_digest))
+            attachment_infos.append(MailAttachmentInfo(attachment_path, hashsum.hex_digest))
+
+        result.append((Mail(
+            date_created=record.date_created or date_created,
+            recipient_coords=record.recipient_coords,
+            name=record.name,
+            additional_notes=record.additional_notes,
+            inline_message=record.inline_message,
+            attachments=attachments,
+        ), attachment_infos))
+
+    return result
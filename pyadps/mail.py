@@ -1,17 +1,61 @@
 # -*- coding: utf-8 -*-
+import math
 import os.path
-from dataclasses import dataclass
+import re
+import threading
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from io import FileIO
 from random import random
-from typing import (BinaryIO, ClassVar, List, NamedTuple, Optional, Tuple,
-                    Type, Union)
+from typing import TYPE_CHECKING, BinaryIO, ClassVar, Iterable, List, NamedTuple, Optional, Tuple, Type, Union
 
-import geopy.distance
-from marshmallow import Schema as MarshmallowSchema
-from marshmallow_dataclass import add_schema
+from pyadps.hashing import get_default_engine
+from pyadps.profiling import stage
 
-from pyadps.helpers import calculate_hashsum
+if TYPE_CHECKING:
+    import numpy as np
+    from marshmallow import Schema as MarshmallowSchema
+
+    from pyadps.table import MailTable
+
+
+class LazySchema:
+    """
+    Class attribute building the marshmallow schema of the dataclass on the first access, it replaces itself
+    with the schema class then. marshmallow and geopy take most of the CLI startup time, so they are imported
+    only when needed.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.RLock()
+        self._is_building = False
+
+    def __get__(self, instance, owner: type) -> Optional[Type['MarshmallowSchema']]:
+        with self._lock:
+            if self._is_building:
+                return None  # class_schema processes the dataclass again and reads its class attributes
+
+            current_value = owner.__dict__.get(self.name)
+            if current_value is not self:
+                return current_value  # built by another thread
+
+            from marshmallow_dataclass import class_schema
+
+            self._is_building = True
+            try:
+                schema_class = class_schema(owner)
+            finally:
+                self._is_building = False
+
+            setattr(owner, self.name, schema_class)
+            return schema_class
+
+
+def get_distance_meters(coords_1: Tuple[float, float], coords_2: Tuple[float, float]) -> float:
+    import geopy.distance
+
+    return geopy.distance.distance(coords_1, coords_2).m
 
 
 class MailAttachmentInfo(NamedTuple):
@@ -48,7 +92,7 @@ class Mail:
     version: str = '1.0'
     min_version: str = '1.0'
 
-    Schema: ClassVar[Type[MarshmallowSchema]] = None
+    Schema: ClassVar[Type['MarshmallowSchema']] = None  # type: ignore
 
     @classmethod
     def from_attachment_streams(
@@ -58,13 +102,13 @@ class Mail:
         name: str,
         additional_notes: Optional[str],
         inline_message: Optional[str],
-        files: List[Union[FileIO, BinaryIO]]
+        files: Iterable[Union[FileIO, BinaryIO]]
     ) -> Tuple['Mail', List[MailAttachmentInfo]]:
+        files = list(files)  # zipped with their hashsums, so a generator must not be iterated twice
         attachments: List[FileAttachment] = []
         attachment_infos: List[MailAttachmentInfo] = []
-        for file_io in files:
+        for file_io, hashsum in zip(files, get_default_engine().hash_streams(files)):  # type: ignore
             file_name = os.path.basename(file_io.name)
-            hashsum = calculate_hashsum(file_io)
             attachments.append(FileAttachment(file_name, hashsum.size_bytes, hashsum.hex_digest))
             attachment_infos.append(MailAttachmentInfo(file_io.name, hashsum.hex_digest))
 
@@ -78,7 +122,100 @@ class Mail:
         ), attachment_infos
 
 
-add_schema(Mail)
+Mail.Schema = LazySchema('Schema')  # type: ignore
+
+MAIL_FIELDS = frozenset(['date_created', 'recipient_coords', 'name', 'additional_notes', 'inline_message',
+                         'attachments', 'version', 'min_version'])
+COORDS_FIELDS = frozenset(['lat', 'lon'])
+FILE_ATTACHMENT_FIELDS = frozenset(['filename', 'size_bytes', 'hashsum_hex', 'hashsum_alg'])
+# naive datetimes as written by datetime.isoformat, parsed by datetime.fromisoformat in every python version
+ISO_DATETIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{3}|\.\d{6})?$')
+
+
+def _is_finite_number(value) -> bool:
+    return type(value) in (float, int) and math.isfinite(value)
+
+
+def _load_canonical_mail_dict(data) -> Optional[Mail]:
+    """Returns None if the dict isn't in the form Storage writes the messages"""
+    if type(data) is not dict or data.keys() != MAIL_FIELDS:
+        return None
+
+    date_created = data['date_created']
+    if type(date_created) is not str or ISO_DATETIME_RE.match(date_created) is None:
+        return None
+
+    recipient_coords = []
+    if type(data['recipient_coords']) is not list:
+        return None
+    for coords in data['recipient_coords']:
+        if (type(coords) is not dict or coords.keys() != COORDS_FIELDS
+                or not _is_finite_number(coords['lat']) or not _is_finite_number(coords['lon'])):
+            return None
+        recipient_coords.append(CoordsData(float(coords['lat']), float(coords['lon'])))
+
+    attachments = []
+    if type(data['attachments']) is not list:
+        return None
+    for attachment in data['attachments']:
+        if (type(attachment) is not dict or attachment.keys() != FILE_ATTACHMENT_FIELDS
+                or type(attachment['filename']) is not str or type(attachment['size_bytes']) is not int
+                or type(attachment['hashsum_hex']) is not str or type(attachment['hashsum_alg']) is not str):
+            return None
+        attachments.append(FileAttachment(
+            attachment['filename'], attachment['size_bytes'], attachment['hashsum_hex'], attachment['hashsum_alg']))
+
+    if (type(data['name']) is not str
+            or (data['additional_notes'] is not None and type(data['additional_notes']) is not str)
+            or (data['inline_message'] is not None and type(data['inline_message']) is not str)
+            or type(data['version']) is not str or type(data['min_version']) is not str):
+        return None
+
+    return Mail(
+        date_created=datetime.fromisoformat(date_created),
+        recipient_coords=recipient_coords,
+        name=data['name'],
+        additional_notes=data['additional_notes'],
+        inline_message=data['inline_message'],
+        attachments=attachments,
+        version=data['version'],
+        min_version=data['min_version'],
+    )
+
+
+def load_mail_dict(data) -> Mail:
+    """
+    Same as Mail.Schema().load(data). The messages in the form Storage writes them are converted directly,
+    the others (missing optional fields, numbers in strings, timezones, unknown fields, ...) go through
+    the marshmallow schema, so the results and the validation errors don't change.
+    """
+    mail = _load_canonical_mail_dict(data)
+    if mail is None:
+        return Mail.Schema().load(data)
+
+    return mail
+
+
+def dump_mail_dict(mail: Mail) -> dict:
+    """Same as Mail.Schema().dump(mail) without building the marshmallow schema"""
+    return {
+        'date_created': mail.date_created.isoformat(),
+        'recipient_coords': [{'lat': float(coords.lat), 'lon': float(coords.lon)} for coords in mail.recipient_coords],
+        'name': mail.name,
+        'additional_notes': mail.additional_notes,
+        'inline_message': mail.inline_message,
+        'attachments': [
+            {
+                'filename': attachment.filename,
+                'size_bytes': int(attachment.size_bytes),
+                'hashsum_hex': attachment.hashsum_hex,
+                'hashsum_alg': attachment.hashsum_alg,
+            }
+            for attachment in mail.attachments
+        ],
+        'version': mail.version,
+        'min_version': mail.min_version,
+    }
 
 
 @dataclass
@@ -93,11 +230,12 @@ class LocationFilterData:
     radius_meters: float
 
     def is_inside(self, msg_coords: List[CoordsData]):
-        for coord in msg_coords:
-            distance = geopy.distance.distance(coord.to_tuple(), self.location.to_tuple()).m
+        with stage('geodesic'):
+            for coord in msg_coords:
+                distance = get_distance_meters(coord.to_tuple(), self.location.to_tuple())
 
-            if distance < self.radius_meters:
-                return True
+                if distance < self.radius_meters:
+                    return True
 
         return False
 
@@ -113,13 +251,14 @@ class DampingDistanceFilterData:
         return random() < probability
 
     def is_inside(self, msg_coords: List[CoordsData]):
-        for coord in msg_coords:
-            distance = geopy.distance.distance(coord.to_tuple(), self.location.to_tuple()).m
+        with stage('geodesic'):
+            for coord in msg_coords:
+                distance = get_distance_meters(coord.to_tuple(), self.location.to_tuple())
 
-            probability = 2 ** (-distance / self.base_distance_meters)
+                probability = 2 ** (-distance / self.base_distance_meters)
 
-            if probability > self.threshold_probability and self._is_matched_with_probability(probability):
-                return True
+                if probability > self.threshold_probability and self._is_matched_with_probability(probability):
+                    return True
 
         return False
 
@@ -155,6 +294,10 @@ class MailFilter:
     damping_distance_filter: Optional[DampingDistanceFilterData] = None
 
     def filter_func(self, mail: Mail) -> bool:
+        with stage('filter'):
+            return self._filter_func(mail)
+
+    def _filter_func(self, mail: Mail) -> bool:
         if self.datetime_created_range_filter is not None:
             if (self.datetime_created_range_filter.date_from is not None
                     and mail.date_created < self.datetime_created_range_filter.date_from):
@@ -203,3 +346,50 @@ class MailFilter:
                 return False
 
         return True
+
+    def filter_table(self, table: 'MailTable', rng: Optional['np.random.Generator'] = None) -> 'np.ndarray':
+        """Vectorized filter_func over the table (requires numpy), returns the boolean mask of the matched messages"""
+        from pyadps.table import filter_table
+        return filter_table(self, table, rng)
+
+
+def dump_mail_filter_dict(mail_filter: MailFilter) -> dict:
+    """JSON-compatible form of the filter for `load_mail_filter_dict`, the datetimes are ISO 8601 strings"""
+    data = asdict(mail_filter)
+    datetime_filter = data['datetime_created_range_filter']
+    if datetime_filter is not None:
+        for field_name in ['date_from', 'date_to']:
+            if datetime_filter[field_name] is not None:
+                datetime_filter[field_name] = datetime_filter[field_name].isoformat()
+
+    return data
+
+
+def load_mail_filter_dict(data: dict) -> MailFilter:
+    def load_datetime(value: Optional[str]) -> Optional[datetime]:
+        return None if value is None else datetime.fromisoformat(value)
+
+    def load_location(value: dict) -> CoordsData:
+        return CoordsData(float(value['lat']), float(value['lon']))
+
+    loaders = {
+        'datetime_created_range_filter': lambda value: DatetimeCreatedRangeFilterData(
+            load_datetime(value.get('date_from')), load_datetime(value.get('date_to'))),
+        'location_filter': lambda value: LocationFilterData(
+            load_location(value['location']), float(value['radius_meters'])),
+        'name_filter': lambda value: NameFilterData(value['name']),
+        'additional_notes_filter': lambda value: AdditionalNotesFilterData(value['additional_notes']),
+        'inline_message_filter': lambda value: InlineMessageFilterData(value['inline_message']),
+        'attachment_filter': lambda value: AttachmentFilterData(value['hashsum']),
+        'damping_distance_filter': lambda value: DampingDistanceFilterData(
+            load_location(value['location']), float(value['base_distance_meters']),
+            float(value.get('threshold_probability', 0.05))),
+    }
+    unknown_names = set(data) - set(loaders)
+    if unknown_names:
+        raise ValueError(f'Unknown filters: {", ".join(sorted(unknown_names))}')
+
+    return MailFilter(**{
+        name: None if data.get(name) is None else loader(data[name])  # type: ignore
+        for name, loader in loaders.items()
+    })
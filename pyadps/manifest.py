@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Manifests are compact summaries of the hashsums of the messages and attachments of a repository. The node which
+receives the manifest of another node copies only the files the other node lacks. The manifest is the header
+(magic, version, mode, number of hashsums) followed by the body of the mode:
+
+* EXACT: the sorted first EXACT_PREFIX_BYTES bytes of every sha512 digest, the lookup is the binary search.
+* BLOOM: the Bloom filter (number of bits, number of hash functions, bits). The digests are uniformly distributed
+  already, so the bit positions are derived from the digest by double hashing without hashing it again.
+  A false positive means the file is thought to exist on the other node and is not copied.
+"""
+import bisect
+import math
+import os
+import os.path
+import struct
+from pathlib import PurePath
+from typing import Collection, Iterable, List, Set
+
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.storage import Storage
+
+MANIFEST_MAGIC = b'ADPSMNFT'
+MANIFEST_VERSION = 1
+MANIFEST_HEADER = struct.Struct('>8sHcQ')  # magic, version, mode, number of hashsums
+BLOOM_HEADER = struct.Struct('>QB')  # number of bits, number of hash functions
+EXACT_PREFIX_BYTES = 8
+DIGEST_PREFIX_BYTES = 16  # enough for the exact prefixes and the double hashing of the Bloom filter
+DEFAULT_FALSE_POSITIVE_RATE = 0.001
+
+
+class ManifestError(Exception):
+    pass
+
+
+class ManifestMode:
+    EXACT = 'EXACT'
+    BLOOM = 'BLOOM'
+
+    ALL = (EXACT, BLOOM)
+
+
+_MODE_CODES = {ManifestMode.EXACT: b'E', ManifestMode.BLOOM: b'B'}
+
+
+def _get_digest_prefix(hashsum_hex: str) -> bytes:
+    return bytes.fromhex(hashsum_hex[:DIGEST_PREFIX_BYTES * 2])
+
+
+class Manifest:
+    mode: str
+
+    def __init__(self, hashsums_number: int):
+        self.hashsums_number = hashsums_number
+
+    def __len__(self) -> int:
+        return self.hashsums_number
+
+    def __contains__(self, hashsum_hex: object) -> bool:
+        return isinstance(hashsum_hex, str) and self.contains_digest_prefix(_get_digest_prefix(hashsum_hex))
+
+    def contains_digest_prefix(self, digest_prefix: bytes) -> bool:
+        raise NotImplementedError()
+
+    def dump_body(self) -> bytes:
+        raise NotImplementedError()
+
+    def dump(self) -> bytes:
+        header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, _MODE_CODES[self.mode], self.hashsums_number)
+        return header + self.dump_body()
+
+
+class ExactManifest(Manifest):
+    mode = ManifestMode.EXACT
+
+    def __init__(self, prefixes: List[bytes]):
+        """prefixes are sorted EXACT_PREFIX_BYTES of the digests"""
+        super().__init__(len(prefixes))
+        self.prefixes = prefixes
+
+    @classmethod
+    def from_digest_prefixes(cls, digest_prefixes: Iterable[bytes]) -> 'ExactManifest':
+        return cls(sorted({digest_prefix[:EXACT_PREFIX_BYTES] for digest_prefix in digest_prefixes}))
+
+    @classmethod
+    def load_body(cls, body: bytes, hashsums_number: int) -> 'ExactManifest':
+        if len(body) != hashsums_number * EXACT_PREFIX_BYTES:
+            raise ManifestError('the manifest is truncated')
+
+        return cls([body[idx:idx + EXACT_PREFIX_BYTES] for idx in range(0, len(body), EXACT_PREFIX_BYTES)])
+
+    def contains_digest_prefix(self, digest_prefix: bytes) -> bool:
+        prefix = digest_prefix[:EXACT_PREFIX_BYTES]
+        idx = bisect.bisect_left(self.prefixes, prefix)
+        return idx < len(self.prefixes) and self.prefixes[idx] == prefix
+
+    def dump_body(self) -> bytes:
+        return b''.join(self.prefixes)
+
+
+class BloomManifest(Manifest):
+    mode = ManifestMode.BLOOM
+
+    def __init__(self, hashsums_number: int, bits_number: int, hashes_number: int, bits: bytearray):
+        super().__init__(hashsums_number)
+        self.bits_number = bits_number
+        self.hashes_number = hashes_number
+        self.bits = bits
+
+    @classmethod
+    def create(cls, hashsums_number: int, false_positive_rate: float) -> 'BloomManifest':
+        """The optimal size and number of hash functions for the expected number of the hashsums"""
+        bits_number = max(8, math.ceil(-max(hashsums_number, 1) * math.log(false_positive_rate) / math.log(2) ** 2))
+        hashes_number = max(1, round(bits_number / max(hashsums_number, 1) * math.log(2)))
+        return cls(0, bits_number, hashes_number, bytearray((bits_number + 7) // 8))
+
+    @classmethod
+    def from_digest_prefixes(cls, digest_prefixes: Collection[bytes], false_positive_rate: float) -> 'BloomManifest':
+        manifest = cls.create(len(digest_prefixes), false_positive_rate)
+        for digest_prefix in digest_prefixes:
+            manifest.add_digest_prefix(digest_prefix)
+
+        return manifest
+
+    @classmethod
+    def load_body(cls, body: bytes, hashsums_number: int) -> 'BloomManifest':
+        if len(body) < BLOOM_HEADER.size:
+            raise ManifestError('the manifest is truncated')
+
+        bits_number, hashes_number = BLOOM_HEADER.unpack_from(body)
+        bits = bytearray(body[BLOOM_HEADER.size:])
+        if len(bits) != (bits_number + 7) // 8:
+            raise ManifestError('the manifest is truncated')
+
+        return cls(hashsums_number, bits_number, hashes_number, bits)
+
+    def _iter_bit_positions(self, digest_prefix: bytes) -> Iterable[int]:
+        first_hash = int.from_bytes(digest_prefix[:8], 'big')
+        second_hash = int.from_bytes(digest_prefix[8:16], 'big') | 1
+        for idx in range(self.hashes_number):
+            yield (first_hash + idx * second_hash) % self.bits_number
+
+    def add_digest_prefix(self, digest_prefix: bytes):
+        for position in self._iter_bit_positions(digest_prefix):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.hashsums_number += 1
+
+    def contains_digest_prefix(self, digest_prefix: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._iter_bit_positions(digest_prefix))
+
+    def dump_body(self) -> bytes:
+        return BLOOM_HEADER.pack(self.bits_number, self.hashes_number) + bytes(self.bits)
+
+
+def collect_digest_prefixes(storage: Storage) -> Set[bytes]:
+    """
+    The digest prefixes of all messages and of the attachments the messages refer to. The attachment files aren't
+    read, the attachment is counted if the attachments folder has a file with its filename prefix.
+    """
+    attachments_folder_path = PurePath(storage.root_dir_path) / storage.ATTACHMENTS_FOLDER
+    attachment_filename_prefixes = {
+        filename[:storage.HASHSUM_FILENAME_PART_LEN]
+        for filename in (os.listdir(attachments_folder_path) if os.path.isdir(attachments_folder_path) else [])
+        if filename.endswith('.bin')
+    }
+
+    digest_prefixes = set()
+    for _, _, _, msg_bytes in storage.iter_messages_bytes():
+        digest_prefixes.add(_get_digest_prefix(calculate_hashsum_hex_from_bytes(msg_bytes)))
+        for attachment in storage.parse_mail(msg_bytes).attachments:
+            if attachment.hashsum_hex[:storage.HASHSUM_FILENAME_PART_LEN] in attachment_filename_prefixes:
+                digest_prefixes.add(_get_digest_prefix(attachment.hashsum_hex))
+
+    return digest_prefixes
+
+
+def build_manifest(
+    storage: Storage,
+    mode: str = ManifestMode.EXACT,
+    false_positive_rate: float = DEFAULT_FALSE_POSITIVE_RATE,
+) -> Manifest:
+    digest_prefixes = collect_digest_prefixes(storage)
+    if mode == ManifestMode.BLOOM:
+        return BloomManifest.from_digest_prefixes(digest_prefixes, false_positive_rate)
+
+    return ExactManifest.from_digest_prefixes(digest_prefixes)
+
+
+def write_manifest(manifest: Manifest, manifest_path: str):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as manifest_file:
+        manifest_file.write(manifest.dump())
+    os.replace(tmp_path, manifest_path)
+
+
+def load_manifest(manifest_path: str) -> Manifest:
+    with open(manifest_path, 'rb') as manifest_file:
+        manifest_bytes = manifest_file.read()
+
+    if len(manifest_bytes) < MANIFEST_HEADER.size:
+        raise ManifestError('the file is not a manifest')
+
+    magic, version, mode_code, hashsums_number = MANIFEST_HEADER.unpack_from(manifest_bytes)
+    if magic != MANIFEST_MAGIC:
+        raise ManifestError('the file is not a manifest')
+    if version != MANIFEST_VERSION:
+        raise ManifestError(f'unsupported manifest version {version}')
+
+    body = manifest_bytes[MANIFEST_HEADER.size:]
+    if mode_code == _MODE_CODES[ManifestMode.EXACT]:
+        manifest: Manifest = ExactManifest.load_body(body, hashsums_number)
+    elif mode_code == _MODE_CODES[ManifestMode.BLOOM]:
+        manifest = BloomManifest.load_body(body, hashsums_number)
+    else:
+        raise ManifestError(f'unknown manifest mode {mode_code!r}')
+
+    return manifest
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Generator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+HISTOGRAM_BUCKETS: Dict[str, Sequence[float]] = {
+    'collision_depth': (0, 1, 2, 5, 10, 100, 1000, 10000),
+    'attachment_lookup_candidates': (1, 2, 5, 10, 100, 1000, 10000),
+}
+
+
+@dataclass
+class Histogram:
+    buckets: Sequence[float]
+    bucket_counts: List[int]  # not cumulative, the last one counts the values above the last bucket
+    sum: float = 0.0
+    count: int = 0
+
+    @classmethod
+    def create(cls, buckets: Sequence[float]) -> 'Histogram':
+        return cls(list(buckets), [0] * (len(buckets) + 1))
+
+    def observe(self, value: float):
+        for idx, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[idx] += 1
+                break
+        else:
+            self.bucket_counts[-1] += 1
+
+        self.sum += value
+        self.count += 1
+
+
+@dataclass
+class MetricsReport:
+    command: Optional[str]
+    started_at: float  # seconds since the epoch
+    duration_seconds: float
+    counters: Dict[str, float] = field(default_factory=dict)
+    histograms: Dict[str, Histogram] = field(default_factory=dict)
+
+    def _get_ratio(self, numerator_name: str, denominator_name: str, multiplier: float = 1.0) -> Optional[float]:
+        denominator = self.counters.get(denominator_name, 0)
+        if not denominator:
+            return None
+
+        return self.counters.get(numerator_name, 0) * multiplier / denominator
+
+    def get_rates(self) -> Dict[str, float]:
+        rates = {
+            'messages_scanned_per_second': self._get_ratio('messages_scanned', 'scan_seconds'),
+            'copied_megabytes_per_second': self._get_ratio('copied_bytes', 'copy_seconds', 1 / 1024 ** 2),
+            'hashsum_cache_hit_ratio': self._get_ratio('hashsum_cache_hits', 'hashsum_lookups'),
+        }
+        return {name: value for name, value in rates.items() if value is not None}
+
+
+class MetricsSink:
+    """Receives the metrics of the finished operation, subclasses write them somewhere"""
+
+    def write(self, report: MetricsReport):
+        raise NotImplementedError()
+
+
+class JsonLinesMetricsSink(MetricsSink):
+    """Appends one JSON object per operation to the file"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, report: MetricsReport):
+        record = asdict(report)
+        record['rates'] = report.get_rates()
+        with open(self.path, 'a') as output_file:
+            output_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class PrometheusTextfileSink(MetricsSink):
+    """
+    Writes the file for the textfile collector of node_exporter. Counters and histograms are accumulated
+    with the values of the previous file, so they grow across the runs; the rates describe the last run.
+    The file is replaced atomically, the concurrent runs may lose each other's increments.
+    """
+    PREFIX = 'adps_'
+    SAMPLE_RE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?P<labels>\{[^}]*\})? (?P<value>\S+)$')
+    TYPE_RE = re.compile(r'^# TYPE (?P<name>\S+) (?P<type>\S+)$')
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read_previous(self) -> Tuple[Dict[str, str], Dict[str, float]]:
+        metric_types: Dict[str, str] = {}
+        samples: Dict[str, float] = {}
+        try:
+            with open(self.path) as input_file:
+                for line in input_file:
+                    line = line.rstrip('\n')
+                    type_match = self.TYPE_RE.match(line)
+                    if type_match is not None:
+                        metric_types[type_match['name']] = type_match['type']
+                        continue
+
+                    sample_match = self.SAMPLE_RE.match(line)
+                    if sample_match is not None:
+                        samples[sample_match['name'] + (sample_match['labels'] or '')] = float(sample_match['value'])
+        except FileNotFoundError:
+            pass
+
+        return metric_types, samples
+
+    def write(self, report: MetricsReport):
+        metric_types, samples = self._read_previous()
+
+        for name, value in report.counters.items():
+            metric_name = f'{self.PREFIX}{name}_total'
+            metric_types[metric_name] = 'counter'
+            samples[metric_name] = samples.get(metric_name, 0.0) + value
+
+        for name, histogram in report.histograms.items():
+            metric_name = f'{self.PREFIX}{name}'
+            metric_types[metric_name] = 'histogram'
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip([*histogram.buckets, '+Inf'], histogram.bucket_counts):
+                cumulative_count += bucket_count
+                sample_name = f'{metric_name}_bucket{{le="{upper_bound}"}}'
+                samples[sample_name] = samples.get(sample_name, 0.0) + cumulative_count
+            for suffix, value in [('_sum', histogram.sum), ('_count', histogram.count)]:
+                samples[metric_name + suffix] = samples.get(metric_name + suffix, 0.0) + value
+
+        # the rates of the previous run are dropped, they may be absent in this one
+        for metric_name in [name for name, type_ in metric_types.items() if type_ == 'gauge']:
+            del metric_types[metric_name]
+            samples.pop(metric_name, None)
+
+        last_run_gauges = {
+            'last_run_timestamp_seconds': report.started_at,
+            'last_run_duration_seconds': report.duration_seconds,
+            **{f'last_run_{name}': value for name, value in report.get_rates().items()},
+        }
+        for name, value in last_run_gauges.items():
+            metric_types[f'{self.PREFIX}{name}'] = 'gauge'
+            samples[f'{self.PREFIX}{name}'] = value
+
+        lines = []
+        for metric_name, metric_type in sorted(metric_types.items()):
+            lines.append(f'# TYPE {metric_name} {metric_type}')
+            lines.extend(
+                f'{sample_name} {value!r}' for sample_name, value in samples.items()
+                if self._get_metric_name(sample_name, metric_type) == metric_name
+            )
+
+        # the collector may read the file at any moment, so it is replaced by the complete one
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as output_file:
+            output_file.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _get_metric_name(sample_name: str, metric_type: str) -> str:
+        sample_name = sample_name.partition('{')[0]
+        if metric_type == 'histogram':
+            for suffix in ['_bucket', '_sum', '_count']:
+                if sample_name.endswith(suffix):
+                    return sample_name[:-len(suffix)]
+
+        return sample_name
+
+
+def get_metrics_sink(path: str) -> MetricsSink:
+    """The Prometheus textfile sink for *.prom files, the JSON lines sink for the others"""
+    if path.endswith('.prom'):
+        return PrometheusTextfileSink(path)
+
+    return JsonLinesMetricsSink(path)
+
+
+class MetricsRecorder:
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram.create(HISTOGRAM_BUCKETS.get(name, DEFAULT_BUCKETS))
+
+            histogram.observe(value)
+
+
+_active_recorder: Optional[MetricsRecorder] = None
+
+
+def increment(name: str, value: float = 1):
+    """Increments the counter of the active `collect_metrics` context, does nothing outside of it"""
+    if _active_recorder is not None:
+        _active_recorder.increment(name, value)
+
+
+def observe(name: str, value: float):
+    """Adds the value to the histogram of the active `collect_metrics` context, does nothing outside of it"""
+    if _active_recorder is not None:
+        _active_recorder.observe(name, value)
+
+
+def is_enabled() -> bool:
+    return _active_recorder is not None
+
+
+@contextmanager
+def collect_metrics(
+    sinks: Sequence[MetricsSink],
+    command: Optional[str] = None,
+) -> Generator[MetricsRecorder, None, None]:
+    """Collects the metrics emitted by the storage operations in the context and writes them to the sinks at exit"""
+    global _active_recorder
+
+    previous_recorder = _active_recorder
+    recorder = MetricsRecorder()
+    _active_recorder = recorder
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield recorder
+    finally:
+        _active_recorder = previous_recorder
+        report = MetricsReport(
+            command=command,
+            started_at=started_at,
+            duration_seconds=time.perf_counter() - start,
+            counters=dict(recorder.counters),
+            histograms=dict(recorder.histograms),
+        )
+        for sink in sinks:
+            sink.write(report)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import os.path
+from typing import BinaryIO, Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple
+
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.profiling import stage
+
+
+class PackIndexEntry(NamedTuple):
+    filename: str
+    offset: int
+    size_bytes: int
+    hashsum_hex: str
+
+
+class MessagePack:
+    """
+    Append-only pack of message files. The pack file is the plain concatenation of the message files,
+    the index file contains one line "<filename> <offset> <size_bytes> <hashsum_hex>" per message (the fields are
+    split from the right, the filename may contain spaces).
+    Data is always written to the pack before the index line, so an interrupted append leaves
+    only unreferenced bytes in the pack and at most one incomplete index line, both are ignored.
+    """
+
+    def __init__(self, pack_path: str, index_path: str):
+        self.pack_path = pack_path
+        self.index_path = index_path
+
+        self._entries: Dict[str, PackIndexEntry] = {}
+        self._index_stat: Optional[Tuple[int, int]] = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.index_path)
+
+    def get_entries(self) -> Dict[str, PackIndexEntry]:
+        """Returns the entries by filename ordered by the offset in the pack file"""
+        try:
+            stat_result = os.stat(self.index_path)
+        except (FileNotFoundError, NotADirectoryError):  # NotADirectoryError: the repository is an archive
+            self._entries, self._index_stat = {}, None
+            return self._entries
+
+        index_stat = (stat_result.st_size, stat_result.st_mtime_ns)
+        if index_stat != self._index_stat:
+            self._entries = self._read_index()
+            self._index_stat = index_stat
+
+        return self._entries
+
+    def _read_index(self) -> Dict[str, PackIndexEntry]:
+        entries: Dict[str, PackIndexEntry] = {}
+        with open(self.index_path) as index_file:
+            for line in index_file:
+                if not line.endswith('\n'):
+                    continue  # incomplete line of the interrupted append
+
+                filename, offset, size_bytes, hashsum_hex = line.rstrip('\n').rsplit(' ', 3)
+                entries[filename] = PackIndexEntry(filename, int(offset), int(size_bytes), hashsum_hex)
+
+        return dict(sorted(entries.items(), key=lambda item: item[1].offset))
+
+    def read(self, entry: PackIndexEntry) -> bytes:
+        with stage('read') as read_stage, open(self.pack_path, 'rb') as pack_file:
+            pack_file.seek(entry.offset)
+            read_stage.add_bytes(entry.size_bytes)
+            return pack_file.read(entry.size_bytes)
+
+    def iter_contents(
+        self,
+        entries: Iterable[PackIndexEntry],
+    ) -> Generator[Tuple[PackIndexEntry, bytes], None, None]:
+        """Reads the entries with one file handle, entries ordered by offset make it one sequential read"""
+        pack_file: Optional[BinaryIO] = None
+        try:
+            for entry in entries:
+                if pack_file is None:
+                    pack_file = open(self.pack_path, 'rb')
+
+                with stage('read') as read_stage:
+                    if pack_file.tell() != entry.offset:
+                        pack_file.seek(entry.offset)
+
+                    content = pack_file.read(entry.size_bytes)
+                    read_stage.add_bytes(len(content))
+
+                yield entry, content
+        finally:
+            if pack_file is not None:
+                pack_file.close()
+
+    def append(self, files: Iterable[Tuple[str, bytes]]) -> List[PackIndexEntry]:
+        new_entries: List[PackIndexEntry] = []
+        with open(self.pack_path, 'ab') as pack_file:
+            offset = pack_file.seek(0, os.SEEK_END)
+            for filename, content in files:
+                pack_file.write(content)
+                new_entries.append(
+                    PackIndexEntry(filename, offset, len(content), calculate_hashsum_hex_from_bytes(content)))
+                offset += len(content)
+
+            pack_file.flush()
+            os.fsync(pack_file.fileno())
+
+        with open(self.index_path, 'a') as index_file:
+            for entry in new_entries:
+                index_file.write(f'{entry.filename} {entry.offset} {entry.size_bytes} {entry.hashsum_hex}\n')
+
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+        return new_entries
+
+    def remove(self):
+        # the index goes first, the pack without the index is not read
+        for path in [self.index_path, self.pack_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self._entries, self._index_stat = {}, None
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Dict, Generator, List, Optional, Union
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes_read: int = 0
+
+
+class ProfileStats:
+    """
+    Time of the stages measured inside the `profile` context. The time of a stage excludes the time of the stages
+    nested into it, e.g. sha512 of the attachment found by glob is not counted as the glob time.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.total_seconds = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self) -> List['_StageTimer']:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        return stack
+
+    def add(self, name: str, seconds: float, bytes_read: int = 0):
+        with self._lock:
+            stage_stats = self.stages.get(name)
+            if stage_stats is None:
+                stage_stats = self.stages[name] = StageStats()
+
+            stage_stats.calls += 1
+            stage_stats.seconds += seconds
+            stage_stats.bytes_read += bytes_read
+
+    def format_table(self) -> str:
+        lines = [f'{"stage":<12} {"calls":>10} {"seconds":>10} {"%":>6} {"MB read":>10}']
+        measured_seconds = 0.0
+        for name, stage_stats in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            measured_seconds += stage_stats.seconds
+            lines.append(f'{name:<12} {stage_stats.calls:>10} {stage_stats.seconds:>10.3f} '
+                         f'{self._get_percent(stage_stats.seconds):>6.1f} {stage_stats.bytes_read / 1024 ** 2:>10.1f}')
+
+        other_seconds = max(self.total_seconds - measured_seconds, 0.0)
+        lines.append(f'{"other":<12} {"":>10} {other_seconds:>10.3f} {self._get_percent(other_seconds):>6.1f}')
+        lines.append(f'{"total":<12} {"":>10} {self.total_seconds:>10.3f}')
+        return '\n'.join(lines)
+
+    def _get_percent(self, seconds: float) -> float:
+        return 100 * seconds / self.total_seconds if self.total_seconds else 0.0
+
+
+class _StageTimer:
+    __slots__ = ('stats', 'stack', 'name', 'bytes_read', 'children_seconds', 'start')
+
+    def __init__(self, stats: ProfileStats, name: str):
+        self.stats = stats
+        self.stack = stats._get_stack()
+        self.name = name
+        self.bytes_read = 0
+        self.children_seconds = 0.0
+        self.start = 0.0
+
+    def add_bytes(self, bytes_read: int):
+        self.bytes_read += bytes_read
+
+    def __enter__(self) -> '_StageTimer':
+        self.stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = perf_counter() - self.start
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1].children_seconds += elapsed
+
+        self.stats.add(self.name, elapsed - self.children_seconds, self.bytes_read)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def add_bytes(self, bytes_read: int):
+        pass
+
+    def __enter__(self) -> '_NullStage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+_active_stats: Optional[ProfileStats] = None
+
+
+def stage(name: str) -> Union[_StageTimer, _NullStage]:
+    """
+    Context manager measuring the stage when the profiling is enabled:
+
+        with stage('read') as read_stage:
+            content = file_.read()
+            read_stage.add_bytes(len(content))
+
+    The shared no-op object is returned while the profiling is disabled.
+    """
+    if _active_stats is None:
+        return _NULL_STAGE
+
+    return _StageTimer(_active_stats, name)
+
+
+@contextmanager
+def profile() -> Generator[ProfileStats, None, None]:
+    """
+    Enables the profiling of the storage operations made in the context. The stages of the other threads
+    (e.g. AsyncStorage workers) are measured too, so their time may exceed the total wall time.
+    """
+    global _active_stats
+
+    previous_stats = _active_stats
+    stats = ProfileStats()
+    _active_stats = stats
+    start = perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.total_seconds = perf_counter() - start
+        _active_stats = previous_stats
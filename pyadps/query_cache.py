@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the search results for the repeated searches. The results of one search are the file
+<repo>/adps_query_cache/<key>.json, the key is the sha256 of the canonical JSON of the filter, the sorting and
+the limit. The file keeps the generation of the repository (see Storage.get_generation) it was found for and is
+valid while the generation is the same. The file is touched when it's read, the files which weren't used for
+the longest time are removed once there are more than max_entries of them or they take more than max_size_bytes.
+The searches with the damping distance filter are random and are not cached.
+"""
+import hashlib
+import json
+import os
+import os.path
+from typing import Generator, Iterable, List, Optional
+
+from pyadps import metrics
+from pyadps.mail import CoordsData, MailFilter, dump_mail_filter_dict
+from pyadps.storage import FilteredMailResult, Storage, dump_filtered_mail_result, load_filtered_mail_result
+
+QUERY_CACHE_FOLDER = 'adps_query_cache'
+QUERY_CACHE_VERSION = 1
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_SIZE_BYTES = 64 * 1024 * 1024
+
+
+def get_query_key(
+    mail_filter: Optional[MailFilter],
+    sort_by: Optional[str] = None,
+    limit: Optional[int] = None,
+    sort_location: Optional[CoordsData] = None,
+) -> Optional[str]:
+    """The key of the search, None if the search is not cacheable"""
+    if mail_filter is not None and mail_filter.damping_distance_filter is not None:
+        return None
+
+    query = {
+        'version': QUERY_CACHE_VERSION,
+        'filter': dump_mail_filter_dict(mail_filter) if mail_filter is not None else None,
+        'sort_by': sort_by,
+        'limit': limit,
+        'sort_location': sort_location.to_tuple() if sort_location is not None else None,
+    }
+    return hashlib.sha256(json.dumps(query, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class QueryCache:
+    def __init__(
+        self,
+        storage: Storage,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES,
+    ):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.max_size_bytes = max_size_bytes
+        self.folder_path = os.path.join(storage.root_dir_path, QUERY_CACHE_FOLDER)
+
+    def _get_entry_path(self, key: str) -> str:
+        return os.path.join(self.folder_path, f'{key}.json')
+
+    def _get_generation(self) -> list:
+        return json.loads(json.dumps(self.storage.get_generation()))  # the tuples as they are read from JSON
+
+    def get(self, key: str) -> Optional[List[FilteredMailResult]]:
+        """The cached results or None if there are no results of the current generation"""
+        entry_path = self._get_entry_path(key)
+        try:
+            with open(entry_path, encoding='utf-8') as entry_file:
+                entry = json.load(entry_file)
+        except (FileNotFoundError, ValueError):
+            metrics.increment('query_cache_misses')
+            return None
+
+        if entry.get('generation') != self._get_generation():
+            metrics.increment('query_cache_misses')
+            return None
+
+        try:
+            os.utime(entry_path)  # the recently used entries are evicted last
+        except OSError:
+            pass  # e.g. the repository is read-only
+
+        metrics.increment('query_cache_hits')
+        root_dir_path = os.path.abspath(self.storage.root_dir_path)
+        return [
+            load_filtered_mail_result({**result, 'mail_path': os.path.join(root_dir_path, result['mail_path'])})
+            for result in entry['results']
+        ]
+
+    def put(self, key: str, filtered_mail_results: Iterable[FilteredMailResult], generation: Optional[tuple] = None):
+        """
+        Saves the results found for the generation, by default for the current one. The results aren't saved
+        if the repository can't be written.
+        """
+        root_dir_path = os.path.abspath(self.storage.root_dir_path)
+        entry = {
+            'generation': json.loads(json.dumps(generation)) if generation is not None else self._get_generation(),
+            'results': [  # the paths are relative, the removable media may be mounted elsewhere next time
+                {**dump_filtered_mail_result(result), 'mail_path': os.path.relpath(result.mail_path, root_dir_path)}
+                for result in filtered_mail_results
+            ],
+        }
+        entry_bytes = json.dumps(entry, separators=(',', ':')).encode()
+        if len(entry_bytes) > self.max_size_bytes:
+            return
+
+        try:
+            os.makedirs(self.folder_path, exist_ok=True)
+            entry_path = self._get_entry_path(key)
+            tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as entry_file:
+                entry_file.write(entry_bytes)
+            os.replace(tmp_path, entry_path)
+            self.evict()
+        except OSError:
+            pass
+
+    def iter_put(
+        self,
+        key: str,
+        filtered_mail_results: Iterable[FilteredMailResult],
+    ) -> Generator[FilteredMailResult, None, None]:
+        """Yields the results and saves them once all of them are yielded"""
+        generation = self.storage.get_generation()  # the messages changed during the search are in the next one
+        results = []
+        for filtered_mail_result in filtered_mail_results:
+            results.append(filtered_mail_result)
+            yield filtered_mail_result
+
+        self.put(key, results, generation)
+
+    def evict(self):
+        """Removes the least recently used entries above max_entries and max_size_bytes"""
+        entries = []
+        for dir_entry in os.scandir(self.folder_path):
+            if dir_entry.name.endswith('.json'):
+                stat_result = dir_entry.stat()
+                entries.append((stat_result.st_mtime_ns, stat_result.st_size, dir_entry.path))
+
+        entries.sort(reverse=True)
+        total_size_bytes = 0
+        for idx, (_, size_bytes, entry_path) in enumerate(entries):
+            total_size_bytes += size_bytes
+            if idx >= self.max_entries or total_size_bytes > self.max_size_bytes:
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                metrics.increment('query_cache_evictions')
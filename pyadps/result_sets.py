@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Saved search results for refining and merging the searches like "Refine current search" and "Add results to current
+search" of SharpADPS. The result set is the file <repo>/adps_results/<name>.jsonl with one line
+{"filename": ..., "hashsum_hex": ..., "stat": [...]} per message. The stat is the size and the modification time of
+the message file or the size and the offset of the packed message: if it's the same, the message is not changed
+and its saved hashsum is trusted; otherwise the message is hashed again and the entry is stale if the hashsum
+differs (e.g. the name was given to another message by the renaming after a deletion).
+"""
+import json
+import os
+import os.path
+import re
+import tempfile
+from typing import Generator, Iterable, NamedTuple, Optional, Set, Tuple
+
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.storage import FilteredMailResult, Storage
+
+RESULTS_FOLDER = 'adps_results'
+RESULT_SET_NAME_RE = re.compile(r'^[\w.-]+$')
+
+
+class ResultSetError(Exception):
+    pass
+
+
+class ResultSetEntry(NamedTuple):
+    filename: str
+    hashsum_hex: str
+    stat: Tuple[int, int]
+
+
+def get_message_stat(msg_path: str) -> Optional[Tuple[int, int]]:
+    """(size, modification time) of the loose message, (size, offset) of the packed one, None if it's missing"""
+    try:
+        stat_result = os.stat(msg_path)
+    except FileNotFoundError:
+        packed_entry = Storage.get_packed_message_entry(msg_path)
+        return (packed_entry.size_bytes, packed_entry.offset) if packed_entry is not None else None
+
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+
+class ResultSet:
+    def __init__(self, storage: Storage, name: str):
+        if not RESULT_SET_NAME_RE.match(name):
+            raise ResultSetError(f'Invalid result set name {name!r}: use letters, digits, "_", "-" and "."')
+
+        self.storage = storage
+        self.name = name
+        self.path = os.path.join(storage.root_dir_path, RESULTS_FOLDER, f'{name}.jsonl')
+        self.stale_number = 0  # the stale entries met by the last iteration
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def iter_entries(self) -> Generator[ResultSetEntry, None, None]:
+        if not self.exists():
+            raise ResultSetError(f'There is no result set {self.name!r}, save it by search --save-results')
+
+        with open(self.path, encoding='utf-8') as result_set_file:
+            for line in result_set_file:
+                if not line.endswith('\n'):
+                    continue  # incomplete line of the interrupted write
+
+                entry_dict = json.loads(line)
+                yield ResultSetEntry(entry_dict['filename'], entry_dict['hashsum_hex'], tuple(entry_dict['stat']))
+
+    def iter_messages_bytes(
+        self,
+        exclude_paths: Optional[Set[str]] = None,
+    ) -> Generator[Tuple[int, int, str, bytes], None, None]:
+        """
+        Yields (idx, total number, path, content) like Storage.iter_messages_bytes for the messages of the set
+        which are not stale and not in exclude_paths, the stale ones are counted in stale_number
+        """
+        self.stale_number = 0
+        messages_folder_path = os.path.abspath(os.path.join(self.storage.root_dir_path, Storage.MESSAGES_FOLDER))
+        entries = list(self.iter_entries())
+        for idx, entry in enumerate(entries):
+            msg_path = os.path.join(messages_folder_path, entry.filename)
+            if exclude_paths is not None and msg_path in exclude_paths:
+                continue
+
+            stat = get_message_stat(msg_path)
+            if stat is None:
+                self.stale_number += 1
+                continue
+
+            msg_bytes = self.storage.read_message_bytes(msg_path)
+            if stat != entry.stat and calculate_hashsum_hex_from_bytes(msg_bytes) != entry.hashsum_hex:
+                self.stale_number += 1
+                continue
+
+            yield idx, len(entries), msg_path, msg_bytes
+
+
+class ResultSetWriter:
+    """Writes the results to the temporary file which replaces the result set once the writing is finished"""
+
+    def __init__(self, result_set: ResultSet):
+        self.result_set = result_set
+        self.count = 0
+
+        results_folder_path = os.path.dirname(result_set.path)
+        os.makedirs(results_folder_path, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=results_folder_path, suffix='.tmp')
+        self._file = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def append(self, filtered_mail_result: FilteredMailResult):
+        stat = get_message_stat(filtered_mail_result.mail_path)
+        if stat is None:
+            return  # removed while the search is running
+
+        self._file.write(json.dumps({
+            'filename': os.path.basename(filtered_mail_result.mail_path),
+            'hashsum_hex': filtered_mail_result.mail_hashsum_hex,
+            'stat': list(stat),
+        }) + '\n')
+        self.count += 1
+
+    def iter_append(
+        self,
+        filtered_mail_results: Iterable[FilteredMailResult],
+    ) -> Generator[FilteredMailResult, None, None]:
+        for filtered_mail_result in filtered_mail_results:
+            self.append(filtered_mail_result)
+            yield filtered_mail_result
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self._file.close()
+        os.replace(self._tmp_path, self.result_set.path)
+
+    def abort(self):
+        if self._file.closed:
+            return
+
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self) -> 'ResultSetWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import heapq
+import math
+import os.path
+from collections import defaultdict
+from random import Random
+from statistics import NormalDist
+from typing import Dict, Generator, List, NamedTuple, Sequence, Tuple
+
+
+class CountEstimate(NamedTuple):
+    count: int
+    lower: int  # the bounds of the confidence interval
+    upper: int
+    confidence: float
+    sampled_number: int
+    matched_number: int
+    total_number: int
+
+    @property
+    def is_exact(self) -> bool:
+        return self.sampled_number == self.total_number
+
+
+def estimate_count(matched_number: int, sampled_number: int, total_number: int, confidence: float) -> CountEstimate:
+    """
+    Estimates the number of the matched messages of the repository by the matched ones of the random sample.
+    The interval is the Wilson score interval of the matched share with the finite population correction,
+    it doesn't collapse to a point when none or all of the sampled messages are matched.
+    """
+    if sampled_number >= total_number:
+        return CountEstimate(matched_number, matched_number, matched_number, confidence, sampled_number,
+                             matched_number, total_number)
+
+    if sampled_number == 0:
+        return CountEstimate(0, 0, total_number, confidence, 0, 0, total_number)
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    share = matched_number / sampled_number
+    denominator = 1 + z ** 2 / sampled_number
+    center = (share + z ** 2 / (2 * sampled_number)) / denominator
+    half_width = z / denominator * math.sqrt(share * (1 - share) / sampled_number + z ** 2 / (4 * sampled_number ** 2))
+    half_width *= math.sqrt((total_number - sampled_number) / (total_number - 1))
+
+    # the sampled messages are known for sure
+    not_matched_number = sampled_number - matched_number
+    lower = max(math.floor((center - half_width) * total_number), matched_number)
+    upper = min(math.ceil((center + half_width) * total_number), total_number - not_matched_number)
+    return CountEstimate(round(share * total_number), lower, upper, confidence, sampled_number, matched_number,
+                         total_number)
+
+
+def get_stratum(msg_path: str) -> str:
+    """The message filenames start with the hex digits of the content hashsum, so the strata are equally likely"""
+    return os.path.basename(msg_path)[:1].lower()
+
+
+def iter_stratified_sample(msg_paths: Sequence[str], rng: Random) -> Generator[str, None, None]:
+    """
+    Yields all paths in the random order where every prefix of the sequence is the proportional stratified sample:
+    each stratum is shuffled and the strata are interleaved at the rate of their sizes.
+    """
+    paths_by_stratum: Dict[str, List[str]] = defaultdict(list)
+    for msg_path in msg_paths:
+        paths_by_stratum[get_stratum(msg_path)].append(msg_path)
+
+    def iter_stratum(stratum_paths: List[str]) -> Generator[Tuple[float, str], None, None]:
+        rng.shuffle(stratum_paths)
+        offset = rng.random()
+        for idx, msg_path in enumerate(stratum_paths):
+            yield (idx + offset) / len(stratum_paths), msg_path
+
+    for _, msg_path in heapq.merge(*(iter_stratum(paths) for _, paths in sorted(paths_by_stratum.items()))):
+        yield msg_path
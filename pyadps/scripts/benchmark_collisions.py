@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import time
+from hashlib import sha512
+from pathlib import PurePath
+from statistics import median
+from typing import Callable, List, Sequence, Tuple
+
+import click
+
+from pyadps.scripts.generate_collisions import CollisionRepository, generate_collision_repository
+
+# [PyADPS]$ python -m pyadps.scripts.benchmark_collisions --depth 1 --depth 10 --depth 100 --depth 1000
+
+
+def measure(func: Callable[[], object], repeat: int) -> List[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def benchmark_repository(repository: CollisionRepository, repeat: int) -> List[Tuple[str, List[float]]]:
+    """Returns (operation, latencies) items, every operation hits the last file of the bucket or misses the bucket"""
+    storage = repository.get_storage()
+    messages_path = PurePath(repository.root_dir_path) / storage.MESSAGES_FOLDER
+    attachments_path = PurePath(repository.root_dir_path) / storage.ATTACHMENTS_FOLDER
+    message_bucket = repository.message_buckets[0]
+    attachment_bucket = repository.attachment_buckets[0]
+    spare_message_hashsum_hex = sha512(repository.spare_messages[message_bucket.prefix]).hexdigest()
+    spare_attachment_hashsum_hex = sha512(repository.spare_attachments[attachment_bucket.prefix]).hexdigest()
+
+    results = [
+        ('get_free_file_path, new message', measure(lambda: storage.get_free_file_path(
+            messages_path / f'{message_bucket.prefix}.json', spare_message_hashsum_hex), repeat)),
+        ('get_free_file_path, existing message', measure(lambda: storage.get_free_file_path(
+            messages_path / f'{message_bucket.prefix}.json', message_bucket.hashsums_hex[-1]), repeat)),
+        ('get_free_file_path, new attachment', measure(lambda: storage.get_free_file_path(
+            attachments_path / f'{attachment_bucket.prefix}.bin', spare_attachment_hashsum_hex), repeat)),
+        ('find_attachment_path', measure(
+            lambda: storage.find_attachment_path(attachment_bucket.hashsums_hex[-1]), repeat)),
+    ]
+
+    # the collision index is built per operation: the listing of the folder and the hashing of the bucket
+    spare_message = repository.spare_messages[message_bucket.prefix]
+    results.append(('collision index, new message', measure(
+        lambda: storage.create_collision_index(messages_path).get_free_file_path(
+            messages_path / f'{message_bucket.prefix}.json', spare_message_hashsum_hex, len(spare_message)), repeat)))
+    messages_collision_index = storage.create_collision_index(messages_path)
+    results.append(('collision index, existing message, warm', measure(
+        lambda: messages_collision_index.get_free_file_path(
+            messages_path / f'{message_bucket.prefix}.json', message_bucket.hashsums_hex[-1]), repeat)))
+
+    # the first file of every bucket is deleted, so every bucket has to be renamed
+    for bucket in repository.attachment_buckets:
+        os.remove(attachments_path / bucket.filenames[0])
+    results.append(('get_correct_filenames_mapping_after_delete', measure(
+        storage.get_correct_filenames_mapping_after_delete, repeat)))
+
+    return results
+
+
+def format_milliseconds(seconds: float) -> str:
+    return f'{seconds * 1000:.3f}'
+
+
+@click.command(help='Measures the latency of the storage operations on the buckets of the partial hashsum collisions')
+@click.option('--depth', 'depths', type=click.IntRange(min=1, max=10001), multiple=True, default=[1, 10, 100, 1000],
+              help='Number of files per bucket, the option can be repeated')
+@click.option('--prefix-len', type=click.IntRange(min=1, max=10), default=3)
+@click.option('--buckets', 'buckets_number', type=click.IntRange(min=1), default=10)
+@click.option('--attachment-size-bytes', type=click.IntRange(min=1), default=64 * 1024)
+@click.option('--repeat', type=click.IntRange(min=1), default=5)
+@click.option('--work-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Folder for the temporary repositories, the system one is used by default')
+def main(
+    depths: Sequence[int],
+    prefix_len: int,
+    buckets_number: int,
+    attachment_size_bytes: int,
+    repeat: int,
+    work_dir: str,
+):
+    click.echo(f'{"depth":>6} {"operation":<45} {"median, ms":>12} {"max, ms":>12}')
+    for depth in sorted(depths):
+        with tempfile.TemporaryDirectory(dir=work_dir) as repository_path:
+            repository = generate_collision_repository(
+                repository_path, prefix_len, buckets_number, depth, attachment_size_bytes)
+
+            for operation, latencies in benchmark_repository(repository, repeat):
+                click.echo(f'{depth:>6} {operation:<45} '
+                           f'{format_milliseconds(median(latencies)):>12} {format_milliseconds(max(latencies)):>12}')
+
+
+if __name__ == '__main__':
+    main()
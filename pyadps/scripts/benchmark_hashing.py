@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+import time
+from typing import Callable, List, Sequence
+
+import click
+
+from pyadps.hashing import HashsumBackend, HashsumEngine
+
+# [PyADPS]$ python -m pyadps.scripts.benchmark_hashing --files 32 --size-bytes 67108864 --workers 1 --workers 4
+
+LEGACY = 'LEGACY'  # the serial hashing allocating the new 8 MB bytes object per chunk
+
+
+def hash_files_legacy(paths: Sequence[str]) -> List[str]:
+    result = []
+    for path in paths:
+        file_hash = hashlib.sha512()
+        with open(path, 'rb') as file_stream:
+            while chunk := file_stream.read(8 * 1024 * 1024):
+                file_hash.update(chunk)
+        result.append(file_hash.hexdigest())
+
+    return result
+
+
+def create_files(folder: str, files_number: int, size_bytes: int) -> List[str]:
+    block = os.urandom(1024 * 1024)
+    paths = []
+    for idx in range(files_number):
+        path = os.path.join(folder, f'{idx}.bin')
+        with open(path, 'wb') as output_file:
+            for offset in range(0, size_bytes, len(block)):
+                output_file.write(idx.to_bytes(8, 'little') + block[8:min(len(block), size_bytes - offset)])
+        paths.append(path)
+
+    return paths
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Returns the best time of the runs, the files are in the page cache after the first one"""
+    best_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+
+    return best_seconds
+
+
+@click.command(help='Compares the throughput of the hashsum engine backends')
+@click.option('--files', 'files_number', type=click.IntRange(min=1), default=16)
+@click.option('--size-bytes', type=click.IntRange(min=1), default=64 * 1024 * 1024)
+@click.option('--workers', 'workers_numbers', type=click.IntRange(min=1), multiple=True, default=[1, 2, 4],
+              help='Number of the engine threads, the option can be repeated')
+@click.option('--repeat', type=click.IntRange(min=1), default=3)
+@click.option('--work-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Folder for the temporary files, the system one is used by default')
+def main(files_number: int, size_bytes: int, workers_numbers: Sequence[int], repeat: int, work_dir: str):
+    with tempfile.TemporaryDirectory(dir=work_dir) as folder:
+        paths = create_files(folder, files_number, size_bytes)
+        total_megabytes = files_number * size_bytes / 1024 ** 2
+        expected_hashsums = hash_files_legacy(paths)
+
+        click.echo(f'{"backend":<10} {"workers":>8} {"seconds":>10} {"MB/s":>10}')
+        seconds = measure(lambda: hash_files_legacy(paths), repeat)
+        click.echo(f'{LEGACY:<10} {1:>8} {seconds:>10.3f} {total_megabytes / seconds:>10.1f}')
+
+        for backend in [HashsumBackend.READINTO, HashsumBackend.MMAP]:
+            for workers in sorted(workers_numbers):
+                engine = HashsumEngine(backend, workers)
+                try:
+                    hashsums = [hash_result.hex_digest for hash_result in engine.hash_files(paths)]
+                    if hashsums != expected_hashsums:
+                        raise click.ClickException(f'The {backend} backend calculated wrong hashsums')
+
+                    seconds = measure(lambda: engine.hash_files(paths), repeat)
+                finally:
+                    engine.close()
+
+                click.echo(f'{backend:<10} {workers:>8} {seconds:>10.3f} {total_megabytes / seconds:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from statistics import median
+from typing import Callable, Dict, List, Sequence
+
+import click
+
+# [PyADPS]$ python -m pyadps.scripts.benchmark_startup --runs 20 --budget-ms 150
+# or python pyadps/scripts/benchmark_startup.py, which puts the scripts folder on the path instead of the project root
+
+PROJECT_ROOT = str(Path(__file__).resolve().parents[2])
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+# the measured commands import pyadps from the same project wherever the benchmark is run from
+SUBPROCESS_ENV = {**os.environ,
+                  'PYTHONPATH': os.pathsep.join(filter(None, [PROJECT_ROOT, os.environ.get('PYTHONPATH')]))}
+
+# the modules which should not be imported by `import pyadps.cli`
+HEAVY_MODULES = ['geopy', 'marshmallow', 'marshmallow_dataclass', 'numpy', 'pandas']
+
+
+def measure_command(get_args: Callable[[], Sequence[str]], runs: int) -> List[float]:
+    latencies = []
+    for _ in range(runs):
+        args = get_args()
+        start = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL, env=SUBPROCESS_ENV)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def get_imported_heavy_modules(code: str) -> List[str]:
+    check_code = f'{code}\nimport sys\nprint(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', check_code], check=True, capture_output=True, text=True,
+                            env=SUBPROCESS_ENV).stdout
+    return [module for module in output.strip().split(',') if module]
+
+
+def prepare_repository(repo_path: str):
+    from pyadps.mail import CoordsData, Mail
+    from pyadps.storage import Storage
+
+    storage = Storage(repo_path)
+    for idx in range(10):
+        mail = Mail(
+            date_created=datetime(2022, 1, 1 + idx),
+            recipient_coords=[CoordsData(55.75, 37.61)],
+            name=f'name{idx}',
+            additional_notes=None,
+            inline_message=None,
+            attachments=[],
+        )
+        storage.save_mail(mail, [], repo_path)
+
+
+@click.command(help='Measures the startup time of the short CLI invocations. The overhead over the bare '
+                    'interpreter start is compared with the budget, the exit code is 1 if the budget is exceeded')
+@click.option('--runs', type=click.IntRange(min=1), default=10)
+@click.option('--budget-ms', type=click.FLOAT, default=150.0,
+              help='Maximal median overhead of a command over "python -c pass"')
+def main(runs: int, budget_ms: float):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        repo_path = os.path.join(tmp_path, 'repo')
+        prepare_repository(repo_path)
+
+        cli_args = [sys.executable, '-m', 'pyadps.cli']
+        commands: Dict[str, Callable[[], Sequence[str]]] = {
+            'import pyadps.cli': lambda: [sys.executable, '-c', 'import pyadps.cli'],
+            'adps --help': lambda: [*cli_args, '--help'],
+            'adps init': lambda: [*cli_args, 'init', tempfile.mkdtemp(dir=tmp_path)],
+            'adps search (date only)': lambda: [*cli_args, 'search', repo_path, '--datetime-from=2021-01-01',
+                                                '--output-format=COUNT', '--no-show-progressbar'],
+        }
+
+        interpreter_median = median(measure_command(lambda: [sys.executable, '-c', 'pass'], runs))
+        click.echo(f'{"command":<30} {"median, ms":>12} {"overhead, ms":>14}')
+        click.echo(f'{"python -c pass":<30} {interpreter_median * 1000:>12.1f}')
+
+        is_budget_exceeded = False
+        for name, get_args in commands.items():
+            latencies = measure_command(get_args, runs)
+            overhead_ms = (median(latencies) - interpreter_median) * 1000
+            is_budget_exceeded |= overhead_ms > budget_ms
+            click.echo(f'{name:<30} {median(latencies) * 1000:>12.1f} {overhead_ms:>14.1f}'
+                       f'{"  OVER BUDGET" if overhead_ms > budget_ms else ""}')
+
+    heavy_modules = get_imported_heavy_modules('import pyadps.cli')
+    if heavy_modules:
+        click.echo(f'pyadps.cli imports the heavy modules: {", ".join(heavy_modules)}')
+        is_budget_exceeded = True
+
+    if is_budget_exceeded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from hashlib import sha512
+from pathlib import PurePath
+from typing import Dict, List, Type
+
+import click
+
+from pyadps.mail import CoordsData, Mail
+from pyadps.storage import Storage
+
+# [PyADPS]$ python -m pyadps.scripts.generate_collisions /path/to/adps_repo --prefix-len 3 --buckets 10 --depth 100
+
+PLACEHOLDER = b'$templateVal'
+
+
+@dataclass
+class CollisionBucket:
+    prefix: str
+    filenames: List[str]
+    hashsums_hex: List[str]
+
+
+@dataclass
+class CollisionRepository:
+    """
+    The repository where the file names are built from the first `prefix_len` hex digits of the hashsum,
+    every bucket contains `depth` files with the same prefix: "abc.bin", "abc_0000.bin", "abc_0001.bin", ...
+    `spare_*` contents collide with the buckets but are not written, they are used for the lookups of
+    the missing files.
+    """
+    root_dir_path: str
+    prefix_len: int
+    message_buckets: List[CollisionBucket]
+    attachment_buckets: List[CollisionBucket]
+    spare_messages: Dict[str, bytes]
+    spare_attachments: Dict[str, bytes]
+
+    def get_storage(self) -> Storage:
+        return get_storage_class(self.prefix_len)(self.root_dir_path)
+
+
+def get_storage_class(prefix_len: int) -> Type[Storage]:
+    """Storage with the shortened partial hashsum, so the collisions are cheap to find"""
+    return type(f'Storage{prefix_len}', (Storage,), {'HASHSUM_FILENAME_PART_LEN': prefix_len})
+
+
+def find_colliding_contents(
+    template: bytes,
+    prefix_len: int,
+    buckets_number: int,
+    depth: int,
+) -> Dict[str, List[bytes]]:
+    """
+    Substitutes the counter into the placeholder of the template until `buckets_number` prefixes
+    have `depth` contents each. Takes about `depth * 16 ** prefix_len` hashsum calculations, the hash state
+    of the part before the placeholder is calculated once.
+    """
+    head, placeholder, tail = template.partition(PLACEHOLDER)
+    if not placeholder:
+        raise ValueError('The template has no placeholder')
+
+    head_hashsum = sha512(head)
+    counters_by_prefix: Dict[str, List[int]] = {}
+    full_buckets_number = 0
+    counter = 0
+    while full_buckets_number < buckets_number:
+        hashsum = head_hashsum.copy()
+        hashsum.update(str(counter).encode() + tail)
+        prefix = hashsum.hexdigest()[:prefix_len]
+
+        counters = counters_by_prefix.get(prefix)
+        if counters is None and len(counters_by_prefix) < buckets_number:
+            counters = counters_by_prefix[prefix] = []
+
+        if counters is not None and len(counters) < depth:
+            counters.append(counter)
+            if len(counters) == depth:
+                full_buckets_number += 1
+
+        counter += 1
+
+    return {
+        prefix: [head + str(counter).encode() + tail for counter in counters]
+        for prefix, counters in counters_by_prefix.items()
+    }
+
+
+def get_message_template() -> bytes:
+    mail = Mail(
+        date_created=datetime(2022, 2, 2),
+        recipient_coords=[CoordsData(1.0, 2.0)],
+        name='Johnny',
+        additional_notes=None,
+        inline_message=f'Collision {PLACEHOLDER.decode()}',
+        attachments=[],
+    )
+    return json.dumps(Mail.Schema().dump(mail), indent=4, sort_keys=True).encode()
+
+
+def get_attachment_template(size_bytes: int) -> bytes:
+    padding_size = max(size_bytes - len(PLACEHOLDER) - 16, 0)
+    return b'\0' * padding_size + b'Collision ' + PLACEHOLDER
+
+
+def write_bucket(folder: str, prefix: str, extension: str, contents: List[bytes]) -> CollisionBucket:
+    """Writes the contents with the names Storage.get_free_file_path would give them"""
+    filenames = [f'{prefix}.{extension}', *(f'{prefix}_{i:04}.{extension}' for i in range(len(contents) - 1))]
+    for filename, content in zip(filenames, contents):
+        with open(os.path.join(folder, filename), 'wb') as output_file:
+            output_file.write(content)
+
+    return CollisionBucket(prefix, filenames, [sha512(content).hexdigest() for content in contents])
+
+
+def generate_collision_repository(
+    output_dir: str,
+    prefix_len: int,
+    buckets_number: int,
+    depth: int,
+    attachment_size_bytes: int,
+) -> CollisionRepository:
+    adps_messages_path = str(PurePath(output_dir) / Storage.MESSAGES_FOLDER)
+    adps_attachments_path = str(PurePath(output_dir) / Storage.ATTACHMENTS_FOLDER)
+    os.makedirs(adps_messages_path)
+    os.makedirs(adps_attachments_path)
+
+    # one more content per bucket is left as the spare one
+    message_contents = find_colliding_contents(get_message_template(), prefix_len, buckets_number, depth + 1)
+    attachment_contents = find_colliding_contents(
+        get_attachment_template(attachment_size_bytes), prefix_len, buckets_number, depth + 1)
+
+    return CollisionRepository(
+        root_dir_path=output_dir,
+        prefix_len=prefix_len,
+        message_buckets=[write_bucket(adps_messages_path, prefix, 'json', contents[:-1])
+                         for prefix, contents in message_contents.items()],
+        attachment_buckets=[write_bucket(adps_attachments_path, prefix, 'bin', contents[:-1])
+                            for prefix, contents in attachment_contents.items()],
+        spare_messages={prefix: contents[-1] for prefix, contents in message_contents.items()},
+        spare_attachments={prefix: contents[-1] for prefix, contents in attachment_contents.items()},
+    )
+
+
+@click.command(help='Generates the repository flooded with the partial hashsum collisions. The file names use '
+                    'the shortened prefix of the hashsum, so the repository is read by Storage with '
+                    'HASHSUM_FILENAME_PART_LEN equal to --prefix-len')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--prefix-len', type=click.IntRange(min=1, max=Storage.HASHSUM_FILENAME_PART_LEN), default=3)
+@click.option('--buckets', 'buckets_number', type=click.IntRange(min=1), default=10,
+              help='Number of the partial hashsums with collisions')
+@click.option('--depth', type=click.IntRange(min=1, max=10001), default=100, help='Number of files per bucket')
+@click.option('--attachment-size-bytes', type=click.IntRange(min=1), default=64 * 1024)
+def main(output_dir: str, prefix_len: int, buckets_number: int, depth: int, attachment_size_bytes: int):
+    generate_collision_repository(output_dir, prefix_len, buckets_number, depth, attachment_size_bytes)
+
+
+if __name__ == '__main__':
+    main()
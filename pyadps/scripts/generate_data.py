@@ -1,32 +1,63 @@
 # -*- coding: utf-8 -*-
+import itertools
 import json
 import os
-import sys
-from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import partial
 from hashlib import sha512
-from io import BytesIO
 from pathlib import PurePath
 from string import Template
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
 
-import geopy.distance
+import click
 import numpy as np
 import pandas as pd
 
-from pyadps.helpers import calculate_hashsum
+from pyadps.helpers import calculate_hashsum_hex_from_file
 from pyadps.mail import CoordsData, FileAttachment, Mail
 
 # [PyADPS]$ time python -m pyadps.scripts.generate_data /path/to/adps_repo
+# [PyADPS]$ time python -m pyadps.scripts.generate_data /path/to/adps_repo --mails 1000000 --attachments 100000 \
+#     --attachment-content sparse --workers 8
+
+T = TypeVar('T')
 
 SEED = 12345
+CHUNK_SIZE_BYTES = 8 * 1024 * 1024
+HASHSUM_FILENAME_PART_LEN = 10
+EARTH_RADIUS_METERS = 6371008.8
+
+DEFAULT_CITIES_CSV_PATH = str(PurePath(__file__).parents[1] / 'static_files/worldcities/worldcities.csv')
+DEFAULT_NAMES_PATH = str(PurePath(__file__).parents[1] / 'static_files/name_databases/all.txt')
+
+
+class AttachmentContent:
+    RANDOM = 'RANDOM'  # random bytes, the slowest one
+    PATTERN = 'PATTERN'  # unique 64 bytes block repeated up to the size
+    SPARSE = 'SPARSE'  # unique 64 bytes header followed by the hole up to the size
 
 
 @dataclass
-class City:
-    name: str
-    country_code: str
-    coords: CoordsData
+class CitiesGroup:
+    lat: np.ndarray
+    lon: np.ndarray
+    cumulative_population: np.ndarray
+
+    @classmethod
+    def from_dataframe(cls, dataframe) -> 'CitiesGroup':
+        return cls(
+            lat=dataframe['lat'].to_numpy(dtype=np.float64),
+            lon=dataframe['lng'].to_numpy(dtype=np.float64),
+            cumulative_population=np.cumsum(dataframe['population'].fillna(0).to_numpy(dtype=np.float64)),
+        )
+
+    def choose(self, random_values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """random values are floats from 0 to 1, a city is chosen with probability proportional to its population"""
+        city_indexes = np.searchsorted(self.cumulative_population, random_values * self.cumulative_population[-1])
+        city_indexes = np.minimum(city_indexes, len(self.cumulative_population) - 1)
+        return self.lat[city_indexes], self.lon[city_indexes]
 
 
 # https://stackoverflow.com/questions/18622781/why-is-numpy-random-choice-so-slow
@@ -44,73 +75,29 @@ class FastRandomGenerator:
         return self._rng.random(*args, **kwargs)
 
     def choice(self, collection: list, *args):
-        if len(collection) < 100:
-            return self._rng.choice(collection, *args)
-
-        count = 1
-        if args:
-            count = args[0]
-
-        indexes = set()
-        for _ in range(count):
-            attempts = 100
-            found_number = False
-            for attempt in range(attempts):
-                idx = self.integers(0, len(collection))
-                if idx not in indexes:
-                    indexes.add(idx)
-                    found_number = True
-                    break
-
-            if not found_number:
-                raise Exception('Could not build unique set')
-
-        if count == 1:
-            return collection[indexes.pop()]
+        # numpy.random.Generator samples without replacement in O(count) time unlike the legacy RandomState
+        count = args[0] if args else 1
+        indexes = self._rng.choice(len(collection), size=count, replace=False)
+
+        if not args:
+            return collection[indexes[0]]
         else:
             return [collection[idx_] for idx_ in indexes]
 
 
-def get_cumulative_list(dataframe):
-    population_list = dataframe['population'].tolist()
-
-    cumulative_list = []
-    s = 0
-    for population_entry in population_list:
-        population_value = population_entry if not pd.isna(population_entry) else 0
-        cumulative_list.append(population_value + s)
-        s += population_value
-
-    return cumulative_list
-
-
-def choose_city_by_random_value(
-    value: float,
-    target_dataframe,
-    population,
-    cumulative_population_list
-) -> City:
-    """value is float from 0 to 1"""
-    people_num = value * population
-    city_idx = bisect_left(cumulative_population_list, people_num)
-    city_row = target_dataframe[city_idx:city_idx + 1]
-
-    return City(
-        name=city_row['city_ascii'].tolist()[0],
-        country_code=city_row['iso2'].tolist()[0],
-        coords=CoordsData(city_row['lat'].tolist()[0], city_row['lng'].tolist()[0]))
-
-
 def get_file_sizes_bytes(number_of_files: int, sum_bytes: int, rng: FastRandomGenerator) -> list:
-    sizes_rnd = [rng.random() for _ in range(number_of_files)]
+    sizes_rnd = rng.random(number_of_files)
     sizes_cum_sum = np.cumsum(sizes_rnd)
     rate_coef = sum_bytes / sizes_cum_sum[-1]
-    boundaries_byte_numbers = [round(rate_coef * el) for el in sizes_cum_sum]
-    return boundaries_byte_numbers
+    boundaries_byte_numbers = np.round(rate_coef * sizes_cum_sum).astype(np.int64)
+    return boundaries_byte_numbers.tolist()
 
 
 def choose_attachments_for_mail(big_attachments: list, short_attachments: list, rng: FastRandomGenerator) -> list:
     random_value = rng.random()
+    if not big_attachments and 0.05 <= random_value < 0.20:
+        return [rng.choice(short_attachments)]
+
     if 0 <= random_value < 0.05:
         return []
     elif 0.05 <= random_value < 0.10:
@@ -135,101 +122,217 @@ def choose_attachments_for_mail(big_attachments: list, short_attachments: list,
         return list(rng.choice(short_attachments, 5))
 
 
-def generate_name(names_dataframe: list, rng: FastRandomGenerator) -> str:
-    random_value = rng.random()
-    if 0 <= random_value < 0.6:
-        return f'{rng.choice(names_dataframe).lower()}@{rng.choice(names_dataframe).lower()}.com'
-    elif 0.6 <= random_value < 0.95:
-        return '+' + ''.join([str(rng.integers(0, 10)) for _ in range(10)])
-    else:
-        return rng.choice(names_dataframe) + ' ' + rng.choice(names_dataframe)
+def generate_names(all_names: np.ndarray, number: int, rng: FastRandomGenerator) -> List[str]:
+    random_values = rng.random(number)
+    first_names = all_names[rng.integers(0, len(all_names), number)]
+    second_names = all_names[rng.integers(0, len(all_names), number)]
+    phone_numbers = rng.integers(0, 10 ** 10, number)
 
+    result = []
+    for random_value, first_name, second_name, phone_number in zip(
+            random_values, first_names, second_names, phone_numbers):
+        if 0 <= random_value < 0.6:
+            result.append(f'{first_name.lower()}@{second_name.lower()}.com')
+        elif 0.6 <= random_value < 0.95:
+            result.append(f'+{phone_number:010}')
+        else:
+            result.append(f'{first_name} {second_name}')
 
-def generate_additional_notes(names_dataframe: list, rng: FastRandomGenerator):
-    random_value = rng.random()
-    if 0 <= random_value < 0.8:
-        return rng.choice(names_dataframe) + ' ' + rng.choice(names_dataframe)
-    else:
-        return None
+    return result
 
 
-def generate_inline_message(names_dataframe: list, rng: FastRandomGenerator):
-    random_value = rng.random()
-    if 0 <= random_value < 0.8:
-        return ' '.join(rng.choice(names_dataframe).lower() for _ in range(rng.integers(1, 40)))
-    else:
-        return None
+def generate_additional_notes(all_names: np.ndarray, number: int, rng: FastRandomGenerator) -> List[Optional[str]]:
+    random_values = rng.random(number)
+    first_names = all_names[rng.integers(0, len(all_names), number)]
+    second_names = all_names[rng.integers(0, len(all_names), number)]
+    return [
+        f'{first_name} {second_name}' if random_value < 0.8 else None
+        for random_value, first_name, second_name in zip(random_values, first_names, second_names)
+    ]
 
 
-def add_error_to_coords(lat: float, lon: float, rng: FastRandomGenerator,
-                        min_error_meters=100, max_error_meters=20_000) -> tuple:
-    bearing = rng.random() * 360
-    distance = rng.random() * (max_error_meters - min_error_meters) + min_error_meters
+def generate_inline_messages(all_names: np.ndarray, number: int, rng: FastRandomGenerator) -> List[Optional[str]]:
+    random_values = rng.random(number)
+    words_numbers = rng.integers(1, 40, number)
+    words_boundaries = np.concatenate([[0], np.cumsum(words_numbers)])
+    words = np.char.lower(all_names[rng.integers(0, len(all_names), words_boundaries[-1])].astype(str))
+
+    return [
+        ' '.join(words[words_boundaries[idx]:words_boundaries[idx + 1]]) if random_value < 0.8 else None
+        for idx, random_value in enumerate(random_values)
+    ]
+
 
-    geodesic = geopy.distance.geodesic()
-    lat_, lon_, _ = geodesic.destination((lat, lon), bearing, distance / 1000)
-    return lat_, lon_
+def add_error_to_coords(lat: np.ndarray, lon: np.ndarray, rng: FastRandomGenerator,
+                        min_error_meters=100, max_error_meters=20_000) -> Tuple[np.ndarray, np.ndarray]:
+    """Moves every point by the random bearing and distance on the sphere"""
+    bearing = np.radians(rng.random(len(lat)) * 360)
+    distance = rng.random(len(lat)) * (max_error_meters - min_error_meters) + min_error_meters
+    angular_distance = distance / EARTH_RADIUS_METERS
+
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    new_lat_rad = np.arcsin(np.sin(lat_rad) * np.cos(angular_distance)
+                            + np.cos(lat_rad) * np.sin(angular_distance) * np.cos(bearing))
+    new_lon_rad = lon_rad + np.arctan2(np.sin(bearing) * np.sin(angular_distance) * np.cos(lat_rad),
+                                       np.cos(angular_distance) - np.sin(lat_rad) * np.sin(new_lat_rad))
+
+    new_lon = (np.degrees(new_lon_rad) + 540) % 360 - 180
+    return np.degrees(new_lat_rad), new_lon
 
 
 def get_list_of_coords(
-    cities,
-    top_100_cities_dataframe,
-    top_100_cities_population,
-    top_100_cities_population_cumulative_list,
+    cities_lat: np.ndarray,
+    cities_lon: np.ndarray,
+    top_100_cities: CitiesGroup,
     rng: FastRandomGenerator
-):
-    result = []
-    for city in cities:
-        random_value = rng.random()
-        if 0 <= random_value < 0.9:
-            additional_cities = 0
-        elif 0.9 <= random_value < 0.95:
-            additional_cities = 1
-        elif 0.95 <= random_value < 0.98:
-            additional_cities = 2
-        else:
-            additional_cities = 3
-
-        filtered_cities = [city]
-        for _ in range(additional_cities):
-            filtered_cities.append(choose_city_by_random_value(
-                rng.random(),
-                top_100_cities_dataframe,
-                top_100_cities_population,
-                top_100_cities_population_cumulative_list,
-            ))
-
-        coords_list = []
-        for filtered_city in filtered_cities:
-            noised_coords = add_error_to_coords(filtered_city.coords.lat, filtered_city.coords.lon, rng)
-            coords_list.append(noised_coords)
+) -> List[List[Tuple[float, float]]]:
+    random_values = rng.random(len(cities_lat))
+    additional_cities_numbers = np.select(
+        [random_values < 0.9, random_values < 0.95, random_values < 0.98], [0, 1, 2], default=3)
 
+    additional_lat, additional_lon = top_100_cities.choose(rng.random(int(additional_cities_numbers.sum())))
+    additional_boundaries = np.concatenate([[0], np.cumsum(additional_cities_numbers)])
+
+    lat = np.concatenate([cities_lat, additional_lat])
+    lon = np.concatenate([cities_lon, additional_lon])
+    noised_lat, noised_lon = add_error_to_coords(lat, lon, rng)
+
+    mails_number = len(cities_lat)
+    result = []
+    for idx in range(mails_number):
+        coords_list = [(float(noised_lat[idx]), float(noised_lon[idx]))]
+        for additional_idx in range(additional_boundaries[idx], additional_boundaries[idx + 1]):
+            coords_list.append((float(noised_lat[mails_number + additional_idx]),
+                                float(noised_lon[mails_number + additional_idx])))
         result.append(coords_list)
 
     return result
 
 
-def create_attachment(adps_attachments_path: PurePath, size_bytes: int, rng: FastRandomGenerator) -> FileAttachment:
-    tmp_file_path = adps_attachments_path / 'tmp.bin'
+def write_file_exclusively(folder: str, hashsum_hex: str, extension: str, tmp_path: str) -> str:
+    """
+    Moves the temporary file to the free path named by the partial hashsum. The target path is reserved by
+    the exclusive creation, so parallel workers never overwrite each other's files. Returns the resulted filename.
+    """
+    base_filename = hashsum_hex[:HASHSUM_FILENAME_PART_LEN]
+    filenames = itertools.chain([f'{base_filename}.{extension}'],
+                                (f'{base_filename}_{i:04}.{extension}' for i in range(10000)))
+    for filename in filenames:
+        path = os.path.join(folder, filename)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if calculate_hashsum_hex_from_file(path) == hashsum_hex:
+                os.remove(tmp_path)
+                return filename
+            continue
+
+        os.replace(tmp_path, path)
+        return filename
+
+    raise Exception(f'Could not get free path value for {hashsum_hex!r}')
+
+
+def create_attachment(
+    adps_attachments_path: str,
+    idx: int,
+    size_bytes: int,
+    attachment_content: str,
+    seed: int,
+) -> FileAttachment:
+    """Writes the attachment calculating its hashsum on the fly, the content depends only on the seed and idx"""
+    tmp_file_path = os.path.join(adps_attachments_path, f'.{os.getpid()}_{idx}.tmp')
+    unique_block = sha512(f'{seed}:{idx}'.encode()).digest()
+    file_hash = sha512()
+
     with open(tmp_file_path, 'wb') as file_:
-        file_.write(rng.bytes(size_bytes))
+        if attachment_content == AttachmentContent.SPARSE:
+            header = unique_block[:size_bytes]
+            file_.write(header)
+            file_.truncate(size_bytes)
+            file_hash.update(header)
+
+            zeros = bytes(CHUNK_SIZE_BYTES)
+            remaining_bytes = size_bytes - len(header)
+            while remaining_bytes > 0:
+                file_hash.update(zeros[:remaining_bytes])
+                remaining_bytes -= CHUNK_SIZE_BYTES
+        else:
+            rng = np.random.default_rng([seed, idx])
+            pattern_chunk = unique_block * (CHUNK_SIZE_BYTES // len(unique_block))
+            remaining_bytes = size_bytes
+            while remaining_bytes > 0:
+                chunk_size_bytes = min(remaining_bytes, CHUNK_SIZE_BYTES)
+                if attachment_content == AttachmentContent.RANDOM:
+                    chunk = rng.bytes(chunk_size_bytes)
+                else:
+                    chunk = pattern_chunk[:chunk_size_bytes]
 
-    with open(tmp_file_path, 'rb') as file_:
-        hashsum_result = calculate_hashsum(file_)
+                file_.write(chunk)
+                file_hash.update(chunk)
+                remaining_bytes -= chunk_size_bytes
 
-    target_filename = hashsum_result.hex_digest[:10] + '.bin'
-    target_file_path = adps_attachments_path / target_filename
-    os.rename(tmp_file_path, target_file_path)
+    hashsum_hex = file_hash.hexdigest()
+    target_filename = write_file_exclusively(adps_attachments_path, hashsum_hex, 'bin', tmp_file_path)
+    return FileAttachment(target_filename, size_bytes, hashsum_hex)
 
-    return FileAttachment(target_filename, hashsum_result.size_bytes, hashsum_result.hex_digest)
 
+def _create_attachments_chunk(
+    adps_attachments_path: str,
+    attachment_content: str,
+    seed: int,
+    indexed_sizes: List[Tuple[int, int]],
+) -> List[FileAttachment]:
+    return [create_attachment(adps_attachments_path, idx, size_bytes, attachment_content, seed)
+            for idx, size_bytes in indexed_sizes]
 
-def generate_random_datetime(start, end, rng: FastRandomGenerator):
-    """Generate a random datetime between `start` and `end`"""
-    return start + timedelta(
-        # Get a random amount of seconds between `start` and `end`
-        seconds=int(rng.integers(0, int((end - start).total_seconds()))),
-    )
+
+MailData = Tuple[datetime, List[Tuple[float, float]], str, Optional[str], Optional[str], List[FileAttachment]]
+
+
+def _write_mails_chunk(adps_messages_path: str, mails_data: List[MailData]) -> int:
+    mail_schema = Mail.Schema()
+    for idx, (created_date, coords_list, name, additional_notes, inline_message, attachments) in enumerate(mails_data):
+        mail = Mail(
+            date_created=created_date,
+            recipient_coords=[CoordsData(*one_coords) for one_coords in coords_list],
+            name=name,
+            additional_notes=additional_notes,
+            inline_message=inline_message,
+            attachments=attachments
+        )
+        mail_json_bytes = json.dumps(mail_schema.dump(mail), indent=4, sort_keys=True).encode()
+        hashsum_hex = sha512(mail_json_bytes).hexdigest()
+
+        tmp_file_path = os.path.join(adps_messages_path, f'.{os.getpid()}_{idx}.tmp')
+        with open(tmp_file_path, 'wb') as output_json_file:
+            output_json_file.write(mail_json_bytes)
+        write_file_exclusively(adps_messages_path, hashsum_hex, 'json', tmp_file_path)
+
+    return len(mails_data)
+
+
+def split_to_chunks(items: Sequence, chunks_number: int) -> List[Sequence]:
+    chunk_size = max(1, -(-len(items) // chunks_number))
+    return [items[idx:idx + chunk_size] for idx in range(0, len(items), chunk_size)]
+
+
+def run_in_pool(executor: ProcessPoolExecutor, func: Callable[[Sequence], T], chunks: List[Sequence]) -> List[T]:
+    futures = [executor.submit(func, chunk) for chunk in chunks]
+    five_percent_step = max(1, len(futures) // 20)
+    results = []
+    for idx, future in enumerate(futures):
+        results.append(future.result())
+        if (idx + 1) % five_percent_step == 0:
+            print(f'...{(idx + 1) * 100 // len(futures)}%...')
+
+    return results
+
+
+def generate_random_datetimes(start: datetime, end: datetime, number: int, rng: FastRandomGenerator) -> List[datetime]:
+    """Generate random datetimes between `start` and `end`"""
+    seconds = rng.integers(0, int((end - start).total_seconds()), number)
+    return [start + timedelta(seconds=int(seconds_)) for seconds_ in seconds]
 
 
 # https://stackoverflow.com/a/60703924
@@ -292,153 +395,197 @@ def find_collisions():
     return [s.encode() for s in (str1, str2, mail_1_json_str, mail_2_json_str)]
 
 
-def main():
-    worldcities_path = PurePath(__file__).parents[1] / 'static_files/worldcities/worldcities.csv'
-    first_names_path = PurePath(__file__).parents[1] / 'static_files/name_databases/all.txt'
+def write_partial_collisions(adps_messages_path: PurePath, adps_attachments_path: PurePath):
+    attachment_1_content, attachment_2_content, msg_json_1, msg_json_2 = find_collisions()
 
-    output_dir = sys.argv[1]
+    for folder, extension, contents in [
+        (adps_messages_path, 'json', [msg_json_1, msg_json_2]),
+        (adps_attachments_path, 'bin', [attachment_1_content, attachment_2_content]),
+    ]:
+        for idx, content in enumerate(contents):
+            tmp_file_path = str(folder / f'.{os.getpid()}_collision_{idx}.tmp')
+            with open(tmp_file_path, 'wb') as output_file:
+                output_file.write(content)
+            write_file_exclusively(str(folder), sha512(content).hexdigest(), extension, tmp_file_path)
 
-    target_country_code_iso2 = 'RU'
-    target_country_part = 0.8
-    rest_part = 1 - target_country_part
 
-    mail_number = 50000
-    attachment_number = 100000
-    target_country_mail_number = round(target_country_part * mail_number)
-    other_countries_mail_number = round(rest_part * mail_number)
+def parse_country_mix(country_mix: Sequence[str]) -> Dict[str, float]:
+    result = {}
+    for country_share in country_mix:
+        country_code, _, share = country_share.partition('=')
+        result[country_code.upper()] = float(share)
 
-    datetime_from = datetime(2022, 1, 1)
-    datetime_to = datetime(2023, 1, 1)
+    if sum(result.values()) > 1.0:
+        raise click.BadParameter('the sum of the country shares should not exceed 1.0', param_hint='--country')
 
-    dataframe = pd.read_csv(worldcities_path)
+    return result
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
+def generate_repository(
+    output_dir: str,
+    mail_number: int,
+    attachment_number: int,
+    seed: int,
+    country_mix: Dict[str, float],
+    attachments_size_bytes: int,
+    big_attachments: bool,
+    attachment_content: str,
+    workers: int,
+    datetime_from: datetime,
+    datetime_to: datetime,
+    collisions: bool,
+    cities_csv_path: str,
+    names_path: str,
+):
     adps_messages_path = PurePath(output_dir) / 'adps_messages'
     adps_attachments_path = PurePath(output_dir) / 'adps_attachments'
 
-    os.mkdir(adps_messages_path)
-    os.mkdir(adps_attachments_path)
+    os.makedirs(adps_messages_path)
+    os.makedirs(adps_attachments_path)
 
-    rng = FastRandomGenerator(np.random.default_rng(SEED))
+    rng = FastRandomGenerator(np.random.default_rng(seed))
 
-    target_country_dataframe = dataframe.loc[dataframe['iso2'] == target_country_code_iso2]
-    target_country_population = target_country_dataframe['population'].sum()
-    target_country_cumulative_population_list = get_cumulative_list(target_country_dataframe)
+    print('Reading cities database...')
+    dataframe = pd.read_csv(cities_csv_path)
+    top_100_cities = CitiesGroup.from_dataframe(dataframe.sort_values(by=['population'], ascending=False).head(100))
 
-    other_countries_dataframe = dataframe.loc[dataframe['iso2'] != target_country_code_iso2]
-    other_countries_population = other_countries_dataframe['population'].sum()
-    other_countries_cumulative_population_list = get_cumulative_list(other_countries_dataframe)
-
-    print('Filtering target country cities...')
-    target_country_cities = [
-        choose_city_by_random_value(rng.random(), target_country_dataframe, target_country_population,
-                                    target_country_cumulative_population_list)
-        for _ in range(target_country_mail_number)
-    ]
-
-    print('Filtering other countries cities...')
-    other_countries_cities = [
-        choose_city_by_random_value(rng.random(), other_countries_dataframe, other_countries_population,
-                                    other_countries_cumulative_population_list)
-        for _ in range(other_countries_mail_number)
+    print('Choosing cities...')
+    mail_numbers_by_country = {country_code: round(share * mail_number) for country_code, share in country_mix.items()}
+    other_countries_mail_number = mail_number - sum(mail_numbers_by_country.values())
+    cities_groups = [
+        (CitiesGroup.from_dataframe(dataframe.loc[dataframe['iso2'] == country_code]), country_mail_number)
+        for country_code, country_mail_number in mail_numbers_by_country.items()
     ]
-
-    print('Filtering top 100 cities...')
-    top_100_cities_dataframe = dataframe.sort_values(by=['population'], ascending=False).head(100)
-    top_100_cities_population = top_100_cities_dataframe['population'].sum()
-    top_100_cities_cumulative_population_list = get_cumulative_list(top_100_cities_dataframe)
-
-    big_files_sizes = [1024 ** 3, *([512 * 1024 ** 2] * 2), *([256 * 1024 ** 2] * 4), *([128 * 1024 ** 2] * 8)]
+    cities_groups.append((
+        CitiesGroup.from_dataframe(dataframe.loc[~dataframe['iso2'].isin(list(country_mix))]),
+        other_countries_mail_number
+    ))
+
+    cities_lat, cities_lon = [], []
+    for cities_group, group_mail_number in cities_groups:
+        group_lat, group_lon = cities_group.choose(rng.random(group_mail_number))
+        cities_lat.append(group_lat)
+        cities_lon.append(group_lon)
+
+    big_files_sizes = ([1024 ** 3, *([512 * 1024 ** 2] * 2), *([256 * 1024 ** 2] * 4), *([128 * 1024 ** 2] * 8)]
+                       if big_attachments else [])
     short_files_sizes = list(np.diff([0, *get_file_sizes_bytes(attachment_number - len(big_files_sizes),
-                                                               1 * 1024 * 1024 * 1024,
+                                                               attachments_size_bytes,
                                                                rng=rng)]))
 
     print('Reading names database...')
-    names_df = pd.read_csv(first_names_path, header=None)
-    all_names = list(names_df[0])
-
-    print('Creating big attachments...')
-    big_attachments = [create_attachment(adps_attachments_path, file_size_bytes, rng)
-                       for file_size_bytes in big_files_sizes]
-
-    print('Creating small attachments...')
-    small_attachments = [create_attachment(adps_attachments_path, file_size_bytes, rng)
-                         for file_size_bytes in short_files_sizes]
-
-    print('Generating names...')
-    list_of_names = [generate_name(all_names, rng) for _ in range(mail_number)]
+    names_df = pd.read_csv(names_path, header=None)
+    all_names = names_df[0].to_numpy(dtype=str)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        print('Creating attachments...')
+        indexed_sizes = list(enumerate(int(size_bytes) for size_bytes in [*big_files_sizes, *short_files_sizes]))
+        attachments_chunks = run_in_pool(
+            executor,
+            partial(_create_attachments_chunk, str(adps_attachments_path), attachment_content, seed),
+            # big attachments go to separate chunks, so they are written in parallel
+            [*([indexed_size] for indexed_size in indexed_sizes[:len(big_files_sizes)]),
+             *split_to_chunks(indexed_sizes[len(big_files_sizes):], workers * 16)],
+        )
+        attachments = [attachment for chunk in attachments_chunks for attachment in chunk]
+        big_attachments_list = attachments[:len(big_files_sizes)]
+        small_attachments_list = attachments[len(big_files_sizes):]
 
-    print('Generating additional notes...')
-    list_of_additional_notes = [generate_additional_notes(all_names, rng) for _ in range(mail_number)]
+        print('Generating names...')
+        list_of_names = generate_names(all_names, mail_number, rng)
 
-    print('Generating inline messages...')
-    list_of_inline_messages = [generate_inline_message(all_names, rng) for _ in range(mail_number)]
+        print('Generating additional notes...')
+        list_of_additional_notes = generate_additional_notes(all_names, mail_number, rng)
 
-    print('Generating dates...')
-    list_of_date_created = [generate_random_datetime(datetime_from, datetime_to, rng) for _ in range(mail_number)]
+        print('Generating inline messages...')
+        list_of_inline_messages = generate_inline_messages(all_names, mail_number, rng)
 
-    print('Generating attachments sets...')
-    list_of_attachments = [choose_attachments_for_mail(big_attachments, small_attachments, rng)
-                           for _ in range(mail_number)]
+        print('Generating dates...')
+        list_of_date_created = generate_random_datetimes(datetime_from, datetime_to, mail_number, rng)
 
-    print('Generating coordinates...')
-    list_of_coords = get_list_of_coords([*target_country_cities, *other_countries_cities],
-                                        top_100_cities_dataframe,
-                                        top_100_cities_population,
-                                        top_100_cities_cumulative_population_list,
-                                        rng)
+        print('Generating attachments sets...')
+        list_of_attachments = [choose_attachments_for_mail(big_attachments_list, small_attachments_list, rng)
+                               for _ in range(mail_number)]
 
-    five_percent_indexes = {i * mail_number // 20 for i in range(1, 20)}
+        print('Generating coordinates...')
+        list_of_coords = get_list_of_coords(
+            np.concatenate(cities_lat), np.concatenate(cities_lon), top_100_cities, rng)
 
-    progress = 0.00
-    for idx, (created_date, coords_list, name, additional_notes, inline_message, attachment_infos) in enumerate(zip(
+        print('Generating mail json files...')
+        mails_data = list(zip(
             list_of_date_created,
             list_of_coords,
             list_of_names,
             list_of_additional_notes,
             list_of_inline_messages,
             list_of_attachments
-    )):
-        if idx in five_percent_indexes:
-            progress += 0.05
-            print(f'Generating mail json files...{int(progress * 100)}%...')
-
-        mail = Mail(
-            date_created=created_date,
-            recipient_coords=[CoordsData(*one_coords) for one_coords in coords_list],
-            name=name,
-            additional_notes=additional_notes,
-            inline_message=inline_message,
-            attachments=attachment_infos
-        )
-        mail_serialized = Mail.Schema().dump(mail)
-        mail_json_bytes = json.dumps(mail_serialized, indent=4, sort_keys=True).encode()
-        hashsum = calculate_hashsum(BytesIO(mail_json_bytes))
-
-        mail_path = adps_messages_path / (hashsum.hex_digest[:10] + '.json')
-        with open(mail_path, 'wb') as output_json_file:
-            output_json_file.write(mail_json_bytes)
-
-    print('Generating partial collisions...')
-    attachment_1_content, attachment_2_content, msg_json_1, msg_json_2 = find_collisions()
-    attachment_1_hashsum = sha512(attachment_1_content).hexdigest()
-    attachment_2_hashsum = sha512(attachment_2_content).hexdigest()
-    msg_json_1_hashsum = sha512(msg_json_1).hexdigest()
-    msg_json_2_hashsum = sha512(msg_json_2).hexdigest()
-
-    with open(adps_messages_path / (msg_json_1_hashsum[:10] + '.json'), 'wb') as output_json_file:
-        output_json_file.write(msg_json_1)
-
-    with open(adps_messages_path / (msg_json_2_hashsum[:10] + '_0' + '.json'), 'wb') as output_json_file:
-        output_json_file.write(msg_json_2)
-
-    with open(adps_attachments_path / (attachment_1_hashsum[:10] + '.bin'), 'wb') as output_attachment_file:
-        output_attachment_file.write(attachment_1_content)
-
-    with open(adps_attachments_path / (attachment_2_hashsum[:10] + '_0' + '.bin'), 'wb') as output_attachment_file:
-        output_attachment_file.write(attachment_2_content)
+        ))
+        run_in_pool(executor, partial(_write_mails_chunk, str(adps_messages_path)),
+                    split_to_chunks(mails_data, workers * 16))
+
+    if collisions:
+        print('Generating partial collisions...')
+        write_partial_collisions(adps_messages_path, adps_attachments_path)
+
+
+@click.command(help='Generates the synthetic repository for benchmarks')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--mails', 'mail_number', type=click.IntRange(min=1), default=50000)
+@click.option('--attachments', 'attachment_number', type=click.IntRange(min=1), default=100000)
+@click.option('--seed', type=click.INT, default=SEED)
+@click.option('--country', 'country_mix', type=click.STRING, multiple=True, default=['RU=0.8'],
+              help='Share of the mails to the country, e.g. "--country RU=0.6 --country BY=0.1", '
+                   'the rest goes to the other countries')
+@click.option('--attachments-size-bytes', type=click.IntRange(min=1), default=1024 ** 3,
+              help='Total size of the small attachments')
+@click.option('--big-attachments/--no-big-attachments', default=True,
+              help='Add 15 attachments from 128 MB to 1 GB')
+@click.option('--attachment-content',
+              type=click.Choice([AttachmentContent.RANDOM, AttachmentContent.PATTERN, AttachmentContent.SPARSE],
+                                case_sensitive=False),
+              default=AttachmentContent.RANDOM)
+@click.option('--workers', type=click.IntRange(min=1), default=os.cpu_count() or 1)
+@click.option('--datetime-from', type=click.DateTime(), default='2022-01-01')
+@click.option('--datetime-to', type=click.DateTime(), default='2023-01-01')
+@click.option('--collisions/--no-collisions', default=True, help='Add the pair of partial collisions (slow)')
+@click.option('--cities-csv', 'cities_csv_path', type=click.Path(exists=True, dir_okay=False),
+              default=DEFAULT_CITIES_CSV_PATH)
+@click.option('--names', 'names_path', type=click.Path(exists=True, dir_okay=False), default=DEFAULT_NAMES_PATH)
+def main(
+    output_dir: str,
+    mail_number: int,
+    attachment_number: int,
+    seed: int,
+    country_mix: Sequence[str],
+    attachments_size_bytes: int,
+    big_attachments: bool,
+    attachment_content: str,
+    workers: int,
+    datetime_from: datetime,
+    datetime_to: datetime,
+    collisions: bool,
+    cities_csv_path: str,
+    names_path: str,
+):
+    if attachment_number - (15 if big_attachments else 0) < 5:
+        raise click.BadParameter('there should be at least 5 small attachments', param_hint='--attachments')
+
+    generate_repository(
+        output_dir=output_dir,
+        mail_number=mail_number,
+        attachment_number=attachment_number,
+        seed=seed,
+        country_mix=parse_country_mix(country_mix),
+        attachments_size_bytes=attachments_size_bytes,
+        big_attachments=big_attachments,
+        attachment_content=attachment_content.upper(),
+        workers=workers,
+        datetime_from=datetime_from,
+        datetime_to=datetime_to,
+        collisions=collisions,
+        cities_csv_path=cities_csv_path,
+        names_path=names_path,
+    )
 
 
 if __name__ == '__main__':
@@ -1,21 +1,43 @@
 # -*- coding: utf-8 -*-
+import bisect
+import functools
+import hashlib
+import heapq
 import itertools
 import json
+import math
 import os
 import os.path
 import string
+import tempfile
+import threading
+import time
 from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
 from glob import glob, iglob
-from io import BytesIO
-from json import load
 from pathlib import Path, PurePath
+from random import Random
 from shutil import copyfile
-from typing import Callable, Collection, Dict, Generator, List, NamedTuple, Optional, Tuple, Union
+from typing import (TYPE_CHECKING, Callable, Collection, Container, Dict, Generator, Iterable, List, NamedTuple,
+                    Optional, Set, Tuple, Union)
 
-from pyadps.helpers import calculate_hashsum, calculate_hashsum_hex_from_file
-from pyadps.mail import Mail, MailAttachmentInfo, MailFilter
+from pyadps import metrics
+from pyadps.collision_index import CollisionDepthError, CollisionIndex
+from pyadps.date_index import DateIndex
+from pyadps.hashing import get_default_engine
+from pyadps.helpers import calculate_hashsum_hex_from_bytes, sync_folder
+from pyadps.mail import (CoordsData, FileAttachment, Mail, MailAttachmentInfo, MailFilter, dump_mail_dict,
+                         get_distance_meters, load_mail_dict)
+from pyadps.pack import MessagePack, PackIndexEntry
+from pyadps.profiling import stage
+
+if TYPE_CHECKING:
+    from marshmallow import Schema as MarshmallowSchema
+
+    from pyadps.archive import ArchiveEntry, RepositoryArchive
+    from pyadps.sampling import CountEstimate
+    from pyadps.table import MailTable
 
 
 class MessageFileTooBigError(Exception):
@@ -34,6 +56,18 @@ class FilteredMailResult:
     mail_hashsum_hex: str
 
 
+def dump_filtered_mail_result(filtered_mail_result: FilteredMailResult) -> dict:
+    return {
+        'mail': dump_mail_dict(filtered_mail_result.mail),
+        'mail_path': filtered_mail_result.mail_path,
+        'mail_hashsum_hex': filtered_mail_result.mail_hashsum_hex,
+    }
+
+
+def load_filtered_mail_result(data: dict) -> FilteredMailResult:
+    return FilteredMailResult(load_mail_dict(data['mail']), data['mail_path'], data['mail_hashsum_hex'])
+
+
 @dataclass
 class EstimationFileResult:
     path: str
@@ -78,138 +112,847 @@ class CopyMailsCallbackData(NamedTuple):
     copying_progress: Optional[CopyMailCallbackData] = None
 
 
+class SortBy:
+    DATE = 'DATE'  # the newest first
+    DISTANCE = 'DISTANCE'  # the nearest to the location first
+    SIZE = 'SIZE'  # the smallest total size of the attachments first
+
+    ALL = (DATE, DISTANCE, SIZE)
+
+
+def get_filter_location(mail_filter: Optional[MailFilter]) -> Optional[CoordsData]:
+    if mail_filter is None:
+        return None
+
+    if mail_filter.location_filter is not None:
+        return mail_filter.location_filter.location
+
+    if mail_filter.damping_distance_filter is not None:
+        return mail_filter.damping_distance_filter.location
+
+    return None
+
+
+def get_sort_score(mail: Mail, sort_by: str, location: Optional[CoordsData] = None) -> float:
+    """The messages with the higher score go first"""
+    if sort_by == SortBy.DATE:
+        return mail.date_created.timestamp()
+
+    if sort_by == SortBy.DISTANCE:
+        if location is None:
+            raise ValueError('location is required for sorting by distance')
+
+        with stage('geodesic'):
+            return -min(
+                (get_distance_meters(coords.to_tuple(), location.to_tuple()) for coords in mail.recipient_coords),
+                default=math.inf,
+            )
+
+    if sort_by == SortBy.SIZE:
+        return -sum(attachment.size_bytes for attachment in mail.attachments)
+
+    raise ValueError(f'Unknown sort_by {sort_by!r}')
+
+
+class TopResults:
+    """The results with the highest scores in the descending order, only `limit` of them are kept if it is set"""
+
+    def __init__(self, get_score: Callable[[Mail], float], limit: Optional[int] = None):
+        self.get_score = get_score
+        self.limit = limit
+
+        # (score, -sequence number, result), the earlier result goes first among the equal scores
+        self._items: List[Tuple[float, int, FilteredMailResult]] = []
+        self._pushed_number = 0
+
+    def push(self, filtered_mail_result: FilteredMailResult):
+        item = (self.get_score(filtered_mail_result.mail), -self._pushed_number, filtered_mail_result)
+        self._pushed_number += 1
+
+        if self.limit is None:
+            self._items.append(item)
+        elif len(self._items) < self.limit:
+            heapq.heappush(self._items, item)
+        elif self.limit > 0 and item[:2] > self._items[0][:2]:
+            heapq.heapreplace(self._items, item)
+
+    def is_full(self) -> bool:
+        return self.limit is not None and len(self._items) >= self.limit
+
+    def get_min_score(self) -> float:
+        """The score of the last result if the results are full"""
+        return self._items[0][0] if self.limit is not None else min(item[0] for item in self._items)
+
+    def get_sorted(self) -> List[FilteredMailResult]:
+        return [item[2] for item in sorted(self._items, key=lambda item: item[:2], reverse=True)]
+
+
+class MessagePathsSpill:
+    """
+    Append-only list of the message paths kept in the temporary file, so the confirmation list of a large
+    delete doesn't grow the memory. It can be iterated many times, but not while it is appended.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._count = 0
+
+    def append(self, msg_path: str):
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(json.dumps(msg_path) + '\n')  # JSON keeps the newlines of the path in one line
+        self._count += 1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Generator[str, None, None]:
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> 'MessagePathsSpill':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class Storage:
     MESSAGES_FOLDER = 'adps_messages'
     ATTACHMENTS_FOLDER = 'adps_attachments'
     HASHSUM_FILENAME_PART_LEN = 10
     MESSAGE_FILE_MAX_SIZE_BYTES = 4 * 1024  # 4 KB
 
+    PACK_FILENAME = 'adps_messages.pack'
+    PACK_INDEX_FILENAME = 'adps_messages.pack.idx'
+    DATE_INDEX_FILENAME = 'adps_messages.dates.idx'
+    ESTIMATION_MIN_SAMPLES = 30  # the normal approximation of the interval is too rough for the smaller samples
+    MAX_COLLISION_DEPTH = 10000  # the colliding files are <prefix>_0000 .. <prefix>_9999
+    COLLISION_INDEX_SUFFIX = '.hashsums.idx'  # <root>/adps_messages.hashsums.idx, see create_collision_index
+    SERVE_SOCKET_FILENAME = 'adps_serve.sock'  # of `adps serve`, see pyadps.daemon
+    DELETE_JOURNAL_FILENAME = 'adps_delete.journal'  # see pyadps.delete_journal
+    DELETE_LOCK_FILENAME = 'adps_delete.lock'  # see pyadps.delete_journal.DeleteLock
+
+    # The packs, the date indexes and the archives by the absolute path of their repository. They are shared by
+    # the instances and the classmethods which get the repository from the message path (load_mail,
+    # read_message_bytes, ...), revalidate themselves by the stats of their files and are dropped by clear_caches.
+    _message_packs: Dict[str, MessagePack] = {}
+    _date_indexes: Dict[str, DateIndex] = {}
+    _archives: Dict[str, 'RepositoryArchive'] = {}
+    _caches_lock = threading.Lock()
+
     def __init__(self, root_dir_path: str):
         self.root_dir_path = root_dir_path
 
     @classmethod
-    def get_free_file_path(cls, path: Union[str, PurePath], hashsum_hex: str) -> FileSearchResult:
-        attempts = 10000
+    def clear_caches(cls, root_dir_path: Optional[Union[str, PurePath]] = None):
+        """Drops the cached pack, date index and archive of the repository, of all repositories by default"""
+        caches: List[dict] = [cls._message_packs, cls._date_indexes, cls._archives]
+        with cls._caches_lock:
+            for cache in caches:
+                if root_dir_path is None:
+                    cache.clear()
+                else:
+                    cache.pop(os.path.abspath(root_dir_path), None)
+
+    @classmethod
+    def get_message_pack(cls, root_dir_path: Union[str, PurePath]) -> MessagePack:
+        abs_root_dir_path = os.path.abspath(root_dir_path)
+        with cls._caches_lock:
+            message_pack = cls._message_packs.get(abs_root_dir_path)
+            if message_pack is None:
+                message_pack = cls._message_packs[abs_root_dir_path] = MessagePack(
+                    os.path.join(abs_root_dir_path, cls.PACK_FILENAME),
+                    os.path.join(abs_root_dir_path, cls.PACK_INDEX_FILENAME),
+                )
+
+        return message_pack
+
+    @classmethod
+    def get_date_index(cls, root_dir_path: Union[str, PurePath]) -> DateIndex:
+        abs_root_dir_path = os.path.abspath(root_dir_path)
+        with cls._caches_lock:
+            date_index = cls._date_indexes.get(abs_root_dir_path)
+            if date_index is None:
+                date_index = cls._date_indexes[abs_root_dir_path] = DateIndex(
+                    os.path.join(abs_root_dir_path, cls.DATE_INDEX_FILENAME))
+
+        return date_index
+
+    @classmethod
+    def get_repository_archive(cls, root_dir_path: Union[str, PurePath]) -> Optional['RepositoryArchive']:
+        """
+        Returns the archive if the repository is a zip or plain tar archive, raises ArchiveError if it's a compressed
+        tar (see pyadps.archive)
+        """
+        if not os.path.isfile(root_dir_path):
+            return None
+
+        from pyadps.archive import open_repository_archive
+
+        abs_root_dir_path = os.path.abspath(root_dir_path)
+        with cls._caches_lock:
+            archive = cls._archives.get(abs_root_dir_path)
+        if archive is None or archive.is_changed():
+            archive = open_repository_archive(abs_root_dir_path, [cls.MESSAGES_FOLDER, cls.ATTACHMENTS_FOLDER])
+            with cls._caches_lock:
+                if archive is None:
+                    cls._archives.pop(abs_root_dir_path, None)
+                    return None
+                cls._archives[abs_root_dir_path] = archive
+
+        return archive
+
+    @classmethod
+    def get_archive_entry(cls, path: Union[str, PurePath]) -> Optional['ArchiveEntry']:
+        """Returns the archive entry if the file is stored in the archive of its repository"""
+        pure_path = PurePath(os.path.abspath(path))
+        if len(pure_path.parents) < 2:
+            return None
+
+        archive = cls.get_repository_archive(pure_path.parents[1])
+        return archive.get_entry(pure_path.parent.name, pure_path.name) if archive is not None else None
+
+    def get_generation(self) -> tuple:
+        """
+        Digest of the message filenames and stats of the pack index: the message filenames are derived from their
+        content and the pack index is only appended to or removed, so the messages are the same while this is
+        the same. The filenames are listed because the mtime of the folder may be as coarse as 2 s (FAT), so
+        the messages written within that time wouldn't change it
+        """
+        def get_stat(path: str) -> Optional[Tuple[int, int]]:
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                return None
+            return stat_result.st_size, stat_result.st_mtime_ns
+
+        if os.path.isfile(self.root_dir_path):
+            return (get_stat(self.root_dir_path),)  # the archive is replaced as a whole
+
+        try:
+            filenames = sorted(os.listdir(os.path.join(self.root_dir_path, self.MESSAGES_FOLDER)))
+        except FileNotFoundError:
+            filenames_digest = None
+        else:  # NUL can't be in the filenames
+            filenames_digest = hashlib.sha256('\0'.join(filenames).encode('utf-8', 'surrogateescape')).hexdigest()
+
+        return (
+            filenames_digest,
+            get_stat(os.path.join(self.root_dir_path, self.PACK_INDEX_FILENAME)),
+        )
+
+    @classmethod
+    def get_packed_message_entry(cls, msg_path: Union[str, PurePath]) -> Optional[PackIndexEntry]:
+        """Returns the pack entry if the message file is stored in the pack of its repository"""
+        pure_path = PurePath(os.path.abspath(msg_path))
+        if pure_path.parent.name != cls.MESSAGES_FOLDER:
+            return None
+
+        return cls.get_message_pack(pure_path.parents[1]).get_entries().get(pure_path.name)
+
+    @classmethod
+    def _iter_files_hashsums_hex(
+        cls,
+        paths: Iterable[Union[str, PurePath]],
+    ) -> Generator[Tuple[Union[str, PurePath], Optional[str]], None, None]:
+        """
+        Yields (path, hashsum hex) up to the first missing file, its hashsum is None. The loose files are hashed
+        concurrently by the batches of the hashsum engine workers number, the packed ones are taken from the index.
+        """
+        hashsum_engine = get_default_engine()
+        paths_iterator = iter(paths)
+        while True:
+            batch = list(itertools.islice(paths_iterator, hashsum_engine.workers))
+            if not batch:
+                return
+
+            batch_hashsums_hex: List[Optional[str]] = []
+            loose_paths_idxs: List[int] = []
+            for path in batch:
+                if os.path.isfile(path):
+                    loose_paths_idxs.append(len(batch_hashsums_hex))
+                    batch_hashsums_hex.append(None)
+                    continue
+
+                packed_entry = cls.get_packed_message_entry(path)
+                if packed_entry is None:
+                    break
+
+                # the hashsum of the packed message is stored in the pack index
+                metrics.increment('hashsum_cache_hits')
+                batch_hashsums_hex.append(packed_entry.hashsum_hex)
+
+            metrics.increment('hashsum_lookups', len(batch_hashsums_hex))
+            hash_results = hashsum_engine.hash_files(batch[idx] for idx in loose_paths_idxs)
+            for idx, hash_result in zip(loose_paths_idxs, hash_results):
+                batch_hashsums_hex[idx] = hash_result.hex_digest
+
+            yield from zip(batch, batch_hashsums_hex)
+            if len(batch_hashsums_hex) < len(batch):
+                yield batch[len(batch_hashsums_hex)], None
+                return
+
+    @classmethod
+    def get_collision_index_path(cls, folder_path: Union[str, PurePath]) -> str:
+        return os.path.abspath(folder_path) + cls.COLLISION_INDEX_SUFFIX
+
+    @classmethod
+    def create_collision_index(cls, folder_path: Union[str, PurePath]) -> CollisionIndex:
+        """
+        The collision index for one operation writing to the folder, the packed messages are included. The hashsums
+        are persisted if the index file exists, it is created by `adps index --hashsums`
+        """
+        pure_path = PurePath(os.path.abspath(folder_path))
+        known_entries = {}
+        if pure_path.name == cls.MESSAGES_FOLDER:
+            known_entries = {entry.filename: (entry.size_bytes, entry.hashsum_hex)
+                             for entry in cls.get_message_pack(pure_path.parent).get_entries().values()}
 
-        if not os.path.isfile(path):
-            return FileSearchResult(path, False)
+        index_path = cls.get_collision_index_path(pure_path)
+        return CollisionIndex(pure_path, cls.MAX_COLLISION_DEPTH, known_entries,
+                              index_path if os.path.isfile(index_path) else None)
 
-        if calculate_hashsum_hex_from_file(path) == hashsum_hex:
-            return FileSearchResult(path, True)
+    @classmethod
+    def get_free_file_path(
+        cls,
+        path: Union[str, PurePath],
+        hashsum_hex: str,
+        collision_index: Optional[CollisionIndex] = None,
+        size_bytes: Optional[int] = None,
+    ) -> FileSearchResult:
+        """
+        Returns the path of the file with the hashsum or the first free path among path and its suffixed variants.
+        The operations saving many files pass the collision index of the folder (see create_collision_index)
+        instead of probing the files one by one, size_bytes of the content lets the index skip the files of
+        another size.
+        """
+        if collision_index is not None:
+            return FileSearchResult(*collision_index.get_free_file_path(path, hashsum_hex, size_bytes))
 
         root, ext = os.path.splitext(path)
-        for i in range(attempts):
-            new_path = f'{root}_{i:04}{ext}'
-            if not os.path.isfile(new_path):
-                return FileSearchResult(new_path, False)
+        candidate_paths = itertools.chain([path], (f'{root}_{i:04}{ext}' for i in range(cls.MAX_COLLISION_DEPTH)))
+        for collision_depth, (candidate_path, existing_hashsum_hex) in enumerate(
+            cls._iter_files_hashsums_hex(candidate_paths)
+        ):
+            if existing_hashsum_hex is None or existing_hashsum_hex == hashsum_hex:
+                metrics.observe('collision_depth', collision_depth)
+                return FileSearchResult(candidate_path, existing_hashsum_hex is not None)  # type: ignore
+
+        raise CollisionDepthError(f'Could not get free path value for {path!r}')
 
-            if calculate_hashsum_hex_from_file(new_path) == hashsum_hex:
-                return FileSearchResult(new_path, True)
+    def _find_archive_attachment_path(self, archive: 'RepositoryArchive', hashsum_hex: str) -> str:
+        # <prefix>.bin is sorted before <prefix>_0000.bin
+        candidate_entries = archive.find_entries(self.ATTACHMENTS_FOLDER, hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN])
+        for candidates_number, entry in enumerate(candidate_entries, start=1):
+            if archive.calculate_hashsum_hex(entry) == hashsum_hex:
+                metrics.observe('attachment_lookup_candidates', candidates_number)
+                return os.path.join(archive.archive_path, self.ATTACHMENTS_FOLDER, entry.filename)
 
-        raise Exception(f'Could not get free path value for {path!r}')
+        raise FileNotFoundError(f'The attachment {hashsum_hex} is not found')
 
     def find_attachment_path(self, hashsum_hex: str) -> str:
+        archive = self.get_repository_archive(self.root_dir_path)
+        if archive is not None:
+            return self._find_archive_attachment_path(archive, hashsum_hex)
+
         attachments_folder_path = PurePath(self.root_dir_path) / self.ATTACHMENTS_FOLDER
 
         default_path = attachments_folder_path / (hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN] + '.bin')
         default_paths = [default_path] if os.path.exists(default_path) else []
 
-        for attachment_path in itertools.chain(
+        candidate_paths = itertools.chain(
             default_paths,
             iglob(f'{attachments_folder_path}/{hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}*')
-        ):
-            calculated_hashsum = calculate_hashsum_hex_from_file(attachment_path)
-            if calculated_hashsum == hashsum_hex:
-                return os.path.abspath(attachment_path)
-
-        raise FileNotFoundError()
+        )
+        hashsum_engine = get_default_engine()
+        candidates_number = 0
+        # the hashsums are calculated in the nested stages, so the glob stage gets only the listing time
+        with stage('glob'):
+            while batch := list(itertools.islice(candidate_paths, hashsum_engine.workers)):
+                for attachment_path, hash_result in zip(batch, hashsum_engine.hash_files(batch)):
+                    candidates_number += 1
+                    if hash_result.hex_digest == hashsum_hex:
+                        metrics.observe('attachment_lookup_candidates', candidates_number)
+                        return os.path.abspath(attachment_path)
+
+        raise FileNotFoundError(f'The attachment {hashsum_hex} is not found')
 
     @classmethod
-    def load_mail(cls, msg_path) -> Mail:
+    def read_message_bytes(cls, msg_path: Union[str, PurePath]) -> bytes:
+        if not os.path.isfile(msg_path):
+            archive_entry = cls.get_archive_entry(msg_path)
+            if archive_entry is not None:
+                if archive_entry.size_bytes > cls.MESSAGE_FILE_MAX_SIZE_BYTES:
+                    raise MessageFileTooBigError()
+
+                archive = cls.get_repository_archive(PurePath(os.path.abspath(msg_path)).parents[1])
+                return archive.read(archive_entry)  # type: ignore
+
+            packed_entry = cls.get_packed_message_entry(msg_path)
+            if packed_entry is None:
+                raise FileNotFoundError(msg_path)
+
+            if packed_entry.size_bytes > cls.MESSAGE_FILE_MAX_SIZE_BYTES:
+                raise MessageFileTooBigError()
+
+            return cls.get_message_pack(PurePath(os.path.abspath(msg_path)).parents[1]).read(packed_entry)
+
         size_bytes = os.path.getsize(msg_path)
         if size_bytes > cls.MESSAGE_FILE_MAX_SIZE_BYTES:
             raise MessageFileTooBigError()
 
-        with open(msg_path) as msg_json_file:
-            msg_json = load(msg_json_file)
+        with stage('read') as read_stage, open(msg_path, 'rb') as msg_file:
+            msg_bytes = msg_file.read()
+            read_stage.add_bytes(len(msg_bytes))
+            return msg_bytes
+
+    @classmethod
+    def parse_mail(cls, msg_bytes: bytes) -> Mail:
+        if len(msg_bytes) > cls.MESSAGE_FILE_MAX_SIZE_BYTES:
+            raise MessageFileTooBigError()
+
+        with stage('parse'):
+            return load_mail_dict(json.loads(msg_bytes))
+
+    @classmethod
+    def load_mail(cls, msg_path) -> Mail:
+        return cls.parse_mail(cls.read_message_bytes(msg_path))
+
+    def _list_messages(self) -> Tuple[List[str], List[PackIndexEntry]]:
+        """Returns paths of the loose message files and the packed entries which aren't shadowed by them"""
+        messages_folder_path = PurePath(self.root_dir_path) / self.MESSAGES_FOLDER
+        archive = self.get_repository_archive(self.root_dir_path)
+        if archive is not None:
+            return [os.path.join(archive.archive_path, self.MESSAGES_FOLDER, filename)
+                    for filename in archive.get_entries(self.MESSAGES_FOLDER) if filename.endswith('.json')], []
+
+        with stage('glob'):
+            loose_paths = glob(f'{messages_folder_path}/*.json')
+
+            packed_entries = list(self.get_message_pack(self.root_dir_path).get_entries().values())
+            if packed_entries:
+                loose_filenames = {os.path.basename(msg_path) for msg_path in loose_paths}
+                packed_entries = [entry for entry in packed_entries if entry.filename not in loose_filenames]
+
+        return loose_paths, packed_entries
+
+    def _get_packed_message_path(self, entry: PackIndexEntry) -> str:
+        return os.path.abspath(PurePath(self.root_dir_path) / self.MESSAGES_FOLDER / entry.filename)
+
+    def get_message_paths(self) -> List[str]:
+        loose_paths, packed_entries = self._list_messages()
+        return [*loose_paths, *(self._get_packed_message_path(entry) for entry in packed_entries)]
+
+    def iter_messages_bytes(self) -> Generator[Tuple[int, int, str, bytes], None, None]:
+        """
+        Yields (idx, total number, path, content) for every message of the repository.
+        The packed messages are read sequentially with one file handle.
+        """
+        archive = self.get_repository_archive(self.root_dir_path)
+        if archive is not None:
+            yield from self._iter_archive_messages_bytes(archive)
+            return
+
+        loose_paths, packed_entries = self._list_messages()
+        total_number = len(loose_paths) + len(packed_entries)
+
+        for idx, msg_path in enumerate(loose_paths):
+            yield idx, total_number, msg_path, self.read_message_bytes(msg_path)
+
+        message_pack = self.get_message_pack(self.root_dir_path)
+        for idx, (entry, msg_bytes) in enumerate(message_pack.iter_contents(packed_entries), start=len(loose_paths)):
+            if entry.size_bytes > self.MESSAGE_FILE_MAX_SIZE_BYTES:
+                raise MessageFileTooBigError()
+
+            yield idx, total_number, self._get_packed_message_path(entry), msg_bytes
+
+    def _iter_archive_messages_bytes(
+        self,
+        archive: 'RepositoryArchive',
+    ) -> Generator[Tuple[int, int, str, bytes], None, None]:
+        """The messages are read in the order of the archive members, the compressed tar is decompressed once"""
+        entries = [entry for filename, entry in archive.get_entries(self.MESSAGES_FOLDER).items()
+                   if filename.endswith('.json')]
+        for idx, (entry, msg_bytes) in enumerate(archive.iter_contents(entries)):
+            if entry.size_bytes > self.MESSAGE_FILE_MAX_SIZE_BYTES:
+                raise MessageFileTooBigError()
+
+            yield idx, len(entries), os.path.join(archive.archive_path, self.MESSAGES_FOLDER, entry.filename), msg_bytes
+
+    def load_filtered_mail(
+        self,
+        msg_path: str,
+        mail_filter: Optional[MailFilter],
+        msg_bytes: Optional[bytes] = None,
+    ) -> Optional[FilteredMailResult]:
+        if msg_bytes is None:
+            msg_bytes = self.read_message_bytes(msg_path)
+
+        mail = self.parse_mail(msg_bytes)
+        if mail_filter is None or mail_filter.filter_func(mail):
+            hashsum_hex = calculate_hashsum_hex_from_bytes(msg_bytes)
+            return FilteredMailResult(mail, os.path.abspath(msg_path), hashsum_hex)
+
+        return None
+
+    def _scan_mails(
+        self,
+        messages_bytes: Iterable[Tuple[int, int, str, bytes]],
+        mail_filter: Optional[MailFilter],
+        callback: Optional[Callable[[FilterMailCallbackData], None]],
+    ) -> Generator[FilteredMailResult, None, None]:
+        scan_start = time.perf_counter()
+        for idx, total_number, msg_path, msg_bytes in messages_bytes:
+            filtered_mail_result = self.load_filtered_mail(msg_path, mail_filter, msg_bytes)
+            metrics.increment('messages_scanned')
+            if filtered_mail_result is not None:
+                # the time of the consumer is not the scan time
+                metrics.increment('scan_seconds', time.perf_counter() - scan_start)
+                yield filtered_mail_result
+                scan_start = time.perf_counter()
+
+            if callback is not None:
+                callback(FilterMailCallbackData(idx, total_number))
 
-        return Mail.Schema().load(msg_json)
+        metrics.increment('scan_seconds', time.perf_counter() - scan_start)
 
     def filter_mails(
         self,
         mail_filter: Optional[MailFilter],
         callback: Optional[Callable[[FilterMailCallbackData], None]] = None,
+        sort_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        sort_location: Optional[CoordsData] = None,
+        messages_bytes: Optional[Iterable[Tuple[int, int, str, bytes]]] = None,
     ) -> Generator[FilteredMailResult, None, None]:
-        messages_folder_path = PurePath(self.root_dir_path) / self.MESSAGES_FOLDER
-        message_paths = glob(f'{messages_folder_path}/*.json')
-        for idx, msg_path in enumerate(message_paths):
-            mail = self.load_mail(msg_path)
-            hashsum_hex = calculate_hashsum_hex_from_file(msg_path)
-            if mail_filter is None or mail_filter.filter_func(mail):
-                yield FilteredMailResult(mail, os.path.abspath(msg_path), hashsum_hex)
+        """
+        Yields the messages matched by the filter in the order of the files or, with sort_by (see SortBy),
+        in the sorted order. The scan stops after `limit` results if there is no sorting; the sorted results are
+        selected by the bounded heap, or the newest messages are read first if the repository has the date index.
+        The distance is measured from sort_location, by default from the location of the filter.
+        The callback may not get the last message if the scan is stopped early.
+        messages_bytes replaces the messages of the repository (see iter_messages_bytes), e.g. by the saved results.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError('limit should not be negative')
+
+        if sort_by is None:
+            mail_results = self._scan_mails(
+                messages_bytes if messages_bytes is not None else self.iter_messages_bytes(), mail_filter, callback)
+            yield from (mail_results if limit is None else itertools.islice(mail_results, limit))
+            return
+
+        if sort_by == SortBy.DISTANCE:
+            sort_location = sort_location or get_filter_location(mail_filter)
+            if sort_location is None:
+                raise ValueError('sort_location is required for sorting by distance if the filter has no location')
+
+        top_results = TopResults(functools.partial(get_sort_score, sort_by=sort_by, location=sort_location), limit)
+        if messages_bytes is not None:
+            pass
+        elif sort_by == SortBy.DATE and limit is not None and self.get_date_index(self.root_dir_path).exists():
+            messages_bytes = self._iter_messages_bytes_newest_first(top_results)
+        else:
+            messages_bytes = self.iter_messages_bytes()
+
+        for filtered_mail_result in self._scan_mails(messages_bytes, mail_filter, callback):
+            top_results.push(filtered_mail_result)
+
+        yield from top_results.get_sorted()
+
+    def estimate_count(
+        self,
+        mail_filter: Optional[MailFilter],
+        confidence: float = 0.95,
+        max_samples: int = 10000,
+        margin: Optional[float] = None,
+        rng: Optional[Random] = None,
+        callback: Optional[Callable[[FilterMailCallbackData], None]] = None,
+    ) -> 'CountEstimate':
+        """
+        Estimates the number of the messages matched by the filter by the stratified random sample of at most
+        max_samples messages. The sampling stops earlier once the half-width of the confidence interval is at most
+        `margin` messages. The whole repository is scanned if it is not larger than the sample.
+        """
+        from pyadps.sampling import estimate_count, iter_stratified_sample
+
+        if not 0 < confidence < 1:
+            raise ValueError('confidence should be between 0 and 1')
+
+        rng = rng or Random()
+        msg_paths = self.get_message_paths()
+        samples_number = min(max_samples, len(msg_paths))
+
+        matched_number = 0
+        estimate = estimate_count(0, 0, len(msg_paths), confidence)
+        sample = itertools.islice(iter_stratified_sample(msg_paths, rng), samples_number)
+        for idx, msg_path in enumerate(sample):
+            if self.load_filtered_mail(msg_path, mail_filter) is not None:
+                matched_number += 1
+            metrics.increment('messages_sampled')
 
             if callback is not None:
-                callback(FilterMailCallbackData(idx, len(message_paths)))
+                callback(FilterMailCallbackData(idx, samples_number))
+
+            estimate = estimate_count(matched_number, idx + 1, len(msg_paths), confidence)
+            if (margin is not None and idx + 1 >= self.ESTIMATION_MIN_SAMPLES
+                    and (estimate.upper - estimate.lower) / 2 <= margin):
+                break
+
+        return estimate
+
+    def _iter_messages_bytes_newest_first(
+        self,
+        top_results: 'TopResults',
+    ) -> Generator[Tuple[int, int, str, bytes], None, None]:
+        """
+        Same as iter_messages_bytes, but the messages of the date index go newest first after the others and
+        the iteration stops once the next message is older than every one of the full top results
+        """
+        timestamps = self.get_date_index(self.root_dir_path).get_timestamps()
+        unindexed_paths, indexed_paths = [], []
+        for msg_path in self.get_message_paths():
+            (indexed_paths if os.path.basename(msg_path) in timestamps else unindexed_paths).append(msg_path)
+        indexed_paths.sort(key=lambda msg_path: timestamps[os.path.basename(msg_path)], reverse=True)
+
+        total_number = len(unindexed_paths) + len(indexed_paths)
+        for idx, msg_path in enumerate(itertools.chain(unindexed_paths, indexed_paths)):
+            if (idx >= len(unindexed_paths) and top_results.is_full()
+                    and timestamps[os.path.basename(msg_path)] < top_results.get_min_score()):
+                metrics.increment('messages_skipped_by_date_index', total_number - idx)
+                return
+
+            yield idx, total_number, msg_path, self.read_message_bytes(msg_path)
+
+    def update_date_index(self) -> int:
+        """
+        Creates the date index of the repository or adds the missing messages to it, the lines of the deleted
+        messages are dropped. Returns the number of the messages read.
+        """
+        started_at = time.time()
+        date_index = self.get_date_index(self.root_dir_path)
+        timestamps = date_index.get_timestamps()
+
+        read_messages_number = 0
+        new_timestamps: Dict[str, float] = {}
+        for msg_path in self.get_message_paths():
+            filename = os.path.basename(msg_path)
+            if filename not in timestamps:
+                new_timestamps[filename] = self.load_mail(msg_path).date_created.timestamp()
+                read_messages_number += 1
+            else:
+                new_timestamps[filename] = timestamps[filename]
+
+        date_index.write(new_timestamps.items())
+        date_index.set_checkpoint(started_at)
+        return read_messages_number
+
+    def load_table(self, callback: Optional[Callable[[FilterMailCallbackData], None]] = None) -> 'MailTable':
+        """Materializes the metadata of all messages into the columnar table (requires numpy)"""
+        from pyadps.table import MailTable
+        return MailTable.from_mails(
+            (filtered_mail_result.mail, filtered_mail_result.mail_path, filtered_mail_result.mail_hashsum_hex)
+            for filtered_mail_result in self.filter_mails(None, callback)
+        )
+
+    @staticmethod
+    def dump_mail_bytes(mail: Mail, schema: Optional['MarshmallowSchema'] = None) -> bytes:
+        """Serializes the message to the file content, pass the schema instance to reuse it for many messages"""
+        mail_serialized = (schema or Mail.Schema()).dump(mail)
+        return json.dumps(mail_serialized, indent=4, sort_keys=True).encode()
 
     def save_mail(self, mail: Mail, mail_attachment_infos: List[MailAttachmentInfo], target_folder_path: str):
+        self.save_mails([(mail, mail_attachment_infos)], target_folder_path)
+
+    def save_mails(
+        self,
+        mails: Iterable[Tuple[Mail, List[MailAttachmentInfo]]],
+        target_folder_path: str,
+        callback: Optional[Callable[[CopyMailCallbackData], None]] = None,
+    ) -> List[str]:
+        """
+        Saves the messages with their attachments, returns paths of the message files in the order of the messages.
+        The attachments are copied once per hashsum for the whole batch, so the attachment shared by many messages
+        is checked for the collisions and copied only once.
+        """
         messages_folder = PurePath(target_folder_path) / self.MESSAGES_FOLDER
         attachments_folder = PurePath(target_folder_path) / self.ATTACHMENTS_FOLDER
 
         os.makedirs(messages_folder, exist_ok=True)
         os.makedirs(attachments_folder, exist_ok=True)
 
-        mail_serialized = Mail.Schema().dump(mail)
-        mail_json_bytes = json.dumps(mail_serialized, indent=4, sort_keys=True).encode()
-        hashsum = calculate_hashsum(BytesIO(mail_json_bytes))
+        schema = Mail.Schema()
+        messages_bytes: List[bytes] = []
+        messages_timestamps: List[float] = []
+        attachment_path_by_hashsum: Dict[str, str] = {}
+        attachment_size_by_hashsum: Dict[str, int] = {}
+        for mail, mail_attachment_infos in mails:
+            messages_bytes.append(self.dump_mail_bytes(mail, schema))
+            messages_timestamps.append(mail.date_created.timestamp())
+            for attachment in mail.attachments:
+                attachment_size_by_hashsum[attachment.hashsum_hex] = attachment.size_bytes
+            for mail_attachment_info in mail_attachment_infos:
+                attachment_path_by_hashsum.setdefault(mail_attachment_info.hashsum_hex, mail_attachment_info.path)
 
-        file_search_result = self.get_free_file_path(
-            messages_folder
-            / f'{hashsum.hex_digest[:self.HASHSUM_FILENAME_PART_LEN]}.json',
-            hashsum_hex=hashsum.hex_digest
+        total_files_number = len(messages_bytes) + len(attachment_path_by_hashsum)
+        total_files_size_bytes = sum(len(mail_json_bytes) for mail_json_bytes in messages_bytes) + sum(
+            attachment_size_by_hashsum.get(hashsum_hex, 0) for hashsum_hex in attachment_path_by_hashsum
         )
+        saved_bytes = 0
 
-        if not file_search_result.is_exist:
-            with open(file_search_result.path, 'wb') as target_message_file:
-                target_message_file.write(mail_json_bytes)
+        def report_progress(file_idx: int, file_bytes: int):
+            nonlocal saved_bytes
+            saved_bytes += file_bytes
+            if callback is not None:
+                callback(CopyMailCallbackData(
+                    current_file_idx=file_idx,
+                    current_file_bytes=file_bytes,
+                    total_files_number=total_files_number,
+                    total_files_size_bytes=total_files_size_bytes,
+                    copied_bytes=saved_bytes,
+                ))
+
+        msg_paths: List[str] = []
+        new_dates: List[Tuple[str, float]] = []
+        messages_collision_index = self.create_collision_index(messages_folder)
+        for idx, mail_json_bytes in enumerate(messages_bytes):
+            hashsum_hex = calculate_hashsum_hex_from_bytes(mail_json_bytes)
+            file_search_result = self.get_free_file_path(
+                messages_folder / f'{hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}.json',
+                hashsum_hex=hashsum_hex,
+                collision_index=messages_collision_index,
+                size_bytes=len(mail_json_bytes),
+            )
 
-        for mail_attachment_info in mail_attachment_infos:
-            attachment_path = mail_attachment_info.path
+            if not file_search_result.is_exist:
+                with open(file_search_result.path, 'wb') as target_message_file:
+                    target_message_file.write(mail_json_bytes)
+
+            msg_paths.append(os.path.abspath(file_search_result.path))
+            new_dates.append((os.path.basename(file_search_result.path), messages_timestamps[idx]))
+            report_progress(idx, len(mail_json_bytes))
 
+        messages_collision_index.save()
+
+        attachments_collision_index = self.create_collision_index(attachments_folder)
+        for idx, (hashsum_hex, attachment_path) in enumerate(attachment_path_by_hashsum.items(),
+                                                             start=len(messages_bytes)):
             target_file_search_result = self.get_free_file_path(
-                attachments_folder
-                / f'{mail_attachment_info.hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}.bin',
-                hashsum_hex=mail_attachment_info.hashsum_hex
+                attachments_folder / f'{hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}.bin',
+                hashsum_hex=hashsum_hex,
+                collision_index=attachments_collision_index,
+                size_bytes=os.path.getsize(attachment_path),
             )
 
             if not target_file_search_result.is_exist:
                 copyfile(attachment_path, target_file_search_result.path)
 
+            report_progress(idx, attachment_size_by_hashsum.get(hashsum_hex, 0))
+        attachments_collision_index.save()
+
+        date_index = self.get_date_index(target_folder_path)
+        if date_index.exists():
+            date_index.append(new_dates)
+
+        return msg_paths
+
+    def estimate_mail_file(self, msg_path: Union[str, Path]) -> Tuple[EstimationFileResult, Mail]:
+        msg_bytes = self.read_message_bytes(msg_path)
+        msg_hashsum_hex = calculate_hashsum_hex_from_bytes(msg_bytes)
+        return EstimationFileResult(msg_path, msg_hashsum_hex, len(msg_bytes)), self.parse_mail(msg_bytes)
+
+    def estimate_attachment_file(self, attachment: FileAttachment) -> EstimationFileResult:
+        attachment_path = self.find_attachment_path(attachment.hashsum_hex)
+        return EstimationFileResult(attachment_path, attachment.hashsum_hex, attachment.size_bytes)
+
+    @classmethod
+    def get_file_size(cls, path: Union[str, PurePath]) -> int:
+        try:
+            return os.path.getsize(path)
+        except (FileNotFoundError, NotADirectoryError):
+            file_entry = cls.get_packed_message_entry(path) or cls.get_archive_entry(path)
+            if file_entry is None:
+                raise
+
+            return file_entry.size_bytes
+
+    def copy_estimated_file(
+        self,
+        estimation_result: EstimationFileResult,
+        folder: PurePath,
+        extension: str,
+        collision_index: Optional[CollisionIndex] = None,
+    ):
+        file_search_result = self.get_free_file_path(
+            folder
+            / f'{estimation_result.hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}.{extension}',
+            hashsum_hex=estimation_result.hashsum_hex,
+            collision_index=collision_index,
+            size_bytes=self.get_file_size(estimation_result.path) if collision_index is not None else None,
+        )
+
+        if not file_search_result.is_exist:
+            self.copy_file(estimation_result.path, file_search_result.path)
+
+    @classmethod
+    def copy_file(cls, source_path: Union[str, PurePath], target_path: Union[str, PurePath]):
+        copy_start = time.perf_counter()
+        archive_entry = cls.get_archive_entry(source_path) if not os.path.isfile(source_path) else None
+        if archive_entry is not None:
+            archive = cls.get_repository_archive(PurePath(os.path.abspath(source_path)).parents[1])
+            archive.copy(archive_entry, os.fspath(target_path))  # type: ignore
+            copied_bytes = archive_entry.size_bytes
+        elif os.path.isfile(source_path) or cls.get_packed_message_entry(source_path) is None:
+            with stage('copy') as copy_stage:
+                copyfile(source_path, target_path)
+                copied_bytes = os.path.getsize(target_path)
+                copy_stage.add_bytes(copied_bytes)
+        else:
+            msg_bytes = cls.read_message_bytes(source_path)
+            with stage('copy'), open(target_path, 'wb') as target_file:
+                target_file.write(msg_bytes)
+            copied_bytes = len(msg_bytes)
+
+        metrics.increment('files_copied')
+        metrics.increment('copied_bytes', copied_bytes)
+        metrics.increment('copy_seconds', time.perf_counter() - copy_start)
+
+    @staticmethod
+    def _is_excluded(hashsum_hex: str, exclude_hashsums: Optional[Container[str]]) -> bool:
+        if exclude_hashsums is not None and hashsum_hex in exclude_hashsums:
+            metrics.increment('files_excluded')
+            return True
+
+        return False
+
     # todo: Check that source_folder != target_folder
     def copy_mails(
         self,
         msg_paths: Collection[Union[str, Path]],
         target_folder_path: Union[str, Path],
-        callback: Optional[Callable[[CopyMailsCallbackData], None]] = None
+        callback: Optional[Callable[[CopyMailsCallbackData], None]] = None,
+        exclude_hashsums: Optional[Container[str]] = None,
     ):
+        """The files whose hashsums are in exclude_hashsums (e.g. the manifest of the target node) are not copied"""
         mail_files_estimation_results: List[EstimationFileResult] = []
         attachments_files_estimation_results: List[EstimationFileResult] = []
 
         attachments_files_hashsums = set()
 
         for idx, msg_path in enumerate(msg_paths):
-            msg_file_size_bytes = os.path.getsize(msg_path)
-            mail_files_estimation_results.append(
-                EstimationFileResult(msg_path, calculate_hashsum_hex_from_file(msg_path), msg_file_size_bytes)
-            )
+            mail_estimation_result, mail = self.estimate_mail_file(msg_path)
+            if not self._is_excluded(mail_estimation_result.hashsum_hex, exclude_hashsums):
+                mail_files_estimation_results.append(mail_estimation_result)
 
-            mail = self.load_mail(msg_path)
             for attachment in mail.attachments:
                 if attachment.hashsum_hex not in attachments_files_hashsums:
                     attachments_files_hashsums.add(attachment.hashsum_hex)
-                    attachment_path = self.find_attachment_path(attachment.hashsum_hex)
-                    attachments_files_estimation_results.append(
-                        EstimationFileResult(attachment_path, attachment.hashsum_hex, attachment.size_bytes)
-                    )
+                    if not self._is_excluded(attachment.hashsum_hex, exclude_hashsums):
+                        attachments_files_estimation_results.append(self.estimate_attachment_file(attachment))
 
             if callback is not None:
                 callback(CopyMailsCallbackData(
@@ -217,6 +960,24 @@ class Storage:
                     estimation_progress=FilterMailCallbackData(idx, len(msg_paths))
                 ))
 
+        self.copy_estimated_files(
+            mail_files_estimation_results, attachments_files_estimation_results, target_folder_path, callback)
+
+    def copy_estimated_files(
+        self,
+        mail_files_estimation_results: List[EstimationFileResult],
+        attachments_files_estimation_results: List[EstimationFileResult],
+        target_folder_path: Union[str, Path],
+        callback: Optional[Callable[[CopyMailsCallbackData], None]] = None,
+        exclude_hashsums: Optional[Container[str]] = None,
+    ):
+        """The copying stage of copy_mails, the attachments are given once"""
+        if exclude_hashsums is not None:
+            mail_files_estimation_results, attachments_files_estimation_results = (
+                [result for result in estimation_results if not self._is_excluded(result.hashsum_hex, exclude_hashsums)]
+                for estimation_results in [mail_files_estimation_results, attachments_files_estimation_results]
+            )
+
         total_files_number = len(mail_files_estimation_results) + len(attachments_files_estimation_results)
         total_files_size_bytes = sum(
             estimation_result.size_bytes
@@ -230,19 +991,14 @@ class Storage:
         os.makedirs(messages_folder, exist_ok=True)
         os.makedirs(attachments_folder, exist_ok=True)
 
+        collision_indexes = {folder: self.create_collision_index(folder)
+                             for folder in [messages_folder, attachments_folder]}
         copied_bytes = 0
         for idx, (folder, estimation_result, extension) in enumerate(itertools.chain(
             zip(itertools.repeat(messages_folder), mail_files_estimation_results, itertools.repeat('json')),
             zip(itertools.repeat(attachments_folder), attachments_files_estimation_results, itertools.repeat('bin'))
         )):
-            file_search_result = self.get_free_file_path(
-                folder
-                / f'{estimation_result.hashsum_hex[:self.HASHSUM_FILENAME_PART_LEN]}.{extension}',
-                hashsum_hex=estimation_result.hashsum_hex
-            )
-
-            if not file_search_result.is_exist:
-                copyfile(estimation_result.path, file_search_result.path)
+            self.copy_estimated_file(estimation_result, folder, extension, collision_indexes[folder])
 
             copied_bytes += estimation_result.size_bytes
 
@@ -258,9 +1014,116 @@ class Storage:
                     )
                 ))
 
-    def get_correct_filenames_mapping_after_delete(self) -> List[Tuple[str, str]]:
+        for collision_index in collision_indexes.values():
+            collision_index.save()
+
+    def _iter_copy_plan(
+        self,
+        filtered_mail_results: Iterable[FilteredMailResult],
+        exclude_hashsums: Optional[Container[str]],
+        estimate_attachment: Optional[Callable[[FilteredMailResult, FileAttachment], EstimationFileResult]],
+    ) -> Generator[Tuple[FilteredMailResult, List[Tuple[EstimationFileResult, str]]], None, None]:
+        """Every result with its files to copy and their extensions, an attachment is given once"""
+        planned_attachments_hashsums = set()
+        for filtered_mail_result in filtered_mail_results:
+            files: List[Tuple[EstimationFileResult, str]] = []
+            if not self._is_excluded(filtered_mail_result.mail_hashsum_hex, exclude_hashsums):
+                files.append((EstimationFileResult(
+                    filtered_mail_result.mail_path, filtered_mail_result.mail_hashsum_hex,
+                    self.get_file_size(filtered_mail_result.mail_path),
+                ), 'json'))
+            for attachment in filtered_mail_result.mail.attachments:
+                if attachment.hashsum_hex not in planned_attachments_hashsums:
+                    planned_attachments_hashsums.add(attachment.hashsum_hex)
+                    if not self._is_excluded(attachment.hashsum_hex, exclude_hashsums):
+                        files.append((
+                            estimate_attachment(filtered_mail_result, attachment) if estimate_attachment is not None
+                            else self.estimate_attachment_file(attachment),
+                            'bin',
+                        ))
+
+            yield filtered_mail_result, files
+
+    def iter_copy_mails(
+        self,
+        filtered_mail_results: Iterable[FilteredMailResult],
+        target_folder_path: Union[str, Path],
+        exclude_hashsums: Optional[Container[str]] = None,
+        callback: Optional[Callable[[CopyMailsCallbackData], None]] = None,
+        estimate_attachment: Optional[Callable[[FilteredMailResult, FileAttachment], EstimationFileResult]] = None,
+    ) -> Generator[FilteredMailResult, None, None]:
+        """
+        Copies every message of the results (e.g. of filter_mails) with its attachments before yielding it,
+        so the messages are copied while they are found. Unlike copy_mails nothing is collected for the
+        estimation, only the hashsums of the copied attachments are kept. The excluded messages are yielded too.
+        With the callback the results are collected first, the progress needs the total size. estimate_attachment
+        finds the attachment of the result, by default in this repository.
+        """
+        messages_folder = PurePath(target_folder_path) / self.MESSAGES_FOLDER
+        attachments_folder = PurePath(target_folder_path) / self.ATTACHMENTS_FOLDER
+
+        os.makedirs(messages_folder, exist_ok=True)
+        os.makedirs(attachments_folder, exist_ok=True)
+
+        copy_plan: Iterable[Tuple[FilteredMailResult, List[Tuple[EstimationFileResult, str]]]] = self._iter_copy_plan(
+            filtered_mail_results, exclude_hashsums, estimate_attachment)
+        total_files_number, total_files_size_bytes = 0, 0
+        if callback is not None:
+            copy_plan = list(copy_plan)
+            total_files_number = sum(len(files) for _, files in copy_plan)
+            total_files_size_bytes = sum(estimation_result.size_bytes
+                                         for _, files in copy_plan for estimation_result, _ in files)
+
+        folders = {'json': messages_folder, 'bin': attachments_folder}
+        collision_indexes = {extension: self.create_collision_index(folder) for extension, folder in folders.items()}
+        file_idx, copied_bytes = 0, 0
+        for filtered_mail_result, files in copy_plan:
+            for estimation_result, extension in files:
+                self.copy_estimated_file(estimation_result, folders[extension], extension,
+                                         collision_indexes[extension])
+                copied_bytes += estimation_result.size_bytes
+                if callback is not None:
+                    callback(CopyMailsCallbackData(
+                        stage=CopyMailsStage.COPYING,
+                        copying_progress=CopyMailCallbackData(
+                            current_file_idx=file_idx,
+                            current_file_bytes=estimation_result.size_bytes,
+                            total_files_number=total_files_number,
+                            total_files_size_bytes=total_files_size_bytes,
+                            copied_bytes=copied_bytes,
+                        )
+                    ))
+                file_idx += 1
+
+            yield filtered_mail_result
+
+        for collision_index in collision_indexes.values():
+            collision_index.save()
+
+    def update_collision_indexes(self) -> int:
+        """Creates or updates the persisted collision indexes of both folders, returns the number of hashed files"""
+        hashed_number = 0
+        for folder in [self.MESSAGES_FOLDER, self.ATTACHMENTS_FOLDER]:
+            folder_path = PurePath(self.root_dir_path) / folder
+            collision_index = self.create_collision_index(folder_path)
+            collision_index.index_path = self.get_collision_index_path(folder_path)
+            hashed_number += collision_index.hash_all()
+            collision_index.save()
+
+        return hashed_number
+
+    def get_correct_filenames_mapping_after_delete(
+        self,
+        deleted_filenames: Container[str] = frozenset(),
+    ) -> List[Tuple[str, str]]:
+        """
+        (before, after) renames of the attachments which close the gaps in the collision suffixes, the attachments
+        with deleted_filenames are treated as already deleted. The renames are ordered, so every target is free
+        when its rename is done.
+        """
         attachments_folder_path = PurePath(self.root_dir_path) / self.ATTACHMENTS_FOLDER
-        attachments_paths = glob(f'{attachments_folder_path}/*.bin')
+        attachments_paths = [attachment_path for attachment_path in glob(f'{attachments_folder_path}/*.bin')
+                             if os.path.basename(attachment_path) not in deleted_filenames]
         partial_hashsums_with_collisions = set()
         hex_digest = set(ch.lower() for ch in string.hexdigits)
         for attachment_path in attachments_paths:
@@ -294,7 +1157,7 @@ class Storage:
                     if before != after:
                         result.append((str(attachments_folder_path / before), str(attachments_folder_path / after)))
 
-            return result
+        return result
 
     def get_attachments_for_delete(
         self,
@@ -303,28 +1166,33 @@ class Storage:
     ) -> List[str]:
         """
         Checks every message file in the repo and returns paths of attachments for delete if they aren't linked
-        to other messages (except messages in msg_paths arg)
+        to other messages (except messages in msg_paths arg). msg_paths are iterated once and may be
+        a MessagePathsSpill, a repeated path is counted once and a path outside the repository raises ValueError.
         """
         if len(msg_paths) == 0:
             return []
 
-        messages_folder_path = PurePath(self.root_dir_path) / self.MESSAGES_FOLDER
+        # the deleted messages are marked in the sorted listing of the repository, which the scan lists anyway,
+        # instead of collecting their paths, so the memory doesn't grow with the number of the deleted messages
+        repo_msg_paths = sorted(os.path.abspath(msg_path) for msg_path in self.get_message_paths())
+        is_deleted = bytearray(len(repo_msg_paths))
 
-        attachment_hashsums_to_delete = set()
-        attachment_path_by_hashsum = {}
-        msg_paths_to_delete = set()
+        def find_repo_msg_idx(msg_path: Union[str, Path]) -> Optional[int]:
+            abs_msg_path = os.path.abspath(msg_path)
+            idx = bisect.bisect_left(repo_msg_paths, abs_msg_path)
+            return idx if idx < len(repo_msg_paths) and repo_msg_paths[idx] == abs_msg_path else None
+
+        # an attachment is deleted if only the deleted messages link to it
+        target_hashsums: Set[str] = set()
         for idx, msg_path in enumerate(msg_paths):
-            msg_paths_to_delete.add(os.path.abspath(msg_path))
+            repo_msg_idx = find_repo_msg_idx(msg_path)
+            if repo_msg_idx is None:
+                raise ValueError(f'The message {os.fspath(msg_path)!r} is not in the repository '
+                                 f'{self.root_dir_path!r}')
 
-            mail = self.load_mail(msg_path)
-            for attachment in mail.attachments:
-                if attachment.hashsum_hex not in attachment_hashsums_to_delete:
-                    try:
-                        attachment_path = self.find_attachment_path(attachment.hashsum_hex)
-                        attachment_hashsums_to_delete.add(attachment.hashsum_hex)
-                        attachment_path_by_hashsum[attachment.hashsum_hex] = attachment_path
-                    except FileNotFoundError:
-                        continue
+            if not is_deleted[repo_msg_idx]:
+                is_deleted[repo_msg_idx] = 1
+                target_hashsums.update(attachment.hashsum_hex for attachment in self.load_mail(msg_path).attachments)
 
             if callback is not None:
                 callback(EstimationDeleteMailsCallbackData(
@@ -332,23 +1200,87 @@ class Storage:
                     FilterMailCallbackData(idx, len(msg_paths)),
                 ))
 
-        if not attachment_hashsums_to_delete:
+        metrics.observe('delete_target_messages', len(msg_paths))
+        if not target_hashsums:
             return []
 
-        message_paths = glob(f'{messages_folder_path}/*.json')
-        for idx, msg_path in enumerate(message_paths):
+        scanned_messages_number = 0
+        for idx, total_number, msg_path, msg_bytes in self.iter_messages_bytes():
+            scanned_messages_number += 1
             if callback is not None:
                 callback(EstimationDeleteMailsCallbackData(
                     EstimationDeleteMailsStage.SCANNING_ALL_FILES,
-                    FilterMailCallbackData(idx, len(message_paths)),
+                    FilterMailCallbackData(idx, total_number),
                 ))
 
-            if os.path.abspath(msg_path) in msg_paths_to_delete:
+            repo_msg_idx = find_repo_msg_idx(msg_path)
+            if repo_msg_idx is not None and is_deleted[repo_msg_idx]:
                 continue
 
-            mail = self.load_mail(msg_path)
-            for attachment in mail.attachments:
-                if attachment.hashsum_hex in attachment_hashsums_to_delete:
-                    attachment_hashsums_to_delete.remove(attachment.hashsum_hex)
+            for attachment in self.parse_mail(msg_bytes).attachments:
+                target_hashsums.discard(attachment.hashsum_hex)  # linked to the message which is kept
+
+        attachment_paths_to_delete = []
+        for hashsum_hex in target_hashsums:
+            try:
+                attachment_paths_to_delete.append(self.find_attachment_path(hashsum_hex))
+            except FileNotFoundError:
+                continue
+
+        metrics.observe('delete_scan_messages', scanned_messages_number)
+        metrics.observe('delete_attachments', len(attachment_paths_to_delete))
+        return attachment_paths_to_delete
+
+    def pack_messages(self) -> List[str]:
+        """
+        Moves the loose message files to the pack of the repository. Returns paths of the files which are left
+        loose because the pack already contains another message with the same filename.
+        """
+        message_pack = self.get_message_pack(self.root_dir_path)
+        packed_entries = message_pack.get_entries()
+
+        messages_folder_path = PurePath(self.root_dir_path) / self.MESSAGES_FOLDER
+        paths_to_remove: List[str] = []
+        skipped_paths: List[str] = []
+
+        def iter_files_to_pack() -> Generator[Tuple[str, bytes], None, None]:
+            for msg_path in sorted(glob(f'{messages_folder_path}/*.json')):
+                msg_filename = os.path.basename(msg_path)
+                msg_bytes = self.read_message_bytes(msg_path)
+
+                packed_entry = packed_entries.get(msg_filename)
+                if packed_entry is None:
+                    paths_to_remove.append(msg_path)
+                    yield msg_filename, msg_bytes
+                elif packed_entry.hashsum_hex == calculate_hashsum_hex_from_bytes(msg_bytes):
+                    paths_to_remove.append(msg_path)
+                else:
+                    skipped_paths.append(msg_path)
+
+        message_pack.append(iter_files_to_pack())
+
+        for msg_path in paths_to_remove:
+            os.remove(msg_path)
+
+        return skipped_paths
+
+    def unpack_messages(self):
+        """Writes the packed messages as loose files (byte-identical to the packed ones) and removes the pack"""
+        message_pack = self.get_message_pack(self.root_dir_path)
+        messages_folder_path = PurePath(self.root_dir_path) / self.MESSAGES_FOLDER
+        os.makedirs(messages_folder_path, exist_ok=True)
+
+        for entry, msg_bytes in message_pack.iter_contents(message_pack.get_entries().values()):
+            msg_path = messages_folder_path / entry.filename
+            if os.path.isfile(msg_path):
+                if get_default_engine().hash_file(msg_path).hex_digest != entry.hashsum_hex:
+                    raise Exception(f'Packed message {entry.filename!r} conflicts with the loose file')
+                continue
+
+            with open(msg_path, 'wb') as msg_file:
+                msg_file.write(msg_bytes)
+                msg_file.flush()
+                os.fsync(msg_file.fileno())
 
-        return [attachment_path_by_hashsum[hashsum] for hashsum in attachment_hashsums_to_delete]
+        sync_folder(str(messages_folder_path))  # the loose files should be on the disk before the pack is removed
+        message_pack.remove()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import os
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from pyadps.mail import Mail, MailFilter
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+@dataclass
+class MailTable:
+    """
+    Columnar representation of the message metadata. Message `i` has the coordinates
+    `lat[coords_offsets[i]:coords_offsets[i + 1]]` and the attachments
+    `attachment_sizes[attachment_offsets[i]:attachment_offsets[i + 1]]`.
+    Strings are interned: `names[name_codes[i]]`, the code -1 stands for None.
+    """
+    mail_paths: np.ndarray
+    mail_hashsums_hex: np.ndarray
+    date_created: np.ndarray  # int64, seconds since the epoch
+
+    coords_offsets: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+
+    name_codes: np.ndarray
+    names: np.ndarray
+    additional_notes_codes: np.ndarray
+    additional_notes: np.ndarray
+    inline_message_codes: np.ndarray
+    inline_messages: np.ndarray
+
+    attachment_offsets: np.ndarray
+    attachment_sizes: np.ndarray
+    attachment_hashsums_hex: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.mail_paths)
+
+    def save(self, snapshot_path: str):
+        """Saves every column to the separate .npy file of the snapshot folder"""
+        os.makedirs(snapshot_path, exist_ok=True)
+        for field in fields(self):
+            np.save(os.path.join(snapshot_path, f'{field.name}.npy'), getattr(self, field.name))
+
+    @classmethod
+    def load(cls, snapshot_path: str, mmap: bool = True) -> 'MailTable':
+        mmap_mode = 'r' if mmap else None
+        return cls(**{
+            field.name: np.load(os.path.join(snapshot_path, f'{field.name}.npy'), mmap_mode=mmap_mode)
+            for field in fields(cls)
+        })
+
+    @classmethod
+    def from_mails(cls, mail_results: Iterable[Tuple[Mail, str, str]]) -> 'MailTable':
+        """Builds the table from (mail, mail path, mail hashsum hex) items"""
+        builder = _MailTableBuilder()
+        for mail, mail_path, mail_hashsum_hex in mail_results:
+            builder.add(mail, mail_path, mail_hashsum_hex)
+
+        return builder.build()
+
+
+class _StringInterner:
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+
+    def get_code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+
+        return self.codes.setdefault(value, len(self.codes))
+
+    def get_values(self) -> np.ndarray:
+        return np.array(list(self.codes), dtype=str)
+
+
+class _MailTableBuilder:
+    def __init__(self):
+        self.mail_paths: List[str] = []
+        self.mail_hashsums_hex: List[str] = []
+        self.date_created: List[datetime] = []
+        self.coords_offsets: List[int] = [0]
+        self.lat: List[float] = []
+        self.lon: List[float] = []
+        self.names = _StringInterner()
+        self.name_codes: List[int] = []
+        self.additional_notes = _StringInterner()
+        self.additional_notes_codes: List[int] = []
+        self.inline_messages = _StringInterner()
+        self.inline_message_codes: List[int] = []
+        self.attachment_offsets: List[int] = [0]
+        self.attachment_sizes: List[int] = []
+        self.attachment_hashsums_hex: List[str] = []
+
+    def add(self, mail: Mail, mail_path: str, mail_hashsum_hex: str):
+        self.mail_paths.append(mail_path)
+        self.mail_hashsums_hex.append(mail_hashsum_hex)
+        self.date_created.append(mail.date_created)
+
+        for coords in mail.recipient_coords:
+            self.lat.append(coords.lat)
+            self.lon.append(coords.lon)
+        self.coords_offsets.append(len(self.lat))
+
+        self.name_codes.append(self.names.get_code(mail.name))
+        self.additional_notes_codes.append(self.additional_notes.get_code(mail.additional_notes))
+        self.inline_message_codes.append(self.inline_messages.get_code(mail.inline_message))
+
+        for attachment in mail.attachments:
+            self.attachment_sizes.append(attachment.size_bytes)
+            self.attachment_hashsums_hex.append(attachment.hashsum_hex)
+        self.attachment_offsets.append(len(self.attachment_sizes))
+
+    def build(self) -> MailTable:
+        return MailTable(
+            mail_paths=np.array(self.mail_paths, dtype=str),
+            mail_hashsums_hex=np.array(self.mail_hashsums_hex, dtype=str),
+            date_created=np.array(self.date_created, dtype='datetime64[s]').astype(np.int64),
+            coords_offsets=np.array(self.coords_offsets, dtype=np.int64),
+            lat=np.array(self.lat, dtype=np.float64),
+            lon=np.array(self.lon, dtype=np.float64),
+            name_codes=np.array(self.name_codes, dtype=np.int32),
+            names=self.names.get_values(),
+            additional_notes_codes=np.array(self.additional_notes_codes, dtype=np.int32),
+            additional_notes=self.additional_notes.get_values(),
+            inline_message_codes=np.array(self.inline_message_codes, dtype=np.int32),
+            inline_messages=self.inline_messages.get_values(),
+            attachment_offsets=np.array(self.attachment_offsets, dtype=np.int64),
+            attachment_sizes=np.array(self.attachment_sizes, dtype=np.int64),
+            attachment_hashsums_hex=np.array(self.attachment_hashsums_hex, dtype=str),
+        )
+
+
+def to_epoch_seconds(value: datetime) -> int:
+    return int(np.datetime64(value, 's').astype(np.int64))
+
+
+def haversine_distances_meters(lat: np.ndarray, lon: np.ndarray, location_lat: float, location_lon: float):
+    lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+    location_lat_rad, location_lon_rad = np.radians(location_lat), np.radians(location_lon)
+
+    a = (np.sin((lat_rad - location_lat_rad) / 2) ** 2
+         + np.cos(lat_rad) * np.cos(location_lat_rad) * np.sin((lon_rad - location_lon_rad) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _any_by_segments(values_mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Reduces the flattened mask to the mask of the messages: True if any value of the message is True"""
+    messages_number = len(offsets) - 1
+    message_indexes = np.repeat(np.arange(messages_number), np.diff(offsets))
+    return np.bincount(message_indexes[values_mask], minlength=messages_number) > 0
+
+
+def _match_interned_substring(query: str, values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    lower_query = query.lower()
+    values_mask = np.array([lower_query in value.lower() for value in values], dtype=bool)
+    # the extra False value is addressed by the code -1 (None)
+    return np.append(values_mask, False)[codes]
+
+
+def filter_table(
+    mail_filter: MailFilter,
+    table: MailTable,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Vectorized version of MailFilter.filter_func, returns the boolean mask of the matched messages.
+    Distances are calculated by the haversine formula, so messages lying within ~0.5% of the radius
+    from the boundary may be matched differently than by the geodesic distance of filter_func.
+    """
+    mask = np.ones(len(table), dtype=bool)
+
+    date_range_filter = mail_filter.datetime_created_range_filter
+    if date_range_filter is not None:
+        if date_range_filter.date_from is not None:
+            mask &= table.date_created >= to_epoch_seconds(date_range_filter.date_from)
+
+        if date_range_filter.date_to is not None:
+            mask &= table.date_created <= to_epoch_seconds(date_range_filter.date_to)
+
+    if mail_filter.location_filter is not None or mail_filter.damping_distance_filter is not None:
+        coords_mask = np.zeros(len(table.lat), dtype=bool)
+
+        location_filter = mail_filter.location_filter
+        if location_filter is not None:
+            distances = haversine_distances_meters(
+                table.lat, table.lon, location_filter.location.lat, location_filter.location.lon)
+            coords_mask |= distances < location_filter.radius_meters
+
+        damping_distance_filter = mail_filter.damping_distance_filter
+        if damping_distance_filter is not None:
+            rng = rng or np.random.default_rng()
+            distances = haversine_distances_meters(
+                table.lat, table.lon, damping_distance_filter.location.lat, damping_distance_filter.location.lon)
+            probabilities = 2 ** (-distances / damping_distance_filter.base_distance_meters)
+            coords_mask |= ((probabilities > damping_distance_filter.threshold_probability)
+                            & (rng.random(len(probabilities)) < probabilities))
+
+        mask &= _any_by_segments(coords_mask, table.coords_offsets)
+
+    if mail_filter.name_filter is not None:
+        name_codes = np.flatnonzero(table.names == mail_filter.name_filter.name)
+        mask &= np.isin(table.name_codes, name_codes)
+
+    if mail_filter.additional_notes_filter is not None:
+        mask &= _match_interned_substring(
+            mail_filter.additional_notes_filter.additional_notes, table.additional_notes, table.additional_notes_codes)
+
+    if mail_filter.inline_message_filter is not None:
+        mask &= _match_interned_substring(
+            mail_filter.inline_message_filter.inline_message, table.inline_messages, table.inline_message_codes)
+
+    if mail_filter.attachment_filter is not None:
+        attachments_mask = np.char.startswith(table.attachment_hashsums_hex, mail_filter.attachment_filter.hashsum)
+        mask &= _any_by_segments(attachments_mask, table.attachment_offsets)
+
+    return mask
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from pyadps.tests.helpers import save_repository
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    """The repository of three mails, the first two of them share an attachment, see `save_repository`"""
+    return save_repository(tmp_path)
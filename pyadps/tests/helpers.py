@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+from contextlib import ExitStack
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
-from pyadps.mail import CoordsData, FileAttachment, Mail
+from pyadps.mail import CoordsData, FileAttachment, Mail, MailAttachmentInfo
+from pyadps.storage import Storage
+
+REPOSITORY_MAIL_FILENAMES = [['shared.txt', 'own.txt'], ['shared.txt'], []]
 
 
 @dataclass
@@ -37,3 +42,37 @@ def fabricate_mail(
         inline_message=inline_message,
         attachments=attachments or []
     )
+
+
+def fabricate_mail_with_files(
+    date_created: datetime,
+    name: str,
+    file_paths: Iterable[Path]
+) -> Tuple[Mail, List[MailAttachmentInfo]]:
+    with ExitStack() as stack:
+        return Mail.from_attachment_streams(date_created, [CoordsData(55.0, 37.0)], name, None, None,
+                                            [stack.enter_context(open(path, 'rb')) for path in file_paths])
+
+
+def save_repository(tmp_path: Path, mail_filenames: Sequence[List[str]] = REPOSITORY_MAIL_FILENAMES) -> Path:
+    """The repository `tmp_path / 'repo'` of the mails `name1`, `name2`, ... created on 2020-01-01, 2020-01-02, ...
+
+    The attachment `<stem>.txt` contains `<stem>`, e.g. `shared.txt` is shared by the first two mails by default
+    """
+    for filename in {filename for filenames in mail_filenames for filename in filenames}:
+        (tmp_path / filename).write_bytes(Path(filename).stem.encode())
+
+    repo_path = tmp_path / 'repo'
+    mails = [fabricate_mail_with_files(datetime(2020, 1, day), f'name{day}',
+                                       [tmp_path / filename for filename in filenames])
+             for day, filenames in enumerate(mail_filenames, start=1)]
+    Storage(str(repo_path)).save_mails(mails, str(repo_path), lambda _: None)
+    return repo_path
+
+
+def get_repo_files(repo_path: Path) -> Dict[str, Dict[str, bytes]]:
+    """The contents of the messages and of the attachments by their filenames"""
+    return {
+        folder: {path.name: path.read_bytes() for path in (repo_path / folder).iterdir()}
+        for folder in [Storage.MESSAGES_FOLDER, Storage.ATTACHMENTS_FOLDER]
+    }
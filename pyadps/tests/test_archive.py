@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import tarfile
+import zipfile
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.archive import ArchiveError
+from pyadps.cli import copy, export, is_valid_repo_folder, search
+from pyadps.storage import Storage
+from pyadps.tests.helpers import get_repo_files
+
+
+def write_archive(repo_path, archive_path, with_root_folder: bool) -> str:
+    """The archive of the repository folder or of its content"""
+    members = [(folder / filename, f'{repo_path.name}/{folder.name}/{filename}' if with_root_folder
+                else f'{folder.name}/{filename}')
+               for folder in [repo_path / Storage.MESSAGES_FOLDER, repo_path / Storage.ATTACHMENTS_FOLDER]
+               for filename in os.listdir(folder)]
+    if archive_path.suffix == '.zip':
+        with zipfile.ZipFile(archive_path, 'w') as zip_file:
+            for path, member_name in members:
+                zip_file.write(path, member_name)
+    else:
+        with tarfile.open(archive_path, 'w:gz' if archive_path.suffix == '.tgz' else 'w') as tar_file:
+            for path, member_name in members:
+                tar_file.add(path, member_name)
+
+    return str(archive_path)
+
+
+@pytest.fixture(params=[('repo.zip', True), ('repo.tar', False), ('repo.tar', True)])
+def archive_path(request, repo_path, tmp_path) -> str:
+    filename, with_root_folder = request.param
+    return write_archive(repo_path, tmp_path / filename, with_root_folder)
+
+
+class TestArchiveStorage:
+    def test_filter_mails(self, repo_path, archive_path):
+        archive_results = list(Storage(archive_path).filter_mails(None))
+        assert sorted(result.mail_hashsum_hex for result in archive_results) == \
+            sorted(result.mail_hashsum_hex for result in Storage(str(repo_path)).filter_mails(None))
+        assert all(result.mail_path.startswith(os.path.join(archive_path, Storage.MESSAGES_FOLDER))
+                   for result in archive_results)
+
+        msg_path = archive_results[0].mail_path
+        assert Storage.load_mail(msg_path) == archive_results[0].mail
+        assert Storage.get_file_size(msg_path) == len(Storage.read_message_bytes(msg_path))
+
+    def test_copy_mails(self, repo_path, archive_path, tmp_path):
+        storage = Storage(archive_path)
+        target_path = tmp_path / 'target'
+        storage.copy_mails(storage.get_message_paths(), str(target_path))
+        assert get_repo_files(target_path) == get_repo_files(repo_path)
+
+    def test_find_attachment_path(self, archive_path, tmp_path):
+        storage = Storage(archive_path)
+        attachment = next(result for result in storage.filter_mails(None)
+                          if result.mail.attachments).mail.attachments[0]
+        attachment_path = storage.find_attachment_path(attachment.hashsum_hex)
+        assert attachment_path.startswith(os.path.join(archive_path, Storage.ATTACHMENTS_FOLDER))
+
+        storage.copy_file(attachment_path, tmp_path / 'attachment')
+        assert (tmp_path / 'attachment').stat().st_size == attachment.size_bytes
+
+    def test_compressed_tar(self, repo_path, tmp_path):
+        archive_path = write_archive(repo_path, tmp_path / 'repo.tgz', with_root_folder=True)
+        with pytest.raises(ArchiveError, match='compressed tar'):
+            Storage.get_repository_archive(archive_path)
+
+    def test_not_archive(self, tmp_path):
+        (tmp_path / 'repo.zip').write_bytes(b'not an archive')
+        assert Storage.get_repository_archive(str(tmp_path / 'repo.zip')) is None
+        assert not is_valid_repo_folder(str(tmp_path / 'repo.zip'))
+
+
+class TestArchiveCommands:
+    def test_search_copy_export(self, repo_path, tmp_path):
+        archive_path = write_archive(repo_path, tmp_path / 'repo.zip', with_root_folder=False)
+        result = CliRunner().invoke(search, [archive_path, '--datetime-from', '2000-01-01',  # type: ignore
+                                             '--output-format', 'PATHS', '--no-show-progressbar', '--no-use-daemon'])
+        assert result.exit_code == 0, result.output
+        msg_path = result.output.splitlines()[0]
+
+        target_path = tmp_path / 'target'
+        Storage(str(target_path)).save_mails([], str(target_path))
+        result = CliRunner().invoke(copy, [archive_path, str(target_path), '--msg-path', msg_path,  # type: ignore
+                                           '--no-show-progressbar', '--no-use-daemon'])
+        assert result.exit_code == 0, result.output
+        assert os.listdir(target_path / Storage.MESSAGES_FOLDER) == [os.path.basename(msg_path)]
+
+        result = CliRunner().invoke(export, [msg_path, str(tmp_path / 'export')])  # type: ignore
+        assert result.exit_code == 0, result.output
+        assert os.path.basename(msg_path) in os.listdir(tmp_path / 'export')
+
+    def test_compressed_tar(self, repo_path, tmp_path):
+        archive_path = write_archive(repo_path, tmp_path / 'repo.tgz', with_root_folder=False)
+        result = CliRunner().invoke(search, [archive_path, '--datetime-from', '2000-01-01',  # type: ignore
+                                             '--no-show-progressbar', '--no-use-daemon'])
+        assert result.exit_code == 1
+        assert 'decompress it to a plain .tar' in result.output
+
+    def test_archive_is_read_only(self, repo_path, tmp_path):
+        archive_path = write_archive(repo_path, tmp_path / 'repo.zip', with_root_folder=False)
+        result = CliRunner().invoke(search, [archive_path, '--delete', '--no-use-daemon'])  # type: ignore
+        assert result.exit_code == 2
+        assert 'read-only' in result.output
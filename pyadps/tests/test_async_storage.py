@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+from pyadps.async_storage import AsyncStorage
+from pyadps.mail import CoordsData, DatetimeCreatedRangeFilterData, Mail, MailFilter
+from pyadps.storage import CopyMailsStage, Storage
+
+
+def prepare_repo(tmp_path):
+    originals_path = tmp_path / 'originals'
+    os.makedirs(originals_path)
+
+    with open(originals_path / 'test.txt', 'wb') as file_:
+        file_.write(b'12345')
+
+    with open(originals_path / 'document.bin', 'wb') as file_:
+        file_.write(b'123123123123')
+
+    mail_1, attachment_infos_1 = Mail.from_attachment_streams(
+        date_created=datetime(2020, 1, 1),
+        recipient_coords=[CoordsData(55.0, 37.0)],
+        name='Donald Smith',
+        additional_notes=None,
+        inline_message='Please see the attachment',
+        files=[open(originals_path / 'test.txt', 'rb')]
+    )
+
+    mail_2, attachment_infos_2 = Mail.from_attachment_streams(
+        date_created=datetime(2019, 3, 4),
+        recipient_coords=[CoordsData(54.0, 36.0)],
+        name='abcde@abcde.com',
+        additional_notes=None,
+        inline_message='The document is in attachment',
+        files=[open(originals_path / 'test.txt', 'rb'), open(originals_path / 'document.bin', 'rb')]
+    )
+
+    source_dir = tmp_path / 'source'
+    storage = Storage(str(source_dir))
+    storage.save_mail(mail_1, attachment_infos_1, str(source_dir))
+    storage.save_mail(mail_2, attachment_infos_2, str(source_dir))
+    return source_dir, mail_1, mail_2
+
+
+class TestAsyncStorage:
+    def test_filter_mails(self, tmp_path):
+        source_dir, mail_1, _ = prepare_repo(tmp_path)
+
+        async def run():
+            async with AsyncStorage(str(source_dir), max_workers=2) as async_storage:
+                return [
+                    result.mail async for result in async_storage.filter_mails(MailFilter(
+                        datetime_created_range_filter=DatetimeCreatedRangeFilterData(date_from=datetime(2019, 12, 1))
+                    ))
+                ]
+
+        assert asyncio.run(run()) == [mail_1]
+
+    def test_copy_mails(self, tmp_path):
+        source_dir, _, _ = prepare_repo(tmp_path)
+        target_dir = tmp_path / 'target'
+
+        async def run():
+            async with AsyncStorage(str(source_dir), max_workers=3) as async_storage:
+                msg_paths = [result.mail_path async for result in async_storage.filter_mails(None)]
+                return [progress async for progress in async_storage.copy_mails(msg_paths, target_dir)]
+
+        progress_list = asyncio.run(run())
+        assert [progress.stage for progress in progress_list] == [CopyMailsStage.ESTIMATION] * 2 + [
+            CopyMailsStage.COPYING] * 4
+        last_progress = progress_list[-1].copying_progress
+        assert last_progress.copied_bytes == last_progress.total_files_size_bytes
+
+        assert set(os.listdir(target_dir / 'adps_messages')) == set(os.listdir(source_dir / 'adps_messages'))
+        assert set(os.listdir(target_dir / 'adps_attachments')) == set(os.listdir(source_dir / 'adps_attachments'))
+
+    def test_cancel_scan(self, tmp_path):
+        source_dir, _, _ = prepare_repo(tmp_path)
+
+        async def run():
+            async with AsyncStorage(str(source_dir), max_workers=1) as async_storage:
+                async def scan():
+                    async for _ in async_storage.filter_mails(None):
+                        await asyncio.sleep(10)
+
+                task = asyncio.create_task(scan())
+                await asyncio.sleep(0.1)
+                task.cancel()
+                await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(run())
+
+    def test_wrong_max_workers(self, tmp_path):
+        with pytest.raises(ValueError):
+            AsyncStorage(str(tmp_path), max_workers=0)
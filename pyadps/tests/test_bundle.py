@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.bundle import (BUNDLE_HEADER, BUNDLE_MAGIC, BUNDLE_VERSION, ENTRY_HEADER, BundleEntryKind, BundleError,
+                           BundleWriter, extract_bundle)
+from pyadps.cli import bundle, unbundle
+from pyadps.storage import Storage
+from pyadps.tests.helpers import get_repo_files
+
+
+class NonSeekableReader(io.BytesIO):
+    def seekable(self) -> bool:
+        return False
+
+
+def write_bundle(repo_path, bundle_path) -> BundleWriter:
+    storage = Storage(str(repo_path))
+    with BundleWriter(str(bundle_path)) as bundle_writer:
+        for _ in bundle_writer.iter_add_mails(storage, storage.filter_mails(None)):
+            pass
+
+    return bundle_writer
+
+
+def make_message_bundle(msg_bytes: bytes) -> bytes:
+    """The bundle with the single message entry"""
+    return b''.join([
+        BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION),
+        ENTRY_HEADER.pack(BundleEntryKind.MESSAGE, 0, len(msg_bytes), hashlib.sha512(msg_bytes).digest()), msg_bytes,
+        ENTRY_HEADER.pack(BundleEntryKind.END, 0, 1, bytes(64)),
+    ])
+
+
+class TestBundle:
+    def test_roundtrip(self, repo_path, tmp_path):
+        bundle_writer = write_bundle(repo_path, tmp_path / 'mails.adps')
+        assert (bundle_writer.stats.messages_number, bundle_writer.stats.attachments_number) == (3, 2)
+
+        target_path = tmp_path / 'target'
+        with open(tmp_path / 'mails.adps', 'rb') as bundle_file:
+            stats = extract_bundle(bundle_file, str(target_path))
+        assert (stats.messages_number, stats.attachments_number, stats.skipped_number) == (3, 2, 0)
+        assert get_repo_files(target_path) == get_repo_files(repo_path)
+
+        stats = extract_bundle(NonSeekableReader((tmp_path / 'mails.adps').read_bytes()), str(target_path))
+        assert (stats.messages_number, stats.attachments_number, stats.skipped_number) == (0, 0, 5)
+
+    def test_date_index(self, repo_path, tmp_path):
+        write_bundle(repo_path, tmp_path / 'mails.adps')
+        target_storage = Storage(str(tmp_path / 'target'))
+        target_storage.save_mails([], str(tmp_path / 'target'))
+        target_storage.update_date_index()
+
+        with open(tmp_path / 'mails.adps', 'rb') as bundle_file:
+            extract_bundle(bundle_file, str(tmp_path / 'target'))
+
+        timestamps = target_storage.get_date_index(str(tmp_path / 'target')).get_timestamps()
+        assert sorted(timestamps.values()) == [datetime(2020, 1, day).timestamp() for day in [1, 2, 3]]
+
+    def test_aborted_write(self, repo_path, tmp_path):
+        with pytest.raises(RuntimeError):
+            with BundleWriter(str(tmp_path / 'mails.adps')):
+                raise RuntimeError()
+
+        assert not [path for path in os.listdir(tmp_path) if 'mails.adps' in path]
+
+    @pytest.mark.parametrize('damage', ['truncate', 'flip'])
+    def test_damaged(self, repo_path, tmp_path, damage):
+        write_bundle(repo_path, tmp_path / 'mails.adps')
+        bundle_bytes = bytearray((tmp_path / 'mails.adps').read_bytes())
+        if damage == 'truncate':
+            bundle_bytes = bundle_bytes[:-10]
+        else:
+            bundle_bytes[-100] ^= 1
+
+        with pytest.raises(BundleError):
+            extract_bundle(io.BytesIO(bytes(bundle_bytes)), str(tmp_path / 'target'))
+
+        target_files = get_repo_files(tmp_path / 'target')
+        source_files = get_repo_files(repo_path)
+        for folder, files in target_files.items():
+            assert files.items() <= source_files[folder].items()  # only the verified entries are saved
+
+    @pytest.mark.parametrize('msg_bytes', [b'not json', b'{}', b'[1, 2]'])
+    def test_invalid_message(self, repo_path, tmp_path, msg_bytes):
+        with pytest.raises(BundleError, match='invalid'):
+            extract_bundle(io.BytesIO(make_message_bundle(msg_bytes)), str(tmp_path / 'target'))
+
+        assert os.listdir(tmp_path / 'target' / Storage.MESSAGES_FOLDER) == []
+
+    def test_foreign_tmp_file_kept(self, repo_path, tmp_path):
+        msg_bytes = (repo_path / Storage.MESSAGES_FOLDER / sorted(os.listdir(repo_path / Storage.MESSAGES_FOLDER))[0]
+                     ).read_bytes()
+        hashsum_hex = hashlib.sha512(msg_bytes).hexdigest()
+        messages_path = tmp_path / 'target' / Storage.MESSAGES_FOLDER
+        messages_path.mkdir(parents=True)
+        tmp_file_path = messages_path / f'{hashsum_hex[:Storage.HASHSUM_FILENAME_PART_LEN]}.json.{os.getpid()}.tmp'
+        tmp_file_path.write_bytes(b'another writer')
+
+        with pytest.raises(FileExistsError):
+            extract_bundle(io.BytesIO(make_message_bundle(msg_bytes)), str(tmp_path / 'target'))
+
+        assert tmp_file_path.read_bytes() == b'another writer'
+
+
+class TestBundleCommands:
+    def test_bundle_unbundle(self, repo_path, tmp_path):
+        msg_path = Storage(str(repo_path)).get_message_paths()[0]
+        result = CliRunner().invoke(bundle, [str(repo_path), str(tmp_path / 'mail.adps'),  # type: ignore
+                                             '--msg-path', msg_path, '--no-use-daemon'])
+        assert result.exit_code == 0, result.output
+
+        target_path = tmp_path / 'target'
+        Storage(str(target_path)).save_mails([], str(target_path))
+        result = CliRunner().invoke(unbundle, [str(tmp_path / 'mail.adps'), str(target_path)])  # type: ignore
+        assert result.exit_code == 0, result.output
+        assert os.listdir(target_path / Storage.MESSAGES_FOLDER) == [os.path.basename(msg_path)]
+
+    def test_unbundle_not_bundle(self, repo_path, tmp_path):
+        (tmp_path / 'mail.adps').write_bytes(b'not a bundle')
+        result = CliRunner().invoke(unbundle, [str(tmp_path / 'mail.adps'), str(repo_path)])  # type: ignore
+        assert result.exit_code == 1
+        assert 'not a bundle' in result.output
+
+    def test_unbundle_invalid_message(self, repo_path, tmp_path):
+        (tmp_path / 'mail.adps').write_bytes(make_message_bundle(b'{}'))
+        result = CliRunner().invoke(unbundle, [str(tmp_path / 'mail.adps'), str(repo_path)])  # type: ignore
+        assert result.exit_code == 1
+        assert 'invalid' in result.output
+        assert result.exc_info[0] is SystemExit
+
+    def test_bundle_missing_attachment(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        result_with_attachments = next(result for result in storage.filter_mails(None) if result.mail.attachments)
+        for attachment_path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir():
+            attachment_path.unlink()
+
+        result = CliRunner().invoke(bundle, [str(repo_path), str(tmp_path / 'mail.adps'),  # type: ignore
+                                             '--msg-path', result_with_attachments.mail_path, '--no-use-daemon'])
+        assert result.exit_code == 1
+        assert result_with_attachments.mail.attachments[0].hashsum_hex in result.output
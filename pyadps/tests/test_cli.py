@@ -13,11 +13,12 @@ from click.testing import CliRunner
 from freezegun import freeze_time
 
 from pyadps.cli import (OutputPrinter, build_filter, clear, copy, create, delete, export,
-                        get_default_damping_distance_filter, init, search)
+                        get_default_damping_distance_filter, init, pack, search, unpack)
 from pyadps.mail import (AdditionalNotesFilterData, AttachmentFilterData, CoordsData, DampingDistanceFilterData,
                          DatetimeCreatedRangeFilterData, InlineMessageFilterData, LocationFilterData, Mail, MailFilter,
                          NameFilterData)
 from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
 
 MOSCOW_COORDS = CoordsData(55.75222, 37.61556)
 SOMEWHERE_ON_ATLANTIC_OCEAN = CoordsData(1.4487406, -2.6771144)
@@ -63,6 +64,32 @@ class TestRepoInit:
         assert set(listdir(tmp_path)) == set()
 
 
+class TestPackUnpack:
+    def test_ok(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        storage.save_mail(fabricate_mail(date_created=datetime(2018, 1, 1)), [], str(tmp_path))
+        msg_filenames = os.listdir(tmp_path / 'adps_messages')
+
+        result = CliRunner().invoke(pack, [str(tmp_path)])  # type: ignore
+        assert result.exit_code == 0
+        assert os.listdir(tmp_path / 'adps_messages') == []
+
+        result = CliRunner().invoke(
+            search, [str(tmp_path), '--datetime-from=2010-01-01', '--output-format=paths', '--no-show-progressbar'])
+        assert result.exit_code == 0
+        assert result.output == f'{tmp_path}/adps_messages/{msg_filenames[0]}\n'
+
+        result = CliRunner().invoke(
+            search, [str(tmp_path), '--datetime-from=2010-01-01', '--no-show-progressbar', '--delete'])
+        assert result.exit_code == 1
+        assert 'use command unpack' in result.output
+
+        result = CliRunner().invoke(unpack, [str(tmp_path)])  # type: ignore
+        assert result.exit_code == 0
+        assert os.listdir(tmp_path / 'adps_messages') == msg_filenames
+        assert not os.path.exists(tmp_path / 'adps_messages.pack')
+
+
 class TestMailCreate:
     @freeze_time('2018-03-17T12:06:54')
     def test_ok(self, tmp_path):
@@ -340,6 +367,10 @@ class TestOutputPrinter:
                   '"inline_message": null, "mail_hashsum_hex": "12345", "mail_path": "/1234/5678", '
                   '"min_version": "1.0", "name": "Donald", "recipient_coords": [{"lat": 55.75222, "lon": 37.61556}], '
                   '"version": "1.0"}')],
+        ['NDJSON', ('{"additional_notes":null,"attachments":[],"date_created":"2021-02-03T00:00:00",'
+                    '"inline_message":null,"mail_hashsum_hex":"12345","mail_path":"/1234/5678",'
+                    '"min_version":"1.0","name":"Donald","recipient_coords":[{"lat":55.75222,"lon":37.61556}],'
+                    '"schema_version":1,"version":"1.0"}')],
         ['HASHSUMS', '12345'],
         ['PATHS', '/1234/5678'],
     ])
@@ -604,6 +635,32 @@ class TestSearch:
         }
 
 
+class TestSearchSorted:
+    def test_ok(self, tmp_path):
+        (tmp_path / 'adps_messages').mkdir()
+        (tmp_path / 'adps_attachments').mkdir()
+        storage = Storage(str(tmp_path))
+        for day in [3, 1, 2]:
+            storage.save_mail(fabricate_mail(date_created=datetime(2020, 1, day), name=f'day{day}'), [], str(tmp_path))
+
+        result = CliRunner().invoke(search, [  # type: ignore
+            str(tmp_path), '--datetime-from=2020-01-01', '--output-format=NDJSON', '--no-show-progressbar',
+            '--sort-by=date', '--limit=2',
+        ])
+
+        assert result.exit_code == 0, result.output
+        assert [json.loads(line)['name'] for line in result.output.splitlines()] == ['day3', 'day2']
+
+    def test_distance_without_location(self, tmp_path):
+        (tmp_path / 'adps_messages').mkdir()
+        (tmp_path / 'adps_attachments').mkdir()
+
+        result = CliRunner().invoke(search, [str(tmp_path), '--sort-by=distance'])  # type: ignore
+
+        assert result.exit_code == 2
+        assert 'requires latitude' in result.output
+
+
 class TestDelete:
     def test_repo_does_not_exist(self, tmp_path):
         result = CliRunner().invoke(delete, [str(tmp_path)+'not_exists'])  # type: ignore
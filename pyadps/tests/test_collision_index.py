@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from pyadps.collision_index import CollisionDepthError, CollisionIndex
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
+
+
+@pytest.fixture
+def bucket_path(tmp_path):
+    """file.bin, file_0000.bin .. file_0003.bin with the contents 0 .. 4 and file_0005.bin after the gap"""
+    for idx, content in enumerate([b'0', b'1', b'2', b'3', b'4']):
+        suffix = '' if idx == 0 else f'_{idx - 1:04}'
+        (tmp_path / f'file{suffix}.bin').write_bytes(content)
+    (tmp_path / 'file_0005.bin').write_bytes(b'after gap')
+    return tmp_path
+
+
+@pytest.fixture
+def hashed_filenames(monkeypatch):
+    hashed_filenames = []
+    original_hash_entries = CollisionIndex._hash_entries
+
+    def hash_entries(self, bucket_slots):
+        hashed_filenames.extend(bucket.entries[slot].filename for bucket, slot in bucket_slots)
+        return original_hash_entries(self, bucket_slots)
+
+    monkeypatch.setattr(CollisionIndex, '_hash_entries', hash_entries)
+    return hashed_filenames
+
+
+class TestCollisionIndex:
+    def test_same_as_probing(self, bucket_path):
+        path = bucket_path / 'file.bin'
+        collision_index = CollisionIndex(bucket_path, max_depth=10000)
+        for content in [b'0', b'3', b'new', b'after gap', b'other']:
+            hashsum_hex = calculate_hashsum_hex_from_bytes(content)
+            file_search_result = Storage.get_free_file_path(path, hashsum_hex)
+            assert collision_index.get_free_file_path(path, hashsum_hex) == (
+                str(file_search_result.path), file_search_result.is_exist)
+
+            if not file_search_result.is_exist:
+                with open(file_search_result.path, 'wb') as target_file:
+                    target_file.write(content)
+
+        # file_0004.bin filled the gap, so file_0005.bin joined the bucket
+        assert sorted(path.name for path in bucket_path.iterdir())[-1] == 'file_0006.bin'
+
+    def test_size_filter(self, bucket_path, hashed_filenames):
+        (bucket_path / 'file_0002.bin').write_bytes(b'33')
+        collision_index = CollisionIndex(bucket_path, max_depth=10000)
+
+        assert collision_index.get_free_file_path(bucket_path / 'file.bin', calculate_hashsum_hex_from_bytes(b'33'),
+                                                  size_bytes=2) == (str(bucket_path / 'file_0002.bin'), True)
+        assert hashed_filenames == ['file_0002.bin']
+
+        collision_index.get_free_file_path(bucket_path / 'file.bin', calculate_hashsum_hex_from_bytes(b'x'))
+        assert len(hashed_filenames) == 5  # every file is hashed once
+
+    def test_find_file_path(self, bucket_path):
+        path = bucket_path / 'file.bin'
+        collision_index = CollisionIndex(bucket_path, max_depth=10000)
+        assert collision_index.find_file_path(path, calculate_hashsum_hex_from_bytes(b'3')) == \
+            str(bucket_path / 'file_0002.bin')
+        assert collision_index.find_file_path(path, calculate_hashsum_hex_from_bytes(b'new')) is None
+        assert collision_index.find_file_path(path, calculate_hashsum_hex_from_bytes(b'new')) is None
+        assert collision_index.get_free_file_path(path, calculate_hashsum_hex_from_bytes(b'new')) == (
+            str(bucket_path / 'file_0004.bin'), False)
+
+    def test_max_depth(self, bucket_path):
+        collision_index = CollisionIndex(bucket_path, max_depth=4)
+        assert collision_index.get_free_file_path(bucket_path / 'file.bin', calculate_hashsum_hex_from_bytes(b'3'))[1]
+        with pytest.raises(CollisionDepthError):
+            collision_index.get_free_file_path(bucket_path / 'file.bin', calculate_hashsum_hex_from_bytes(b'new'))
+
+    def test_known_entries(self, tmp_path):
+        hashsum_hex = calculate_hashsum_hex_from_bytes(b'packed')
+        collision_index = CollisionIndex(tmp_path, max_depth=10000, known_entries={'file.json': (6, hashsum_hex)})
+
+        assert collision_index.get_free_file_path(tmp_path / 'file.json', hashsum_hex) == (
+            str(tmp_path / 'file.json'), True)
+
+    def test_persisted(self, bucket_path, tmp_path, hashed_filenames):
+        index_path = str(tmp_path / 'hashsums.idx')
+        collision_index = CollisionIndex(bucket_path, max_depth=10000, index_path=index_path)
+        assert collision_index.hash_all() == 5  # the files after the gap aren't found by the lookups anyway
+        collision_index.save()
+
+        collision_index = CollisionIndex(bucket_path, max_depth=10000, index_path=index_path)
+        (bucket_path / 'file_0001.bin').write_bytes(b'changed')
+        assert collision_index.get_free_file_path(bucket_path / 'file.bin', calculate_hashsum_hex_from_bytes(b'new'))
+        assert hashed_filenames[5:] == ['file_0001.bin']
+
+    def test_persisted_filename_with_spaces(self, tmp_path, hashed_filenames):
+        (tmp_path / 'bucket').mkdir()
+        (tmp_path / 'bucket' / 'my file.bin').write_bytes(b'content')
+        index_path = str(tmp_path / 'hashsums.idx')
+        collision_index = CollisionIndex(tmp_path / 'bucket', max_depth=10000, index_path=index_path)
+        assert collision_index.hash_all() == 1
+        collision_index.save()
+
+        collision_index = CollisionIndex(tmp_path / 'bucket', max_depth=10000, index_path=index_path)
+        assert collision_index.get_free_file_path(tmp_path / 'bucket' / 'my file.bin',
+                                                  calculate_hashsum_hex_from_bytes(b'content')) == (
+            str(tmp_path / 'bucket' / 'my file.bin'), True)
+        assert hashed_filenames == ['my file.bin']
+
+
+class TestStorageCollisionIndex:
+    def test_save_mails_max_depth(self, tmp_path, monkeypatch):
+        storage = Storage(str(tmp_path))
+        mail = fabricate_mail(date_created=datetime(2020, 1, 1))
+        msg_path, = storage.save_mails([(mail, [])], str(tmp_path))
+        with open(msg_path, 'ab') as msg_file:
+            msg_file.write(b' ')  # the colliding file
+
+        monkeypatch.setattr(Storage, 'MAX_COLLISION_DEPTH', 0)
+        with pytest.raises(CollisionDepthError):
+            storage.save_mails([(mail, [])], str(tmp_path))
+
+    def test_update_collision_indexes(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        storage.save_mails([(fabricate_mail(date_created=datetime(2020, 1, day)), []) for day in [1, 2]],
+                           str(tmp_path))
+
+        assert storage.update_collision_indexes() == 2
+        assert storage.update_collision_indexes() == 0
+        index_path = storage.get_collision_index_path(tmp_path / Storage.MESSAGES_FOLDER)
+        assert len(open(index_path).readlines()) == 2
+
+        storage.save_mails([(fabricate_mail(date_created=datetime(2020, 1, 3)), [])], str(tmp_path))
+        assert len(open(index_path).readlines()) == 3  # the saving operations keep the existing index up to date
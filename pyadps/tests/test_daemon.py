@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import copy, delete, search
+from pyadps.daemon import DaemonClient, DaemonError, RepositoryCache, create_server, get_socket_path, run_server
+from pyadps.mail import (CoordsData, DatetimeCreatedRangeFilterData, LocationFilterData, MailFilter, NameFilterData,
+                         dump_mail_filter_dict, load_mail_filter_dict)
+from pyadps.storage import SortBy, Storage
+from pyadps.tests.helpers import fabricate_mail
+
+
+@pytest.fixture
+def server(repo_path):
+    server = create_server(str(repo_path))
+    thread = threading.Thread(target=run_server, args=(server,), daemon=True)
+    thread.start()
+    yield server
+
+    server.shutdown()
+    thread.join()
+
+
+def test_mail_filter_dict():
+    mail_filter = MailFilter(
+        datetime_created_range_filter=DatetimeCreatedRangeFilterData(date_from=datetime(2020, 1, 1, 12, 30)),
+        location_filter=LocationFilterData(CoordsData(55.0, 37.0), 1000.0),
+        name_filter=NameFilterData('john'),
+    )
+
+    assert load_mail_filter_dict(json.loads(json.dumps(dump_mail_filter_dict(mail_filter)))) == mail_filter
+
+
+class TestRepositoryCache:
+    def test_refresh(self, repo_path):
+        storage = Storage(str(repo_path))
+        cache = RepositoryCache(storage)
+        assert cache.load() == 3
+        assert cache.refresh() == (0, 0)
+
+        storage.save_mail(fabricate_mail(name='new'), [], str(repo_path))
+        removed_path = sorted((repo_path / 'adps_messages').iterdir())[0]
+        os.remove(removed_path)
+
+        assert cache.refresh() == (1, 1)
+        assert sorted(result.mail.name for result in cache.search(None)) == sorted(
+            storage.load_mail(msg_path).name for msg_path in storage.get_message_paths())
+
+    def test_search(self, repo_path):
+        storage = Storage(str(repo_path))
+        cache = RepositoryCache(storage)
+        cache.load()
+        mail_filter = MailFilter(DatetimeCreatedRangeFilterData(date_from=datetime(2020, 1, 2)))
+
+        assert cache.count(mail_filter) == 2
+        assert cache.search(mail_filter, sort_by=SortBy.DATE, limit=1) == list(
+            storage.filter_mails(mail_filter, sort_by=SortBy.DATE, limit=1))
+
+    def test_estimate_delete(self, repo_path):
+        storage = Storage(str(repo_path))
+        cache = RepositoryCache(storage)
+        cache.load()
+        msg_paths = [result.mail_path for result in cache.search(MailFilter(name_filter=NameFilterData('name1')))]
+
+        assert cache.estimate_delete(msg_paths) == storage.get_attachments_for_delete(msg_paths)
+        assert [os.path.basename(path) for path in cache.estimate_delete(msg_paths)] == ['bcabe3f2dc.bin']
+
+    def test_estimate_delete_foreign_paths(self, repo_path, tmp_path):
+        """The repeated paths don't count as the deleted references, the messages of another repository are rejected"""
+        storage = Storage(str(repo_path))
+        cache = RepositoryCache(storage)
+        cache.load()
+        name2_path = cache.search(MailFilter(name_filter=NameFilterData('name2')))[0].mail_path
+        storage.copy_mails([name2_path], str(tmp_path / 'other'))
+        other_name2_path = str(tmp_path / 'other' / Storage.MESSAGES_FOLDER / os.path.basename(name2_path))
+
+        assert cache.estimate_delete([name2_path, name2_path]) == storage.get_attachments_for_delete(
+            [name2_path, name2_path]) == []
+        with pytest.raises(ValueError, match='is not in the repository'):
+            cache.estimate_delete([name2_path, other_name2_path])
+
+
+class TestServer:
+    def test_client(self, repo_path, server):
+        storage = Storage(str(repo_path))
+        mail_filter = MailFilter(location_filter=LocationFilterData(CoordsData(55.0, 37.0), 1000.0))
+
+        with DaemonClient.connect(str(repo_path)) as daemon_client:  # type: ignore
+            assert daemon_client.status()['messages_number'] == 3
+            assert sorted(daemon_client.search(mail_filter), key=lambda result: result.mail_path) == sorted(
+                storage.filter_mails(mail_filter), key=lambda result: result.mail_path)
+            assert daemon_client.count(mail_filter) == 3
+
+            msg_paths = storage.get_message_paths()
+            message_results, attachment_results = daemon_client.plan_copy(msg_path for msg_path in msg_paths)
+            assert sorted(result.path for result in message_results) == sorted(msg_paths)
+            assert sorted(result.size_bytes for result in attachment_results) == [3, 6]
+            assert sorted(daemon_client.estimate_delete(msg_path for msg_path in msg_paths + msg_paths)) == sorted(
+                storage.get_attachments_for_delete(msg_paths))
+
+            with pytest.raises(DaemonError):
+                daemon_client.plan_copy([str(repo_path / 'adps_messages' / 'missing.json')])
+            assert daemon_client.count(None) == 3  # the connection is usable after the error
+
+    def test_already_running(self, repo_path, server):
+        with pytest.raises(DaemonError):
+            create_server(str(repo_path))
+
+    def test_stale_socket(self, repo_path):
+        server = create_server(str(repo_path))
+        server.server_close()  # the socket file is left as by the killed daemon
+
+        assert DaemonClient.connect(str(repo_path)) is None
+        create_server(str(repo_path)).server_close()
+
+    def test_search_cli(self, repo_path, server):
+        args = [str(repo_path), '--datetime-from=2020-01-01', '--output-format=NDJSON', '--no-show-progressbar',
+                '--sort-by=date']
+        result = CliRunner().invoke(search, args)  # type: ignore
+        os.remove(get_socket_path(str(repo_path)))  # the daemon isn't found by the next command
+        no_daemon_result = CliRunner().invoke(search, args)  # type: ignore
+
+        assert result.exit_code == 0, result.output
+        assert result.output == no_daemon_result.output
+        assert [json.loads(line)['name'] for line in result.output.splitlines()] == ['name3', 'name2', 'name1']
+
+    def test_daemon_error_cli(self, repo_path, server, tmp_path):
+        """The message unknown to the daemon ends the command with the message instead of the traceback"""
+        storage = Storage(str(repo_path))
+        msg_path = storage.get_message_paths()[0]
+        storage.copy_mails([msg_path], str(tmp_path / 'other'))
+        other_msg_path = str(tmp_path / 'other' / Storage.MESSAGES_FOLDER / os.path.basename(msg_path))
+        Storage(str(tmp_path / 'target')).save_mails([], str(tmp_path / 'target'))
+
+        result = CliRunner().invoke(copy, [  # type: ignore
+            str(repo_path), str(tmp_path / 'target'), '--msg-path', other_msg_path, '--no-show-progressbar'])
+        assert result.exit_code == 1
+        assert 'The daemon of the repository failed' in result.output
+        assert '--no-use-daemon' in result.output
+
+    def test_delete_foreign_message_cli(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        msg_path = storage.get_message_paths()[0]
+        storage.copy_mails([msg_path], str(tmp_path / 'other'))
+        other_msg_path = str(tmp_path / 'other' / Storage.MESSAGES_FOLDER / os.path.basename(msg_path))
+
+        result = CliRunner().invoke(delete, [  # type: ignore
+            str(repo_path), '--msg-path', other_msg_path, '--no-confirm', '--no-show-progressbar', '--no-use-daemon'])
+        assert result.exit_code == 1
+        assert 'is not in the repository' in result.output
+        assert os.path.isfile(other_msg_path)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+
+from pyadps.date_index import DateIndex
+
+
+class TestDateIndex:
+    def test_append_and_write(self, tmp_path):
+        date_index = DateIndex(str(tmp_path / 'dates.idx'))
+        assert not date_index.exists()
+        assert date_index.get_timestamps() == {}
+
+        date_index.append([('a.json', 1.5), ('b.json', 2.0)])
+        date_index.append([('a.json', 3.25)])
+        assert date_index.get_timestamps() == {'a.json': 3.25, 'b.json': 2.0}
+
+        date_index.write([('c.json', 4.0)])
+        assert date_index.get_timestamps() == {'c.json': 4.0}
+
+    def test_filename_with_spaces(self, tmp_path):
+        DateIndex(str(tmp_path / 'dates.idx')).append([('a b .json', 1.5)])
+        assert DateIndex(str(tmp_path / 'dates.idx')).get_timestamps() == {'a b .json': 1.5}
+
+    def test_write_coarse_mtime(self, tmp_path):
+        """The rewritten index of the same size within the mtime resolution of the filesystem, e.g. 2 s of FAT"""
+        date_index = DateIndex(str(tmp_path / 'dates.idx'))
+        date_index.write([('a.json', 1.0)])
+        assert date_index.get_timestamps() == {'a.json': 1.0}
+
+        stat_result = os.stat(tmp_path / 'dates.idx')
+        date_index.write([('b.json', 2.0)])
+        os.utime(tmp_path / 'dates.idx', ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        assert date_index.get_timestamps() == {'b.json': 2.0}
+
+    def test_incomplete_line(self, tmp_path):
+        (tmp_path / 'dates.idx').write_text('a.json 1.0\nb.json 2')
+        assert DateIndex(str(tmp_path / 'dates.idx')).get_timestamps() == {'a.json': 1.0}
+
+    def test_checkpoint(self, tmp_path):
+        date_index = DateIndex(str(tmp_path / 'dates.idx'))
+        assert date_index.get_checkpoint() is None
+
+        date_index.set_checkpoint(1650000000.25)
+        assert date_index.get_checkpoint() == 1650000000.25
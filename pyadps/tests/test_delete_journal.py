@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from pyadps.cli import is_valid_repo_folder
+from pyadps.delete_journal import DeleteJournal, DeleteJournalError, delete_files, roll_forward
+from pyadps.storage import Storage
+
+CONTENTS = {
+    'aaaaaaaaaa.bin': b'a', 'aaaaaaaaaa_0000.bin': b'a0', 'aaaaaaaaaa_0001.bin': b'a1',
+    'bbbbbbbbbb.bin': b'b', 'bbbbbbbbbb_0000.bin': b'b0',
+    'cccccccccc.bin': b'c',
+}
+DELETED_FILENAMES = ['aaaaaaaaaa.bin', 'bbbbbbbbbb.bin', 'cccccccccc.bin']
+EXPECTED_CONTENTS = {'aaaaaaaaaa.bin': b'a0', 'aaaaaaaaaa_0000.bin': b'a1', 'bbbbbbbbbb.bin': b'b0'}
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    """Two buckets of the colliding attachments which lose their first files"""
+    os.makedirs(tmp_path / Storage.MESSAGES_FOLDER)
+    os.makedirs(tmp_path / Storage.ATTACHMENTS_FOLDER)
+    for filename, content in CONTENTS.items():
+        (tmp_path / Storage.ATTACHMENTS_FOLDER / filename).write_bytes(content)
+    (tmp_path / Storage.MESSAGES_FOLDER / 'dddddddddd.json').write_bytes(b'{}')
+
+    return tmp_path
+
+
+def get_attachments_contents(repo_path) -> dict:
+    return {path.name: path.read_bytes() for path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir()}
+
+
+def get_delete_plan(repo_path):
+    remove_paths = [str(repo_path / Storage.MESSAGES_FOLDER / 'dddddddddd.json')] + [
+        str(repo_path / Storage.ATTACHMENTS_FOLDER / filename) for filename in DELETED_FILENAMES]
+    renames = Storage(str(repo_path)).get_correct_filenames_mapping_after_delete(set(DELETED_FILENAMES))
+    return remove_paths, renames
+
+
+class TestDeleteFiles:
+    def test_ok(self, repo_path):
+        delete_files(str(repo_path), *get_delete_plan(repo_path))
+        assert get_attachments_contents(repo_path) == EXPECTED_CONTENTS
+        assert os.listdir(repo_path / Storage.MESSAGES_FOLDER) == []
+        assert not DeleteJournal(str(repo_path)).exists()
+
+    @pytest.mark.parametrize('done_number', range(8))
+    def test_roll_forward(self, repo_path, done_number):
+        """The deletion is interrupted after done_number of its 4 removals, the mark and 3 renames"""
+        remove_paths, renames = get_delete_plan(repo_path)
+        journal = DeleteJournal(str(repo_path))
+        journal.write(remove_paths, renames)
+
+        operations = [lambda path=path: os.remove(path) for path in remove_paths] + [journal.mark_removed] + [
+            lambda before=before, after=after: os.rename(before, after) for before, after in renames]
+        assert len(operations) == 8
+        for operation in operations[:done_number]:
+            operation()
+
+        assert roll_forward(str(repo_path))
+        assert get_attachments_contents(repo_path) == EXPECTED_CONTENTS
+        assert not roll_forward(str(repo_path))
+
+    def test_interrupted_deletion_first(self, repo_path):
+        DeleteJournal(str(repo_path)).write(*get_delete_plan(repo_path))
+        with pytest.raises(DeleteJournalError):
+            delete_files(str(repo_path), [])
+
+        assert is_valid_repo_folder(str(repo_path), is_written=True)
+        assert get_attachments_contents(repo_path) == EXPECTED_CONTENTS
+
+    def test_not_rolled_forward_by_readers(self, repo_path):
+        DeleteJournal(str(repo_path)).write(*get_delete_plan(repo_path))
+        assert is_valid_repo_folder(str(repo_path))
+        assert DeleteJournal(str(repo_path)).exists()
+        assert get_attachments_contents(repo_path) == CONTENTS
+
+    def test_roll_forward_waits_for_lock(self, repo_path):
+        """The roll forward doesn't apply the journal while another process deletes"""
+        pytest.importorskip('fcntl')
+        DeleteJournal(str(repo_path)).write(*get_delete_plan(repo_path))
+        lock_path = str(repo_path / Storage.DELETE_LOCK_FILENAME)
+        with subprocess.Popen([sys.executable, '-c', (
+            'import fcntl, os, sys\n'
+            f'fcntl.flock(os.open({lock_path!r}, os.O_RDWR | os.O_CREAT), fcntl.LOCK_EX)\n'
+            'print("locked", flush=True)\n'
+            'sys.stdin.read()\n'
+        )], stdin=subprocess.PIPE, stdout=subprocess.PIPE) as locking_process:
+            assert locking_process.stdout.readline() == b'locked\n'  # type: ignore
+            thread = threading.Thread(target=roll_forward, args=(str(repo_path),))
+            thread.start()
+            thread.join(0.5)
+            assert thread.is_alive()
+            assert get_attachments_contents(repo_path) == CONTENTS
+
+            locking_process.stdin.close()  # type: ignore
+            thread.join(10)
+
+        assert not thread.is_alive()
+        assert get_attachments_contents(repo_path) == EXPECTED_CONTENTS
+        assert not DeleteJournal(str(repo_path)).exists()
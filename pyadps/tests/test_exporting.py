@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import export, search
+from pyadps.exporting import MailExporter, export_file, resolve_attachment_paths
+from pyadps.storage import SortBy, Storage
+
+
+def get_exported_files(export_path) -> dict:
+    return {folder.name: sorted(path.name for path in folder.iterdir()) for folder in export_path.iterdir()}
+
+
+class TestResolveAttachmentPaths:
+    def test_ok(self, repo_path):
+        storage = Storage(str(repo_path))
+        attachments = [attachment for result in storage.filter_mails(None) for attachment in result.mail.attachments]
+        attachment_paths = resolve_attachment_paths(storage, attachments)
+        assert attachment_paths == {attachment.hashsum_hex: storage.find_attachment_path(attachment.hashsum_hex)
+                                    for attachment in attachments}
+
+    def test_collision(self, repo_path):
+        storage = Storage(str(repo_path))
+        attachment = next(result for result in storage.filter_mails(None)
+                          if result.mail.name == 'name2').mail.attachments[0]
+        attachment_path = storage.find_attachment_path(attachment.hashsum_hex)
+        os.rename(attachment_path, attachment_path.replace('.bin', '_0000.bin'))
+        with open(attachment_path, 'wb') as attachment_file:
+            attachment_file.write(b'sharee')  # the same prefix and size, another content
+
+        assert resolve_attachment_paths(storage, [attachment]) == {
+            attachment.hashsum_hex: attachment_path.replace('.bin', '_0000.bin')}
+
+    def test_same_size(self, repo_path):
+        """The only file of the hashsum prefix with the size of the attachment but another content"""
+        storage = Storage(str(repo_path))
+        attachment = next(result for result in storage.filter_mails(None)
+                          if result.mail.name == 'name2').mail.attachments[0]
+        with open(storage.find_attachment_path(attachment.hashsum_hex), 'wb') as attachment_file:
+            attachment_file.write(b'sharee')
+
+        assert resolve_attachment_paths(storage, [attachment]) == {}
+
+
+class TestExportFile:
+    @pytest.mark.parametrize('hardlink', [False, True])
+    def test_ok(self, tmp_path, hardlink):
+        (tmp_path / 'source').write_bytes(b'content')
+        assert export_file(str(tmp_path / 'source'), str(tmp_path / 'target'), hardlink) is hardlink
+        assert (tmp_path / 'target').read_bytes() == b'content'
+        assert os.path.samefile(tmp_path / 'source', tmp_path / 'target') is hardlink
+
+    @pytest.mark.parametrize('hardlinks', [[True, True], [True, False], [False, True], [False, False]])
+    def test_repeated(self, tmp_path, hardlinks):
+        """The second export into the same target doesn't write into the repository file through the hard link"""
+        (tmp_path / 'source').write_bytes(b'content')
+        (tmp_path / 'other').write_bytes(b'other content')
+        export_file(str(tmp_path / 'source'), str(tmp_path / 'target'), hardlinks[0])
+        export_file(str(tmp_path / 'source'), str(tmp_path / 'target'), hardlinks[1])
+        assert (tmp_path / 'source').read_bytes() == b'content'
+        assert (tmp_path / 'target').read_bytes() == b'content'
+
+        assert export_file(str(tmp_path / 'other'), str(tmp_path / 'target'), hardlinks[1]) is hardlinks[1]
+        assert (tmp_path / 'source').read_bytes() == b'content'
+        assert (tmp_path / 'target').read_bytes() == b'other content'
+
+
+class TestMailExporter:
+    def test_ok(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        mail_exporter = MailExporter(storage, str(tmp_path / 'export'), workers=2)
+        for result in storage.filter_mails(None):
+            mail_exporter.add_mail(result.mail_path, result.mail)
+
+        stats = mail_exporter.export()
+        assert (stats.messages_number, stats.files_number) == (3, 6)
+        assert get_exported_files(tmp_path / 'export') == {
+            os.path.splitext(os.path.basename(result.mail_path))[0]: sorted(
+                [os.path.basename(result.mail_path)] + [attachment.filename for attachment in result.mail.attachments])
+            for result in storage.filter_mails(None)
+        }
+        assert mail_exporter.missing_attachments == []
+
+    def test_batches(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        (repo_path / Storage.ATTACHMENTS_FOLDER / os.path.basename(storage.find_attachment_path(
+            next(result for result in storage.filter_mails(None)
+                 if result.mail.name == 'name2').mail.attachments[0].hashsum_hex))).unlink()
+
+        os.mkdir(tmp_path / 'export')
+        mail_exporter = MailExporter(storage, str(tmp_path / 'export'), batch_size=2)
+        for idx, result in enumerate(storage.filter_mails(None, sort_by=SortBy.DATE)):
+            mail_exporter.add_mail(result.mail_path, result.mail)
+            assert len(os.listdir(tmp_path / 'export')) == (0 if idx == 0 else 2)
+
+        stats = mail_exporter.export()
+        assert (stats.messages_number, stats.files_number) == (3, 4)
+        assert len(get_exported_files(tmp_path / 'export')) == 3
+        assert sorted((os.path.basename(msg_path), attachment.filename)
+                      for msg_path, attachment in mail_exporter.missing_attachments) == sorted(
+            (os.path.basename(result.mail_path), 'shared.txt') for result in storage.filter_mails(None)
+            if result.mail.name in ['name1', 'name2'])
+
+    def test_repeated_hardlink(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        contents = {path.name: path.read_bytes() for path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir()}
+        for hardlink in [True, True, False]:
+            mail_exporter = MailExporter(storage, str(tmp_path / 'export'), hardlink=hardlink)
+            for result in storage.filter_mails(None):
+                mail_exporter.add_mail(result.mail_path, result.mail)
+            assert mail_exporter.export().files_number == 6
+
+        assert {path.name: path.read_bytes() for path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir()} == contents
+
+
+class TestExportCommand:
+    def test_hashsums(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        results = list(storage.filter_mails(None))
+        result = CliRunner().invoke(export, [  # type: ignore
+            str(repo_path), str(tmp_path / 'export'), '--hashsums',
+            ','.join(result.mail_hashsum_hex[:10] for result in results[:2]), '--hardlink'])
+        assert result.exit_code == 0, result.output
+        assert set(get_exported_files(tmp_path / 'export')) == {
+            os.path.splitext(os.path.basename(result.mail_path))[0] for result in results[:2]}
+
+    def test_missing_attachment(self, repo_path, tmp_path):
+        for attachment_path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir():
+            attachment_path.unlink()
+
+        result = CliRunner(mix_stderr=False).invoke(search, [  # type: ignore
+            str(repo_path), '--datetime-from', '2000-01-01', '--output-format', 'COUNT', '--no-show-progressbar',
+            '--no-use-daemon', '--export-folder', str(tmp_path / 'export')])
+        assert result.exit_code == 0, result.output
+        assert result.stderr.count('is not found') == 3
+        assert len(get_exported_files(tmp_path / 'export')) == 3
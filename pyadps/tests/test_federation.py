@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import copy, search
+from pyadps.federation import FederatedStorage, group_by_device
+from pyadps.storage import SortBy, Storage
+from pyadps.tests.helpers import fabricate_mail_with_files
+
+
+@pytest.fixture
+def repo_paths(tmp_path):
+    """Two repositories which share the message of day 2, the message of day 3 is without its attachment"""
+    (tmp_path / 'own.txt').write_bytes(b'own')
+    mails = {day: fabricate_mail_with_files(datetime(2020, 1, day), f'name{day}',
+                                            [tmp_path / 'own.txt'] if day == 3 else [])
+             for day in [1, 2, 3]}
+    first_path, second_path = tmp_path / 'first', tmp_path / 'second'
+    Storage(str(first_path)).save_mails([mails[1], mails[2]], str(first_path))
+    Storage(str(second_path)).save_mails([mails[2], mails[3]], str(second_path))
+
+    shutil.rmtree(second_path / Storage.ATTACHMENTS_FOLDER)
+    os.makedirs(second_path / Storage.ATTACHMENTS_FOLDER)
+    Storage(str(first_path)).save_mails([mails[3]], str(tmp_path / 'with_attachment'))
+    shutil.copytree(tmp_path / 'with_attachment' / Storage.ATTACHMENTS_FOLDER,
+                    first_path / Storage.ATTACHMENTS_FOLDER, dirs_exist_ok=True)
+    return str(first_path), str(second_path)
+
+
+class TestFederatedStorage:
+    def test_filter_mails(self, repo_paths):
+        results = FederatedStorage(repo_paths).filter_mails(None)
+        repo_folders_by_name = {result.mail.name: result.repo_folders for result in results}
+        assert repo_folders_by_name == {'name1': [repo_paths[0]], 'name2': list(repo_paths), 'name3': [repo_paths[1]]}
+        assert all(result.mail_path.startswith(result.repo_folders[0]) for result in results)
+
+    def test_sort_limit(self, repo_paths):
+        results = FederatedStorage(repo_paths).filter_mails(None, sort_by=SortBy.DATE, limit=2)
+        assert [result.mail.name for result in results] == ['name3', 'name2']
+        assert results[1].repo_folders == list(repo_paths)
+
+    def test_callback(self, repo_paths):
+        callback_data = []
+        FederatedStorage(repo_paths).filter_mails(None, callback_data.append)
+        assert [data.current_mail_idx for data in callback_data] == [0, 1, 2, 3]
+        assert {data.total_mails_number for data in callback_data} == {4}
+
+    def test_iter_copy_mails(self, repo_paths, tmp_path):
+        federated_storage = FederatedStorage(repo_paths)
+        target_path = tmp_path / 'target'
+        copied = list(federated_storage.iter_copy_mails(federated_storage.filter_mails(None), str(target_path)))
+        assert len(copied) == 3
+        assert len(os.listdir(target_path / Storage.MESSAGES_FOLDER)) == 3
+        assert [path.read_bytes() for path in (target_path / Storage.ATTACHMENTS_FOLDER).iterdir()] == [b'own']
+
+    def test_iter_copy_mails_callback(self, repo_paths, tmp_path):
+        federated_storage = FederatedStorage(repo_paths)
+        callback_data = []
+        list(federated_storage.iter_copy_mails(federated_storage.filter_mails(None), str(tmp_path / 'target'),
+                                               callback=callback_data.append))
+        copying_progress = [data.copying_progress for data in callback_data]
+        assert [progress.current_file_idx for progress in copying_progress] == [0, 1, 2, 3]
+        assert {progress.total_files_number for progress in copying_progress} == {4}
+        assert copying_progress[-1].copied_bytes == copying_progress[-1].total_files_size_bytes
+
+    def test_group_by_device(self, repo_paths):
+        assert group_by_device(repo_paths) == [list(repo_paths)]
+
+
+class TestSearchCommand:
+    def test_extra_repo_folder(self, repo_paths):
+        result = CliRunner().invoke(search, [  # type: ignore
+            repo_paths[0], '--extra-repo-folder', repo_paths[1], '--datetime-from', '2000-01-01',
+            '--output-format', 'NDJSON', '--no-show-progressbar', '--no-use-daemon'])
+        assert result.exit_code == 0, result.output
+        records = [json.loads(line) for line in result.output.splitlines()]
+        assert sorted(len(record['repo_folders']) for record in records) == [1, 1, 2]
+
+    def test_extra_repo_folder_with_delete(self, repo_paths):
+        result = CliRunner().invoke(search, [  # type: ignore
+            repo_paths[0], '--extra-repo-folder', repo_paths[1], '--delete', '--no-use-daemon'])
+        assert result.exit_code == 2
+
+
+class TestCopyCommand:
+    def test_extra_repo_folder(self, repo_paths, tmp_path):
+        target_path = tmp_path / 'target'
+        Storage(str(target_path)).save_mails([], str(target_path))
+        hashsums = ','.join(result.mail_hashsum_hex for result in FederatedStorage(repo_paths).filter_mails(None))
+        result = CliRunner().invoke(copy, [  # type: ignore
+            repo_paths[0], str(target_path), '--extra-repo-folder', repo_paths[1], '--hashsums', hashsums,
+            '--no-use-daemon'])
+        assert result.exit_code == 0, result.output
+        assert 'Copying files...' in result.output
+        assert len(os.listdir(target_path / Storage.MESSAGES_FOLDER)) == 3
+        assert [path.read_bytes() for path in (target_path / Storage.ATTACHMENTS_FOLDER).iterdir()] == [b'own']
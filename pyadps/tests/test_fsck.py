@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import fsck
+from pyadps.fsck import FsckIssueKind, check_repository
+from pyadps.storage import Storage
+from pyadps.tests.helpers import save_repository
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    return save_repository(tmp_path, [['shared.txt', 'own.txt'], ['shared.txt'], ['other.txt']])
+
+
+def get_attachment_path(repo_path, content: bytes) -> str:
+    for attachment_path in (repo_path / 'adps_attachments').iterdir():
+        if attachment_path.read_bytes() == content:
+            return str(attachment_path)
+
+    raise FileNotFoundError()
+
+
+def get_issues(repo_path, **kwargs) -> list:
+    return sorted((issue.kind, os.path.basename(issue.path))
+                  for issue in check_repository(Storage(str(repo_path)), workers=2, **kwargs))
+
+
+class TestCheckRepository:
+    def test_ok(self, repo_path):
+        callback_data = []
+        assert get_issues(repo_path, callback=callback_data.append) == []
+        assert [data.checked_files_number for data in callback_data] == [1, 2, 3, 4, 5, 6]
+        assert callback_data[-1].total_files_number == 6
+
+    def test_packed(self, repo_path):
+        Storage(str(repo_path)).pack_messages()
+        assert get_issues(repo_path) == []
+
+    def test_issues(self, repo_path):
+        storage = Storage(str(repo_path))
+        own_path = get_attachment_path(repo_path, b'own')
+        other_path = get_attachment_path(repo_path, b'other')
+        msg_paths = {result.mail.name: result.mail_path for result in storage.filter_mails(None)}
+
+        with open(own_path, 'ab') as own_file:
+            own_file.write(b'damaged')
+        os.remove(msg_paths['name3'])
+        shared_path = get_attachment_path(repo_path, b'shared')
+        shutil.copy(shared_path, shared_path.replace('.bin', '_0001.bin'))
+        (repo_path / 'adps_messages' / '0123456789.json').write_text('{')
+
+        own_filename, other_filename = os.path.basename(own_path), os.path.basename(other_path)
+        assert get_issues(repo_path) == sorted([
+            (FsckIssueKind.UNREADABLE, '0123456789.json'),
+            (FsckIssueKind.HASHSUM_MISMATCH, '0123456789.json'),
+            (FsckIssueKind.HASHSUM_MISMATCH, own_filename),
+            (FsckIssueKind.MISSING_ATTACHMENT, os.path.basename(msg_paths['name1'])),
+            (FsckIssueKind.ORPHAN_ATTACHMENT, other_filename),
+            (FsckIssueKind.COLLISION_GAP, os.path.basename(shared_path).replace('.bin', '_0000.bin')),
+        ])
+
+    def test_checkpoint(self, repo_path, tmp_path):
+        checkpoint_path = str(tmp_path / 'fsck.checkpoint')
+        assert get_issues(repo_path, checkpoint_path=checkpoint_path) == []
+        assert len((tmp_path / 'fsck.checkpoint').read_text().splitlines()) == 6
+
+        # the damage keeping the size and the modification time isn't seen through the checkpoint
+        own_path = get_attachment_path(repo_path, b'own')
+        own_stat = os.stat(own_path)
+        with open(own_path, 'wb') as own_file:
+            own_file.write(b'OWN')
+        os.utime(own_path, ns=(own_stat.st_atime_ns, own_stat.st_mtime_ns))
+
+        assert get_issues(repo_path, checkpoint_path=checkpoint_path) == []
+        assert get_issues(repo_path) != []
+
+        os.utime(own_path)  # the changed files are checked again
+        assert (FsckIssueKind.HASHSUM_MISMATCH, os.path.basename(own_path)) in get_issues(
+            repo_path, checkpoint_path=checkpoint_path)
+
+
+class TestFsckCommand:
+    def test_ok(self, repo_path):
+        result = CliRunner().invoke(fsck, [str(repo_path), '--no-show-progressbar'])  # type: ignore
+
+        assert result.exit_code == 0, result.output
+        assert result.output == '0 issues found\n'
+
+    def test_issues(self, repo_path):
+        os.remove(get_attachment_path(repo_path, b'other'))
+
+        result = CliRunner().invoke(fsck, [str(repo_path), '--no-show-progressbar'])  # type: ignore
+
+        assert result.exit_code == 1
+        assert result.output.startswith(FsckIssueKind.MISSING_ATTACHMENT)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+
+import pytest
+
+from pyadps.hashing import HashsumBackend, HashsumEngine, get_default_engine, set_default_engine
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.storage import Storage
+
+
+@pytest.fixture(params=[1, 3])
+def default_engine(request):
+    engine = HashsumEngine(HashsumBackend.AUTO, request.param)
+    previous_engine = set_default_engine(engine)
+    yield engine
+    set_default_engine(previous_engine)
+    engine.close()
+
+
+class TestHashsumEngine:
+    @pytest.mark.parametrize('backend', HashsumBackend.ALL)
+    @pytest.mark.parametrize('size_bytes', [0, 3, 18 * 1024 * 1024])  # the last one is larger than a chunk
+    def test_hash_file(self, tmp_path, backend, size_bytes):
+        content = bytes(range(256)) * (size_bytes // 256) + b'abc'[:size_bytes % 256]
+        path = tmp_path / 'file.bin'
+        path.write_bytes(content)
+
+        engine = HashsumEngine(backend)
+        hash_result = engine.hash_file(path)
+
+        assert hash_result.hex_digest == hashlib.sha512(content).hexdigest()
+        assert hash_result.size_bytes == len(content)
+
+    @pytest.mark.parametrize('backend', HashsumBackend.ALL)
+    def test_hash_stream_from_position(self, tmp_path, backend):
+        path = tmp_path / 'file.bin'
+        path.write_bytes(b'header' + b'content')
+
+        with open(path, 'rb') as file_stream:
+            file_stream.seek(len(b'header'))
+            hash_result = HashsumEngine(backend).hash_stream(file_stream)
+
+        assert hash_result.hex_digest == hashlib.sha512(b'content').hexdigest()
+
+    def test_hash_streams_bytes_io(self):
+        engine = HashsumEngine(HashsumBackend.MMAP, 2)
+        try:
+            hash_results = engine.hash_streams([io.BytesIO(b'a'), io.BytesIO(b'b')])
+        finally:
+            engine.close()
+
+        assert [hash_result.hex_digest for hash_result in hash_results] == [
+            hashlib.sha512(b'a').hexdigest(), hashlib.sha512(b'b').hexdigest()
+        ]
+
+    def test_hash_files_order(self, tmp_path):
+        paths = []
+        for idx in range(10):
+            path = tmp_path / f'{idx}.bin'
+            path.write_bytes(b'x' * idx * 1000)
+            paths.append(path)
+
+        engine = HashsumEngine(HashsumBackend.READINTO, 4)
+        try:
+            hash_results = engine.hash_files(paths)
+        finally:
+            engine.close()
+
+        assert [hash_result.hex_digest for hash_result in hash_results] == [
+            hashlib.sha512(b'x' * idx * 1000).hexdigest() for idx in range(10)
+        ]
+
+    @pytest.mark.parametrize('backend, workers', [('SHA512', 1), (HashsumBackend.AUTO, 0)])
+    def test_invalid_arguments(self, backend, workers):
+        with pytest.raises(ValueError):
+            HashsumEngine(backend, workers)
+
+    def test_set_default_engine(self):
+        engine = HashsumEngine(workers=2)
+        previous_engine = set_default_engine(engine)
+        try:
+            assert get_default_engine() is engine
+        finally:
+            set_default_engine(previous_engine)
+
+
+class TestStorageWithEngine:
+    def test_get_free_file_path(self, tmp_path, default_engine):
+        for idx, content in enumerate([b'0', b'1', b'2', b'3', b'4']):
+            suffix = '' if idx == 0 else f'_{idx - 1:04}'
+            (tmp_path / f'file{suffix}.bin').write_bytes(content)
+
+        path = tmp_path / 'file.bin'
+        assert Storage.get_free_file_path(path, calculate_hashsum_hex_from_bytes(b'3')) == (
+            str(tmp_path / 'file_0002.bin'), True
+        )
+        assert Storage.get_free_file_path(path, calculate_hashsum_hex_from_bytes(b'new')) == (
+            str(tmp_path / 'file_0004.bin'), False
+        )
+
+    def test_find_attachment_path(self, tmp_path, default_engine):
+        storage = Storage(str(tmp_path))
+        hashsum_hex = calculate_hashsum_hex_from_bytes(b'content')
+        prefix = hashsum_hex[:Storage.HASHSUM_FILENAME_PART_LEN]
+        attachments_path = tmp_path / Storage.ATTACHMENTS_FOLDER
+        attachments_path.mkdir()
+        (attachments_path / f'{prefix}.bin').write_bytes(b'other')
+        for idx in range(4):
+            (attachments_path / f'{prefix}_{idx:04}.bin').write_bytes(b'content' if idx == 2 else b'other%d' % idx)
+
+        assert storage.find_attachment_path(hashsum_hex) == str(attachments_path / f'{prefix}_0002.bin')
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import import_
+from pyadps.helpers import calculate_hashsum_hex_from_bytes
+from pyadps.importing import ManifestError, build_mails, read_manifest
+from pyadps.mail import CoordsData
+from pyadps.storage import Storage
+
+
+@pytest.fixture
+def attachments_path(tmp_path):
+    attachments_path = tmp_path / 'attachments'
+    attachments_path.mkdir()
+    (attachments_path / 'a.txt').write_bytes(b'aaa')
+    (attachments_path / 'b.txt').write_bytes(b'bbbb')
+    return attachments_path
+
+
+class TestReadManifest:
+    def test_csv(self, tmp_path, attachments_path):
+        manifest_path = tmp_path / 'manifest.csv'
+        manifest_path.write_text(
+            'name,recipient_coords,date_created,additional_notes,inline_message,attachments\n'
+            'alice,"55.75,37.61;59.93,30.33",2022-01-01T10:00:00,,"hello, world",attachments/a.txt;attachments/b.txt\n'
+            'bob,"10,20",,notes,,\n'
+        )
+
+        records = read_manifest(str(manifest_path))
+
+        assert [record.name for record in records] == ['alice', 'bob']
+        assert records[0].recipient_coords == [CoordsData(55.75, 37.61), CoordsData(59.93, 30.33)]
+        assert records[0].date_created == datetime(2022, 1, 1, 10)
+        assert records[0].inline_message == 'hello, world'
+        assert records[0].attachment_paths == [str(attachments_path / 'a.txt'), str(attachments_path / 'b.txt')]
+        assert records[1].date_created is None
+        assert records[1].additional_notes == 'notes'
+        assert records[1].attachment_paths == []
+
+    def test_json_lines(self, tmp_path, attachments_path):
+        manifest_path = tmp_path / 'manifest.jsonl'
+        lines = [
+            {'name': 'alice', 'recipient_coords': [{'lat': 55.75, 'lon': 37.61}],
+             'attachments': [str(attachments_path / 'a.txt')]},
+            {'name': 'bob', 'recipient_coords': [{'lat': 10, 'lon': 20}], 'date_created': '2022-01-01T10:00:00'},
+        ]
+        manifest_path.write_text('\n'.join(json.dumps(line) for line in lines) + '\n\n')
+
+        records = read_manifest(str(manifest_path))
+
+        assert [record.name for record in records] == ['alice', 'bob']
+        assert records[0].attachment_paths == [str(attachments_path / 'a.txt')]
+        assert records[1].recipient_coords == [CoordsData(10.0, 20.0)]
+
+    @pytest.mark.parametrize('line', [
+        '{"name": "bob", "recipient_coords": [{"lat": 10, "lon": 200}]}',
+        '{"name": "bob", "recipient_coords": []}',
+        '{"recipient_coords": [{"lat": 10, "lon": 20}]}',
+        '{"name": "bob", "recipient_coords": [{"lat": 10, "lon": 20}], "attachments": ["missing.txt"]}',
+        '{"name": "bob", "recipient_coords": [{"lat": 10, "lon": 20}], "date_created": 1}',
+        '[1, 2]',
+        '{"name": ',
+    ])
+    def test_invalid_line(self, tmp_path, line):
+        manifest_path = tmp_path / 'manifest.jsonl'
+        manifest_path.write_text('{"name": "alice", "recipient_coords": [{"lat": 10, "lon": 20}]}\n' + line + '\n')
+
+        with pytest.raises(ManifestError, match='line 2'):
+            read_manifest(str(manifest_path))
+
+
+class TestBuildMails:
+    def test_shared_attachment(self, tmp_path, attachments_path):
+        manifest_path = tmp_path / 'manifest.csv'
+        manifest_path.write_text(
+            'name,recipient_coords,attachments\n'
+            'alice,"55.75,37.61",attachments/a.txt;attachments/b.txt\n'
+            'bob,"10,20",attachments/a.txt\n'
+        )
+
+        mails = build_mails(read_manifest(str(manifest_path)))
+
+        (mail_1, attachment_infos_1), (mail_2, attachment_infos_2) = mails
+        assert [attachment.filename for attachment in mail_1.attachments] == ['a.txt', 'b.txt']
+        assert mail_1.attachments[1].size_bytes == 4
+        assert mail_2.attachments[0].hashsum_hex == calculate_hashsum_hex_from_bytes(b'aaa')
+        assert attachment_infos_2[0].path == str(attachments_path / 'a.txt')
+
+
+class TestImportCommand:
+    def test_ok(self, tmp_path, attachments_path):
+        repo_path = tmp_path / 'repo'
+        repo_path.mkdir()
+        (repo_path / Storage.MESSAGES_FOLDER).mkdir()
+        (repo_path / Storage.ATTACHMENTS_FOLDER).mkdir()
+
+        manifest_path = tmp_path / 'manifest.csv'
+        manifest_path.write_text(
+            'name,recipient_coords,attachments\n'
+            'alice,"55.75,37.61",attachments/a.txt;attachments/b.txt\n'
+            'bob,"10,20",attachments/a.txt\n'
+        )
+
+        result = CliRunner().invoke(import_, [str(manifest_path), str(repo_path)])  # type: ignore
+
+        assert result.exit_code == 0, result.output
+        assert 'Imported 2 messages' in result.output
+        assert len(list((repo_path / Storage.MESSAGES_FOLDER).iterdir())) == 2
+        assert len(list((repo_path / Storage.ATTACHMENTS_FOLDER).iterdir())) == 2
+
+    def test_invalid_manifest(self, tmp_path):
+        repo_path = tmp_path / 'repo'
+        repo_path.mkdir()
+        (repo_path / Storage.MESSAGES_FOLDER).mkdir()
+        (repo_path / Storage.ATTACHMENTS_FOLDER).mkdir()
+
+        manifest_path = tmp_path / 'manifest.csv'
+        manifest_path.write_text('name,recipient_coords\nalice,"100,37.61"\n')
+
+        result = CliRunner().invoke(import_, [str(manifest_path), str(repo_path)])  # type: ignore
+
+        assert result.exit_code == 1
+        assert 'line 2' in result.output
+        assert list((repo_path / Storage.MESSAGES_FOLDER).iterdir()) == []
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
+import json
+import subprocess
+import sys
+from contextlib import ExitStack
 from datetime import datetime
+from pathlib import PurePath
 from typing import Optional
 from unittest.mock import patch
 
 import pytest
+from marshmallow import ValidationError
 
 from pyadps.mail import (AdditionalNotesFilterData, AttachmentFilterData,
                          CoordsData, DampingDistanceFilterData,
                          DatetimeCreatedRangeFilterData, FileAttachment,
-                         InlineMessageFilterData, LocationFilterData,
-                         MailFilter, NameFilterData)
+                         InlineMessageFilterData, LocationFilterData, Mail,
+                         MailFilter, NameFilterData, dump_mail_dict,
+                         load_mail_dict)
 from pyadps.tests.helpers import fabricate_mail
 
 MOSCOW_COORDS = CoordsData(55.75222, 37.61556)
@@ -94,3 +101,100 @@ class TestMailFilter:
         mail = fabricate_mail(attachments=[FileAttachment('123.mp4', 12345678, '0123456789abcdef')])
         is_filtered_actual = mail_filter.filter_func(mail)
         assert is_filtered_actual is is_filtered_expected
+
+
+def get_mail_dict(**changes) -> dict:
+    mail = fabricate_mail(
+        date_created=datetime(2021, 3, 4, 5, 6, 7, 891011),
+        additional_notes='Vavilova st.',
+        attachments=[FileAttachment('doc.txt', 10, 'ab' * 64)],
+    )
+    mail_dict = json.loads(json.dumps(Mail.Schema().dump(mail)))
+    mail_dict.update(changes)
+    return mail_dict
+
+
+class TestLoadMailDict:
+    @pytest.mark.parametrize('changes', [
+        {},
+        {'date_created': '2021-03-04T05:06:07'},
+        {'date_created': '2021-03-04T05:06:07Z'},
+        {'recipient_coords': [{'lat': 1, 'lon': '2.5'}]},
+        {'attachments': []},
+        {'attachments': [{'filename': 'doc.txt', 'size_bytes': 10, 'hashsum_hex': 'ab'}]},
+        {'inline_message': 'Hello'},
+    ])
+    def test_same_as_schema(self, changes):
+        mail_dict = get_mail_dict(**changes)
+        assert load_mail_dict(mail_dict) == Mail.Schema().load(mail_dict)
+
+    def test_missing_optional_field(self):
+        mail_dict = get_mail_dict()
+        del mail_dict['additional_notes']
+        assert load_mail_dict(mail_dict) == Mail.Schema().load(mail_dict)
+
+    @pytest.mark.parametrize('changes', [
+        {'unknown_field': 1},
+        {'recipient_coords': [{'lat': True, 'lon': 2.0}]},
+        {'recipient_coords': [{'lat': float('nan'), 'lon': 2.0}]},
+        {'attachments': [{'filename': 'doc.txt', 'size_bytes': 'big', 'hashsum_hex': 'ab', 'hashsum_alg': 'sha512'}]},
+        {'name': None},
+        {'date_created': 'yesterday'},
+    ])
+    def test_validation_error(self, changes):
+        mail_dict = get_mail_dict(**changes)
+        with pytest.raises(ValidationError) as expected_error:
+            Mail.Schema().load(mail_dict)
+
+        with pytest.raises(ValidationError) as error:
+            load_mail_dict(mail_dict)
+        assert error.value.messages == expected_error.value.messages
+
+
+class TestDumpMailDict:
+    @pytest.mark.parametrize('mail', [
+        fabricate_mail(),
+        fabricate_mail(
+            date_created=datetime(2021, 3, 4, 5, 6, 7, 891011),
+            recipient_coords=[CoordsData(1, 2)],
+            additional_notes='Vavilova st.',
+            inline_message='Hello',
+            attachments=[FileAttachment('doc.txt', 10, 'ab' * 64)],
+        ),
+    ])
+    def test_same_as_schema(self, mail):
+        assert json.dumps(dump_mail_dict(mail), sort_keys=True) == json.dumps(Mail.Schema().dump(mail), sort_keys=True)
+
+
+class TestFromAttachmentStreams:
+    def test_generator(self, tmp_path):
+        for filename, content in [('a.txt', b'a'), ('bb.txt', b'bb')]:
+            (tmp_path / filename).write_bytes(content)
+
+        with ExitStack() as stack:
+            mail, attachment_infos = Mail.from_attachment_streams(
+                datetime(2020, 1, 1), [CoordsData(55.0, 37.0)], 'name', None, None,
+                (stack.enter_context(open(tmp_path / filename, 'rb')) for filename in ['a.txt', 'bb.txt']))
+        assert [(attachment.filename, attachment.size_bytes) for attachment in mail.attachments] == [
+            ('a.txt', 1), ('bb.txt', 2)]
+        assert [attachment_info.hashsum_hex for attachment_info in attachment_infos] == [
+            attachment.hashsum_hex for attachment in mail.attachments]
+
+
+class TestLazyImports:
+    def test_cli_import(self):
+        code = ('import sys, pyadps.cli\n'
+                'print(sorted(m for m in ["geopy", "marshmallow", "numpy"] if m in sys.modules))')
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                                cwd=PurePath(__file__).parents[2]).stdout
+        assert output.strip() == '[]'
+
+    def test_cli_command_modules(self):
+        """The modules of the commands are imported by the commands only"""
+        modules = ['pyadps.archive', 'pyadps.bundle', 'pyadps.daemon', 'pyadps.delete_journal', 'pyadps.exporting',
+                   'pyadps.federation', 'pyadps.fsck', 'pyadps.manifest', 'pyadps.query_cache', 'pyadps.result_sets',
+                   'pyadps.sampling', 'pyadps.watching', 'concurrent.futures']
+        code = f'import sys, pyadps.cli\nprint(sorted(m for m in {modules!r} if m in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+                                cwd=PurePath(__file__).parents[2]).stdout
+        assert output.strip() == '[]'
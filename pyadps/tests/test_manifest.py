@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import copy, manifest
+from pyadps.manifest import (BloomManifest, ExactManifest, ManifestError, ManifestMode, build_manifest, load_manifest,
+                             write_manifest)
+from pyadps.storage import Storage
+from pyadps.tests.helpers import get_repo_files
+
+
+def get_hashsum_hex(idx: int) -> str:
+    return hashlib.sha512(str(idx).encode()).hexdigest()
+
+
+class TestManifest:
+    @pytest.mark.parametrize('mode', ManifestMode.ALL)
+    def test_dump_load(self, repo_path, tmp_path, mode):
+        repo_manifest = build_manifest(Storage(str(repo_path)), mode)
+        write_manifest(repo_manifest, str(tmp_path / 'manifest'))
+        loaded_manifest = load_manifest(str(tmp_path / 'manifest'))
+
+        assert type(loaded_manifest) is type(repo_manifest)
+        assert len(loaded_manifest) == 5
+        storage = Storage(str(repo_path))
+        for result in storage.filter_mails(None):
+            assert result.mail_hashsum_hex in loaded_manifest
+            assert all(attachment.hashsum_hex in loaded_manifest for attachment in result.mail.attachments)
+        assert get_hashsum_hex(0) not in loaded_manifest
+
+    def test_missing_attachment_is_not_listed(self, repo_path):
+        attachment_path, = [path for path in (repo_path / Storage.ATTACHMENTS_FOLDER).iterdir()
+                            if path.read_bytes() == b'own']
+        os.remove(attachment_path)
+
+        repo_manifest = build_manifest(Storage(str(repo_path)))
+        assert len(repo_manifest) == 4
+        assert hashlib.sha512(b'own').hexdigest() not in repo_manifest
+
+    def test_bloom_false_positive_rate(self):
+        hashsums = [get_hashsum_hex(idx) for idx in range(10000)]
+        bloom_manifest = BloomManifest.from_digest_prefixes(
+            [bytes.fromhex(hashsum_hex[:32]) for hashsum_hex in hashsums], false_positive_rate=0.01)
+
+        assert all(hashsum_hex in bloom_manifest for hashsum_hex in hashsums)
+        false_positives = sum(get_hashsum_hex(idx) in bloom_manifest for idx in range(10000, 20000))
+        assert false_positives < 200
+        assert len(bloom_manifest.dump()) < len(ExactManifest.from_digest_prefixes(
+            bytes.fromhex(hashsum_hex[:32]) for hashsum_hex in hashsums).dump()) / 4
+
+    def test_not_manifest(self, tmp_path):
+        (tmp_path / 'manifest').write_bytes(b'not a manifest')
+        with pytest.raises(ManifestError):
+            load_manifest(str(tmp_path / 'manifest'))
+
+
+class TestExcludeManifest:
+    def test_copy_mails(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        msg_paths = {result.mail.name: result.mail_path for result in storage.filter_mails(None)}
+        target_path = tmp_path / 'target'
+        storage.copy_mails([msg_paths['name2']], str(target_path))
+        target_manifest = build_manifest(Storage(str(target_path)))
+        target_files = get_repo_files(target_path)
+
+        storage.copy_mails(list(msg_paths.values()), str(target_path), exclude_hashsums=target_manifest)
+        assert get_repo_files(target_path) == get_repo_files(repo_path)
+
+        other_path = tmp_path / 'other'
+        storage.copy_mails(list(msg_paths.values()), str(other_path), exclude_hashsums=target_manifest)
+        other_files = get_repo_files(other_path)
+        for folder, files in get_repo_files(repo_path).items():
+            assert other_files[folder].keys() == files.keys() - target_files[folder].keys()
+
+    def test_iter_copy_mails(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        target_manifest = build_manifest(storage)
+
+        copied = list(storage.iter_copy_mails(storage.filter_mails(None), str(tmp_path / 'target'),
+                                              exclude_hashsums=target_manifest))
+        assert len(copied) == 3
+        assert get_repo_files(tmp_path / 'target') == {Storage.MESSAGES_FOLDER: {}, Storage.ATTACHMENTS_FOLDER: {}}
+
+    def test_commands(self, repo_path, tmp_path):
+        target_path = tmp_path / 'target'
+        Storage(str(target_path)).save_mails([], str(target_path))
+        result = CliRunner().invoke(manifest, [str(target_path), str(tmp_path / 'manifest'),  # type: ignore
+                                               '--mode', ManifestMode.BLOOM])
+        assert result.exit_code == 0, result.output
+
+        msg_path = Storage(str(repo_path)).get_message_paths()[0]
+        result = CliRunner().invoke(copy, [str(repo_path), str(target_path), '--msg-path', msg_path,  # type: ignore
+                                           '--no-show-progressbar', '--no-use-daemon',
+                                           '--exclude-manifest', str(tmp_path / 'manifest')])
+        assert result.exit_code == 0, result.output
+        assert os.listdir(target_path / Storage.MESSAGES_FOLDER) == [os.path.basename(msg_path)]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from click.testing import CliRunner
+
+from pyadps.cli import search
+from pyadps.metrics import (Histogram, JsonLinesMetricsSink, MetricsReport, PrometheusTextfileSink, collect_metrics,
+                            get_metrics_sink, increment)
+from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
+
+
+class TestHistogram:
+    def test_ok(self):
+        histogram = Histogram.create([1, 10])
+        for value in [0, 1, 5, 100]:
+            histogram.observe(value)
+
+        assert histogram.bucket_counts == [2, 1, 1]
+        assert histogram.count == 4
+        assert histogram.sum == 106
+
+
+class TestCollectMetrics:
+    def test_disabled(self):
+        increment('messages_scanned')  # does nothing outside of the context
+
+        sink = JsonLinesMetricsSink(os.devnull)
+        with collect_metrics([sink]) as recorder:
+            pass
+        assert recorder.counters == {}
+
+    def test_storage_operations(self, tmp_path):
+        source_path, target_path = tmp_path / 'source', tmp_path / 'target'
+        storage = Storage(str(source_path))
+        storage.save_mail(fabricate_mail(name='John'), [], str(source_path))
+        storage.save_mail(fabricate_mail(name='Donald'), [], str(source_path))
+
+        reports = []
+
+        class ListSink:
+            def write(self, report: MetricsReport):
+                reports.append(report)
+
+        with collect_metrics([ListSink()], command='test'):
+            msg_paths = [result.mail_path for result in storage.filter_mails(None)]
+            storage.copy_mails(msg_paths, target_path)
+            storage.copy_mails(msg_paths, target_path)
+
+        report, = reports
+        assert report.command == 'test'
+        assert report.counters['messages_scanned'] == 2
+        assert report.counters['files_copied'] == 2
+        assert report.counters['copied_bytes'] == sum(
+            os.path.getsize(target_path / 'adps_messages' / filename)
+            for filename in os.listdir(target_path / 'adps_messages')
+        )
+        assert report.counters['hashsum_lookups'] == 2  # the second copy finds the existing files
+        assert report.histograms['collision_depth'].count == 4
+        assert set(report.get_rates()) == {
+            'messages_scanned_per_second', 'copied_megabytes_per_second', 'hashsum_cache_hit_ratio'}
+
+
+class TestPrometheusTextfileSink:
+    def test_accumulates_counters(self, tmp_path):
+        path = str(tmp_path / 'adps.prom')
+        sink = get_metrics_sink(path)
+        assert isinstance(sink, PrometheusTextfileSink)
+
+        histogram = Histogram.create([1, 10])
+        histogram.observe(5)
+        sink.write(MetricsReport('search', 1000.0, 2.0, {'messages_scanned': 10, 'scan_seconds': 2.0},
+                                 {'delete_scan_messages': histogram}))
+        sink.write(MetricsReport('search', 1010.0, 1.0, {'messages_scanned': 5}, {'delete_scan_messages': histogram}))
+
+        with open(path) as prom_file:
+            lines = prom_file.read().splitlines()
+
+        assert '# TYPE adps_messages_scanned_total counter' in lines
+        assert 'adps_messages_scanned_total 15.0' in lines
+        assert 'adps_delete_scan_messages_bucket{le="1"} 0.0' in lines
+        assert 'adps_delete_scan_messages_bucket{le="10"} 2.0' in lines
+        assert 'adps_delete_scan_messages_bucket{le="+Inf"} 2.0' in lines
+        assert 'adps_delete_scan_messages_count 2.0' in lines
+        assert 'adps_last_run_timestamp_seconds 1010.0' in lines
+        # the rate of the first run isn't reported as the rate of the last one
+        assert not any(line.startswith('adps_last_run_messages_scanned_per_second') for line in lines)
+
+
+class TestSearchMetricsOut:
+    def test_ok(self, tmp_path):
+        repo_path = tmp_path / 'repo'
+        storage = Storage(str(repo_path))
+        storage.save_mail(fabricate_mail(), [], str(repo_path))
+
+        metrics_path = tmp_path / 'metrics.jsonl'
+        for _ in range(2):
+            result = CliRunner().invoke(
+                search,  # type: ignore
+                [str(repo_path), '--datetime-from=2010-01-01', '--output-format=count', '--no-show-progressbar',
+                 '--metrics-out', str(metrics_path)]
+            )
+            assert result.exit_code == 0
+
+        with open(metrics_path) as metrics_file:
+            records = [json.loads(line) for line in metrics_file]
+
+        assert len(records) == 2
+        assert records[0]['command'] == 'search'
+        assert records[0]['counters']['messages_scanned'] == 1
+        assert 'messages_scanned_per_second' in records[0]['rates']
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from hashlib import sha512
+
+from pyadps.pack import MessagePack, PackIndexEntry
+
+
+class TestMessagePack:
+    def test_append_and_read(self, tmp_path):
+        message_pack = MessagePack(str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx'))
+        assert not message_pack.exists()
+        assert message_pack.get_entries() == {}
+
+        message_pack.append([('aaaaaaaaaa.json', b'{"a": 1}'), ('bbbbbbbbbb.json', b'{"b": 22}')])
+        message_pack.append([('cccccccccc.json', b'{}')])
+
+        assert message_pack.exists()
+        entries = message_pack.get_entries()
+        assert list(entries.values()) == [
+            PackIndexEntry('aaaaaaaaaa.json', 0, 8, sha512(b'{"a": 1}').hexdigest()),
+            PackIndexEntry('bbbbbbbbbb.json', 8, 9, sha512(b'{"b": 22}').hexdigest()),
+            PackIndexEntry('cccccccccc.json', 17, 2, sha512(b'{}').hexdigest()),
+        ]
+
+        assert message_pack.read(entries['bbbbbbbbbb.json']) == b'{"b": 22}'
+        assert [content for _, content in message_pack.iter_contents(entries.values())] == [
+            b'{"a": 1}', b'{"b": 22}', b'{}']
+
+        message_pack.remove()
+        assert not message_pack.exists()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_filename_with_spaces(self, tmp_path):
+        message_pack = MessagePack(str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx'))
+        message_pack.append([('a b .json', b'{}')])
+        assert MessagePack(str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx')).get_entries() == {
+            'a b .json': PackIndexEntry('a b .json', 0, 2, sha512(b'{}').hexdigest())}
+
+    def test_interrupted_append(self, tmp_path):
+        message_pack = MessagePack(str(tmp_path / 'test.pack'), str(tmp_path / 'test.pack.idx'))
+        message_pack.append([('aaaaaaaaaa.json', b'{"a": 1}')])
+
+        # the data was written to the pack, but the index line was not finished
+        with open(tmp_path / 'test.pack', 'ab') as pack_file:
+            pack_file.write(b'{"b": 2')
+        with open(tmp_path / 'test.pack.idx', 'a') as index_file:
+            index_file.write('bbbbbbbbbb.json 8 ')
+
+        assert list(message_pack.get_entries()) == ['aaaaaaaaaa.json']
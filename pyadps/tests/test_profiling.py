@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import datetime
+
+from click.testing import CliRunner
+
+from pyadps.cli import search
+from pyadps.mail import CoordsData, LocationFilterData, MailFilter
+from pyadps.profiling import ProfileStats, profile, stage
+from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
+
+
+class TestProfile:
+    def test_disabled(self):
+        with stage('read') as read_stage:
+            read_stage.add_bytes(10)
+
+        with profile() as stats:
+            pass
+        assert stats.stages == {}
+
+    def test_nested_stages(self):
+        with profile() as stats:
+            with stage('glob'):
+                with stage('read') as read_stage:
+                    read_stage.add_bytes(10)
+                with stage('read') as read_stage:
+                    read_stage.add_bytes(5)
+
+        assert stats.stages['read'].calls == 2
+        assert stats.stages['read'].bytes_read == 15
+        assert stats.stages['glob'].calls == 1
+        assert stats.stages['glob'].seconds + stats.stages['read'].seconds <= stats.total_seconds
+
+    def test_filter_mails(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        storage.save_mail(fabricate_mail(recipient_coords=[CoordsData(55.0, 37.0)]), [], str(tmp_path))
+        storage.save_mail(fabricate_mail(recipient_coords=[CoordsData(0.0, 0.0)]), [], str(tmp_path))
+
+        mail_filter = MailFilter(location_filter=LocationFilterData(CoordsData(55.0, 37.0), 1000))
+        with profile() as stats:
+            assert len(list(storage.filter_mails(mail_filter))) == 1
+
+        messages_size_bytes = sum(os.path.getsize(tmp_path / 'adps_messages' / filename)
+                                  for filename in os.listdir(tmp_path / 'adps_messages'))
+        assert stats.stages['glob'].calls == 1
+        assert stats.stages['read'].calls == 2
+        assert stats.stages['read'].bytes_read == messages_size_bytes
+        assert stats.stages['parse'].calls == 2
+        assert stats.stages['filter'].calls == 2
+        assert stats.stages['geodesic'].calls == 2
+        assert stats.stages['sha512'].calls == 1
+        assert isinstance(stats, ProfileStats)
+
+
+class TestSearchProfile:
+    def test_ok(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        storage.save_mail(fabricate_mail(date_created=datetime(2020, 1, 1)), [], str(tmp_path))
+
+        result = CliRunner(mix_stderr=False).invoke(
+            search,  # type: ignore
+            [str(tmp_path), '--datetime-from=2010-01-01', '--output-format=count', '--no-show-progressbar', '--profile']
+        )
+        assert result.exit_code == 0
+        assert result.stdout == '1\n'
+        stages = {line.split()[0] for line in result.stderr.splitlines()}
+        assert {'parse', 'read', 'glob', 'output', 'total'} <= stages
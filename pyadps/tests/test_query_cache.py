@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from pathlib import PurePath
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import search
+from pyadps.mail import CoordsData, DampingDistanceFilterData, Mail, MailFilter, NameFilterData
+from pyadps.query_cache import QUERY_CACHE_FOLDER, QueryCache, get_query_key
+from pyadps.storage import SortBy, Storage
+
+
+def create_mail(day: int, name: str) -> Mail:
+    return Mail.from_attachment_streams(datetime(2020, 1, day), [CoordsData(55.0, 37.0)], name, None, None, [])
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    repo_path = tmp_path / 'repo'
+    mails = [create_mail(day, name) for day, name in [(1, 'apple'), (2, 'apricot'), (3, 'banana')]]
+    Storage(str(repo_path)).save_mails(mails, str(repo_path), lambda _: None)
+    return repo_path
+
+
+class TestQueryCache:
+    def test_get_put(self, repo_path):
+        storage = Storage(str(repo_path))
+        query_cache = QueryCache(storage)
+        key = get_query_key(None, SortBy.DATE, 2)
+        assert query_cache.get(key) is None
+
+        results = list(query_cache.iter_put(key, storage.filter_mails(None, sort_by=SortBy.DATE, limit=2)))
+        assert query_cache.get(key) == results
+        assert query_cache.get(get_query_key(None, SortBy.DATE, 3)) is None
+
+    def test_changed_repository(self, repo_path):
+        storage = Storage(str(repo_path))
+        query_cache = QueryCache(storage)
+        key = get_query_key(None)
+        query_cache.put(key, storage.filter_mails(None))
+
+        storage.save_mails([create_mail(4, 'cherry')], str(repo_path))
+        assert query_cache.get(key) is None
+
+    def test_coarse_mtime(self, repo_path):
+        """The message replaced within the mtime resolution of the filesystem, e.g. 2 s of FAT"""
+        storage = Storage(str(repo_path))
+        query_cache = QueryCache(storage)
+        key = get_query_key(None)
+        query_cache.put(key, storage.filter_mails(None))
+
+        messages_path = repo_path / Storage.MESSAGES_FOLDER
+        stat_result = os.stat(messages_path)
+        os.remove(next(result.mail_path for result in storage.filter_mails(None) if result.mail.name == 'banana'))
+        storage.save_mails([create_mail(4, 'cherry')], str(repo_path))
+        os.utime(messages_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        assert query_cache.get(key) is None
+
+    def test_keys(self):
+        location = CoordsData(55.0, 37.0)
+        assert get_query_key(MailFilter(name_filter=NameFilterData('apple'))) == \
+            get_query_key(MailFilter(name_filter=NameFilterData('apple')))
+        assert get_query_key(MailFilter(name_filter=NameFilterData('apple'))) != get_query_key(None)
+        assert get_query_key(MailFilter(damping_distance_filter=DampingDistanceFilterData(location, 1000))) is None
+
+    def test_eviction(self, repo_path):
+        storage = Storage(str(repo_path))
+        query_cache = QueryCache(storage, max_entries=2)
+        keys = [get_query_key(None, limit=limit) for limit in range(1, 4)]
+        for idx, key in enumerate(keys[:2]):
+            query_cache.put(key, [])
+            os.utime(os.path.join(query_cache.folder_path, f'{key}.json'), ns=(idx, idx))
+
+        query_cache.get(keys[0])  # the first one is used recently, the second one is evicted
+        query_cache.put(keys[2], [])
+        assert query_cache.get(keys[0]) == []
+        assert query_cache.get(keys[1]) is None
+        assert query_cache.get(keys[2]) == []
+
+    def test_size_cap(self, repo_path):
+        storage = Storage(str(repo_path))
+        query_cache = QueryCache(storage, max_size_bytes=100)
+        key = get_query_key(None)
+        query_cache.put(key, storage.filter_mails(None))
+        assert query_cache.get(key) is None
+
+
+class TestSearchCommand:
+    def test_query_cache(self, repo_path):
+        args = [str(repo_path), '--datetime-from', '2000-01-01', '--output-format', 'HASHSUMS',
+                '--no-show-progressbar', '--no-use-daemon', '--query-cache']
+        result = CliRunner().invoke(search, args)  # type: ignore
+        assert result.exit_code == 0, result.output
+        assert len(os.listdir(repo_path / QUERY_CACHE_FOLDER)) == 1
+
+        os.remove(Storage(str(repo_path)).get_message_paths()[0])
+        cached_result = CliRunner().invoke(search, args)  # type: ignore
+        assert cached_result.exit_code == 0, cached_result.output
+        assert len(cached_result.output.splitlines()) == len(result.output.splitlines()) - 1
+
+    def test_default_datetime_from(self, repo_path, tmp_path):
+        """The same search without --datetime-from in another process hits the cache"""
+        storage = Storage(str(repo_path))
+        storage.save_mails([Mail.from_attachment_streams(datetime.now() - timedelta(days=1), [CoordsData(55.0, 37.0)],
+                                                         'recent', None, None, [])], str(repo_path), lambda _: None)
+        args = [sys.executable, '-m', 'pyadps.cli', 'search', str(repo_path), '--output-format', 'HASHSUMS',
+                '--no-show-progressbar', '--no-use-daemon', '--query-cache',
+                '--metrics-out', str(tmp_path / 'metrics.jsonl')]
+        outputs = [subprocess.run(args, check=True, capture_output=True, text=True,
+                                  cwd=PurePath(__file__).parents[2]).stdout for _ in range(2)]
+        assert outputs[0] == outputs[1]
+        assert len(outputs[0].splitlines()) == 1
+        assert len(os.listdir(repo_path / QUERY_CACHE_FOLDER)) == 1
+
+        with open(tmp_path / 'metrics.jsonl') as metrics_file:
+            counters = [json.loads(line)['counters'] for line in metrics_file]
+        assert counters[1].get('query_cache_hits') == 1
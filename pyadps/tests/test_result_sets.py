@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from pyadps.cli import search
+from pyadps.mail import CoordsData, Mail, MailFilter, NameFilterData
+from pyadps.result_sets import ResultSet, ResultSetError, ResultSetWriter
+from pyadps.storage import Storage
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    repo_path = tmp_path / 'repo'
+    mails = [Mail.from_attachment_streams(datetime(2020, 1, day), [CoordsData(55.0, 37.0)], name, None, None, [])
+             for day, name in [(1, 'apple'), (2, 'apricot'), (3, 'banana')]]
+    Storage(str(repo_path)).save_mails(mails, str(repo_path), lambda _: None)
+    return repo_path
+
+
+def save_result_set(storage: Storage, name: str, mail_filter=None) -> ResultSet:
+    result_set = ResultSet(storage, name)
+    with ResultSetWriter(result_set) as result_set_writer:
+        for _ in result_set_writer.iter_append(storage.filter_mails(mail_filter)):
+            pass
+
+    return result_set
+
+
+def get_names(search_results) -> list:
+    return sorted(result.mail.name for result in search_results)
+
+
+def invoke_search(repo_path, *args):
+    result = CliRunner(mix_stderr=False).invoke(search, [  # type: ignore
+        str(repo_path), '--output-format', 'NDJSON', '--no-show-progressbar', '--no-use-daemon', *args])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def get_output_names(result) -> list:
+    return sorted(json.loads(line)['name'] for line in result.stdout.splitlines())
+
+
+class TestResultSet:
+    def test_refine(self, repo_path):
+        storage = Storage(str(repo_path))
+        result_set = save_result_set(storage, 'apricot', MailFilter(name_filter=NameFilterData('apricot')))
+
+        assert get_names(storage.filter_mails(None, messages_bytes=result_set.iter_messages_bytes())) == ['apricot']
+        refined = storage.filter_mails(MailFilter(name_filter=NameFilterData('apple')),
+                                       messages_bytes=result_set.iter_messages_bytes())
+        assert get_names(refined) == []
+        assert result_set.stale_number == 0
+
+    def test_stale_entries(self, repo_path):
+        storage = Storage(str(repo_path))
+        result_set = save_result_set(storage, 'all')
+        msg_paths = {result.mail.name: result.mail_path for result in storage.filter_mails(None)}
+
+        os.remove(msg_paths['apple'])
+        with open(msg_paths['banana'], 'rb+') as msg_file:  # the same size, another content
+            msg_bytes = msg_file.read()
+            msg_file.seek(0)
+            msg_file.write(msg_bytes.replace(b'banana', b'bananb'))
+
+        assert get_names(storage.filter_mails(None, messages_bytes=result_set.iter_messages_bytes())) == ['apricot']
+        assert result_set.stale_number == 2
+
+    def test_touched_message_is_not_stale(self, repo_path):
+        storage = Storage(str(repo_path))
+        result_set = save_result_set(storage, 'all')
+        for msg_path in storage.get_message_paths():
+            os.utime(msg_path, ns=(0, 0))
+
+        assert len(list(result_set.iter_messages_bytes())) == 3
+        assert result_set.stale_number == 0
+
+    def test_aborted_write(self, repo_path):
+        storage = Storage(str(repo_path))
+        with pytest.raises(RuntimeError):
+            with ResultSetWriter(ResultSet(storage, 'all')):
+                raise RuntimeError()
+
+        assert not ResultSet(storage, 'all').exists()
+        assert not os.listdir(os.path.dirname(ResultSet(storage, 'all').path))
+
+    def test_invalid_name(self, repo_path):
+        with pytest.raises(ResultSetError):
+            ResultSet(Storage(str(repo_path)), '../all')
+
+
+class TestSearchCommand:
+    def test_save_refine_merge(self, repo_path):
+        invoke_search(repo_path, '--datetime-from', '2000-01-01', '--datetime-to', '2020-01-02 12:00:00',
+                      '--save-results', 'ap')
+
+        result = invoke_search(repo_path, '--datetime-from', '2020-01-01 12:00:00', '--refine', 'ap')
+        assert get_output_names(result) == ['apricot']
+
+        result = invoke_search(repo_path, '--datetime-from', '2020-01-02', '--merge', 'ap', '--save-results', 'ab')
+        assert get_output_names(result) == ['apple', 'apricot', 'banana']
+        assert len(list(ResultSet(Storage(str(repo_path)), 'ab').iter_entries())) == 3
+
+    def test_stale_entries_are_reported(self, repo_path):
+        invoke_search(repo_path, '--datetime-from', '2000-01-01', '--save-results', 'all')
+        os.remove(Storage(str(repo_path)).get_message_paths()[0])
+
+        result = invoke_search(repo_path, '--datetime-from', '2000-01-01', '--refine', 'all')
+        assert len(result.stdout.splitlines()) == 2
+        assert '1 stale entries' in result.stderr
+
+    def test_missing_result_set(self, repo_path):
+        result = CliRunner().invoke(search, [str(repo_path), '--refine', 'missing', '--no-use-daemon'])  # type: ignore
+        assert result.exit_code == 2
+        assert 'There is no result set' in result.output
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from random import Random
+
+import pytest
+
+from pyadps.sampling import estimate_count, get_stratum, iter_stratified_sample
+
+
+class TestEstimateCount:
+    def test_exact(self):
+        count_estimate = estimate_count(10, 100, 100, 0.95)
+        assert (count_estimate.count, count_estimate.lower, count_estimate.upper) == (10, 10, 10)
+        assert count_estimate.is_exact
+
+    @pytest.mark.parametrize('matched_number, sampled_number, total_number', [
+        (0, 100, 10000),
+        (100, 100, 10000),
+        (37, 400, 1000000),
+        (1, 2, 3),
+    ])
+    def test_interval(self, matched_number, sampled_number, total_number):
+        count_estimate = estimate_count(matched_number, sampled_number, total_number, 0.95)
+
+        assert count_estimate.lower <= count_estimate.count <= count_estimate.upper
+        assert matched_number <= count_estimate.lower
+        assert count_estimate.upper <= total_number - (sampled_number - matched_number)
+        assert count_estimate.lower < count_estimate.upper
+        assert not count_estimate.is_exact
+
+    def test_coverage(self):
+        rng = Random(1)
+        population = [idx < 3000 for idx in range(10000)]
+        covered_number = 0
+        for _ in range(200):
+            sample = rng.sample(population, 200)
+            count_estimate = estimate_count(sum(sample), len(sample), len(population), 0.9)
+            covered_number += count_estimate.lower <= 3000 <= count_estimate.upper
+
+        assert covered_number >= 170
+
+
+class TestIterStratifiedSample:
+    def test_proportional(self):
+        rng = Random(1)
+        msg_paths = [f'/repo/adps_messages/{rng.getrandbits(40):010x}.json' for _ in range(1600)]
+        msg_paths += [f'/repo/adps_messages/f{idx:09x}.json' for idx in range(400)]
+
+        sample = list(iter_stratified_sample(msg_paths, rng))
+
+        assert sorted(sample) == sorted(msg_paths)
+        strata_sizes = Counter(map(get_stratum, msg_paths))
+        for prefix_len in [50, 200, 1000]:
+            prefix_strata_sizes = Counter(map(get_stratum, sample[:prefix_len]))
+            for stratum, size in strata_sizes.items():
+                assert abs(prefix_strata_sizes[stratum] - size * prefix_len / len(msg_paths)) <= 1
@@ -2,9 +2,13 @@
 import os
 from datetime import datetime
 from hashlib import sha512
+from random import Random
 
-from pyadps.mail import CoordsData, DatetimeCreatedRangeFilterData, Mail, MailFilter
-from pyadps.storage import Storage
+import pytest
+
+from pyadps.mail import CoordsData, DatetimeCreatedRangeFilterData, FileAttachment, LocationFilterData, Mail, MailFilter
+from pyadps.storage import MessagePathsSpill, SortBy, Storage
+from pyadps.tests.helpers import fabricate_mail, fabricate_mail_with_files
 
 
 class TestCopyMails:
@@ -113,3 +117,278 @@ class TestFilterMails:
 
         filtered_mails = [filtered_mail_result.mail for filtered_mail_result in filtered_mail_results]
         assert filtered_mails == [mail_1]
+
+
+class TestPackedRepository:
+    def test_pack_and_unpack(self, tmp_path):
+        mail_1 = fabricate_mail(date_created=datetime(2020, 1, 1), name='Donald Smith')
+        mail_2 = fabricate_mail(date_created=datetime(2019, 3, 4), name='abcde@abcde.com')
+        mail_3 = fabricate_mail(date_created=datetime(2021, 3, 4), name='John')
+
+        storage = Storage(str(tmp_path))
+        storage.save_mail(mail_1, [], str(tmp_path))
+        storage.save_mail(mail_2, [], str(tmp_path))
+
+        loose_contents = {
+            filename: open(tmp_path / 'adps_messages' / filename, 'rb').read()
+            for filename in os.listdir(tmp_path / 'adps_messages')
+        }
+
+        assert storage.pack_messages() == []
+        assert os.listdir(tmp_path / 'adps_messages') == []
+        assert os.path.isfile(tmp_path / 'adps_messages.pack')
+
+        # the packed and the loose messages are read together
+        storage.save_mail(mail_3, [], str(tmp_path))
+        storage.save_mail(mail_1, [], str(tmp_path))
+        assert len(os.listdir(tmp_path / 'adps_messages')) == 1
+
+        filtered_mail_results = list(storage.filter_mails(MailFilter(
+            datetime_created_range_filter=DatetimeCreatedRangeFilterData(date_from=datetime(2019, 12, 1))
+        )))
+        assert sorted(result.mail.name for result in filtered_mail_results) == ['Donald Smith', 'John']
+        for result in filtered_mail_results:
+            assert storage.load_mail(result.mail_path) == result.mail
+
+        storage.unpack_messages()
+        assert not os.path.exists(tmp_path / 'adps_messages.pack')
+        for filename, content in loose_contents.items():
+            assert open(tmp_path / 'adps_messages' / filename, 'rb').read() == content
+        assert len(os.listdir(tmp_path / 'adps_messages')) == 3
+
+    def test_unpack_synced(self, tmp_path, monkeypatch):
+        storage = Storage(str(tmp_path))
+        for name in ['first', 'second']:
+            storage.save_mail(fabricate_mail(name=name), [], str(tmp_path))
+        storage.pack_messages()
+
+        synced_paths = []
+        fsync = os.fsync
+
+        def record_fsync(fd: int):
+            synced_paths.append(os.readlink(f'/proc/self/fd/{fd}'))
+            fsync(fd)
+
+        monkeypatch.setattr(os, 'fsync', record_fsync)
+        monkeypatch.delattr(os, 'sync', raising=False)
+        storage.unpack_messages()
+        assert sorted(synced_paths) == sorted(
+            [str(tmp_path / 'adps_messages')] + [str(path) for path in (tmp_path / 'adps_messages').iterdir()])
+
+    def test_clear_caches(self, tmp_path):
+        message_pack = Storage.get_message_pack(tmp_path)
+        assert Storage.get_message_pack(str(tmp_path)) is message_pack
+
+        Storage.clear_caches(tmp_path)
+        assert Storage.get_message_pack(tmp_path) is not message_pack
+
+    def test_copy_from_packed(self, tmp_path):
+        source_dir = tmp_path / 'source'
+        target_dir = tmp_path / 'target'
+
+        storage = Storage(str(source_dir))
+        storage.save_mail(fabricate_mail(), [], str(source_dir))
+        storage.pack_messages()
+
+        msg_paths = storage.get_message_paths()
+        assert len(msg_paths) == 1
+        assert not os.path.exists(msg_paths[0])
+
+        storage.copy_mails(msg_paths, target_dir)
+        assert os.listdir(target_dir / 'adps_messages') == [os.path.basename(msg_paths[0])]
+        with open(target_dir / 'adps_messages' / os.path.basename(msg_paths[0]), 'rb') as msg_file:
+            assert msg_file.read() == storage.read_message_bytes(msg_paths[0])
+
+
+class TestSaveMails:
+    def test_shared_attachments(self, tmp_path):
+        (tmp_path / 'a.txt').write_bytes(b'aaa')
+        (tmp_path / 'a_copy.txt').write_bytes(b'aaa')
+        (tmp_path / 'b.txt').write_bytes(b'bbb')
+
+        mails = [fabricate_mail_with_files(datetime(2020, 1, 1), f'name{idx}',
+                                           [tmp_path / filename for filename in filenames])
+                 for idx, filenames in enumerate([['a.txt', 'b.txt'], ['a_copy.txt'], ['b.txt']])]
+        callback_data = []
+
+        repo_path = tmp_path / 'repo'
+        msg_paths = Storage(str(repo_path)).save_mails(mails, str(repo_path), callback_data.append)
+
+        assert len(set(msg_paths)) == 3
+        assert [Storage.load_mail(msg_path).name for msg_path in msg_paths] == ['name0', 'name1', 'name2']
+        attachments_contents = [path.read_bytes() for path in (repo_path / 'adps_attachments').iterdir()]
+        assert sorted(attachments_contents) == [b'aaa', b'bbb']
+
+        assert [data.current_file_idx for data in callback_data] == [0, 1, 2, 3, 4]
+        assert callback_data[-1].copied_bytes == callback_data[-1].total_files_size_bytes
+
+
+class TestMessagePathsSpill:
+    def test_ok(self):
+        with MessagePathsSpill() as msg_paths:
+            msg_paths.append('/repo/adps_messages/1.json')
+            msg_paths.append('/repo/adps_messages/new\nline.json')
+
+            assert len(msg_paths) == 2
+            assert list(msg_paths) == ['/repo/adps_messages/1.json', '/repo/adps_messages/new\nline.json']
+            assert list(msg_paths) == ['/repo/adps_messages/1.json', '/repo/adps_messages/new\nline.json']
+
+
+class TestStreamingConsumers:
+    @pytest.fixture
+    def repo_path(self, tmp_path):
+        for filename, content in [('shared.txt', b'shared'), ('own.txt', b'own')]:
+            (tmp_path / filename).write_bytes(content)
+
+        mails = [fabricate_mail_with_files(datetime(2020, 1, 1 + idx), f'name{idx}',
+                                           [tmp_path / filename for filename in filenames])
+                 for idx, filenames in enumerate([['shared.txt', 'own.txt'], ['shared.txt'], ['own.txt', 'own.txt']])]
+
+        repo_path = tmp_path / 'repo'
+        Storage(str(repo_path)).save_mails(mails, str(repo_path))
+        return repo_path
+
+    @staticmethod
+    def get_msg_paths(storage: Storage, *names: str) -> MessagePathsSpill:
+        msg_paths = MessagePathsSpill()
+        for filtered_mail_result in storage.filter_mails(None):
+            if filtered_mail_result.mail.name in names:
+                msg_paths.append(filtered_mail_result.mail_path)
+
+        return msg_paths
+
+    @pytest.mark.parametrize('names, expected_contents', [
+        [['name0'], []],
+        [['name0', 'name2'], [b'own']],
+        [['name0', 'name1'], [b'shared']],
+        [['name0', 'name1', 'name2'], [b'own', b'shared']],
+    ])
+    def test_get_attachments_for_delete(self, repo_path, names, expected_contents):
+        storage = Storage(str(repo_path))
+        with self.get_msg_paths(storage, *names) as msg_paths:
+            attachment_paths = storage.get_attachments_for_delete(msg_paths)
+
+        assert sorted(open(path, 'rb').read() for path in attachment_paths) == expected_contents
+
+    def test_get_attachments_for_delete_foreign_paths(self, repo_path, tmp_path):
+        """The repeated paths don't count as the deleted references, the messages of another repository are rejected"""
+        storage = Storage(str(repo_path))
+        with self.get_msg_paths(storage, 'name0', 'name1') as msg_paths:
+            name0_path, name1_path = sorted(msg_paths, key=lambda msg_path: storage.load_mail(msg_path).name)
+
+        storage.copy_mails([name0_path], str(tmp_path / 'other'))
+        other_name0_path = str(tmp_path / 'other' / Storage.MESSAGES_FOLDER / os.path.basename(name0_path))
+
+        assert storage.get_attachments_for_delete([name1_path, name1_path]) == []
+        with pytest.raises(ValueError, match='is not in the repository'):
+            storage.get_attachments_for_delete([name1_path, other_name0_path])
+
+    def test_iter_copy_mails(self, repo_path, tmp_path):
+        storage = Storage(str(repo_path))
+        target_path = tmp_path / 'target'
+        mail_filter = MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(
+            date_from=datetime(2020, 1, 2)))
+
+        copied_names = [
+            filtered_mail_result.mail.name
+            for filtered_mail_result in storage.iter_copy_mails(storage.filter_mails(mail_filter), target_path)
+        ]
+
+        assert sorted(copied_names) == ['name1', 'name2']
+        assert sorted(mail.name for mail in map(Storage.load_mail, Storage(str(target_path)).get_message_paths())) == [
+            'name1', 'name2'
+        ]
+        attachments_contents = [path.read_bytes() for path in (target_path / 'adps_attachments').iterdir()]
+        assert sorted(attachments_contents) == [b'own', b'shared']
+
+
+class TestSortedFilterMails:
+    @pytest.fixture
+    def storage(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        for day in [5, 1, 9, 3, 7, 2]:
+            mail = fabricate_mail(
+                date_created=datetime(2020, 1, day),
+                recipient_coords=[CoordsData(55.0 + day / 100, 37.0)],
+                attachments=[FileAttachment(f'{day}.txt', 100 - day, str(day) * 128)],
+            )
+            storage.save_mail(mail, [], str(tmp_path))
+        return storage
+
+    @staticmethod
+    def get_days(filtered_mail_results) -> list:
+        return [filtered_mail_result.mail.date_created.day for filtered_mail_result in filtered_mail_results]
+
+    @pytest.mark.parametrize('sort_by, limit, expected_days', [
+        [SortBy.DATE, None, [9, 7, 5, 3, 2, 1]],
+        [SortBy.DATE, 2, [9, 7]],
+        [SortBy.DISTANCE, 3, [1, 2, 3]],
+        [SortBy.SIZE, 2, [9, 7]],
+    ])
+    def test_sort(self, storage, sort_by, limit, expected_days):
+        mail_results = storage.filter_mails(None, sort_by=sort_by, limit=limit, sort_location=CoordsData(55.0, 37.0))
+        assert self.get_days(mail_results) == expected_days
+
+    def test_limit_without_sort(self, storage):
+        callback_data = []
+        assert len(list(storage.filter_mails(None, callback_data.append, limit=2))) == 2
+        assert len(callback_data) < 6
+
+    def test_distance_from_filter(self, storage):
+        mail_filter = MailFilter(location_filter=LocationFilterData(CoordsData(55.09, 37.0), 100000))
+        assert self.get_days(storage.filter_mails(mail_filter, sort_by=SortBy.DISTANCE, limit=2)) == [9, 7]
+
+        with pytest.raises(ValueError):
+            list(storage.filter_mails(None, sort_by=SortBy.DISTANCE))
+
+    def test_date_index(self, storage, tmp_path):
+        assert storage.update_date_index() == 6
+        assert storage.update_date_index() == 0
+
+        # the message missing in the index is read anyway
+        storage.save_mail(fabricate_mail(date_created=datetime(2020, 1, 8)), [], str(tmp_path))
+        os.remove(tmp_path / Storage.DATE_INDEX_FILENAME)
+        storage.update_date_index()
+        storage.save_mail(fabricate_mail(date_created=datetime(2020, 1, 4)), [], str(tmp_path))
+        Storage.get_date_index(tmp_path).write(
+            (filename, timestamp) for filename, timestamp in Storage.get_date_index(tmp_path).get_timestamps().items()
+            if timestamp != datetime(2020, 1, 8).timestamp()
+        )
+        mail_filter = MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(
+            date_to=datetime(2020, 1, 8)))
+
+        callback_data = []
+        mail_results = storage.filter_mails(mail_filter, callback_data.append, sort_by=SortBy.DATE, limit=3)
+
+        assert self.get_days(mail_results) == [8, 7, 5]
+        # the unindexed message (8) and the indexed ones up to the 3rd result: 9, 7, 5
+        assert len(callback_data) == 4
+
+
+class TestEstimateCount:
+    @pytest.fixture
+    def storage(self, tmp_path):
+        storage = Storage(str(tmp_path))
+        mails = [(fabricate_mail(date_created=datetime(2020, 1 + idx % 4, 1), name=f'name{idx}'), [])
+                 for idx in range(200)]
+        storage.save_mails(mails, str(tmp_path))
+        return storage
+
+    def test_exact(self, storage):
+        mail_filter = MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(
+            date_from=datetime(2020, 4, 1)))
+        count_estimate = storage.estimate_count(mail_filter)
+        assert (count_estimate.count, count_estimate.lower, count_estimate.upper) == (50, 50, 50)
+        assert count_estimate.is_exact
+
+    def test_sample(self, storage):
+        mail_filter = MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(
+            date_from=datetime(2020, 4, 1)))
+        callback_data = []
+        count_estimate = storage.estimate_count(mail_filter, max_samples=100, margin=40, rng=Random(1),
+                                                callback=callback_data.append)
+
+        assert Storage.ESTIMATION_MIN_SAMPLES <= count_estimate.sampled_number < 100
+        assert len(callback_data) == count_estimate.sampled_number
+        assert count_estimate.upper - count_estimate.lower <= 80
+        assert count_estimate.lower <= 50 <= count_estimate.upper
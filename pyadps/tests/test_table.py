@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from pyadps.mail import (AdditionalNotesFilterData, AttachmentFilterData, CoordsData, DampingDistanceFilterData,
+                         DatetimeCreatedRangeFilterData, FileAttachment, InlineMessageFilterData, LocationFilterData,
+                         MailFilter, NameFilterData)
+from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
+
+np = pytest.importorskip('numpy')
+
+MOSCOW_COORDS = CoordsData(55.75222, 37.61556)
+YEKATERINBURG_COORDS = CoordsData(56.8519, 60.6122)
+
+MAILS = [
+    fabricate_mail(date_created=datetime(2020, 5, 5), recipient_coords=[MOSCOW_COORDS]),
+    fabricate_mail(date_created=datetime(2021, 1, 1), recipient_coords=[YEKATERINBURG_COORDS, MOSCOW_COORDS],
+                   name='Bob', additional_notes='For Bob Smith', inline_message='Hello there',
+                   attachments=[FileAttachment('1.txt', 5, 'ab' * 64), FileAttachment('2.txt', 7, 'cd' * 64)]),
+    fabricate_mail(date_created=datetime(2022, 3, 4), recipient_coords=[YEKATERINBURG_COORDS],
+                   name='Alice', inline_message='hello from Alice',
+                   attachments=[FileAttachment('3.txt', 11, 'ef' * 64)]),
+]
+
+
+class TestMailTable:
+    @pytest.mark.parametrize('mail_filter', [
+        MailFilter(),
+        MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(datetime(2020, 6, 1))),
+        MailFilter(datetime_created_range_filter=DatetimeCreatedRangeFilterData(None, datetime(2021, 1, 1))),
+        MailFilter(location_filter=LocationFilterData(MOSCOW_COORDS, 1000.0)),
+        MailFilter(location_filter=LocationFilterData(YEKATERINBURG_COORDS, 500 * 1000.0)),
+        MailFilter(name_filter=NameFilterData('Bob')),
+        MailFilter(name_filter=NameFilterData('Unknown')),
+        MailFilter(additional_notes_filter=AdditionalNotesFilterData('bob smith')),
+        MailFilter(inline_message_filter=InlineMessageFilterData('HELLO')),
+        MailFilter(attachment_filter=AttachmentFilterData('efef')),
+        MailFilter(damping_distance_filter=DampingDistanceFilterData(MOSCOW_COORDS, 1.0, threshold_probability=0.9)),
+    ])
+    def test_filter_table_matches_filter_func(self, tmp_path, mail_filter: MailFilter):
+        storage = Storage(str(tmp_path))
+        for mail in MAILS:
+            storage.save_mail(mail, [], str(tmp_path))
+
+        table = storage.load_table()
+        expected_mask = [mail_filter.filter_func(storage.load_mail(path)) for path in table.mail_paths]
+        assert mail_filter.filter_table(table).tolist() == expected_mask
+
+    def test_snapshot(self, tmp_path):
+        storage = Storage(str(tmp_path / 'repo'))
+        for mail in MAILS:
+            storage.save_mail(mail, [], str(tmp_path / 'repo'))
+
+        table = storage.load_table()
+        table.save(str(tmp_path / 'snapshot'))
+        loaded_table = type(table).load(str(tmp_path / 'snapshot'))
+
+        assert isinstance(loaded_table.date_created, np.memmap)
+        assert loaded_table.mail_paths.tolist() == table.mail_paths.tolist()
+        assert loaded_table.coords_offsets.tolist() == table.coords_offsets.tolist()
+        assert loaded_table.names[loaded_table.name_codes].tolist() == [
+            storage.load_mail(path).name for path in table.mail_paths]
+
+        mail_filter = MailFilter(inline_message_filter=InlineMessageFilterData('hello'))
+        assert mail_filter.filter_table(loaded_table).tolist() == mail_filter.filter_table(table).tolist()
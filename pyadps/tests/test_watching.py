@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import pytest
+
+from pyadps.storage import Storage
+from pyadps.tests.helpers import fabricate_mail
+from pyadps.watching import (CHECKPOINT_SLACK_SECONDS, IndexMaintainer, InotifyWatcher, PollingWatcher, WatchBatch,
+                             WatchEvent, WatchEventKind, iter_batches)
+
+MESSAGES = Storage.MESSAGES_FOLDER
+
+
+@pytest.fixture
+def repo_path(tmp_path):
+    repo_path = tmp_path / 'repo'
+    storage = Storage(str(repo_path))
+    storage.save_mails([(fabricate_mail(date_created=datetime(2020, 1, day), name=f'day{day}'), [])
+                        for day in [1, 2, 3]], str(repo_path), lambda _: None)
+    return repo_path
+
+
+def write_external_message(tmp_path, repo_path, day: int) -> str:
+    """Writes the message to the repository folder bypassing Storage of the repository"""
+    other_repo_path = tmp_path / f'other{day}'
+    msg_path, = Storage(str(other_repo_path)).save_mails(
+        [(fabricate_mail(date_created=datetime(2020, 2, day), name=f'external{day}'), [])],
+        str(other_repo_path), lambda _: None)
+    shutil.copy(msg_path, repo_path / MESSAGES)
+    return os.path.basename(msg_path)
+
+
+def set_old_mtimes(repo_path):
+    old_time = time.time() - 100 * CHECKPOINT_SLACK_SECONDS
+    for msg_path in (repo_path / MESSAGES).iterdir():
+        os.utime(msg_path, (old_time, old_time))
+
+
+class TestWatchBatch:
+    def test_last_event_wins(self):
+        batch = WatchBatch.from_events(1.0, [
+            WatchEvent(WatchEventKind.CREATED, MESSAGES, 'a.json'),
+            WatchEvent(WatchEventKind.DELETED, MESSAGES, 'a.json'),
+            WatchEvent(WatchEventKind.DELETED, MESSAGES, 'b.json'),
+            WatchEvent(WatchEventKind.CREATED, MESSAGES, 'b.json'),
+            WatchEvent(WatchEventKind.OVERFLOW, Storage.ATTACHMENTS_FOLDER, None),
+        ])
+
+        assert batch.created == {MESSAGES: {'b.json'}}
+        assert batch.deleted == {MESSAGES: {'a.json'}}
+        assert batch.overflowed_folders == {Storage.ATTACHMENTS_FOLDER}
+        assert len(batch) == 2
+
+
+class TestWatchers:
+    @pytest.mark.parametrize('watcher_class', [
+        pytest.param(InotifyWatcher, marks=pytest.mark.skipif(sys.platform != 'linux', reason='inotify is Linux only')),
+        PollingWatcher,
+    ])
+    def test_events(self, tmp_path, repo_path, watcher_class):
+        watcher_args = {'interval': 0.05} if watcher_class is PollingWatcher else {}
+        deleted_filename = sorted(os.listdir(repo_path / MESSAGES))[0]
+        with watcher_class(str(repo_path), **watcher_args) as watcher:
+            created_filename = write_external_message(tmp_path, repo_path, 1)
+            os.remove(repo_path / MESSAGES / deleted_filename)
+
+            batch = next(iter_batches(watcher, debounce_seconds=0.2, wait_seconds=1.0))
+
+        assert batch.created == {MESSAGES: {created_filename}}
+        assert batch.deleted == {MESSAGES: {deleted_filename}}
+
+
+class TestIndexMaintainer:
+    def test_reconcile(self, tmp_path, repo_path):
+        storage = Storage(str(repo_path))
+        maintainer = IndexMaintainer(storage)
+        assert maintainer.reconcile() == 3  # no index
+        set_old_mtimes(repo_path)
+        storage.get_date_index(str(repo_path)).set_checkpoint(time.time())
+        assert maintainer.reconcile() == 0
+
+        created_filename = write_external_message(tmp_path, repo_path, 1)
+        deleted_filename = sorted(set(os.listdir(repo_path / MESSAGES)) - {created_filename})[0]
+        os.remove(repo_path / MESSAGES / deleted_filename)
+
+        assert maintainer.reconcile() == 1  # only the new file is read
+        timestamps = storage.get_date_index(str(repo_path)).get_timestamps()
+        assert set(timestamps) == set(os.listdir(repo_path / MESSAGES))
+        assert timestamps[created_filename] == datetime(2020, 2, 1).timestamp()
+
+    def test_reconcile_modified_after_checkpoint(self, repo_path):
+        storage = Storage(str(repo_path))
+        maintainer = IndexMaintainer(storage)
+        maintainer.reconcile()
+        set_old_mtimes(repo_path)
+        storage.get_date_index(str(repo_path)).set_checkpoint(time.time())
+
+        modified_path = sorted((repo_path / MESSAGES).iterdir())[0]
+        os.utime(modified_path)
+
+        assert maintainer.reconcile() == 1
+
+    def test_apply_batch(self, tmp_path, repo_path):
+        storage = Storage(str(repo_path))
+        maintainer = IndexMaintainer(storage)
+        maintainer.reconcile()
+
+        created_filename = write_external_message(tmp_path, repo_path, 2)
+        deleted_filename = sorted(set(os.listdir(repo_path / MESSAGES)) - {created_filename})[0]
+        os.remove(repo_path / MESSAGES / deleted_filename)
+        maintainer.apply_batch(WatchBatch.from_events(123.0, [
+            WatchEvent(WatchEventKind.CREATED, MESSAGES, created_filename),
+            WatchEvent(WatchEventKind.DELETED, MESSAGES, deleted_filename),
+            WatchEvent(WatchEventKind.CREATED, MESSAGES, 'not_a_message.tmp'),
+        ]))
+
+        date_index = storage.get_date_index(str(repo_path))
+        assert set(date_index.get_timestamps()) == set(os.listdir(repo_path / MESSAGES))
+        assert date_index.get_checkpoint() == 123.0
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental maintenance of the date index by the changes of the repository folders. The files may be added
+by SharpADPS, manual copying or any other tool, so the folders are watched by inotify on Linux or by the periodic
+listing elsewhere, the events are debounced and applied to the index by batches.
+"""
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from pyadps import metrics
+from pyadps.storage import MessageFileTooBigError, Storage
+
+# the modification times of FAT32 have the resolution of 2 seconds
+CHECKPOINT_SLACK_SECONDS = 2.0
+
+
+class WatchEventKind:
+    CREATED = 'CREATED'  # written or moved into the folder
+    DELETED = 'DELETED'  # removed or moved out of the folder
+    OVERFLOW = 'OVERFLOW'  # the events are lost, the folder has to be listed again
+
+
+class WatchEvent(NamedTuple):
+    kind: str
+    folder: str  # Storage.MESSAGES_FOLDER or Storage.ATTACHMENTS_FOLDER
+    filename: Optional[str]  # None for OVERFLOW
+
+
+class WatchBatch(NamedTuple):
+    """The last event of every file of the debounced batch"""
+    started_at: float  # the time of the first event, the changes after it may be missing in the batch
+    created: Dict[str, Set[str]]  # filenames by folder
+    deleted: Dict[str, Set[str]]
+    overflowed_folders: Set[str]
+
+    @classmethod
+    def from_events(cls, started_at: float, events: Iterable[WatchEvent]) -> 'WatchBatch':
+        batch = cls(started_at, {}, {}, set())
+        for event in events:
+            if event.kind == WatchEventKind.OVERFLOW:
+                batch.overflowed_folders.add(event.folder)
+                continue
+
+            added_to, removed_from = ((batch.created, batch.deleted) if event.kind == WatchEventKind.CREATED
+                                      else (batch.deleted, batch.created))
+            added_to.setdefault(event.folder, set()).add(event.filename)  # type: ignore
+            removed_from.get(event.folder, set()).discard(event.filename)  # type: ignore
+
+        return batch
+
+    def __len__(self) -> int:
+        return sum(len(filenames) for filenames in [*self.created.values(), *self.deleted.values()])
+
+
+class Watcher:
+    """Events of the messages and the attachments folders of the repository"""
+
+    def __init__(self, root_dir_path: str):
+        self.root_dir_path = root_dir_path
+        self.folders = [Storage.MESSAGES_FOLDER, Storage.ATTACHMENTS_FOLDER]
+
+    def read_events(self, timeout: Optional[float]) -> List[WatchEvent]:
+        """Waits for the events at most timeout seconds (forever if None), returns an empty list on timeout"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> 'Watcher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PollingWatcher(Watcher):
+    """Compares the listings of the folders with their previous listings every `interval` seconds"""
+
+    def __init__(self, root_dir_path: str, interval: float = 2.0):
+        super().__init__(root_dir_path)
+        self.interval = interval
+        self._listings = {folder: self._list_folder(folder) for folder in self.folders}
+        self._next_poll = time.monotonic() + interval
+
+    def _list_folder(self, folder: str) -> Dict[str, Tuple[int, int]]:
+        listing = {}
+        with os.scandir(os.path.join(self.root_dir_path, folder)) as entries:
+            for entry in entries:
+                try:
+                    stat_result = entry.stat()
+                except FileNotFoundError:
+                    continue
+                listing[entry.name] = (stat_result.st_size, stat_result.st_mtime_ns)
+
+        return listing
+
+    def read_events(self, timeout: Optional[float]) -> List[WatchEvent]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_seconds = self._next_poll - time.monotonic()
+            if deadline is not None and self._next_poll > deadline:
+                time.sleep(max(deadline - time.monotonic(), 0.0))
+                return []
+
+            time.sleep(max(wait_seconds, 0.0))
+            self._next_poll = time.monotonic() + self.interval
+
+            events = []
+            for folder in self.folders:
+                listing = self._list_folder(folder)
+                previous_listing = self._listings[folder]
+                events.extend(
+                    WatchEvent(WatchEventKind.DELETED, folder, filename)
+                    for filename in previous_listing.keys() - listing.keys()
+                )
+                events.extend(
+                    WatchEvent(WatchEventKind.CREATED, folder, filename)
+                    for filename, file_stat in listing.items() if previous_listing.get(filename) != file_stat
+                )
+                self._listings[folder] = listing
+
+            if events:
+                return events
+
+
+class InotifyWatcher(Watcher):
+    """Linux inotify by ctypes. A file is reported when it is closed after writing, so it is complete."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    CREATED_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+    DELETED_MASK = IN_DELETE | IN_MOVED_FROM
+
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len of the name
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, root_dir_path: str):
+        super().__init__(root_dir_path)
+        libc = self._get_libc()
+        if libc is None:
+            raise OSError('inotify is not available')
+
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._folders_by_wd: Dict[int, str] = {}
+        try:
+            for folder in self.folders:
+                wd = libc.inotify_add_watch(self._fd, os.fsencode(os.path.join(root_dir_path, folder)),
+                                            self.CREATED_MASK | self.DELETED_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {folder!r}')
+                self._folders_by_wd[wd] = folder
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    @staticmethod
+    def _get_libc() -> Optional[ctypes.CDLL]:
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            return None
+
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+
+        return libc
+
+    def _parse_events(self, data: bytes) -> List[WatchEvent]:
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            filename = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+
+            if mask & self.IN_Q_OVERFLOW:
+                events.extend(WatchEvent(WatchEventKind.OVERFLOW, folder, None) for folder in self.folders)
+            elif wd in self._folders_by_wd and not mask & self.IN_ISDIR:
+                kind = WatchEventKind.CREATED if mask & self.CREATED_MASK else WatchEventKind.DELETED
+                events.append(WatchEvent(kind, self._folders_by_wd[wd], filename))
+
+        return events
+
+    def read_events(self, timeout: Optional[float]) -> List[WatchEvent]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, self.READ_SIZE)
+            except BlockingIOError:
+                break
+            events.extend(self._parse_events(data))
+
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(root_dir_path: str, polling: bool = False, poll_interval: float = 2.0) -> Watcher:
+    """InotifyWatcher if it is available and polling isn't required, otherwise PollingWatcher"""
+    if not polling:
+        try:
+            return InotifyWatcher(root_dir_path)
+        except (OSError, AttributeError):
+            pass
+
+    return PollingWatcher(root_dir_path, poll_interval)
+
+
+def iter_batches(
+    watcher: Watcher,
+    debounce_seconds: float = 0.5,
+    max_batch_seconds: float = 5.0,
+    max_batch_size: int = 10000,
+    stop_event: Optional[threading.Event] = None,
+    wait_seconds: float = 1.0,
+):
+    """
+    Yields the batches of the events: a batch is closed when no events come for debounce_seconds, or it collects
+    events for max_batch_seconds or max_batch_size files. The events are waited for by wait_seconds steps
+    until stop_event is set.
+    """
+    while stop_event is None or not stop_event.is_set():
+        events = watcher.read_events(wait_seconds)
+        if not events:
+            continue
+
+        started_at = time.time()
+        batch_deadline = time.monotonic() + max_batch_seconds
+        while len(events) < max_batch_size:
+            timeout = min(debounce_seconds, batch_deadline - time.monotonic())
+            if timeout <= 0:
+                break
+
+            new_events = watcher.read_events(timeout)
+            if not new_events:
+                break
+            events.extend(new_events)
+
+        yield WatchBatch.from_events(started_at, events)
+
+
+class IndexMaintainer:
+    """
+    Keeps the date index of the repository up to date by the watch batches. The checkpoint of the index is
+    the start time of the last applied batch, so on the next start `reconcile` reads only the message files
+    which are modified after it or are missing in the index (e.g. copied with the modification time).
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.date_index = storage.get_date_index(storage.root_dir_path)
+
+    def _get_packed_filenames(self) -> Set[str]:
+        return set(self.storage.get_message_pack(self.storage.root_dir_path).get_entries())
+
+    def _read_timestamps(self, filenames: Iterable[str]) -> Dict[str, float]:
+        from marshmallow import ValidationError
+
+        messages_folder_path = os.path.join(self.storage.root_dir_path, Storage.MESSAGES_FOLDER)
+        timestamps = {}
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+
+            try:
+                mail = self.storage.load_mail(os.path.join(messages_folder_path, filename))
+            except FileNotFoundError:
+                continue  # deleted after the event
+            except (MessageFileTooBigError, ValueError, ValidationError):
+                metrics.increment('watch_unreadable_messages')  # not a message, the searches fail on it
+                continue
+            timestamps[filename] = mail.date_created.timestamp()
+
+        return timestamps
+
+    def _update_index(self, created_timestamps: Dict[str, float], deleted_filenames: Set[str], checkpoint: float):
+        # the packed messages are listed by the pack, their loose files are removed by `pack`
+        deleted_filenames = deleted_filenames - self._get_packed_filenames()
+        timestamps = self.date_index.get_timestamps()
+        if deleted_filenames & timestamps.keys():
+            new_timestamps = {filename: timestamp for filename, timestamp in timestamps.items()
+                              if filename not in deleted_filenames}
+            new_timestamps.update(created_timestamps)
+            self.date_index.write(new_timestamps.items())
+        elif created_timestamps:
+            self.date_index.append(created_timestamps.items())
+
+        self.date_index.set_checkpoint(checkpoint)
+        metrics.increment('watch_messages_indexed', len(created_timestamps))
+
+    def reconcile(self) -> int:
+        """Startup pass applying the changes made while the index wasn't watched, returns the number of reads"""
+        started_at = time.time()
+        checkpoint = self.date_index.get_checkpoint()
+        if checkpoint is None or not self.date_index.exists():
+            return self.storage.update_date_index()
+
+        timestamps = self.date_index.get_timestamps()
+        listed_filenames = set(self._get_packed_filenames())
+        changed_filenames = []
+        with os.scandir(os.path.join(self.storage.root_dir_path, Storage.MESSAGES_FOLDER)) as entries:
+            for entry in entries:
+                listed_filenames.add(entry.name)
+                if entry.name not in timestamps:
+                    changed_filenames.append(entry.name)
+                    continue
+
+                try:
+                    if entry.stat().st_mtime > checkpoint - CHECKPOINT_SLACK_SECONDS:
+                        changed_filenames.append(entry.name)
+                except FileNotFoundError:
+                    continue
+
+        created_timestamps = self._read_timestamps(changed_filenames)
+        self._update_index(created_timestamps, timestamps.keys() - listed_filenames, started_at)
+        return len(changed_filenames)
+
+    def apply_batch(self, batch: WatchBatch) -> int:
+        """Returns the number of the message files read"""
+        if Storage.MESSAGES_FOLDER in batch.overflowed_folders:
+            return self.storage.update_date_index()
+
+        created_filenames = batch.created.get(Storage.MESSAGES_FOLDER, set())
+        deleted_filenames = batch.deleted.get(Storage.MESSAGES_FOLDER, set())
+        self._update_index(self._read_timestamps(created_filenames), deleted_filenames, batch.started_at)
+        return len(created_filenames)
+
+    def run(
+        self,
+        watcher: Watcher,
+        stop_event: Optional[threading.Event] = None,
+        listeners: Iterable[Callable[[WatchBatch], None]] = (),
+        **batch_params,
+    ):
+        """Applies the batches of the watcher until stop_event is set, the listeners get every batch after it"""
+        for batch in iter_batches(watcher, stop_event=stop_event, **batch_params):
+            self.apply_batch(batch)
+            metrics.observe('watch_batch_files', len(batch))
+            for listener in listeners:
+                listener(batch)